@@ -41,6 +41,14 @@
  *    matters. Call addSensor() in increasing order according to the device's
  *    unique 64-bit ROM code.
  *
+ *  + Each sync is sent with a sync_id, of a random boot id and the sync
+ *    count, so the control server can tell a retried sync from a new one
+ *    (even after the probe restarts) and doesn't write it twice.  A sync
+ *    that gets no response, or a 503, is retried with the same sync_id, so
+ *    it must be resent with the same sensor data.  The boot id is seeded
+ *    from analog pin A5 and the time since power on.  To change, see
+ *    setupControlServer()
+ *
  *  + Memory is tight. By default a maximum of 5 sensors is allowed.
  *    To change, see MAX_SENSORS
  * 
@@ -104,6 +112,10 @@ void Autogarten::setupControlServer(char address[], int port, char token[]) {
   _ctrlSrvrPort  = port;
   _ctrlSrvrToken = token;
   _ctrlSrvrSyncCount = 0;
+
+  // A random boot id, so sync ids don't repeat after a restart
+  randomSeed(analogRead(A5) ^ micros());
+  _bootId = random(0x8000);
 }
 
 
@@ -172,10 +184,15 @@ void Autogarten::syncWithControlServer(void (*onSyncWithControlServer)(), void (
 
       // Read the first line of the HTTP Response.  It should contain the 
       // HTTP Response Code.  Only continue if it's 200 OK. (LineFeed=10)
+      // If there's no response, or a 503, the sync may or may not have been
+      // applied, so it's retried with the same sync_id.
       String response = _wifiClient.readStringUntil(10);
       if (response.indexOf("200 OK") < 0) {      	
         Serial.println(response);
       	printErrorCode(301);
+        if (response.length() == 0 || response.indexOf(" 503 ") >= 0) {
+          continue;
+        }
         return;        
       }
 
@@ -506,7 +523,8 @@ void Autogarten::sendProbeSyncRequest(byte connectionAttempts) {
     strlen(_ctrlSrvrToken) +
     numberStrlen(_ctrlSrvrSyncCount) +
     numberStrlen(currentTime()) +
-    numberStrlen(connectionAttempts);
+    numberStrlen(connectionAttempts) +
+    11 + numberStrlen(syncId());
 
   _wifiClient.print(F("Content-Length: "));
   _wifiClient.println(contentLength);
@@ -523,12 +541,21 @@ void Autogarten::sendProbeSyncRequest(byte connectionAttempts) {
   _wifiClient.print(currentTime());
   _wifiClient.print(F(",\"connection_attempts\":"));
   _wifiClient.print(connectionAttempts);
+  _wifiClient.print(F(",\"sync_id\":"));
+  _wifiClient.print(syncId());
   _wifiClient.print(F(",\"sensor_data\":["));
   _wifiClient.print(F("]}"));
   _wifiClient.println();
 }
 
 
+// Returns the sync_id of the current sync, the boot id and the sync count.
+// The sync count only advances once a sync completes, so a retry keeps it.
+long Autogarten::syncId() {
+  return (_bootId << 16) | (_ctrlSrvrSyncCount & 0xFFFF);
+}
+
+
 // Establish a WiFi connection. If already connected, no action is taken.
 void Autogarten::connectToWiFi() {
 
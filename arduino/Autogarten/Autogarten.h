@@ -51,7 +51,9 @@ class Autogarten {
     int   _ctrlSrvrPort;
     char *_ctrlSrvrToken;
     int   _ctrlSrvrSyncCount;
+    long  _bootId;
     void sendProbeSyncRequest(byte connectionAttempts);
+    long syncId();
 
     /* WiFI */
     char      *_wifiSSID;
@@ -12,6 +12,7 @@ import argparse
 import ConfigParser
 import json
 import math
+import threading
 import traceback
 
 from datetime import datetime
@@ -22,10 +23,28 @@ from flask import jsonify
 from flask import make_response
 from flask import render_template
 from flask import request
-
+from flask import Response
+from werkzeug.utils import secure_filename
+
+from db import shared_state
+from db import storage
+from service import alert_service
+from service import clock_drift
+from service import export_service
+from service import hot_tier
+from service import ingest_queue
+from service import live_updates
+from service import overview_cache
 from service import probe_service
+from service import retention_service
+from service import rule_service
+from service import sync_dedup
+from service import sync_spool
+from probe_sync import BINARY_CONTENT_TYPE
 from probe_sync import ProbeSync
 import date_util
+import metrics
+import series_util
 
 app = Flask(__name__)
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
@@ -34,46 +53,289 @@ verbose = False
 
 token = None
 time_diff_threshold = 30  # Value read from settings, but tolerate some difference
+sparkline_downsampler = "bucket"
+lazy_sparklines = True
+series_max_points = 5000
+series_max_age = 60
+series_history_max_age = 3600
 
 def init_config():
     """ Read settings from config file
 
     """
-    global token, time_diff_threshold
+    global token, time_diff_threshold, sparkline_downsampler, \
+        lazy_sparklines, series_max_points, series_max_age, \
+        series_history_max_age
 
     config = ConfigParser.SafeConfigParser()
     config.read("settings.cfg")
 
     token = config.get("control_server", "token")
     time_diff_threshold = config.getint("control_server", "time_diff_threshold")
+    sparkline_downsampler = config.get("control_server",
+        "sparkline_downsampler")
+    lazy_sparklines = config.getboolean("control_server", "lazy_sparklines")
+    series_max_points = config.getint("control_server", "series_max_points")
+    series_max_age = config.getint("control_server", "series_max_age")
+    series_history_max_age = config.getint("control_server",
+        "series_history_max_age")
 
     # Setup Jinja Filters
     app.jinja_env.filters['format_number'] = format_number
     app.jinja_env.filters['format_date'] = format_date
 
+    # Indexes are ensured in the background, so startup doesn't wait
+    # on the DB
+    threading.Thread(target=storage.bootstrap, name="bootstrap").start()
+
+    if hot_tier.enabled:
+        probe_service.warm_hot_tier()
+
+    if ingest_queue.async_mode:
+        ingest_queue.start()
+
+    if sync_spool.enabled:
+        sync_spool.start()
+
+    if retention_service.interval_hours:
+        retention_service.start()
+
+    if shared_state.backend != "memory":
+        shared_state.start()
+
+    metrics.register_gauge("ingest_queue", ingest_queue.get_stats)
+    metrics.register_gauge("hot_tier", hot_tier.get_stats)
+    metrics.register_gauge("sync_dedup", sync_dedup.get_stats)
+    if rule_service.enabled:
+        metrics.register_gauge("rules", rule_service.get_stats)
+    if alert_service.enabled:
+        metrics.register_gauge("alerts", alert_service.get_stats)
+    if clock_drift.enabled:
+        metrics.register_gauge("clock_drift", clock_drift.get_stats)
+    if live_updates.enabled:
+        metrics.register_gauge("live_updates", live_updates.get_stats)
+    if sync_spool.enabled:
+        metrics.register_gauge("sync_spool", sync_spool.get_stats)
+
 
 @app.route("/")
+@metrics.timed("main_page")
 def main_page():
-    probe_overview = probe_service.get_probe_overview()
-    return render_template("index.html", probe_overview=probe_overview)
+
+    # The sparklines' downsampler may be chosen per request, but only
+    # pages with the configured one are cached
+    downsampler = request.args.get("downsample", sparkline_downsampler)
+    if downsampler not in series_util.downsamplers:
+        abort(400)
+    if downsampler != sparkline_downsampler:
+        return render_overview(downsampler, cached=False)
+
+    # The rendered page is cached until a sync writes new data, so
+    # revalidating browsers get a 304 while nothing has changed
+    page = overview_cache.get_page()
+    if page is not None:
+        etag, html = page
+    else:
+        generation = overview_cache.get_generation()
+        html = render_overview(downsampler)
+        etag = overview_cache.set_page(html, generation)
+
+    if etag in request.if_none_match:
+        metrics.inc("overview_not_modified_total")
+        return "", 304, {"ETag" : '"%s"' % etag}
+
+    response = make_response(html)
+    response.set_etag(etag)
+    return response
+
+
+def render_overview(downsampler, cached=True):
+    """ Renders the overview page.  With lazy_sparklines only a skeleton
+        of the probes is rendered, and each probe's sensors and their
+        series are loaded by the page from the API.
+
+    """
+    if lazy_sparklines:
+        probe_overview = probe_service.get_probe_summaries()
+    else:
+        probe_overview = probe_service.get_probe_overview(downsampler, cached)
+
+    with metrics.timed("render_overview"):
+        return render_template("index.html", probe_overview=probe_overview,
+            lazy=lazy_sparklines, downsampler=downsampler,
+            live=live_updates.enabled)
+
+
+@app.route("/api/probes/<probe_id>/sensors")
+@metrics.timed("api_sensors")
+def probe_sensors(probe_id):
+    """ Returns the overview of a probe's sensors, without their series,
+        for a lazily loaded overview page
+
+    """
+    probe = probe_service.get_overview_for_probe_id(probe_id)
+    if probe is None:
+        abort(404)
+
+    return cacheable(jsonify({
+        "probe_id" : probe_id,
+        "start" : probe["start"],
+        "end" : probe["end"],
+        "sensors" : [dict((key, value) for key, value in sensor.items()
+            if key in ["id", "desc", "units_label", "curr_value",
+                "min_value", "max_value", "avg_value"])
+            for sensor in probe["sensors"]]
+    }), series_max_age)
+
+
+@app.route("/api/probes/<probe_id>/sensors/<sensor_id>/series")
+@metrics.timed("api_series")
+def sensor_series(probe_id, sensor_id):
+    """ Returns the series of a sensor as JSON (see
+        probe_service.get_sensor_series).  Arguments are start and end
+        (timestamps or YYYY-MM-DD[THH:MM:SS], default to the last week),
+        points (default to all readings), downsample ('bucket', 'minmax'
+        or 'lttb'), agg (for 'bucket', default 'mean') and since (the
+        last_timestamp of a previous response, to get only newer data).
+
+    """
+    now = date_util.get_current_timestamp()
+    try:
+        end = export_service.parse_time(request.args["end"]) \
+            if "end" in request.args else now
+        start = export_service.parse_time(request.args["start"]) \
+            if "start" in request.args else end - 7 * 86400
+        points = int(request.args["points"]) \
+            if "points" in request.args else None
+        since = int(request.args["since"]) if "since" in request.args else None
+        downsampler = request.args.get("downsample", "bucket")
+        agg = request.args.get("agg", "mean")
+
+        # Points are spread over the range, so it can't be empty
+        if start > end or points is not None and \
+                (end <= start or not 3 <= points <= series_max_points) or \
+                downsampler not in series_util.downsamplers or \
+                agg not in series_util.aggregations:
+            raise ValueError()
+    except ValueError:
+        abort(400)
+
+    series = probe_service.get_sensor_series(probe_id, sensor_id, start, end,
+        points, agg, downsampler, since)
+
+    # A range that has ended only changes if a late sync fills it in,
+    # so it's cached for longer than one still receiving readings
+    return cacheable(jsonify(series),
+        series_history_max_age if end < now else series_max_age)
+
+
+@app.route("/api/probes/<probe_id>/clock/series")
+@metrics.timed("api_clock_series")
+def clock_series(probe_id):
+    """ Returns the history of the drift of a probe's clock as JSON (see
+        clock_drift.get_clock_series).  Arguments are start and end
+        (timestamps or YYYY-MM-DD[THH:MM:SS], default to the last week)
+        and points (default to all samples).
+
+    """
+    now = date_util.get_current_timestamp()
+    try:
+        end = export_service.parse_time(request.args["end"]) \
+            if "end" in request.args else now
+        start = export_service.parse_time(request.args["start"]) \
+            if "start" in request.args else end - 7 * 86400
+        points = int(request.args["points"]) \
+            if "points" in request.args else None
+
+        # Points are spread over the range, so it can't be empty
+        if start > end or points is not None and \
+                (end <= start or not 3 <= points <= series_max_points):
+            raise ValueError()
+    except ValueError:
+        abort(400)
+
+    return cacheable(jsonify(clock_drift.get_clock_series(probe_id, start,
+        end, points)), series_history_max_age if end < now else series_max_age)
+
+
+@app.route("/api/live")
+def live():
+    """ Streams new sensor readings and probe status changes, as they're
+        written, as Server-Sent Events (see service.live_updates)
+
+    """
+    if not live_updates.enabled:
+        abort(404)
+
+    subscriber = live_updates.subscribe()
+    if subscriber is None:
+        abort(503)
+
+    metrics.inc("live_streams_total")
+    response = Response(live_updates.stream(subscriber),
+        mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # Unbuffered by nginx
+    response.call_on_close(lambda: live_updates.unsubscribe(subscriber))
+    return response
+
+
+@app.route("/api/alerts")
+@metrics.timed("api_alerts")
+def alerts():
+    """ Returns alerts as they were raised and cleared, newest first.
+        Arguments are probe_id (optional) and limit (default 100).
+
+    """
+    try:
+        limit = int(request.args.get("limit", 100))
+        if limit < 1:
+            raise ValueError()
+    except ValueError:
+        abort(400)
+
+    return jsonify({"alerts" : storage.get_storage().get_alerts(
+        request.args.get("probe_id"), limit)})
+
+
+def cacheable(response, max_age):
+    """ Lets browsers and proxies cache the given response for max_age
+        seconds, then revalidate it with its ETag
+
+    """
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @app.route("/probe_sync", methods=['POST'])
+@metrics.timed("probe_sync")
 def probe_sync():
 
     response = {}
 
-    # Read and validate probe sync request.  Assumes request data is of
-    # content-type 'application/json'
+    # Read and validate probe sync request.  Request data is either of
+    # content-type 'application/json' or a binary frame.
     try:
-        probe_sync = ProbeSync(request.json)
+        with metrics.timed("probe_sync_parse"):
+            if request.mimetype == BINARY_CONTENT_TYPE:
+                probe_sync = ProbeSync.from_binary(request.get_data())
+            else:
+                probe_sync = ProbeSync(request.json)
         if not probe_sync.is_valid():
             abort(400)
 
+        # Sensor data is read into SensorReadings now, so a malformed
+        # reading is rejected before the sync is dedup'd, queued or
+        # written
+        probe_sync.validate_readings()
+
     except Exception,e :
         # If there are problems reading the request arguments, then
         # the request is bad.  Return a 400 HTTP Status Code - Bad
         # Request
+        metrics.inc("sync_bad_requests_total")
         if verbose:
             print "  %s" % str(e)
             traceback.print_exc() 
@@ -86,25 +348,86 @@ def probe_sync():
         print "<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<"
 
     # Validate probe sync request token
-    if not probe_sync.token == token:
+    with metrics.timed("probe_sync_token_validation"):
+        valid_token = probe_sync.token == token
+    if not valid_token:
+        metrics.inc("sync_unauthorized_total")
         print "[WARN] Connection attempt by probe '%s' from %s with invalid token." %\
             (probe_sync.probe_id, request.remote_addr)
         abort(401)
 
-    # Compare probe's time with Control Server time.  Log if the
-    # difference is significant.  If the probe's current time is 0,
-    # that indicates that time hasn't yet been set on the probe.
-    time_diff = date_util.get_current_timestamp() - probe_sync.curr_time
-    if probe_sync.curr_time > 0 and math.fabs(time_diff) > time_diff_threshold:
-        print "[WARN] Probe time is off by %ds" % time_diff
-
     # If the probe tried to connect to the Control Server more than
     # once, then log the the failed connection attemps
     if probe_sync.connection_attempts > 1:
         print "[WARN] Probe '%s' attemped to connect %d times" %\
             (probe_sync.probe_id, probe_sync.connection_attempts)
-
-    response = probe_service.process_probe_sync(probe_sync)
+        metrics.inc("sync_retries_total")
+
+    # A sync with a sync_id that was already applied is a retry, so
+    # it's acknowledged without being written again.  If the same sync
+    # is still being applied, the probe should retry later.
+    sync_id = getattr(probe_sync, "sync_id", None)
+    if sync_id is not None:
+        dedup = sync_dedup.begin(probe_sync.probe_id, sync_id)
+        if dedup == sync_dedup.DUPLICATE:
+            response = probe_service.build_sync_response(probe_sync,
+                duplicate=True)
+            response["duplicate"] = True
+            return make_response(jsonify(response))
+        if dedup == sync_dedup.IN_FLIGHT:
+            abort(503)
+
+    applied = queued = False
+    try:
+        # Compare probe's time with Control Server time, updating the
+        # drift estimate its readings are corrected by (only once per
+        # sync, as a retry arrives late).  Log if the difference is
+        # significant.  If the probe's current time is 0, that indicates
+        # that time hasn't yet been set on the probe.
+        clock = clock_drift.observe(probe_sync)
+        time_diff = clock["offset"] if clock is not None else \
+            date_util.get_current_timestamp() - probe_sync.curr_time
+        if probe_sync.curr_time > 0 and \
+                math.fabs(time_diff) > time_diff_threshold:
+            print "[WARN] Probe '%s' time is off by %ds" % (
+                probe_sync.probe_id, time_diff)
+            metrics.inc("clock_skew_warnings_total")
+
+        # In async ingest mode the sync is queued to be written in the
+        # background.  If the queue is full, the probe should retry
+        # later.  A queued sync is only recorded as applied once it has
+        # been written (see ingest_queue), so a retry of it is in
+        # flight until then.
+        if ingest_queue.async_mode:
+            if not ingest_queue.submit(probe_sync):
+                print "[WARN] Ingest queue full, rejecting sync from probe '%s'" %\
+                    probe_sync.probe_id
+                metrics.inc("sync_queue_full_total")
+                abort(503)
+            queued = True
+            response = probe_service.build_sync_response(probe_sync)
+
+        # In spool ingest mode the sync is written to the local spool,
+        # and replayed to the DB in the background
+        elif sync_spool.enabled:
+            if not sync_spool.append(probe_sync):
+                abort(503)
+            response = probe_service.build_sync_response(probe_sync)
+
+        else:
+            try:
+                response = probe_service.process_probe_sync(probe_sync)
+            except Exception:
+                metrics.inc("sync_errors_total")
+                raise
+        applied = True
+
+    finally:
+        if sync_id is not None and not queued:
+            sync_dedup.end(probe_sync.probe_id, sync_id, applied)
+
+    metrics.inc("syncs_total")
+    metrics.inc("points_received_total", len(probe_sync.readings))
 
     if verbose:
         print response
@@ -113,6 +436,82 @@ def probe_sync():
     return make_response(jsonify(response))
 
 
+@app.route("/export")
+def export():
+    """ Streams the readings of a probe as CSV or newline-delimited
+        JSON.  Arguments are probe_id, sensor_id (optional, may be
+        repeated), start and end (timestamps or YYYY-MM-DD[THH:MM:SS],
+        default to all time) and format ('csv' or 'ndjson').
+
+    """
+    try:
+        probe_id = request.args["probe_id"]
+        start = export_service.parse_time(request.args.get("start", "0"))
+        end = export_service.parse_time(request.args["end"]) \
+            if "end" in request.args else date_util.get_current_timestamp()
+        format = request.args.get("format", "csv")
+        content_type = export_service.formats[format]
+    except (KeyError, ValueError):
+        abort(400)
+
+    metrics.inc("exports_total")
+    filename = secure_filename("%s.%s" % (probe_id, format)) or "export"
+    return Response(export_service.export_readings(probe_id, start, end,
+            request.args.getlist("sensor_id") or None, format),
+        mimetype=content_type,
+        headers={"Content-Disposition" : "attachment; filename=%s" % filename})
+
+
+@app.route("/health")
+def health():
+    """ Readiness check for load balancers and process supervisors.
+        Returns 200 if the storage backend can be reached, or 503.
+
+    """
+    status = {
+        "status" : "ok",
+        "storage" : storage.backend,
+        "ingest_queue_depth" : ingest_queue.get_stats()["depth"]
+    }
+
+    try:
+        storage.get_storage().ping()
+    except storage.StorageUnavailable, e:
+        status["status"] = "unavailable"
+        status["error"] = str(e)
+
+    response = make_response(jsonify(status))
+    if status["status"] != "ok":
+        response.status_code = 503
+    return response
+
+
+@app.errorhandler(storage.StorageUnavailable)
+def storage_unavailable(e):
+    # Probes retry a sync that fails with a 503
+    print "[WARN] Storage unavailable: %s" % str(e)
+    metrics.inc("storage_unavailable_total")
+    return make_response("Storage unavailable", 503)
+
+
+@app.route("/ingest_stats")
+def ingest_stats():
+    return make_response(jsonify(ingest_queue.get_stats()))
+
+
+@app.route("/metrics")
+def metrics_page():
+    # Sums the metrics of every worker, when there are several
+    snapshots = None
+    if shared_state.backend != "memory":
+        shared_state.publish_metrics()
+        snapshots = shared_state.get_shared_state().get_metrics()
+
+    response = make_response(metrics.render(snapshots))
+    response.mimetype = "text/plain"
+    return response
+
+
 def format_number(value):
     """ Used as custom Jinja Filter to format numbers
 
@@ -158,4 +557,5 @@ if __name__ == "__main__":
 
     print "----------------------------------< autogarten Control Server >----" 
     app.config['DEBUG'] = True  # If running directly from the CLI, run in debug mode.
-    app.run(host='0.0.0.0') 
\ No newline at end of file
+    # Threaded, as live update streams (/api/live) stay open
+    app.run(host='0.0.0.0', threaded=True) 
\ No newline at end of file
@@ -34,6 +34,14 @@ def get_midnight(date_time):
     return datetime(date_time.year, date_time.month, date_time.day)
 
 
+def get_hour(date_time):
+    """ Returns a datetime of the start of the hour of the given date
+
+    """
+    return datetime(date_time.year, date_time.month, date_time.day,
+        date_time.hour)
+
+
 def get_timestamp(date_time):
     """ Return the UTC timestamp for the given date
 
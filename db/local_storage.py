@@ -0,0 +1,619 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.db.local_storage
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    An embedded storage backend, so small installs and test rigs can
+    run without a database server.  The readings of each sensor-day
+    are kept in a pair of append-only column files, of int64 timestamps
+    and float64 values, which are memory-mapped to answer range
+    queries...
+
+        <data_dir>/<probe_id>/status.json
+        <data_dir>/<probe_id>/clock_history.ndjson
+        <data_dir>/<probe_id>/sensors/<sensor_id>/index.json
+        <data_dir>/<probe_id>/sensors/<sensor_id>/YYYYMMDD.ts
+        <data_dir>/<probe_id>/sensors/<sensor_id>/YYYYMMDD.val
+        <data_dir>/alerts.ndjson
+
+    Each sensor has a small index recording, per day, the number of
+    readings, their first and last timestamps, and whether they were
+    appended in strictly increasing time order.  Range scans skip days
+    outside the range and binary search ordered days, so only readings
+    in the range are copied out.  The index is written after the column
+    files, and anything past its count (from an interrupted append) is
+    ignored and later overwritten.
+
+    A compacted sensor-day (see service.retention_service) is stored in
+    column files named for its resolution (YYYYMMDD.r900.ts), with the
+    mean of each bucket as its reading and a further column file of the
+    min, max, sum and count of each bucket (YYYYMMDD.r900.stats).  Its
+    index entry also records the resolution and the number of buckets,
+    as readings appended later are stored raw after them.
+
+    Hourly rollups aren't stored, they're computed from the readings
+    when queried.  The data directory must only be used by one process
+    at a time.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+import os
+import threading
+import time
+import urllib
+
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+
+import numpy
+
+from db.storage import Storage
+from db.storage import StorageUnavailable
+from probe_sync import SensorReadings
+
+import date_util
+import series_util
+
+TIMESTAMP_TYPE = numpy.dtype("<i8")
+VALUE_TYPE = numpy.dtype("<f8")
+
+
+class LocalStorage(Storage):
+    """ Stores probe status and sensor data in files under data_dir
+
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.lock = threading.RLock()
+        self.statuses = None  # Loaded on first use
+        self.indexes = {}
+        self.alerts = None
+        self.alerts_torn = False
+        self.clock_histories = {}  # Probe id to (samples, torn)
+
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+
+    def update_probe_status(self, probe_id, contact_time, sync_total=1,
+            restart=False, clock=None):
+        with self.lock:
+            statuses = self._get_statuses()
+            status = statuses.get(probe_id)
+            if status is None:
+                status = statuses[probe_id] = {
+                    "_id" : probe_id,
+                    "first_contact" : contact_time,
+                    "last_restart" : None,
+                    "sync_count" : 0,
+                    "clock" : None
+                }
+
+            status["last_contact"] = contact_time
+            if restart:
+                status["last_restart"] = contact_time
+            if clock is not None:
+                status["clock"] = dict(clock)
+            status["sync_count"] += sync_total
+
+            probe_dir = self._get_probe_dir(probe_id)
+            if not os.path.isdir(probe_dir):
+                os.makedirs(probe_dir)
+            _write_json(os.path.join(probe_dir, "status.json"),
+                dict((key, _to_time(value) if isinstance(value, datetime)
+                    else value) for key, value in status.items()))
+
+    def get_probe_ids(self):
+        with self.lock:
+            return [status["_id"] for status in sorted(
+                self._get_statuses().values(),
+                key=lambda status: (status["first_contact"], status["_id"]))]
+
+    def get_probe_statuses(self, probe_ids=None):
+        with self.lock:
+            statuses = self._get_statuses()
+            if probe_ids is None:
+                probe_ids = self.get_probe_ids()
+            return [dict(statuses[probe_id]) for probe_id in probe_ids
+                if probe_id in statuses]
+
+    def append_points(self, probe_id, readings):
+        readings = SensorReadings.wrap(readings)
+
+        with self.lock:
+            for index, sensor_id in enumerate(readings.sensor_ids):
+                in_sensor = readings.sensor_indexes == index
+                timestamps = readings.timestamps[in_sensor]
+                values = readings.values[in_sensor]
+                if not len(timestamps):
+                    continue
+
+                # A stable sort, so of readings at the same timestamp
+                # the last received is still appended last
+                order = numpy.argsort(timestamps, kind="mergesort")
+                self._append_sensor(probe_id, sensor_id, timestamps[order],
+                    values[order])
+
+    def _append_sensor(self, probe_id, sensor_id, timestamps, values):
+        sensor_dir = self._get_sensor_dir(probe_id, sensor_id)
+        if not os.path.isdir(sensor_dir):
+            os.makedirs(sensor_dir)
+        index = self._get_index(probe_id, sensor_id)
+
+        for day, lo, hi in _split_days(timestamps):
+            day_timestamps = timestamps[lo:hi]
+            entry = index.get(day, [0, None, None, True])
+            count, first, last, ordered = entry[:4]
+
+            path = _get_day_path(sensor_dir, day, entry)
+            _write_column(path + ".ts", count,
+                day_timestamps.astype(TIMESTAMP_TYPE))
+            _write_column(path + ".val", count,
+                values[lo:hi].astype(VALUE_TYPE))
+
+            ordered = bool(ordered and
+                (count == 0 or day_timestamps[0] > last) and
+                (numpy.diff(day_timestamps) > 0).all())
+            index[day] = [
+                count + len(day_timestamps),
+                int(day_timestamps[0] if first is None
+                    else min(first, day_timestamps[0])),
+                int(day_timestamps[-1] if last is None
+                    else max(last, day_timestamps[-1])),
+                ordered] + entry[4:]
+
+        _write_json(os.path.join(sensor_dir, "index.json"), index)
+
+    def walk_points(self, probe_id, start, end, sensor_ids=None):
+        """ Sensor-days are read in order of day, then of sensor id
+
+        """
+        for sensor_id, timestamps, values, stats in self._walk_days(
+                probe_id, start, end, sensor_ids):
+            yield sensor_id, timestamps, values
+
+    def _walk_days(self, probe_id, start, end, sensor_ids=None,
+            with_stats=False):
+        """ Walks the readings of each sensor-day, as walk_points().  If
+            with_stats is set, the (n, 4) min, max, sum and count of
+            each reading (or compacted bucket) are also read.
+
+        """
+
+        # Snapshot the days to read.  Appends after this only add
+        # readings past each day's count, which aren't read.
+        with self.lock:
+            days = []
+            for sensor_id in self._get_sensor_ids(probe_id):
+                if sensor_ids is not None and sensor_id not in sensor_ids:
+                    continue
+                index = self._get_index(probe_id, sensor_id)
+                for day, entry in index.items():
+                    if entry[1] <= end and entry[2] >= start:
+                        days.append((day, sensor_id, list(entry)))
+
+        for day, sensor_id, entry in sorted(days):
+            path = _get_day_path(self._get_sensor_dir(probe_id, sensor_id),
+                day, entry)
+            stats_count = (entry[5] if len(entry) > 4 else 0) \
+                if with_stats else None
+            columns = _read_day(path, entry[0], entry[3], start, end,
+                stats_count)
+            if len(columns[0]):
+                yield (sensor_id,) + columns[:2] + (columns[2] if with_stats
+                    else None,)
+
+    def get_hourly_rollups(self, probe_id, start_time, end_time):
+        """ Rollups are computed from the readings of the whole hours,
+            with each hour's aggregates reduced in one vectorized pass.
+
+        """
+        sensors = OrderedDict()
+
+        hours = []
+        hour = date_util.get_hour(start_time)
+        while hour <= end_time:
+            hours.append(hour)
+            hour += timedelta(hours=1)
+        if not hours:
+            return sensors
+
+        bounds = numpy.array([date_util.get_timestamp(hour) for hour in
+            hours + [hours[-1] + timedelta(hours=1)]], dtype=numpy.int64)
+
+        chunks = OrderedDict()
+        for sensor_id, timestamps, values, stats in self._walk_days(
+                probe_id, bounds[0], bounds[-1] - 1, with_stats=True):
+            chunks.setdefault(sensor_id, []).append((timestamps, values,
+                stats))
+
+        for sensor_id, sensor_chunks in sorted(chunks.items()):
+            timestamps = numpy.concatenate([c[0] for c in sensor_chunks])
+            values = numpy.concatenate([c[1] for c in sensor_chunks])
+            stats = numpy.concatenate([c[2] for c in sensor_chunks])
+
+            # Index of the first reading of each hour that has any
+            splits = numpy.searchsorted(timestamps, bounds)
+            has_readings = numpy.flatnonzero(splits[:-1] < splits[1:])
+            firsts = splits[has_readings]
+            lasts = splits[has_readings + 1] - 1
+
+            mins = numpy.minimum.reduceat(stats[:, 0], firsts)
+            maxs = numpy.maximum.reduceat(stats[:, 1], firsts)
+            sums = numpy.add.reduceat(stats[:, 2], firsts)
+            counts = numpy.add.reduceat(stats[:, 3], firsts).astype(
+                numpy.int64)
+
+            sensors[sensor_id] = [{
+                "hour" : hours[hour_index],
+                "min_value" : min_value,
+                "max_value" : max_value,
+                "sum_values" : sum_values,
+                "count_values" : count_values,
+                "last_timestamp" : last_timestamp,
+                "last_value" : last_value
+            } for hour_index, min_value, max_value, sum_values, count_values,
+                last_timestamp, last_value in zip(
+                    has_readings.tolist(), mins.tolist(), maxs.tolist(),
+                    sums.tolist(), counts.tolist(),
+                    timestamps[lasts].tolist(), values[lasts].tolist())]
+
+        return sensors
+
+    def backfill_rollups(self, probe_id=None, verbose=False):
+        if verbose:
+            print "  Rollups are computed from the readings, nothing to do"
+        return 0
+
+    def compact_points(self, probe_id, before, resolution, limit=None):
+        """ The compacted columns are written to new files before the
+            index is updated to refer to them, so an interrupted
+            compaction leaves the day as it was.
+
+        """
+        before = before.strftime("%Y%m%d")
+        doc_count = reclaimed = 0
+
+        with self.lock:
+            for sensor_id in self._get_sensor_ids(probe_id):
+                sensor_dir = self._get_sensor_dir(probe_id, sensor_id)
+                index = self._get_index(probe_id, sensor_id)
+
+                for day in sorted(index):
+                    entry = index[day]
+                    if day >= before or (len(entry) > 4 and
+                            entry[4] >= resolution):
+                        continue
+                    if limit is not None and doc_count >= limit:
+                        return doc_count, reclaimed
+
+                    old_path = _get_day_path(sensor_dir, day, entry)
+                    timestamps, values, stats = _read_day(old_path,
+                        entry[0], entry[3], entry[1], entry[2],
+                        entry[5] if len(entry) > 4 else 0)
+                    buckets, stats = series_util.downsample(timestamps,
+                        values, resolution, date_util.get_timestamp(
+                            datetime.strptime(day, "%Y%m%d")), stats)
+
+                    new_entry = [len(buckets), int(buckets[0]),
+                        int(buckets[-1]), True, resolution, len(buckets)]
+                    path = _get_day_path(sensor_dir, day, new_entry)
+                    _write_column(path + ".ts", 0,
+                        buckets.astype(TIMESTAMP_TYPE))
+                    _write_column(path + ".val", 0,
+                        (stats[:, 2] / stats[:, 3]).astype(VALUE_TYPE))
+                    _write_column(path + ".stats", 0,
+                        stats.astype(VALUE_TYPE))
+
+                    index[day] = new_entry
+                    _write_json(os.path.join(sensor_dir, "index.json"),
+                        index)
+
+                    doc_count += 1
+                    reclaimed += _remove_day(old_path) - _get_day_size(path)
+
+        return doc_count, reclaimed
+
+    def drop_points(self, probe_id, before):
+        before = before.strftime("%Y%m%d")
+        doc_count = reclaimed = 0
+
+        with self.lock:
+            for sensor_id in self._get_sensor_ids(probe_id):
+                sensor_dir = self._get_sensor_dir(probe_id, sensor_id)
+                index = self._get_index(probe_id, sensor_id)
+
+                days = [day for day in index if day < before]
+                if not days:
+                    continue
+
+                entries = [(day, index.pop(day)) for day in days]
+                _write_json(os.path.join(sensor_dir, "index.json"), index)
+                for day, entry in entries:
+                    reclaimed += _remove_day(_get_day_path(sensor_dir, day,
+                        entry))
+                doc_count += len(days)
+
+        return doc_count, reclaimed
+
+    def append_alerts(self, alerts):
+        with self.lock:
+            stored = self._get_alerts()
+            ids = set(alert["_id"] for alert in stored)
+            alerts = [alert for alert in alerts if alert["_id"] not in ids]
+            if not alerts:
+                return
+
+            _append_ndjson(os.path.join(self.data_dir, "alerts.ndjson"),
+                alerts, self.alerts_torn)
+            self.alerts_torn = False
+            stored.extend(dict(alert) for alert in alerts)
+
+    def get_alerts(self, probe_id=None, limit=None):
+        with self.lock:
+            alerts = [dict(alert) for alert in self._get_alerts()
+                if probe_id is None or alert["probe_id"] == probe_id]
+
+        alerts.sort(key=lambda alert: alert["timestamp"], reverse=True)
+        return alerts[:limit] if limit else alerts
+
+    def get_alert_states(self):
+        states = {}
+        with self.lock:
+            for alert in self._get_alerts():
+                key = (alert["probe_id"], alert["sensor_id"], alert["kind"])
+                if key not in states or \
+                        alert["timestamp"] > states[key]["timestamp"]:
+                    states[key] = dict((field, alert[field]) for field in
+                        ["probe_id", "sensor_id", "kind", "state",
+                            "timestamp"])
+        return states.values()
+
+    def append_clock_history(self, samples):
+        with self.lock:
+            by_probe = OrderedDict()
+            for sample in samples:
+                by_probe.setdefault(sample["probe_id"], []).append(sample)
+
+            for probe_id, probe_samples in by_probe.items():
+                stored, torn = self._get_clock_history(probe_id)
+                ids = set(sample["_id"] for sample in stored)
+                probe_samples = [sample for sample in probe_samples
+                    if sample["_id"] not in ids]
+                if not probe_samples:
+                    continue
+
+                probe_dir = self._get_probe_dir(probe_id)
+                if not os.path.isdir(probe_dir):
+                    os.makedirs(probe_dir)
+                _append_ndjson(os.path.join(probe_dir,
+                    "clock_history.ndjson"), probe_samples, torn)
+                stored.extend(dict(sample) for sample in probe_samples)
+                self.clock_histories[probe_id] = (stored, False)
+
+    def get_clock_history(self, probe_id, start, end):
+        with self.lock:
+            samples = [dict(sample) for sample in
+                self._get_clock_history(probe_id)[0]
+                if start <= sample["timestamp"] <= end]
+
+        samples.sort(key=lambda sample: sample["timestamp"])
+        return samples
+
+    def ping(self):
+        if not os.access(self.data_dir, os.W_OK):
+            raise StorageUnavailable("Data directory '%s' isn't writable" %
+                self.data_dir)
+
+    def close(self):
+        with self.lock:
+            self.statuses = None
+            self.indexes = {}
+            self.alerts = None
+            self.clock_histories = {}
+
+    def _get_statuses(self):
+        if self.statuses is None:
+            self.statuses = {}
+            for name in os.listdir(self.data_dir):
+                path = os.path.join(self.data_dir, name, "status.json")
+                if not os.path.isfile(path):
+                    continue
+
+                with open(path) as status_file:
+                    status = json.load(status_file)
+                for key in ["first_contact", "last_contact", "last_restart"]:
+                    if status.get(key) is not None:
+                        status[key] = datetime.fromtimestamp(status[key])
+                status.setdefault("clock", None)
+                self.statuses[status["_id"]] = status
+
+        return self.statuses
+
+    def _get_alerts(self):
+        if self.alerts is None:
+            self.alerts, self.alerts_torn = _read_ndjson(
+                os.path.join(self.data_dir, "alerts.ndjson"))
+        return self.alerts
+
+    def _get_clock_history(self, probe_id):
+        history = self.clock_histories.get(probe_id)
+        if history is None:
+            history = self.clock_histories[probe_id] = _read_ndjson(
+                os.path.join(self._get_probe_dir(probe_id),
+                    "clock_history.ndjson"))
+        return history
+
+    def _get_index(self, probe_id, sensor_id):
+        index = self.indexes.get((probe_id, sensor_id))
+        if index is None:
+            path = os.path.join(self._get_sensor_dir(probe_id, sensor_id),
+                "index.json")
+            index = {}
+            if os.path.isfile(path):
+                with open(path) as index_file:
+                    index = json.load(index_file)
+            self.indexes[(probe_id, sensor_id)] = index
+        return index
+
+    def _get_sensor_ids(self, probe_id):
+        sensors_dir = os.path.join(self._get_probe_dir(probe_id), "sensors")
+        if not os.path.isdir(sensors_dir):
+            return []
+        return sorted(urllib.unquote(name).decode("utf-8")
+            for name in os.listdir(sensors_dir))
+
+    def _get_probe_dir(self, probe_id):
+        return os.path.join(self.data_dir, _get_file_name(probe_id))
+
+    def _get_sensor_dir(self, probe_id, sensor_id):
+        return os.path.join(self._get_probe_dir(probe_id), "sensors",
+            _get_file_name(sensor_id))
+
+
+def _split_days(timestamps):
+    """ Splits the given sorted timestamps by day.  Yields a tuple of
+        (YYYYMMDD, start index, end index) per day.
+
+    """
+    lo = 0
+    while lo < len(timestamps):
+        day = date_util.get_midnight(datetime.fromtimestamp(timestamps[lo]))
+        hi = int(numpy.searchsorted(timestamps,
+            date_util.get_timestamp(day + timedelta(days=1))))
+        yield day.strftime("%Y%m%d"), lo, hi
+        lo = hi
+
+
+def _read_day(path, count, ordered, start, end, stats_count=None):
+    """ Returns the readings of a sensor-day's column files between the
+        given timestamps, as a tuple of NumPy arrays of timestamps and
+        values sorted by time.  Of readings at the same timestamp, the
+        last appended is kept.
+
+        If stats_count is given, the (n, 4) stats of each reading are
+        also returned, read for the first stats_count (compacted)
+        readings and of a single reading for the rest.
+
+    """
+    timestamps = numpy.memmap(path + ".ts", TIMESTAMP_TYPE, "r", shape=(count,))
+    columns = [numpy.memmap(path + ".val", VALUE_TYPE, "r", shape=(count,))]
+    if stats_count is not None:
+        columns.append(_read_stats(path, columns[0], stats_count))
+
+    if ordered:
+        lo = numpy.searchsorted(timestamps, start, "left")
+        hi = numpy.searchsorted(timestamps, end, "right")
+        return tuple(numpy.array(column[lo:hi]) for column in
+            [timestamps] + columns)
+
+    in_range = (timestamps >= start) & (timestamps <= end)
+    timestamps = numpy.array(timestamps[in_range])
+    columns = [numpy.array(column[in_range]) for column in columns]
+
+    order = numpy.argsort(timestamps, kind="mergesort")
+    timestamps = timestamps[order]
+    is_last = numpy.append(timestamps[1:] != timestamps[:-1], True)
+    return (timestamps[is_last],) + tuple(column[order][is_last]
+        for column in columns)
+
+
+def _read_stats(path, values, stats_count):
+    raw = numpy.asarray(values[stats_count:])
+    stats = numpy.column_stack([raw, raw, raw, numpy.ones(len(raw))])
+    if stats_count:
+        stats = numpy.concatenate([numpy.memmap(path + ".stats", VALUE_TYPE,
+            "r", shape=(stats_count, 4)), stats])
+    return stats
+
+
+def _write_column(path, offset, column):
+    """ Writes the given column at the given offset (in items) of a
+        column file, dropping anything after it.
+
+    """
+    with open(path, "r+b" if os.path.exists(path) else "wb") as column_file:
+        column_file.seek(offset * column.itemsize)
+        column_file.write(column.tostring())
+        column_file.truncate()
+
+
+def _get_day_path(sensor_dir, day, entry):
+    """ Returns the path of a sensor-day's column files, without their
+        extension
+
+    """
+    if len(entry) > 4:
+        return os.path.join(sensor_dir, "%s.r%d" % (day, entry[4]))
+    return os.path.join(sensor_dir, day)
+
+
+def _get_day_size(path):
+    return sum(os.path.getsize(path + extension) for extension in
+        [".ts", ".val", ".stats"] if os.path.exists(path + extension))
+
+
+def _remove_day(path):
+    """ Removes a sensor-day's column files, returning their size
+
+    """
+    size = _get_day_size(path)
+    for extension in [".ts", ".val", ".stats"]:
+        if os.path.exists(path + extension):
+            os.remove(path + extension)
+    return size
+
+
+def _write_json(path, content):
+    """ Replaces the given file, atomically, with the given JSON
+
+    """
+    with open(path + ".tmp", "w") as json_file:
+        json.dump(content, json_file)
+    os.rename(path + ".tmp", path)
+
+
+def _read_ndjson(path):
+    """ Returns a tuple of the records of the given newline-delimited
+        JSON file (empty if there's no such file), and whether its last
+        line was cut short
+
+    """
+    records = []
+    torn = False
+    if os.path.isfile(path):
+        with open(path) as ndjson_file:
+            for line in ndjson_file:
+                # A line cut short by a crash is skipped, and the next
+                # append starts on a new line
+                torn = not line.endswith("\n")
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    return records, torn
+
+
+def _append_ndjson(path, records, torn):
+    """ Appends the given records to a newline-delimited JSON file,
+        starting on a new line if its last line was cut short
+
+    """
+    with open(path, "a") as ndjson_file:
+        if torn:
+            ndjson_file.write("\n")
+        for record in records:
+            ndjson_file.write(json.dumps(record) + "\n")
+
+
+def _get_file_name(id):
+    if not id or id in [".", ".."]:
+        raise ValueError("Invalid id '%s'" % id)
+    return urllib.quote(id.encode("utf-8"), safe="")
+
+
+def _to_time(date_time):
+    return time.mktime(date_time.timetuple()) + date_time.microsecond / 1e6
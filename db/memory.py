@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.db.memory
+    ~~~~~~~~~~~~~~~~~~~~
+
+    A local, in-memory stand-in for mongoDB collections.  It supports
+    the subset of the pymongo collection API used by autogarten (find
+    with simple range queries, upserts with $set/$inc/$min/$max/
+    $setOnInsert and bulk writes), so the Control Server can run
+    without a database server for load tests and test rigs.
+
+    Select it by setting db_host to 'memory' in settings.cfg, or by
+    calling mongo.use_memory_db() before the service modules are
+    imported.  Data is lost when the process exits.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import copy
+import threading
+
+from pymongo.errors import DuplicateKeyError
+
+_collections = {}
+_collections_lock = threading.Lock()
+
+
+def get_collection(name):
+    """ Returns the named in-memory collection, creating it if needed
+
+    """
+    with _collections_lock:
+        if name not in _collections:
+            _collections[name] = MemoryCollection(name)
+        return _collections[name]
+
+
+class MemoryCollection(object):
+    """ An in-memory collection of documents keyed by _id
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.lock = threading.RLock()
+
+    def find(self, spec=None, fields=None):
+        with self.lock:
+            docs = [copy.deepcopy(doc) for doc in self.docs.itervalues()
+                if _matches(doc, spec or {})]
+        return MemoryCursor(docs, fields)
+
+    def find_one(self, spec=None, fields=None):
+        for doc in self.find(spec, fields):
+            return doc
+        return None
+
+    def count(self):
+        return len(self.docs)
+
+    def insert(self, doc_or_docs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+        with self.lock:
+            for doc in docs:
+                if doc["_id"] in self.docs:
+                    raise DuplicateKeyError("Duplicate _id '%s'" % doc["_id"])
+                self.docs[doc["_id"]] = copy.deepcopy(doc)
+
+    def update(self, spec, document, upsert=False, multi=False):
+        with self.lock:
+            if "_id" in spec and not isinstance(spec["_id"], dict):
+                doc = self.docs.get(spec["_id"])
+                matched = [doc] if doc and _matches(doc, spec) else []
+            else:
+                matched = [doc for doc in self.docs.itervalues()
+                    if _matches(doc, spec)]
+                if not multi:
+                    matched = matched[:1]
+
+            for doc in matched:
+                self.docs[doc["_id"]] = _apply_update(doc, document, False)
+
+            if not matched and upsert:
+                doc = dict((k, copy.deepcopy(v)) for k, v in spec.iteritems()
+                    if not isinstance(v, dict))
+                doc = _apply_update(doc, document, True)
+                self.docs[doc["_id"]] = doc
+
+    def remove(self, spec=None):
+        with self.lock:
+            for doc in self.docs.values():
+                if _matches(doc, spec or {}):
+                    del self.docs[doc["_id"]]
+
+    def create_index(self, keys):
+        # Queries always scan, so indexes are only named
+        return "_".join("%s_%s" % key for key in keys)
+
+    def drop(self):
+        with self.lock:
+            self.docs.clear()
+
+    def initialize_ordered_bulk_op(self):
+        return MemoryBulkOperation(self)
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulkOperation(self)
+
+
+class MemoryCursor(object):
+    """ Iterable result of a find(), supporting sort() and limit().
+        Fields are projected as it's iterated, so it can be sorted by
+        fields that aren't returned.
+
+    """
+
+    def __init__(self, docs, fields=None):
+        self.docs = docs
+        self.fields = fields
+
+    def sort(self, key, direction=1):
+        self.docs.sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        if count:
+            self.docs = self.docs[:count]
+        return self
+
+    def __iter__(self):
+        return (_project(doc, self.fields) for doc in self.docs)
+
+
+class MemoryBulkOperation(object):
+    """ Collects upserts and applies them all on execute()
+
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.ops = []
+
+    def find(self, spec):
+        return _BulkSelector(self, spec)
+
+    def execute(self):
+        with self.collection.lock:
+            for spec, document, upsert in self.ops:
+                self.collection.update(spec, document, upsert)
+        return {"nUpserted" : 0, "nModified" : len(self.ops)}
+
+
+class _BulkSelector(object):
+
+    def __init__(self, bulk, spec, upsert=False):
+        self.bulk = bulk
+        self.spec = spec
+        self.upsert_ = upsert
+
+    def upsert(self):
+        return _BulkSelector(self.bulk, self.spec, True)
+
+    def update_one(self, document):
+        self.bulk.ops.append((self.spec, document, self.upsert_))
+
+    def replace_one(self, document):
+        self.bulk.ops.append((self.spec, document, self.upsert_))
+
+
+def _matches(doc, spec):
+    for key, condition in spec.iteritems():
+        value = _get_path(doc, key)
+        if isinstance(condition, dict):
+            for op, operand in condition.iteritems():
+                if op == "$gte" and not (value is not None and value >= operand):
+                    return False
+                if op == "$gt" and not (value is not None and value > operand):
+                    return False
+                if op == "$lte" and not (value is not None and value <= operand):
+                    return False
+                if op == "$lt" and not (value is not None and value < operand):
+                    return False
+                if op == "$in" and value not in operand:
+                    return False
+                if op == "$ne" and value == operand:
+                    return False
+                if op == "$exists" and (value is not None) != operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(doc, fields):
+    if not fields:
+        return doc
+
+    projected = {"_id" : doc["_id"]}
+    for key in fields:
+        if key in doc:
+            projected[key] = doc[key]
+    return projected
+
+
+def _apply_update(doc, document, inserting):
+    """ Applies the given update to doc (in place), either an update of
+        $ operators or a whole replacement document.  Returns the
+        updated document.
+
+    """
+    if not any(key.startswith("$") for key in document):
+        replacement = copy.deepcopy(document)
+        replacement["_id"] = doc.get("_id", document.get("_id"))
+        return replacement
+
+    for op, fields in document.iteritems():
+        for path, operand in fields.iteritems():
+            current = _get_path(doc, path)
+            if op == "$set":
+                _set_path(doc, path, copy.deepcopy(operand))
+            elif op == "$setOnInsert":
+                if inserting:
+                    _set_path(doc, path, copy.deepcopy(operand))
+            elif op == "$inc":
+                _set_path(doc, path, (current or 0) + operand)
+            elif op == "$min":
+                if current is None or operand < current:
+                    _set_path(doc, path, operand)
+            elif op == "$max":
+                if current is None or operand > current:
+                    _set_path(doc, path, operand)
+            elif op == "$unset":
+                _unset_path(doc, path)
+            else:
+                raise ValueError("Unsupported update operator '%s'" % op)
+
+    return doc
+
+
+def _get_path(doc, path):
+    for key in path.split("."):
+        if not isinstance(doc, dict) or key not in doc:
+            return None
+        doc = doc[key]
+    return doc
+
+
+def _set_path(doc, path, value):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[keys[-1]] = value
+
+
+def _unset_path(doc, path):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        doc = doc.get(key, {})
+    doc.pop(keys[-1], None)
@@ -5,53 +5,185 @@
 
     This module supports interaction with mongoDB.
 
-    Usage: Call a get_<collection_name>() function to return a
-    connection to a particular mongoDB collection.  The connection
-    should he reused to limit the number of concurrent connections
-    open to mongoDB.
-    
+    Usage: Call get_mongodb_connection() to return a particular mongoDB
+    collection.  All collections share a single pooled MongoClient per
+    process.  It's created on first use without blocking on the DB, so
+    the Control Server starts even while mongoDB is down, and it's
+    recreated in a forked child process (such as a WSGI worker) rather
+    than sharing the parent's sockets.  The services use the mongoDB
+    storage backend (see db.mongo_storage).
+
+    Operations wrapped with reconnecting() are retried with exponential
+    backoff while mongoDB is unreachable (e.g. restarting or failing
+    over), then raise StorageUnavailable (see db.storage).  Writes that
+    increment counts can't tell whether a failed attempt was applied,
+    so they're wrapped with not_retried() instead, which raises
+    StorageUnavailable right away.
+
     :license: MIT, see LICENSE for more details.
 """
 
 import ConfigParser
+import functools
+import os
+import threading
+import time
+
 import pymongo
+import pymongo.errors
+
+from db import memory
+from db.storage import StorageUnavailable
+
+import metrics
 
 
 # These values set from config file
 db_host = None
 db_port = None
+max_pool_size = 100
+connect_timeout_ms = 2000
+socket_timeout_ms = 10000
+wait_queue_timeout_ms = 5000
+write_concern = {}
+retry_attempts = 5
+retry_backoff = 0.1
+retry_backoff_max = 2.0
+
+db_name = "autogartenDB"
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
 
 
 def init_config():
     """ Read mongoDB connection settings from config file
 
     """
-    global db_host, db_port
+    global db_host, db_port, max_pool_size, connect_timeout_ms, \
+        socket_timeout_ms, wait_queue_timeout_ms, write_concern, \
+        retry_attempts, retry_backoff, retry_backoff_max
 
     config = ConfigParser.SafeConfigParser()
     config.read("settings.cfg")
 
     db_host = config.get("mongo", "db_host")
-    db_port = config.getint("mongo", "db_port")  
+    db_port = config.getint("mongo", "db_port")
+    max_pool_size = config.getint("mongo", "max_pool_size")
+    connect_timeout_ms = config.getint("mongo", "connect_timeout_ms")
+    socket_timeout_ms = config.getint("mongo", "socket_timeout_ms")
+    wait_queue_timeout_ms = config.getint("mongo", "wait_queue_timeout_ms")
+    retry_attempts = config.getint("mongo", "retry_attempts")
+    retry_backoff = config.getfloat("mongo", "retry_backoff")
+    retry_backoff_max = config.getfloat("mongo", "retry_backoff_max")
+
+    # w is a number of members, or a mode such as 'majority'
+    w = config.get("mongo", "write_concern")
+    write_concern = {
+        "w" : int(w) if w.isdigit() else w,
+        "j" : config.getboolean("mongo", "journal")
+    }
+
+
+def use_memory_db():
+    """ Use the local in-memory stand-in for mongoDB (see db.memory).
+        Must be called before any collections are requested.
+
+    """
+    global db_host
+    db_host = "memory"
+
+
+def get_client():
+    """ Returns the MongoClient of this process, creating it on first
+        use.  Its connection pool is shared by all threads.
+
+    """
+    global _client, _client_pid
+
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            # Sockets inherited from a parent process are abandoned, not
+            # closed, as the parent is still using them
+            print " * Connecting to mongoDB @ %s:%d (pid %d)" % \
+                (db_host, db_port, os.getpid())
+
+            _client = pymongo.MongoClient(db_host, db_port,
+                max_pool_size=max_pool_size,
+                connectTimeoutMS=connect_timeout_ms,
+                socketTimeoutMS=socket_timeout_ms,
+                waitQueueTimeoutMS=wait_queue_timeout_ms,
+                _connect=False, **write_concern)
+            _client_pid = os.getpid()
+
+        return _client
 
 
 def get_mongodb_connection(collection_name):
-    print " * Connecting to mongoDB @ %s:%d   autogartenDB.%s" % \
-            (db_host, db_port, collection_name)
+    if db_host == "memory":
+        return memory.get_collection(collection_name)
 
-    client = pymongo.MongoClient(db_host, db_port)
-    return client["autogartenDB"][collection_name]
+    return get_client()[db_name][collection_name]
 
 
-def get_probe_status_collection():
-    collection = get_mongodb_connection("probe_status")
-    return collection
+def ping():
+    """ Round trips to mongoDB, raising StorageUnavailable if it can't
+        be reached
+
+    """
+    if db_host == "memory":
+        return
+
+    try:
+        get_client().admin.command("ping")
+    except pymongo.errors.ConnectionFailure, e:
+        raise StorageUnavailable("mongoDB @ %s:%d: %s" % (db_host, db_port,
+            str(e)))
 
 
-def get_sensor_data_collection():
-    collection = get_mongodb_connection("sensor_data")
-    return collection
+def reconnecting(func):
+    """ Decorates a function of mongoDB operations to retry it with
+        exponential backoff when the connection fails, up to
+        retry_attempts times.  The function should be safe to retry.
+
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        backoff = retry_backoff
+        for attempt in range(retry_attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except pymongo.errors.AutoReconnect, e:
+                if attempt == retry_attempts:
+                    raise StorageUnavailable("mongoDB @ %s:%d: %s" % (
+                        db_host, db_port, str(e)))
+
+                print "[WARN] mongoDB unreachable (%s), retrying in %0.1fs" %\
+                    (str(e), backoff)
+                metrics.inc("mongo_reconnects_total")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, retry_backoff_max)
+
+    return wrapper
+
+
+def not_retried(func):
+    """ Decorates a function of mongoDB operations that isn't safe to
+        retry, such as writes that increment counts, to raise
+        StorageUnavailable as soon as the connection fails
+
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except pymongo.errors.AutoReconnect, e:
+            raise StorageUnavailable("mongoDB @ %s:%d: %s" % (db_host,
+                db_port, str(e)))
+
+    return wrapper
 
 
 # Initialize config when loading module
-init_config()
\ No newline at end of file
+init_config()
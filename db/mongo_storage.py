@@ -0,0 +1,647 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.db.mongo_storage
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The mongoDB storage backend.  Sensor data uses a Document-Oriented
+    schema design, a document per sensor-day holding its readings keyed
+    by timestamp.  For more details see:
+      * http://blog.mongodb.org/post/65517193370/
+          schema-design-for-time-series-data-in-mongodb
+
+    Hourly and daily rollups of each sensor (min, max, sum and count of
+    its values) are kept in their own collections, updated as readings
+    are appended, so overviews can be built from a handful of small
+    documents instead of every raw data point.  Rollups for data
+    recorded before they existed can be built with...
+
+        $ python manage.py backfill_rollups
+
+    The indexes that the range, overview and export queries depend on
+    are created by bootstrap(), which the Control Server runs at startup
+    and which can be run with...
+
+        $ python manage.py bootstrap
+
+    Compacted daily documents (see service.retention_service) hold the
+    mean of each bucket in 'data', the min, max, sum and count of each
+    bucket in 'stats', and the bucket width in seconds in 'resolution'.
+
+    The newest state of each (probe, sensor, kind) of alert is kept in
+    the alert_states collection as it's appended, so alert states are
+    restored without reading every alert.  Its 'transition' is twice the
+    timestamp of the newest alert, plus 1 if it was raised, and is only
+    ever increased with $max, so alerts written out of order leave the
+    newest state.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import itertools
+
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+
+import bson
+import numpy
+import pymongo
+import pymongo.errors
+
+from db import mongo
+from db.storage import Storage
+from db.storage import StorageUnavailable
+from probe_sync import SensorReadings
+
+import date_util
+import metrics
+import series_util
+
+# Indexes of each collection, as lists of (field, direction).  Queries
+# on sensor data match a probe and a range of days, optionally of some
+# sensors, sorted by day.  Queries on hourly rollups match a probe and
+# a range of hours, sorted by hour.
+indexes = {
+    "sensor_data" : [
+        [("probe_id", pymongo.ASCENDING), ("day", pymongo.ASCENDING),
+            ("sensor_id", pymongo.ASCENDING)]],
+    "sensor_rollup_hourly" : [
+        [("probe_id", pymongo.ASCENDING), ("hour", pymongo.ASCENDING)]],
+    "alerts" : [
+        [("probe_id", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)],
+        [("timestamp", pymongo.DESCENDING)]],
+    "clock_history" : [
+        [("probe_id", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)]]
+}
+
+
+class MongoStorage(Storage):
+    """ Stores probe status, sensor data and rollups in mongoDB.
+        Operations are retried while mongoDB is unreachable (see
+        mongo.reconnecting), except for the writes that increment sync
+        counts and the counts and sums of readings, which raise
+        StorageUnavailable right away (see mongo.not_retried).  Callers
+        that retry them should only retry the writes that failed.
+
+    """
+
+    def __init__(self):
+        # Collections set here are used instead of those of the
+        # configured DB, such as by benchmarks
+        self.collections = {}
+
+    def get_collection(self, name):
+        # Not cached, so a forked process uses its own client
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = mongo.get_mongodb_connection(name)
+        return collection
+
+    def ping(self):
+        mongo.ping()
+
+    @mongo.reconnecting
+    def bootstrap(self):
+        """ Indexes that already exist are left as they are
+
+        """
+        created = []
+        for name, collection_indexes in sorted(indexes.items()):
+            for keys in collection_indexes:
+                created.append("%s.%s" % (name,
+                    self.get_collection(name).create_index(keys)))
+        return created
+
+    @mongo.not_retried
+    def update_probe_status(self, probe_id, contact_time, sync_total=1,
+            restart=False, clock=None):
+        update_set = {"last_contact" : contact_time}
+        if restart:
+            update_set["last_restart"] = contact_time
+        if clock is not None:
+            update_set["clock"] = clock
+
+        self.get_collection("probe_status").update(
+            {"_id" : probe_id}, {
+                "$set" : update_set,
+                "$inc" : {"sync_count" : sync_total},
+                "$setOnInsert" : {"first_contact" : contact_time}
+            }, True)  # True for upsert
+
+    @mongo.reconnecting
+    def get_probe_ids(self):
+        return [probe_status["_id"] for probe_status in
+            self.get_collection("probe_status").find({}, {"_id" : 1})]
+
+    @mongo.reconnecting
+    def get_probe_statuses(self, probe_ids=None):
+        query = {} if probe_ids is None else {"_id" : {"$in" : probe_ids}}
+
+        probes_status = list(self.get_collection("probe_status").find(query))
+        for probe_status in probes_status:
+            probe_status.setdefault("last_restart", None)
+            probe_status.setdefault("clock", None)
+        return probes_status
+
+    @mongo.not_retried
+    def append_points(self, probe_id, readings):
+        """ Data points are first grouped by their daily document, so
+            each document is written with a single merged update.  All
+            of the updates are then sent to mongoDB as one ordered bulk
+            write, rather than one round trip per data point.
+
+        """
+        readings = SensorReadings.wrap(readings)
+        updates = group_sensor_data(probe_id, readings)
+        if not updates:
+            return
+
+        bulk = self.get_collection("sensor_data").initialize_ordered_bulk_op()
+        for metric_id, update in updates:
+            bulk.find({"_id" : metric_id}).upsert().update_one(update)
+        bulk.execute()
+
+        self.persist_rollups(probe_id, readings)
+
+    @metrics.timed("persist_rollups")
+    def persist_rollups(self, probe_id, readings):
+        """ Folds the given readings into the hourly and daily rollups.
+            Each rollup document gets a single merged update, and each
+            rollup collection is written with one bulk write.  The last
+            value of each hourly rollup is then set, in the same bulk
+            write, only if its last_timestamp is still that of the
+            readings, so a late sync doesn't overwrite a newer value.
+
+        """
+        hourly_updates, daily_updates, last_value_updates = group_rollups(
+            probe_id, readings)
+
+        for name, updates, conditional_updates in [
+                ("sensor_rollup_hourly", hourly_updates, last_value_updates),
+                ("sensor_rollup_daily", daily_updates, [])]:
+
+            if not updates:
+                continue
+
+            bulk = self.get_collection(name).initialize_ordered_bulk_op()
+            for rollup_id, update in updates:
+                bulk.find({"_id" : rollup_id}).upsert().update_one(update)
+            for query, update in conditional_updates:
+                bulk.find(query).update_one(update)
+            bulk.execute()
+
+    def walk_points(self, probe_id, start, end, sensor_ids=None):
+        """ Daily documents are walked with a cursor, so only one is in
+            memory at a time.  Days without data in the range are
+            skipped.
+
+        """
+        query = get_walk_query(probe_id, start, end, sensor_ids)
+        cursor = iter(self.get_collection("sensor_data").find(query,
+            {"sensor_id" : 1, "data" : 1}).sort("day", 1))
+
+        while True:
+            # A walk that's underway can't be retried
+            try:
+                sensor_data = next(cursor)
+            except StopIteration:
+                return
+            except pymongo.errors.AutoReconnect, e:
+                raise StorageUnavailable(str(e))
+
+            data = sensor_data["data"]
+            timestamps = numpy.fromiter(itertools.imap(int, data.iterkeys()),
+                numpy.int64, len(data))
+            values = numpy.fromiter(data.itervalues(), numpy.float64,
+                len(data))
+
+            in_range = (timestamps >= start) & (timestamps <= end)
+            if not in_range.any():
+                continue
+
+            timestamps, values = timestamps[in_range], values[in_range]
+            order = numpy.argsort(timestamps, kind="mergesort")
+            yield sensor_data["sensor_id"], timestamps[order], values[order]
+
+    @mongo.reconnecting
+    def get_hourly_rollups(self, probe_id, start_time, end_time):
+        rollups = self.get_collection("sensor_rollup_hourly").find(
+            get_rollup_query(probe_id, start_time, end_time)).sort("hour", 1)
+
+        sensors = OrderedDict()
+        for rollup in rollups:
+            sensors.setdefault(rollup["sensor_id"], []).append(rollup)
+
+        return sensors
+
+    def backfill_rollups(self, probe_id=None, verbose=False):
+        """ Each rollup is replaced rather than incremented, so the
+            backfill can safely be rerun.
+
+        """
+        query = {} if probe_id is None else {"probe_id" : probe_id}
+        db_rollup_hourly = self.get_collection("sensor_rollup_hourly")
+        db_rollup_daily = self.get_collection("sensor_rollup_daily")
+        doc_count = 0
+
+        for sensor_data in self.get_collection("sensor_data").find(
+                query).sort("day", 1):
+            hourly = {}
+            stats = sensor_data.get("stats", {})
+            for timestamp, value in sensor_data["data"].iteritems():
+                hour = date_util.get_hour(
+                    datetime.fromtimestamp(int(timestamp)))
+                rollup = hourly.get(hour)
+                if rollup is None:
+                    rollup = hourly[hour] = _new_rollup(sensor_data, "hour",
+                        hour)
+                    rollup["last_timestamp"] = int(timestamp)
+                    rollup["last_value"] = value
+
+                # A compacted bucket is folded in whole
+                if timestamp in stats:
+                    _fold_stats(rollup, *stats[timestamp])
+                else:
+                    _fold_value(rollup, value)
+                if int(timestamp) >= rollup["last_timestamp"]:
+                    rollup["last_timestamp"] = int(timestamp)
+                    rollup["last_value"] = value
+
+            if hourly:
+                bulk = db_rollup_hourly.initialize_unordered_bulk_op()
+                for rollup in hourly.values():
+                    bulk.find({"_id" : rollup["_id"]}).upsert().replace_one(
+                        rollup)
+                bulk.execute()
+
+            # The daily rollup is folded from the hourly ones, rather
+            # than copied from the document's counts, which a repeated
+            # write may have incremented twice
+            daily = _new_rollup(sensor_data, "day", sensor_data["day"])
+            for rollup in hourly.values():
+                _fold_stats(daily, rollup["min_value"], rollup["max_value"],
+                    rollup["sum_values"], rollup["count_values"])
+            db_rollup_daily.update({"_id" : daily["_id"]}, daily, True)
+
+            doc_count += 1
+            if verbose:
+                print "  %s: %d hourly rollups" % (sensor_data["_id"],
+                    len(hourly))
+
+        return doc_count
+
+    @mongo.reconnecting
+    def compact_points(self, probe_id, before, resolution, limit=None):
+        """ Each daily document is replaced by its compacted form, only
+            if no readings were appended to it in the meantime, so the
+            compaction can be interrupted and rerun.
+
+        """
+        db_sensor_data = self.get_collection("sensor_data")
+        metric_ids = [sensor_data["_id"] for sensor_data in
+            db_sensor_data.find(get_before_query(probe_id, before),
+                {"resolution" : 1}).sort("day", 1)
+            if sensor_data.get("resolution", 0) < resolution]
+
+        doc_count = reclaimed = 0
+        for metric_id in metric_ids[:limit]:
+            sensor_data = db_sensor_data.find_one({"_id" : metric_id})
+            if sensor_data is None:
+                continue
+
+            compacted = compact_sensor_data(sensor_data, resolution)
+            db_sensor_data.update({
+                "_id" : metric_id,
+                "count_values" : sensor_data["count_values"]
+            }, compacted)
+
+            doc_count += 1
+            reclaimed += len(bson.BSON.encode(sensor_data)) - \
+                len(bson.BSON.encode(compacted))
+
+        return doc_count, reclaimed
+
+    @mongo.reconnecting
+    def drop_points(self, probe_id, before):
+        query = get_before_query(probe_id, before)
+        db_sensor_data = self.get_collection("sensor_data")
+
+        sizes = [len(bson.BSON.encode(sensor_data)) for sensor_data in
+            db_sensor_data.find(query)]
+        if sizes:
+            db_sensor_data.remove(query)
+        return len(sizes), sum(sizes)
+
+    @mongo.reconnecting
+    def append_alerts(self, alerts):
+        """ Alerts are upserted by _id, so a retry doesn't duplicate them
+
+        """
+        db_alerts = self.get_collection("alerts")
+        db_alert_states = self.get_collection("alert_states")
+        for alert in alerts:
+            db_alerts.update({"_id" : alert["_id"]}, {"$setOnInsert" : alert},
+                True)  # True for upsert
+
+            db_alert_states.update({"_id" : "%s/%s/%s" % (alert["probe_id"],
+                alert["sensor_id"], alert["kind"])}, {
+                "$setOnInsert" : {
+                    "probe_id" : alert["probe_id"],
+                    "sensor_id" : alert["sensor_id"],
+                    "kind" : alert["kind"]
+                },
+                "$max" : {"transition" : alert["timestamp"] * 2 +
+                    (1 if alert["state"] == "raised" else 0)}
+            }, True)  # True for upsert
+
+    @mongo.reconnecting
+    def get_alerts(self, probe_id=None, limit=None):
+        query = {} if probe_id is None else {"probe_id" : probe_id}
+        return list(self.get_collection("alerts").find(query).sort(
+            "timestamp", pymongo.DESCENDING).limit(limit or 0))
+
+    @mongo.reconnecting
+    def get_alert_states(self):
+        states = []
+        for alert_state in self.get_collection("alert_states").find():
+            timestamp, raised = divmod(alert_state["transition"], 2)
+            states.append({
+                "probe_id" : alert_state["probe_id"],
+                "sensor_id" : alert_state["sensor_id"],
+                "kind" : alert_state["kind"],
+                "state" : "raised" if raised else "cleared",
+                "timestamp" : timestamp
+            })
+        return states
+
+    @mongo.reconnecting
+    def append_clock_history(self, samples):
+        """ Samples are upserted by _id, so a retry doesn't duplicate them
+
+        """
+        db_clock_history = self.get_collection("clock_history")
+        for sample in samples:
+            db_clock_history.update({"_id" : sample["_id"]},
+                {"$setOnInsert" : sample}, True)  # True for upsert
+
+    @mongo.reconnecting
+    def get_clock_history(self, probe_id, start, end):
+        return list(self.get_collection("clock_history").find({
+            "probe_id" : probe_id,
+            "timestamp" : {"$gte" : start, "$lte" : end}
+        }).sort("timestamp", pymongo.ASCENDING))
+
+
+def get_walk_query(probe_id, start, end, sensor_ids=None):
+    """ Returns the query of the daily documents of the given probe
+        holding readings between the given timestamps
+
+    """
+    query = {
+        "probe_id" : probe_id,
+        "day" : {
+            "$gte" : date_util.get_midnight(datetime.fromtimestamp(start)),
+            "$lte" : datetime.fromtimestamp(end)
+        }}
+    if sensor_ids is not None:
+        query["sensor_id"] = {"$in" : list(sensor_ids)}
+    return query
+
+
+def get_rollup_query(probe_id, start_time, end_time):
+    """ Returns the query of the hourly rollups of the given probe for
+        the hours starting between the given times
+
+    """
+    return {
+        "probe_id" : probe_id,
+        "hour" : {
+            "$gte" : date_util.get_hour(start_time),
+            "$lte" : end_time
+        }}
+
+
+def get_before_query(probe_id, before):
+    """ Returns the query of the daily documents of the given probe
+        before the given day
+
+    """
+    return {"probe_id" : probe_id, "day" : {"$lt" : before}}
+
+
+def compact_sensor_data(sensor_data, resolution):
+    """ Returns the given daily document downsampled into buckets of
+        resolution seconds.  Its day's min, max, sum and count are kept
+        as they are.
+
+    """
+    data = sensor_data["data"]
+    stats = sensor_data.get("stats", {})
+
+    keys = sorted(data, key=int)
+    timestamps = numpy.array([int(key) for key in keys], dtype=numpy.int64)
+    bucket_stats = numpy.array([stats.get(key) or [data[key], data[key],
+        data[key], 1] for key in keys], dtype=numpy.float64).reshape(-1, 4)
+
+    buckets, bucket_stats = series_util.downsample(timestamps, None,
+        resolution, date_util.get_timestamp(sensor_data["day"]),
+        bucket_stats)
+
+    compacted = dict(sensor_data)
+    compacted["resolution"] = resolution
+    compacted["data"] = {}
+    compacted["stats"] = {}
+    for bucket, (min_value, max_value, sum_values, count_values) in zip(
+            buckets.tolist(), bucket_stats.tolist()):
+        compacted["data"][str(bucket)] = sum_values / count_values
+        compacted["stats"][str(bucket)] = [min_value, max_value,
+            sum_values, int(count_values)]
+
+    return compacted
+
+
+def group_sensor_data(probe_id, sensor_data):
+    """ Groups the given sensor data by (day, probe id, sensor id) and
+        returns a list of (metric id, update) tuples, one per daily
+        document, in the order each document was first seen.  Each
+        update merges the $set/$inc/$min/$max of all data points that
+        belong to that document.
+
+    """
+    updates = OrderedDict()
+
+    # Data points generally arrive in time order, so remember the
+    # bounds of the last day seen to avoid recomputing midnight.
+    day = None
+    day_start = day_end = 0
+
+    for sensor_id, timestamp, value in SensorReadings.wrap(sensor_data):
+        if not day_start <= timestamp < day_end:
+            day = date_util.get_midnight(datetime.fromtimestamp(timestamp))
+            day_start = date_util.get_timestamp(day)
+            day_end = date_util.get_timestamp(day + timedelta(days=1))
+
+        metric_id = get_metric_id(day, probe_id, sensor_id)
+        update = updates.get(metric_id)
+        if update is None:
+            update = {
+                "$set" : {
+                    "probe_id" : probe_id,
+                    "sensor_id" : sensor_id,
+                    "day" : day},
+                "$inc" : {
+                    "count_values" : 0,
+                    "sum_values" : 0},
+                "$min" : {
+                    "min_value" : value},
+                "$max" : {
+                    "max_value" : value}
+            }
+            updates[metric_id] = update
+
+        update["$set"]["data.%d" % (timestamp)] = value
+        update["$inc"]["count_values"] += 1
+        update["$inc"]["sum_values"] += value
+        if value < update["$min"]["min_value"]:
+            update["$min"]["min_value"] = value
+        if value > update["$max"]["max_value"]:
+            update["$max"]["max_value"] = value
+
+    return updates.items()
+
+
+def group_rollups(probe_id, sensor_data):
+    """ Groups the given sensor data into hourly and daily rollups.
+        Returns a tuple of two lists of (rollup id, update) tuples, the
+        first for hourly rollups and the second for daily rollups, and a
+        list of (query, update) tuples that set the last value of each
+        hourly rollup if its last_timestamp is that of the given data.
+
+    """
+    hourly_updates = OrderedDict()
+    daily_updates = OrderedDict()
+
+    # Remember the bounds of the last hour seen to avoid recomputing
+    # the hour and day of each data point.
+    hour = day = None
+    hour_start = hour_end = 0
+
+    for sensor_id, timestamp, value in SensorReadings.wrap(sensor_data):
+        if not hour_start <= timestamp < hour_end:
+            hour = date_util.get_hour(datetime.fromtimestamp(timestamp))
+            day = date_util.get_midnight(hour)
+            hour_start = date_util.get_timestamp(hour)
+            hour_end = hour_start + 3600
+
+        update = _get_rollup_update(hourly_updates, "hour", hour,
+            probe_id, sensor_id, value)
+
+        # Track the most recent value, so the current value of a sensor
+        # can be read from its latest hourly rollup
+        if timestamp >= update["$max"].get("last_timestamp", timestamp):
+            update["$max"]["last_timestamp"] = timestamp
+            update["$set"]["last_value"] = value
+
+        _get_rollup_update(daily_updates, "day", day,
+            probe_id, sensor_id, value)
+
+    # The last_timestamp is kept with $max, but the last value can't be,
+    # so it's set by a separate update matching the last_timestamp
+    last_value_updates = [({
+            "_id" : rollup_id,
+            "last_timestamp" : update["$max"]["last_timestamp"]
+        }, {
+            "$set" : {"last_value" : update["$set"].pop("last_value")}
+        }) for rollup_id, update in hourly_updates.items()]
+
+    return hourly_updates.items(), daily_updates.items(), last_value_updates
+
+
+def _get_rollup_update(updates, period_name, period, probe_id, sensor_id,
+        value):
+    """ Gets (creating if needed) the update for the rollup of the
+        given period, and folds the given value into it.
+
+    """
+    rollup_id = get_rollup_id(period, probe_id, sensor_id,
+        period_name == "hour")
+
+    update = updates.get(rollup_id)
+    if update is None:
+        update = {
+            "$set" : {
+                "probe_id" : probe_id,
+                "sensor_id" : sensor_id,
+                period_name : period},
+            "$inc" : {
+                "count_values" : 0,
+                "sum_values" : 0},
+            "$min" : {
+                "min_value" : value},
+            "$max" : {
+                "max_value" : value}
+        }
+        updates[rollup_id] = update
+
+    update["$inc"]["count_values"] += 1
+    update["$inc"]["sum_values"] += value
+    if value < update["$min"]["min_value"]:
+        update["$min"]["min_value"] = value
+    if value > update["$max"]["max_value"]:
+        update["$max"]["max_value"] = value
+
+    return update
+
+
+def _new_rollup(sensor_data, period_name, period):
+    return {
+        "_id" : get_rollup_id(period, sensor_data["probe_id"],
+            sensor_data["sensor_id"], period_name == "hour"),
+        "probe_id" : sensor_data["probe_id"],
+        "sensor_id" : sensor_data["sensor_id"],
+        period_name : period,
+        "min_value" : None,
+        "max_value" : None,
+        "sum_values" : 0,
+        "count_values" : 0
+    }
+
+
+def _fold_value(rollup, value):
+    _fold_stats(rollup, value, value, value, 1)
+
+
+def _fold_stats(rollup, min_value, max_value, sum_values, count_values):
+    if rollup["min_value"] is None or min_value < rollup["min_value"]:
+        rollup["min_value"] = min_value
+    if rollup["max_value"] is None or max_value > rollup["max_value"]:
+        rollup["max_value"] = max_value
+    rollup["sum_values"] += sum_values
+    rollup["count_values"] += count_values
+
+
+def get_metric_id(day, probe_id, instrument_id):
+    """ Returns a string that can be used as the document id for
+        storing metric data.  Metric data is stored at daily
+        granularity, the id is a composite key of the day, probe id
+        and instrument (sensor/actuator) id.
+          ex:  YYYYMMDD-probe_id-instrument_id
+
+    """
+    mm = date_util.pad_month_day_value(day.month)
+    dd = date_util.pad_month_day_value(day.day)
+    return "%s%s%s-%s-%s" % (day.year, mm, dd, probe_id, instrument_id)
+
+
+def get_rollup_id(period, probe_id, sensor_id, hourly):
+    """ Returns a string that can be used as the document id for a
+        rollup.  Like metric ids, it's a composite key of the period,
+        probe id and sensor id.
+          ex:  YYYYMMDDHH-probe_id-sensor_id  (hourly)
+               YYYYMMDD-probe_id-sensor_id    (daily)
+
+    """
+    mm = date_util.pad_month_day_value(period.month)
+    dd = date_util.pad_month_day_value(period.day)
+    hh = date_util.pad_month_day_value(period.hour) if hourly else ""
+    return "%s%s%s%s-%s-%s" % (period.year, mm, dd, hh, probe_id, sensor_id)
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.db.shared_state
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    State shared by the Control Server's worker processes, when served
+    from a pool of them (see serve.py), so a request sees the same state
+    whichever worker it reaches.  It holds...
+
+      * the windows of recently applied sync ids (see service.sync_dedup)
+      * versions of cached entries, bumped when they're invalidated, so
+        one worker's writes invalidate the others' caches (see
+        service.overview_cache)
+      * snapshots of each worker's metrics, summed at /metrics
+      * leases, so a background task such as retention compaction runs
+        in only one worker at a time
+
+    Two backends are provided...
+
+      * memory: in this process, for a single process server (the
+        default)
+      * sqlite: an SQLite database file, shared by the workers on this
+        host.  Writes are short transactions, and it isn't synced to
+        disk, as it's only needed while the server runs.
+
+    Usage: Call get_shared_state() to return the configured backend.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import atexit
+import ConfigParser
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+
+# These values set from config file
+backend = "memory"
+path = "data/shared_state.db"
+in_flight_timeout = 120
+metrics_interval = 10
+
+# Results of begin_sync()
+NEW = "new"
+DUPLICATE = "duplicate"
+IN_FLIGHT = "in_flight"
+
+_shared_state = None
+_lock = threading.Lock()
+_thread = None
+_stopping = threading.Event()
+
+
+class SharedState(object):
+    """ Interface of a shared state backend
+
+    """
+
+    def begin_sync(self, probe_id, sync_id):
+        """ Returns DUPLICATE if the given sync was applied, IN_FLIGHT if
+            it's being applied, otherwise marks it as being applied and
+            returns NEW
+
+        """
+        raise NotImplementedError()
+
+    def end_sync(self, probe_id, sync_id, applied, window):
+        """ Records that a sync begun with begin_sync() was applied (or
+            failed, so a retry of it is applied).  Only the last window
+            applied syncs of each probe are remembered.
+
+        """
+        raise NotImplementedError()
+
+    def get_version(self, key):
+        """ Returns the version of the given key, 0 until bumped
+
+        """
+        raise NotImplementedError()
+
+    def bump_versions(self, keys):
+        """ Increments the version of each of the given keys
+
+        """
+        raise NotImplementedError()
+
+    def put_metrics(self, worker_id, snapshot):
+        """ Stores the given worker's snapshot of its metrics (see
+            metrics.snapshot()), replacing its previous one
+
+        """
+        raise NotImplementedError()
+
+    def get_metrics(self):
+        """ Returns the stored snapshots of every worker's metrics
+
+        """
+        raise NotImplementedError()
+
+    def acquire_lease(self, name, owner, seconds):
+        """ Returns True if the named lease is free, expired or already
+            held by owner, which then holds it for the given seconds
+
+        """
+        raise NotImplementedError()
+
+    def get_stats(self):
+        """ Returns the number of probes with applied syncs remembered
+
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class MemorySharedState(SharedState):
+    """ Shared state held in this process
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.applied = {}  # Probe id to a tuple of (deque, set) of sync ids
+        self.in_flight = set()  # Tuples of (probe id, sync id)
+        self.versions = {}
+        self.metrics = {}
+        self.leases = {}
+
+    def begin_sync(self, probe_id, sync_id):
+        with self.lock:
+            applied = self.applied.get(probe_id)
+            if applied is not None and sync_id in applied[1]:
+                return DUPLICATE
+            if (probe_id, sync_id) in self.in_flight:
+                return IN_FLIGHT
+            self.in_flight.add((probe_id, sync_id))
+            return NEW
+
+    def end_sync(self, probe_id, sync_id, applied, window):
+        with self.lock:
+            self.in_flight.discard((probe_id, sync_id))
+            if not applied:
+                return
+
+            ids = self.applied.get(probe_id)
+            if ids is None:
+                ids = self.applied[probe_id] = (deque(), set())
+
+            ids[0].append(sync_id)
+            ids[1].add(sync_id)
+            while len(ids[0]) > window:
+                ids[1].discard(ids[0].popleft())
+
+    def get_version(self, key):
+        return self.versions.get(key, 0)
+
+    def bump_versions(self, keys):
+        with self.lock:
+            for key in keys:
+                self.versions[key] = self.versions.get(key, 0) + 1
+
+    def put_metrics(self, worker_id, snapshot):
+        with self.lock:
+            self.metrics[worker_id] = snapshot
+
+    def get_metrics(self):
+        with self.lock:
+            return self.metrics.values()
+
+    def acquire_lease(self, name, owner, seconds):
+        now = time.time()
+        with self.lock:
+            lease = self.leases.get(name)
+            if lease is not None and lease[0] != owner and lease[1] > now:
+                return False
+            self.leases[name] = (owner, now + seconds)
+            return True
+
+    def get_stats(self):
+        with self.lock:
+            return {"dedup_probes" : len(self.applied)}
+
+
+class SqliteSharedState(SharedState):
+    """ Shared state in an SQLite database, shared by processes on this
+        host.  Each thread of each process has its own connection.
+
+    """
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS syncs (probe_id TEXT, sync_id TEXT, "
+            "applied INTEGER, seq INTEGER, started REAL, "
+            "PRIMARY KEY (probe_id, sync_id))",
+        "CREATE TABLE IF NOT EXISTS versions (key TEXT PRIMARY KEY, "
+            "version INTEGER)",
+        "CREATE TABLE IF NOT EXISTS metrics (worker_id TEXT PRIMARY KEY, "
+            "snapshot TEXT)",
+        "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, "
+            "owner TEXT, expires REAL)"
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_connection(self):
+        """ Returns the connection of this thread, opening it on first
+            use (or in a forked child process)
+
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30,
+                isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            for statement in self.schema:
+                connection.execute(statement)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """ Runs a block in a transaction that takes the database's write
+            lock up front, so its reads can't be raced by another writer
+
+        """
+        connection = self.get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def begin_sync(self, probe_id, sync_id):
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute("SELECT applied, started FROM syncs "
+                "WHERE probe_id = ? AND sync_id = ?",
+                (probe_id, str(sync_id))).fetchone()
+
+            # A sync that's been in flight too long was abandoned, such
+            # as by a worker that died
+            if row is not None:
+                if row[0]:
+                    return DUPLICATE
+                if row[1] > now - in_flight_timeout:
+                    return IN_FLIGHT
+
+            connection.execute("INSERT OR REPLACE INTO syncs "
+                "VALUES (?, ?, 0, NULL, ?)", (probe_id, str(sync_id), now))
+            return NEW
+
+    def end_sync(self, probe_id, sync_id, applied, window):
+        with self.transaction() as connection:
+            if not applied:
+                connection.execute("DELETE FROM syncs WHERE probe_id = ? "
+                    "AND sync_id = ?", (probe_id, str(sync_id)))
+                return
+
+            seq = connection.execute("SELECT COALESCE(MAX(seq), 0) + 1 "
+                "FROM syncs WHERE probe_id = ?", (probe_id,)).fetchone()[0]
+            connection.execute("UPDATE syncs SET applied = 1, seq = ? "
+                "WHERE probe_id = ? AND sync_id = ?",
+                (seq, probe_id, str(sync_id)))
+            connection.execute("DELETE FROM syncs WHERE probe_id = ? AND "
+                "applied = 1 AND seq <= ?", (probe_id, seq - window))
+
+    def get_version(self, key):
+        row = self.get_connection().execute(
+            "SELECT version FROM versions WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def bump_versions(self, keys):
+        with self.transaction() as connection:
+            for key in keys:
+                connection.execute("INSERT OR IGNORE INTO versions "
+                    "VALUES (?, 0)", (key,))
+                connection.execute("UPDATE versions SET version = "
+                    "version + 1 WHERE key = ?", (key,))
+
+    def put_metrics(self, worker_id, snapshot):
+        with self.transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO metrics VALUES (?, ?)",
+                (worker_id, json.dumps(snapshot)))
+
+    def get_metrics(self):
+        return [json.loads(row[0]) for row in self.get_connection().execute(
+            "SELECT snapshot FROM metrics")]
+
+    def acquire_lease(self, name, owner, seconds):
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute("SELECT owner, expires FROM leases "
+                "WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            connection.execute("INSERT OR REPLACE INTO leases "
+                "VALUES (?, ?, ?)", (name, owner, now + seconds))
+            return True
+
+    def get_stats(self):
+        row = self.get_connection().execute(
+            "SELECT COUNT(DISTINCT probe_id) FROM syncs "
+            "WHERE applied = 1").fetchone()
+        return {"dedup_probes" : row[0]}
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None and self.local.pid == os.getpid():
+            connection.close()
+        self.local.connection = None
+
+
+def init_config():
+    """ Read shared state settings from config file
+
+    """
+    global backend, path, in_flight_timeout, metrics_interval
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    backend = config.get("shared_state", "backend")
+    path = config.get("shared_state", "path")
+    in_flight_timeout = config.getint("shared_state", "in_flight_timeout")
+    metrics_interval = config.getint("shared_state", "metrics_interval")
+
+
+def create_shared_state(name, **kwargs):
+    """ Returns a new shared state backend of the given name, 'memory'
+        or 'sqlite'
+
+    """
+    if name == "memory":
+        return MemorySharedState()
+
+    if name == "sqlite":
+        return SqliteSharedState(kwargs.get("path", path))
+
+    raise ValueError("Unknown shared state backend '%s'" % name)
+
+
+def get_shared_state():
+    """ Returns the configured backend, creating it on first use
+
+    """
+    global _shared_state
+
+    with _lock:
+        if _shared_state is None:
+            _shared_state = create_shared_state(backend)
+        return _shared_state
+
+
+def set_shared_state(shared_state):
+    """ Replaces the backend used by the services, closing the previous
+        one.  Used by tools and test rigs.
+
+    """
+    global _shared_state
+
+    with _lock:
+        if _shared_state is not None and _shared_state is not shared_state:
+            _shared_state.close()
+        _shared_state = shared_state
+
+
+def get_worker_id():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def publish_metrics():
+    """ Stores this process's metrics, for /metrics to sum across the
+        workers
+
+    """
+    get_shared_state().put_metrics(get_worker_id(), metrics.snapshot())
+
+
+def start():
+    """ Starts publishing this process's metrics every metrics_interval
+        seconds
+
+    """
+    global _thread
+
+    if _thread is not None:
+        return
+
+    _stopping.clear()
+    _thread = threading.Thread(target=_publish_loop, name="shared_state")
+    _thread.daemon = True
+    _thread.start()
+
+    atexit.register(stop)
+
+
+def stop():
+    """ Stops publishing metrics, publishing them a last time
+
+    """
+    global _thread
+
+    if _thread is None:
+        return
+
+    _stopping.set()
+    _thread.join()
+    _thread = None
+
+    try:
+        publish_metrics()
+    except sqlite3.Error, e:
+        print "[WARN] Unable to publish metrics: %s" % str(e)
+
+
+def _publish_loop():
+    while not _stopping.wait(metrics_interval):
+        try:
+            publish_metrics()
+        except sqlite3.Error, e:
+            print "[WARN] Unable to publish metrics: %s" % str(e)
+
+
+# Initialize config when loading module
+init_config()
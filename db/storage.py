@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.db.storage
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    The storage interface used by the services, and selection of the
+    configured backend.  A backend persists probe status, appends
+    sensor readings and answers time range and hourly rollup queries.
+    Two backends are provided...
+
+      * mongo: mongoDB, with a document per sensor-day and rollup
+        collections (see db.mongo_storage)
+      * local: an embedded engine storing append-only, memory-mapped
+        column files per sensor-day, so small installs and test rigs
+        don't need a database server (see db.local_storage)
+
+    Usage: Call get_storage() to return the configured backend.  It's
+    created on first use, so importing the services doesn't connect to
+    a database.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import ConfigParser
+import threading
+
+# These values set from config file
+backend = "mongo"
+data_dir = "data"
+
+_storage = None
+_lock = threading.Lock()
+
+
+class StorageUnavailable(Exception):
+    """ Raised when a backend can't currently be reached, such as while
+        the database server restarts.  The operation may succeed if
+        retried later.
+
+    """
+    pass
+
+
+class Storage(object):
+    """ Interface of a storage backend.  Times of probe status and
+        rollups are datetimes, and sensor reading timestamps are epoch
+        seconds.
+
+    """
+
+    def update_probe_status(self, probe_id, contact_time, sync_total=1,
+            restart=False, clock=None):
+        """ Upserts the status of the given probe after sync_total syncs,
+            the latest received at contact_time.  If restart is set, the
+            probe restarted with these syncs.  If clock is given, it
+            replaces the drift estimate of the probe's clock (a dict, see
+            service.clock_drift).
+
+        """
+        raise NotImplementedError()
+
+    def get_probe_ids(self):
+        """ Returns the ids of all probes with a status
+
+        """
+        raise NotImplementedError()
+
+    def get_probe_statuses(self, probe_ids=None):
+        """ Returns the status of the given probes (or of all probes) as
+            a list of dicts...
+
+              {"_id" : "probe_id", "first_contact" : datetime,
+               "last_contact" : datetime, "last_restart" : datetime,
+               "sync_count" : 42, "clock" : {...}}
+
+            The clock is None until a drift estimate is stored.
+
+        """
+        raise NotImplementedError()
+
+    def append_points(self, probe_id, readings):
+        """ Persists the given SensorReadings of a probe, and folds them
+            into its hourly rollups.  A reading at the same timestamp as
+            an existing one of the sensor replaces it.
+
+        """
+        raise NotImplementedError()
+
+    def walk_points(self, probe_id, start, end, sensor_ids=None):
+        """ Walks the sensor readings of the given probe between the
+            given timestamps (inclusive), optionally limited to the
+            given sensors.  Yields tuples of (sensor id, timestamps,
+            values) as NumPy arrays, a chunk per sensor-day in order of
+            day, each sorted by time with unique timestamps.
+
+        """
+        raise NotImplementedError()
+
+    def get_hourly_rollups(self, probe_id, start_time, end_time):
+        """ Returns the hourly rollups of each of the given probe's
+            sensors for the hours starting between the given times, as
+            a dict of sensor id to a list of rollups ordered by hour...
+
+              {"hour" : datetime, "min_value" : 68.0, "max_value" : 72.5,
+               "sum_values" : 1402.5, "count_values" : 20,
+               "last_timestamp" : 1400003599, "last_value" : 70.0}
+
+        """
+        raise NotImplementedError()
+
+    def backfill_rollups(self, probe_id=None, verbose=False):
+        """ Rebuilds any stored rollups from the sensor readings,
+            optionally limited to one probe.  Returns the number of
+            sensor-days read.
+
+        """
+        raise NotImplementedError()
+
+    def compact_points(self, probe_id, before, resolution, limit=None):
+        """ Downsamples the given probe's sensor-days before the given
+            day (a datetime at midnight) that are stored at a finer
+            resolution, into buckets of resolution seconds.  Each
+            bucket keeps the min, max, sum and count of its readings,
+            and is walked as a single reading of its mean at the
+            bucket's start, so the aggregates of each day and hour stay
+            exact.  Up to limit sensor-days are compacted.  Returns a
+            tuple of (sensor-days compacted, bytes reclaimed).
+
+        """
+        raise NotImplementedError()
+
+    def drop_points(self, probe_id, before):
+        """ Deletes the given probe's sensor-days before the given day.
+            Returns a tuple of (sensor-days deleted, bytes reclaimed).
+
+        """
+        raise NotImplementedError()
+
+    def append_alerts(self, alerts):
+        """ Persists the given alert state transitions (see
+            service.alert_service), each a dict...
+
+              {"_id" : "probe_id/tmp0/out_of_range/1400000000/raised",
+               "probe_id" : "probe_id", "sensor_id" : "tmp0",
+               "kind" : "out_of_range", "state" : "raised",
+               "timestamp" : 1400000000, "value" : 98.5,
+               "message" : "..."}
+
+            An alert with the _id of one already stored is ignored.
+
+        """
+        raise NotImplementedError()
+
+    def get_alerts(self, probe_id=None, limit=None):
+        """ Returns the stored alerts of all probes, or the given probe,
+            newest first, up to limit
+
+        """
+        raise NotImplementedError()
+
+    def get_alert_states(self):
+        """ Returns the state of each (probe, sensor, kind) of alert, from
+            the newest of its stored alerts, as a list of dicts...
+
+              {"probe_id" : "probe_id", "sensor_id" : "tmp0",
+               "kind" : "out_of_range", "state" : "raised",
+               "timestamp" : 1400000000}
+
+        """
+        raise NotImplementedError()
+
+    def append_clock_history(self, samples):
+        """ Persists the given samples of probes' clock drift estimates
+            (see service.clock_drift), each a dict...
+
+              {"_id" : "probe_id/1400000000", "probe_id" : "probe_id",
+               "timestamp" : 1400000000, "observed" : 2.5,
+               "offset" : 2.1, "rate" : 0.00002}
+
+            A sample with the _id of one already stored is ignored.
+
+        """
+        raise NotImplementedError()
+
+    def get_clock_history(self, probe_id, start, end):
+        """ Returns the stored clock drift samples of the given probe
+            between the given timestamps (inclusive), oldest first
+
+        """
+        raise NotImplementedError()
+
+    def bootstrap(self):
+        """ Creates anything the backend needs to answer queries
+            efficiently, such as indexes.  Safe to run repeatedly.
+            Returns a list of what was ensured.
+
+        """
+        return []
+
+    def ping(self):
+        """ Checks that the backend can be reached, raising
+            StorageUnavailable if not
+
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+def init_config():
+    """ Read storage settings from config file
+
+    """
+    global backend, data_dir
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    backend = config.get("storage", "backend")
+    data_dir = config.get("storage", "data_dir")
+
+
+def create_storage(name, **kwargs):
+    """ Returns a new storage backend of the given name, 'mongo' or
+        'local'
+
+    """
+    if name == "mongo":
+        from db.mongo_storage import MongoStorage
+        return MongoStorage(**kwargs)
+
+    if name == "local":
+        from db.local_storage import LocalStorage
+        return LocalStorage(kwargs.get("data_dir", data_dir))
+
+    raise ValueError("Unknown storage backend '%s'" % name)
+
+
+def get_storage():
+    """ Returns the configured storage backend, creating it on first use
+
+    """
+    global _storage
+
+    with _lock:
+        if _storage is None:
+            _storage = create_storage(backend)
+        return _storage
+
+
+def bootstrap():
+    """ Bootstraps the configured backend, such as creating its indexes.
+        Logs, rather than raises, if it can't currently be reached.
+
+    """
+    try:
+        for name in get_storage().bootstrap():
+            print " * Ensured %s" % name
+    except StorageUnavailable, e:
+        print "[WARN] Unable to bootstrap storage, run 'manage.py " \
+            "bootstrap' once it's available: %s" % str(e)
+
+
+def set_storage(storage):
+    """ Replaces the storage backend used by the services, closing the
+        previous one.  Used by tools and test rigs.
+
+    """
+    global _storage
+
+    with _lock:
+        if _storage is not None and _storage is not storage:
+            _storage.close()
+        _storage = storage
+
+
+# Initialize config when loading module
+init_config()
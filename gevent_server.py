@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.gevent_server
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Serves the Control Server with gevent, so each connection runs as a
+    greenlet rather than a thread.  Live update streams (/api/live) stay
+    open while the page is, and hundreds of idle ones then cost little
+    more than their sockets...
+
+        $ pip install gevent
+        $ python gevent_server.py --port 5000
+
+    The standard library is patched to cooperate with gevent before the
+    Control Server is imported, so its locks, events and sockets (and
+    the mongoDB driver's) yield to other connections rather than block.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+
+from gevent.pywsgi import WSGIServer
+
+import control_server
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten Control Server, served with gevent")
+    parser.add_argument("--host", default="0.0.0.0",
+            help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=5000,
+            help="Port to listen on")
+    parser.add_argument("-v", "--verbose", action="store_true",
+            help="Make the operation talkative")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    control_server.verbose = args.verbose
+    control_server.init_config()
+
+    print "----------------------------------< autogarten Control Server >----"
+    print " * Serving on http://%s:%d/ with gevent" % (args.host, args.port)
+    server = WSGIServer((args.host, args.port), control_server.app,
+        log=None if not args.verbose else "default")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        control_server.live_updates.close_all()
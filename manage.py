@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.manage
+    ~~~~~~~~~~~~~~~~~
+
+    Command line tasks for maintaining an autogarten Control Server.
+    Run with -h for the list of commands.
+
+        $ python manage.py bootstrap
+        $ python manage.py -v backfill_rollups
+        $ python manage.py export -p probe_id --start 2014-05-01 -o out.csv
+        $ python manage.py -v import_readings backlog.csv -w 4
+        $ python manage.py -v compact
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import sys
+import time
+
+
+def bootstrap(args):
+    """ Creates the indexes of the storage backend
+
+    """
+    from db import storage
+
+    for name in storage.get_storage().bootstrap():
+        print "Ensured %s" % name
+
+
+def backfill_rollups(args):
+    """ Builds the hourly/daily rollups from existing sensor data
+
+    """
+    from service import rollup_service
+
+    start = time.time()
+    doc_count = rollup_service.backfill(args.probe_id, args.verbose)
+    print "Rolled up %d sensor data documents in %0.1fs" % \
+        (doc_count, time.time() - start)
+
+
+def export(args):
+    """ Streams the readings of a probe to a file, or to stdout
+
+    """
+    from service import export_service
+    import date_util
+
+    start = export_service.parse_time(args.start)
+    end = export_service.parse_time(args.end) if args.end \
+        else date_util.get_current_timestamp()
+
+    output = open(args.output, "wb") if args.output else sys.stdout
+    try:
+        for chunk in export_service.export_readings(args.probe_id, start,
+                end, args.sensor_id, args.format):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+
+
+def import_readings(args):
+    """ Bulk imports the readings of a log file
+
+    """
+    from db import storage
+    from service import import_service
+
+    format = args.format
+    if format is None:
+        extension = args.path.rsplit(".", 1)[-1].lower()
+        format = {"csv" : "csv", "ndjson" : "ndjson", "jsonl" : "ndjson"}.get(
+            extension, "binary")
+
+    if args.workers > 1 and storage.backend == "local":
+        print "The local storage backend can only be written by one process"
+        sys.exit(1)
+
+    stats = import_service.import_file(args.path, format, args.workers,
+        args.batch, not args.restart, args.verbose)
+    print "Imported %s" % stats.report()
+
+
+def compact(args):
+    """ Applies the retention policy, compacting and deleting old
+        sensor data
+
+    """
+    from service import retention_service
+
+    if args.tiers:
+        retention_service.tiers = retention_service.parse_tiers(args.tiers)
+
+    stats = retention_service.compact(args.probe_id, args.verbose)
+    print "Retention: %s" % stats.report()
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten Control Server management")
+    parser.add_argument("-v", "--verbose", action="store_true",
+            help="Make the operation talkative")
+    subparsers = parser.add_subparsers(title="commands")
+
+    bootstrap_parser = subparsers.add_parser("bootstrap",
+        help="Create the indexes of the storage backend (safe to rerun)")
+    bootstrap_parser.set_defaults(func=bootstrap)
+
+    backfill = subparsers.add_parser("backfill_rollups",
+        help="Build hourly/daily rollups from existing sensor data")
+    backfill.add_argument("-p", "--probe_id",
+        help="Only backfill rollups for this probe")
+    backfill.set_defaults(func=backfill_rollups)
+
+    export_parser = subparsers.add_parser("export",
+        help="Export the readings of a probe as CSV or newline-delimited JSON")
+    export_parser.add_argument("-p", "--probe_id", required=True,
+        help="Probe to export")
+    export_parser.add_argument("-s", "--sensor_id", action="append",
+        help="Only export this sensor (may be repeated)")
+    export_parser.add_argument("--start", default="0",
+        help="Start time, a timestamp or YYYY-MM-DD[THH:MM:SS] "
+             "(default: all time)")
+    export_parser.add_argument("--end",
+        help="End time, inclusive (default: now)")
+    export_parser.add_argument("-f", "--format", default="csv",
+        choices=["csv", "ndjson"], help="Export format")
+    export_parser.add_argument("-o", "--output",
+        help="File to write to (default: stdout)")
+    export_parser.set_defaults(func=export)
+
+    import_parser = subparsers.add_parser("import_readings",
+        help="Bulk import readings from a CSV, NDJSON or binary log file")
+    import_parser.add_argument("path",
+        help="Log file to import")
+    import_parser.add_argument("-f", "--format",
+        choices=["csv", "ndjson", "binary"],
+        help="Log file format (default: from the file extension)")
+    import_parser.add_argument("-w", "--workers", type=int, default=1,
+        help="Worker processes writing days of readings")
+    import_parser.add_argument("--batch", type=int, default=1000000,
+        help="Readings buffered before writing them")
+    import_parser.add_argument("--restart", action="store_true",
+        help="Import from the start of the file, even if a previous "
+             "import was interrupted")
+    import_parser.set_defaults(func=import_readings)
+
+    compact_parser = subparsers.add_parser("compact",
+        help="Compact and delete old sensor data per the retention policy")
+    compact_parser.add_argument("-p", "--probe_id",
+        help="Only compact the sensor data of this probe")
+    compact_parser.add_argument("--tiers",
+        help="Retention tiers, overriding settings.cfg "
+             "(e.g. raw:30,900:365,3600:forever)")
+    compact_parser.set_defaults(func=compact)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.metrics
+    ~~~~~~~~~~~~~~~~~~
+
+    Lightweight, always-on instrumentation.  Counters and latency
+    histograms are kept in memory and rendered in the plaintext
+    Prometheus exposition format at the Control Server's /metrics
+    endpoint.  Recording a timing costs two clock reads, a bisect and
+    an uncontended lock.  When the Control Server is served by several
+    worker processes, each stores snapshots of its metrics in the shared
+    state (see db.shared_state), and /metrics sums them.
+
+    Usage...
+
+        metrics.inc("syncs_total")
+
+        with metrics.timed("probe_sync_parse"):
+            ...
+
+        @metrics.timed("persist_sensor_data")
+        def persist_sensor_data(...):
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import bisect
+import threading
+import time
+
+from functools import wraps
+
+PREFIX = "autogarten_"
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+    0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+
+
+class Histogram(object):
+    """ Counts observations into fixed buckets, tracking their sum
+
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class timed(object):
+    """ Times a block (as a context manager) or each call of a function
+        (as a decorator) into the named histogram.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        observe(self.name, time.time() - self.start)
+
+    def __call__(self, fn):
+        name = self.name
+
+        @wraps(fn)
+        def timed_fn(*args, **kwargs):
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(name, time.time() - start)
+
+        return timed_fn
+
+
+def inc(name, amount=1):
+    """ Increments the named counter
+
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def observe(name, seconds):
+    """ Records a timing, in seconds, in the named histogram
+
+    """
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+
+def register_gauge(name, fn):
+    """ Registers a function that's called when metrics are rendered.
+        It returns either a number, or a dict of numbers that are
+        rendered as name_<key>.
+
+    """
+    _gauges[name] = fn
+
+
+def get_counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot():
+    """ Returns this process's counters and histograms, as a dict that
+        can be serialized as JSON
+
+    """
+    with _lock:
+        return {
+            "counters" : dict(_counters),
+            "histograms" : dict((name, [list(h.counts), h.sum, h.count])
+                for name, h in _histograms.items())
+        }
+
+
+def render(snapshots=None):
+    """ Returns all metrics in the plaintext Prometheus format.  If
+        snapshots of several processes' metrics are given (see
+        snapshot()), their counters and histograms are summed, otherwise
+        this process's are rendered.  Gauges are always this process's.
+
+    """
+    if snapshots is None:
+        snapshots = [snapshot()]
+
+    counter_totals = {}
+    histogram_totals = {}
+    for metrics_snapshot in snapshots:
+        for name, value in metrics_snapshot["counters"].items():
+            counter_totals[name] = counter_totals.get(name, 0) + value
+        for name, (counts, total, count) in \
+                metrics_snapshot["histograms"].items():
+            totals = histogram_totals.get(name)
+            if totals is None:
+                histogram_totals[name] = [list(counts), total, count]
+            else:
+                totals[0] = [a + b for a, b in zip(totals[0], counts)]
+                totals[1] += total
+                totals[2] += count
+
+    counters = sorted(counter_totals.items())
+    histograms = sorted((name, counts, total, count)
+        for name, (counts, total, count) in histogram_totals.items())
+
+    lines = []
+    for name, value in counters:
+        lines.append("# TYPE %s%s counter" % (PREFIX, name))
+        lines.append("%s%s %s" % (PREFIX, name, value))
+
+    for name, counts, total, count in histograms:
+        metric = "%s%s_seconds" % (PREFIX, name)
+        lines.append("# TYPE %s histogram" % metric)
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + ("+Inf",), counts):
+            cumulative += bucket_count
+            lines.append('%s_bucket{le="%s"} %d' % (metric, bound, cumulative))
+        lines.append("%s_sum %f" % (metric, total))
+        lines.append("%s_count %d" % (metric, count))
+
+    for name, fn in sorted(_gauges.items()):
+        values = fn()
+        if not isinstance(values, dict):
+            values = {None : values}
+        for key, value in sorted(values.items()):
+            metric = PREFIX + name + ("_%s" % key if key else "")
+            lines.append("# TYPE %s gauge" % metric)
+            lines.append("%s %s" % (metric, value))
+
+    return "\n".join(lines) + "\n"
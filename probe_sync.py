@@ -5,9 +5,66 @@
 
     Object that defines a sync request from a probe
 
+    A probe sync request is sent either as JSON (content-type
+    'application/json') or as a compact binary frame (content-type
+    'application/x-autogarten-sync').  All binary values are little
+    endian...
+
+        u32    Frame length (of everything that follows)
+        2s     Magic 'AG'
+        u8     Version (1)
+        u8     Flags, bit 0 set if a sync_id follows the header, bit 1
+               if a round_trip_ms follows it
+        u16    connection_attempts
+        u32    sync_count
+        u32    curr_time
+        u16    sensor_freq
+        u16    sync_freq
+        u32    sync_id (only if flagged)
+        u16    round_trip_ms (only if flagged)
+        u8+s   probe_id (length, then bytes)
+        u8+s   token
+        u8     Number of sensor ids, then each as u8+s.  Readings
+               refer to sensors by their index in this dictionary.
+        u32    Base timestamp
+        u16    Number of readings, then each as...
+                 u8   Sensor index
+                 u16  Seconds since the previous reading (or the base
+                      timestamp for the first reading)
+                 f32  Value
+
+    A probe may send the round_trip_ms of its previous sync, from
+    sending the request to reading the response's curr_time, so the
+    Control Server can allow for the time the request took to arrive
+    when tracking the drift of the probe's clock (see
+    service.clock_drift).
+
     :license: MIT, see LICENSE for more details.
 """
 
+import math
+import struct
+
+import numpy
+
+BINARY_CONTENT_TYPE = "application/x-autogarten-sync"
+BINARY_MAGIC = "AG"
+BINARY_VERSION = 1
+BINARY_FLAG_SYNC_ID = 0x01
+BINARY_FLAG_ROUND_TRIP = 0x02
+
+_frame_length = struct.Struct("<I")
+_frame_header = struct.Struct("<2sBBHIIHH")
+_sync_id = struct.Struct("<I")
+_round_trip = struct.Struct("<H")
+_short_string_length = struct.Struct("<B")
+_readings_header = struct.Struct("<IH")
+_reading_dtype = numpy.dtype([
+    ("sensor", "<u1"),
+    ("delta", "<u2"),
+    ("value", "<f4")])
+
+
 class ProbeSync(object):
     """ Represents a probe sync request
 
@@ -19,4 +76,272 @@ class ProbeSync(object):
 
     def is_valid(self):
         return hasattr(self, "probe_id") and\
-            hasattr(self, "connection_attempts")
\ No newline at end of file
+            hasattr(self, "connection_attempts") and\
+            isinstance(getattr(self, "sync_id", ""), (basestring, int, long))
+
+    @property
+    def readings(self):
+        """ The sensor data of this sync as SensorReadings
+
+        """
+        if not isinstance(getattr(self, "sensor_data", None), SensorReadings):
+            self.sensor_data = SensorReadings.from_dicts(
+                getattr(self, "sensor_data", []))
+        return self.sensor_data
+
+    def validate_readings(self):
+        """ Reads the sensor data of this sync into SensorReadings.
+            Raises ValueError if a reading is malformed, or its value
+            isn't a finite number.
+
+        """
+        readings = self.readings
+        if not numpy.isfinite(readings.values).all():
+            raise ValueError("Sensor values must be finite")
+        return readings
+
+    @classmethod
+    def from_binary(cls, frame):
+        """ Returns a ProbeSync decoded from the given binary frame.
+            Raises ValueError if the frame is malformed.
+
+        """
+        probe_sync, length = decode_binary(frame)
+        if length != len(frame):
+            raise ValueError("Trailing data after binary frame")
+        return probe_sync
+
+
+class SensorReadings(object):
+    """ Sensor readings held as columns rather than a dict per reading:
+        a dictionary of sensor ids, and parallel arrays of each
+        reading's sensor index, timestamp and value.  Iterating yields
+        (sensor id, timestamp, value) tuples.
+
+    """
+
+    def __init__(self, sensor_ids, sensor_indexes, timestamps, values):
+        self.sensor_ids = list(sensor_ids)
+        self.sensor_indexes = numpy.asarray(sensor_indexes, dtype=numpy.int64)
+        self.timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+        self.values = numpy.asarray(values, dtype=numpy.float64)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        sensor_ids = self.sensor_ids
+        for index, timestamp, value in zip(self.sensor_indexes.tolist(),
+                self.timestamps.tolist(), self.values.tolist()):
+            yield sensor_ids[index], timestamp, value
+
+    @classmethod
+    def from_dicts(cls, data_points):
+        """ Returns SensorReadings of the given list of data point dicts,
+            as sent in a JSON probe sync or recorded by a probe.
+            Raises ValueError if a value isn't a finite number.
+
+        """
+        sensor_ids = []
+        sensor_map = {}
+        sensor_indexes = []
+        for data_point in data_points:
+            sensor_id = data_point["id"]
+            if sensor_id not in sensor_map:
+                sensor_map[sensor_id] = len(sensor_ids)
+                sensor_ids.append(sensor_id)
+            sensor_indexes.append(sensor_map[sensor_id])
+
+        values = [data_point["value"] for data_point in data_points]
+        for value in values:
+            if not is_valid_value(value):
+                raise ValueError("Invalid sensor value %r" % (value,))
+
+        return cls(sensor_ids, sensor_indexes,
+            [data_point["timestamp"] for data_point in data_points], values)
+
+    @classmethod
+    def wrap(cls, sensor_data):
+        """ Returns the given sensor data as SensorReadings, converting
+            it if it's a list of data point dicts.
+
+        """
+        if isinstance(sensor_data, SensorReadings):
+            return sensor_data
+        return cls.from_dicts(sensor_data)
+
+    @classmethod
+    def concatenate(cls, readings_list):
+        """ Returns one SensorReadings with all of the given readings
+
+        """
+        sensor_ids = []
+        sensor_map = {}
+        sensor_indexes = []
+        for readings in readings_list:
+            for sensor_id in readings.sensor_ids:
+                if sensor_id not in sensor_map:
+                    sensor_map[sensor_id] = len(sensor_ids)
+                    sensor_ids.append(sensor_id)
+
+            # Remap this set of readings' sensor indexes
+            remap = numpy.array([sensor_map[s] for s in readings.sensor_ids],
+                dtype=numpy.int64)
+            sensor_indexes.append(remap[readings.sensor_indexes]
+                if len(remap) else readings.sensor_indexes)
+
+        if not readings_list:
+            return cls([], [], [], [])
+
+        return cls(sensor_ids, numpy.concatenate(sensor_indexes),
+            numpy.concatenate([r.timestamps for r in readings_list]),
+            numpy.concatenate([r.values for r in readings_list]))
+
+
+def is_valid_value(value):
+    """ Returns whether a sensor value is a finite number (JSON null,
+        strings and booleans aren't)
+
+    """
+    return isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool) and \
+        not (math.isinf(value) or math.isnan(value))
+
+
+def encode_binary(probe_id, token, connection_attempts, sync_count,
+        curr_time, sensor_freq, sync_freq, readings, sync_id=None,
+        round_trip_ms=None):
+    """ Encodes a probe sync as a binary frame.  Readings are given as
+        SensorReadings (or data point dicts) and are encoded in time
+        order.  The sync_id, if given, is a 32 bit unsigned int, and the
+        round_trip_ms is capped at 65535.
+        Raises ValueError if consecutive readings are more than 65535s
+        apart.
+
+    """
+    readings = SensorReadings.wrap(readings)
+    order = numpy.argsort(readings.timestamps, kind="mergesort")
+    timestamps = readings.timestamps[order]
+
+    base = int(timestamps[0]) if len(timestamps) else 0
+    deltas = numpy.diff(timestamps, prepend=base) \
+        if len(timestamps) else timestamps
+    if len(deltas) and deltas.max() > 0xFFFF:
+        raise ValueError("Readings are too far apart for a binary frame")
+
+    packed = numpy.empty(len(timestamps), dtype=_reading_dtype)
+    packed["sensor"] = readings.sensor_indexes[order]
+    packed["delta"] = deltas
+    packed["value"] = readings.values[order]
+
+    parts = [
+        _frame_header.pack(BINARY_MAGIC, BINARY_VERSION,
+            (0 if sync_id is None else BINARY_FLAG_SYNC_ID) |
+            (0 if round_trip_ms is None else BINARY_FLAG_ROUND_TRIP),
+            connection_attempts, sync_count, curr_time, sensor_freq,
+            sync_freq)]
+    if sync_id is not None:
+        parts.append(_sync_id.pack(sync_id))
+    if round_trip_ms is not None:
+        parts.append(_round_trip.pack(min(int(round_trip_ms), 0xFFFF)))
+    parts += [
+        _pack_short_string(probe_id),
+        _pack_short_string(token),
+        _short_string_length.pack(len(readings.sensor_ids))]
+    parts.extend(_pack_short_string(s) for s in readings.sensor_ids)
+    parts.append(_readings_header.pack(base, len(packed)))
+    parts.append(packed.tobytes())
+
+    body = "".join(parts)
+    return _frame_length.pack(len(body)) + body
+
+
+def decode_binary(data, offset=0):
+    """ Decodes the binary frame at the given offset of data.  Returns
+        a tuple of the ProbeSync and the offset just past the frame, so
+        a stream of frames can be read one after another.  Raises
+        ValueError if the frame is malformed.
+
+    """
+    try:
+        view = memoryview(data)
+        length, = _frame_length.unpack_from(view, offset)
+        end = offset + _frame_length.size + length
+        if end > len(view):
+            raise ValueError("Truncated binary frame")
+
+        pos = offset + _frame_length.size
+        (magic, version, flags, connection_attempts, sync_count, curr_time,
+            sensor_freq, sync_freq) = _frame_header.unpack_from(view, pos)
+        pos += _frame_header.size
+
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError("Unsupported binary frame")
+
+        sync_id = None
+        if flags & BINARY_FLAG_SYNC_ID:
+            sync_id, = _sync_id.unpack_from(view, pos)
+            pos += _sync_id.size
+
+        round_trip_ms = None
+        if flags & BINARY_FLAG_ROUND_TRIP:
+            round_trip_ms, = _round_trip.unpack_from(view, pos)
+            pos += _round_trip.size
+
+        probe_id, pos = _unpack_short_string(view, pos)
+        token, pos = _unpack_short_string(view, pos)
+
+        sensor_count, = _short_string_length.unpack_from(view, pos)
+        pos += _short_string_length.size
+        sensor_ids = []
+        for ii in range(sensor_count):
+            sensor_id, pos = _unpack_short_string(view, pos)
+            sensor_ids.append(sensor_id)
+
+        base, count = _readings_header.unpack_from(view, pos)
+        pos += _readings_header.size
+        if pos + count * _reading_dtype.itemsize != end:
+            raise ValueError("Binary frame length mismatch")
+
+    except struct.error, e:
+        raise ValueError("Truncated binary frame: %s" % e)
+
+    packed = numpy.frombuffer(data, dtype=_reading_dtype, count=count,
+        offset=pos)
+    if count and packed["sensor"].max() >= sensor_count:
+        raise ValueError("Reading refers to an unknown sensor")
+
+    timestamps = base + numpy.cumsum(packed["delta"], dtype=numpy.int64)
+
+    request_data = {
+        "probe_id" : probe_id,
+        "token" : token,
+        "connection_attempts" : connection_attempts,
+        "sync_count" : sync_count,
+        "curr_time" : curr_time,
+        "sensor_freq" : sensor_freq,
+        "sync_freq" : sync_freq,
+        "sensor_data" : SensorReadings(sensor_ids, packed["sensor"],
+            timestamps, packed["value"])
+    }
+    if sync_id is not None:
+        request_data["sync_id"] = sync_id
+    if round_trip_ms is not None:
+        request_data["round_trip_ms"] = round_trip_ms
+
+    return ProbeSync(request_data), end
+
+
+def _pack_short_string(value):
+    value = value.encode("utf-8") if isinstance(value, unicode) else value
+    if len(value) > 0xFF:
+        raise ValueError("String too long for a binary frame")
+    return _short_string_length.pack(len(value)) + value
+
+
+def _unpack_short_string(view, pos):
+    length, = _short_string_length.unpack_from(view, pos)
+    pos += _short_string_length.size
+    if pos + length > len(view):
+        raise ValueError("Truncated binary frame")
+    return view[pos:pos + length].tobytes().decode("utf-8"), pos + length
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.series_util
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides NumPy based functions for working with time
+    series of sensor data, held as parallel arrays of timestamps and
+    values.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import numpy
+
+aggregations = ["mean", "min", "max", "last", "count", "sum"]
+
+# Ways of reducing a series to a number of points for display.  'bucket'
+# aggregates equal width buckets, 'minmax' keeps each bucket's min and
+# max as an envelope, and 'lttb' picks visually significant points.
+downsamplers = ["bucket", "minmax", "lttb"]
+
+
+def bucketize(timestamps, values, bucket_count, start, end, agg="mean",
+        fill=numpy.nan, groups=None, group_count=None):
+    """ Maps the given data into bucket_count equal width buckets over
+        the time range [start, end], and aggregates the values in each
+        bucket.  Returns an array of exactly bucket_count values ordered
+        by time, where buckets without any data are set to fill.  Data
+        outside of the time range is ignored.
+
+        To bucketize many series (such as sensors) at once, pass groups,
+        an array giving the series index (0 to group_count - 1) of each
+        data point.  A 2D array of shape (group_count, bucket_count) is
+        then returned.
+
+    """
+    if agg not in aggregations:
+        raise ValueError("Unknown aggregation '%s'" % agg)
+
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    slots = bucket_count * (group_count if groups is not None else 1)
+
+    # Determine the bucket of each data point within the time range.
+    # A data point at exactly the end of the range is in the last bucket.
+    in_range = (timestamps >= start) & (timestamps <= end)
+    if not in_range.all():
+        timestamps = timestamps[in_range]
+        values = values[in_range]
+        if groups is not None:
+            groups = numpy.asarray(groups)[in_range]
+
+    # An empty time range (start == end) has no width, so all of its
+    # data points are at the end, in the last bucket
+    width = (end - start) / float(bucket_count)
+    if width > 0:
+        keys = ((timestamps - start) / width).astype(numpy.int64)
+        numpy.minimum(keys, bucket_count - 1, out=keys)
+    else:
+        keys = numpy.full(len(timestamps), bucket_count - 1, numpy.int64)
+    if groups is not None:
+        keys += numpy.asarray(groups, dtype=numpy.int64) * bucket_count
+
+    counts = numpy.bincount(keys, minlength=slots)
+
+    if agg == "count":
+        result = counts.astype(numpy.float64)
+    elif agg in ["mean", "sum"]:
+        # bincount gives ints rather than floats when there's no data
+        result = numpy.bincount(keys, weights=values, minlength=slots
+            ).astype(numpy.float64, copy=False)
+        if agg == "mean":
+            result /= numpy.maximum(counts, 1)
+    else:
+        result = _reduce_buckets(timestamps, values, keys, slots, agg)
+
+    if agg != "count":
+        result[counts == 0] = fill
+
+    if groups is not None:
+        return result.reshape(group_count, bucket_count)
+    return result
+
+
+def _reduce_buckets(timestamps, values, keys, slots, agg):
+    """ Computes the min, max or last value of each bucket by sorting
+        the data points by bucket (then time) and reducing each run.
+
+    """
+    result = numpy.zeros(slots)
+    if not len(keys):
+        return result
+
+    # Data usually arrives in time order, so sorting can often be skipped
+    ordered = (keys[1:] >= keys[:-1]).all()
+    if agg == "last":
+        ordered = ordered and (timestamps[1:] >= timestamps[:-1]).all()
+    if not ordered:
+        order = numpy.lexsort((timestamps, keys))
+        keys = keys[order]
+        values = values[order]
+
+    starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+    if agg == "min":
+        result[keys[starts]] = numpy.minimum.reduceat(values, starts)
+    elif agg == "max":
+        result[keys[starts]] = numpy.maximum.reduceat(values, starts)
+    else:
+        ends = numpy.r_[starts[1:], len(keys)] - 1
+        result[keys[starts]] = values[ends]
+
+    return result
+
+
+def downsample(timestamps, values, resolution, origin=0, stats=None):
+    """ Downsamples the given data (sorted by time) into buckets of
+        resolution seconds, aligned to the origin timestamp.  Returns a
+        tuple of the start timestamp of each bucket that has data, and
+        an array of shape (buckets, 4) of the min, max, sum and count of
+        each bucket's values.
+
+        Data that was already downsampled can be downsampled further by
+        passing its (n, 4) stats, so the results stay exact.
+
+    """
+    timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+    if stats is None:
+        values = numpy.asarray(values, dtype=numpy.float64)
+        stats = numpy.column_stack([values, values, values,
+            numpy.ones(len(values))])
+
+    if not len(timestamps):
+        return timestamps, numpy.zeros((0, 4))
+
+    keys = (timestamps - origin) // resolution
+    starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+
+    return origin + keys[starts] * resolution, numpy.column_stack([
+        numpy.minimum.reduceat(stats[:, 0], starts),
+        numpy.maximum.reduceat(stats[:, 1], starts),
+        numpy.add.reduceat(stats[:, 2], starts),
+        numpy.add.reduceat(stats[:, 3], starts)])
+
+
+def lttb(timestamps, values, points):
+    """ Downsamples the given data (sorted by time) to at most points
+        data points with Largest-Triangle-Three-Buckets, which keeps the
+        shape of a series (including its spikes) when it's drawn as a
+        line.  Returns a tuple of the timestamps and values of the kept
+        data points, which always include the first and last.
+
+        The data points between the first and last are split into
+        points - 2 buckets of equal count.  From each bucket, the point
+        forming the largest triangle with the point kept from the
+        previous bucket and the average of the next bucket is kept.
+        Each bucket depends on the one before it, so buckets are walked
+        in order, but the triangles within a bucket are computed at once.
+
+    """
+    timestamps = numpy.asarray(timestamps)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    count = len(values)
+
+    if points >= count:
+        return timestamps, values
+    if points < 3:
+        raise ValueError("LTTB needs at least 3 points")
+
+    x = timestamps.astype(numpy.float64)
+    y = values
+
+    # Bucket i holds the data points [edges[i], edges[i + 1])
+    edges = (numpy.arange(points - 1) * (count - 2) / float(points - 2)
+        ).astype(numpy.int64) + 1
+    sizes = numpy.diff(edges)
+    avg_x = numpy.r_[numpy.add.reduceat(x[1:-1], edges[:-1] - 1) / sizes,
+        x[-1]]
+    avg_y = numpy.r_[numpy.add.reduceat(y[1:-1], edges[:-1] - 1) / sizes,
+        y[-1]]
+
+    kept = numpy.empty(points, dtype=numpy.int64)
+    kept[0] = 0
+    kept[-1] = count - 1
+    previous = 0
+
+    for ii in xrange(points - 2):
+        lo, hi = edges[ii], edges[ii + 1]
+        ax, ay = x[previous], y[previous]
+        areas = numpy.abs((ax - avg_x[ii + 1]) * (y[lo:hi] - ay) -
+            (ax - x[lo:hi]) * (avg_y[ii + 1] - ay))
+        previous = lo + areas.argmax()
+        kept[ii + 1] = previous
+
+    return timestamps[kept], values[kept]
+
+
+def to_list(values):
+    """ Returns the given array as a list, with NaN values (empty
+        buckets) replaced by None so they serialize as JSON null.
+
+    """
+    return [None if v != v else v for v in values.tolist()]
+
+
+class BucketAccumulator(object):
+    """ Incrementally bucketizes a series that is read in chunks (such
+        as one daily document at a time), so memory use depends on the
+        bucket count rather than the number of data points.
+
+    """
+
+    def __init__(self, bucket_count, start, end):
+        self.bucket_count = bucket_count
+        self.start = start
+        self.end = end
+        self.counts = numpy.zeros(bucket_count)
+        self.sums = numpy.zeros(bucket_count)
+        self.mins = numpy.full(bucket_count, numpy.inf)
+        self.maxs = numpy.full(bucket_count, -numpy.inf)
+        self.last_times = numpy.full(bucket_count, -numpy.inf)
+        self.lasts = numpy.full(bucket_count, numpy.nan)
+
+    def add(self, timestamps, values):
+        """ Adds a chunk of raw data points
+
+        """
+        self.add_aggregates(timestamps, values, numpy.ones(len(values)),
+            values, values, timestamps, values)
+
+    def add_aggregates(self, timestamps, sums, counts, mins, maxs,
+            last_times, lasts):
+        """ Adds a chunk of already aggregated data, such as rollups.
+            Each aggregate is placed in the bucket of its timestamp.
+
+        """
+        def bucketize_chunk(values, agg, fill):
+            return bucketize(timestamps, values, self.bucket_count,
+                self.start, self.end, agg, fill)
+
+        self.counts += bucketize_chunk(counts, "sum", 0)
+        self.sums += bucketize_chunk(sums, "sum", 0)
+        numpy.minimum(self.mins, bucketize_chunk(mins, "min", numpy.inf),
+            out=self.mins)
+        numpy.maximum(self.maxs, bucketize_chunk(maxs, "max", -numpy.inf),
+            out=self.maxs)
+
+        chunk_last_times = bucketize_chunk(last_times, "max", -numpy.inf)
+        newer = chunk_last_times > self.last_times
+        self.lasts[newer] = bucketize_chunk(lasts, "last", numpy.nan)[newer]
+        self.last_times[newer] = chunk_last_times[newer]
+
+    def get_timestamps(self):
+        """ Returns the start time of each bucket
+
+        """
+        width = (self.end - self.start) / float(self.bucket_count)
+        return self.start + numpy.arange(self.bucket_count) * width
+
+    def get_values(self, agg="mean", fill=numpy.nan):
+        """ Returns the aggregated value of each bucket
+
+        """
+        if agg == "count":
+            return self.counts.copy()
+
+        if agg == "mean":
+            values = self.sums / numpy.maximum(self.counts, 1)
+        elif agg == "sum":
+            values = self.sums.copy()
+        elif agg == "min":
+            values = self.mins.copy()
+        elif agg == "max":
+            values = self.maxs.copy()
+        elif agg == "last":
+            values = self.lasts.copy()
+        else:
+            raise ValueError("Unknown aggregation '%s'" % agg)
+
+        values[self.counts == 0] = fill
+        return values
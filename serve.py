@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.serve
+    ~~~~~~~~~~~~~~~~
+
+    Production entry point of the Control Server.  Rather than Flask's
+    single process debug server, it's served by a pool of worker
+    processes forked by gunicorn, each serving requests on a number of
+    threads...
+
+        $ pip install gunicorn futures
+        $ python serve.py --workers 4 --threads 8
+
+    Defaults are read from the [server] section of settings.cfg.  Each
+    worker imports the app after it's forked, so each has its own DB
+    client and background threads.  State that requests share (applied
+    sync ids, cache versions and metrics) is kept in the shared state
+    (see db.shared_state), which uses 'sqlite' when there's more than
+    one worker, so it's shared by all of them.
+
+    Some state can't be split across processes, so with more than one
+    worker the local storage backend, the write-ahead spool and the hot
+    tier aren't supported.  Actuator rules, alerts and clock drift
+    estimates see only the syncs their own worker receives, so use one
+    worker if they matter.  Live updates are only supported by one
+    'gevent' worker, as a stream would only get the events of its own
+    worker, and would hold one of a 'gthread' worker's threads for as
+    long as its page is open.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import ConfigParser
+import os
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+# These values set from config file
+bind = "0.0.0.0:5000"
+workers = 4
+threads = 8
+worker_class = "gthread"
+timeout = 60
+shared_state_path = "data/shared_state.db"
+
+
+class ControlServerApplication(BaseApplication):
+    """ Serves the Control Server with gunicorn, with the given options
+        (see gunicorn's settings).  setup, if given, is called in each
+        worker before the app is imported.
+
+    """
+
+    def __init__(self, options, verbose=False, setup=None):
+        self.options = options
+        self.verbose = verbose
+        self.setup = setup
+        BaseApplication.__init__(self)
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        if self.setup is not None:
+            self.setup()
+
+        from db import shared_state
+        if self.cfg.workers > 1 and shared_state.backend == "memory":
+            shared_state.backend = "sqlite"
+
+        import control_server
+        control_server.verbose = self.verbose
+        control_server.init_config()
+        return control_server.app
+
+
+def init_config():
+    """ Read server settings from config file
+
+    """
+    global bind, workers, threads, worker_class, timeout, shared_state_path
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    bind = config.get("server", "bind")
+    workers = config.getint("server", "workers")
+    threads = config.getint("server", "threads")
+    worker_class = config.get("server", "worker_class")
+    timeout = config.getint("server", "timeout")
+    shared_state_path = config.get("shared_state", "path")
+
+
+def check_config(worker_count, worker_class="gthread"):
+    """ Returns the settings that can't be used with the given number of
+        workers of the given class, printing warnings for those that may
+        not work as expected
+
+    """
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    errors = []
+    if config.getboolean("live_updates", "enabled"):
+        if worker_class != "gevent":
+            errors.append("Each live update stream would hold one of a "
+                "worker's threads, use worker_class 'gevent' or disable "
+                "live updates")
+        if worker_count > 1:
+            errors.append("Each live update stream would only get the "
+                "syncs written by its own worker, use one worker or "
+                "disable live updates")
+
+    if worker_count <= 1:
+        return errors
+
+    if config.get("storage", "backend") == "local":
+        errors.append("The local storage backend can only be written by "
+            "one process, use 'mongo'")
+    if config.get("ingest", "mode") == "spool":
+        errors.append("The write-ahead spool can only be written by one "
+            "process, use ingest mode 'sync' or 'async'")
+    if config.getboolean("hot_tier", "enabled"):
+        errors.append("Each worker's hot tier would only hold the syncs it "
+            "wrote, disable it")
+
+    for section, name in [("rules", "Actuator rules"), ("alerts", "Alerts"),
+            ("clock_drift", "Clock drift estimates")]:
+        if config.getboolean(section, "enabled"):
+            print "[WARN] %s only see the syncs written by their own " \
+                "worker" % name
+
+    return errors
+
+
+def run(options, verbose=False, setup=None):
+    """ Serves the Control Server with the given gunicorn options, until
+        it's stopped
+
+    """
+    errors = check_config(options["workers"], options["worker_class"])
+    if errors:
+        for error in errors:
+            print "[ERROR] %s" % error
+        sys.exit(1)
+
+    # The shared state is only needed while the server runs
+    if options["workers"] > 1:
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(shared_state_path + suffix):
+                os.remove(shared_state_path + suffix)
+
+    ControlServerApplication(options, verbose, setup).run()
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten Control Server, production server")
+    parser.add_argument("-b", "--bind", default=bind,
+            help="Address and port to listen on")
+    parser.add_argument("-w", "--workers", type=int, default=workers,
+            help="Worker processes")
+    parser.add_argument("-t", "--threads", type=int, default=threads,
+            help="Threads of each worker")
+    parser.add_argument("-k", "--worker_class", default=worker_class,
+            help="'gthread' or 'gevent'")
+    parser.add_argument("--timeout", type=int, default=timeout,
+            help="Restart workers handling a request for this long")
+    parser.add_argument("-v", "--verbose", action="store_true",
+            help="Make the operation talkative")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    init_config()
+    args = parse_args()
+
+    print "----------------------------------< autogarten Control Server >----"
+    run({
+        "bind" : args.bind,
+        "workers" : args.workers,
+        "threads" : args.threads,
+        "worker_class" : args.worker_class,
+        "timeout" : args.timeout
+    }, args.verbose)
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.alert_service
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Streaming alerts on sensor data, checked as readings are persisted
+    (see probe_service.persist_sensor_data).  Three kinds of alert are
+    raised for a sensor...
+
+      * out_of_range: a reading is outside the sensor's range, set by
+        the first of the configured 'pattern:low:high' ranges whose
+        (shell style) pattern matches its id
+      * stuck: stuck_points readings in a row are equal (within
+        stuck_tolerance), such as from a disconnected sensor
+      * drift: the sensor's recent level, an exponentially weighted
+        moving average (EWMA) of its readings, is more than
+        drift_sigmas standard deviations from its long run mean.  The
+        mean and variance are kept with Welford's online algorithm, and
+        drift is only checked after drift_warmup readings.
+
+    Each (probe, sensor) keeps only these running statistics, so every
+    reading is checked in constant time, without querying history.  An
+    alert is written to the alerts collection (see Storage.append_alerts)
+    and passed to the notifier only when it changes state, when raised
+    and when cleared, rather than for every reading while it holds.
+    Drift clears once the EWMA is back within half of drift_sigmas.
+
+    The notifier is 'log' (appends a line per alert to log_file), 'none',
+    or the dotted path of a class (such as 'mymodule.SmsNotifier') whose
+    instances have a notify(alert) method.  Alert states are restored
+    from the newest alert of each (probe, sensor, kind) on first use
+    (see Storage.get_alert_states), retried at most every restore_retry
+    seconds while storage is unavailable, but the statistics restart, so
+    drift is only checked again once warmed up.  Alerts that can't be
+    written are kept, and written with the next readings.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import ConfigParser
+import fnmatch
+import math
+import threading
+import time
+
+from db import storage
+
+import metrics
+
+# These values set from config file
+enabled = True
+ranges = []
+stuck_points = 60
+stuck_tolerance = 0.0
+drift_alpha = 0.05
+drift_sigmas = 3.0
+drift_warmup = 500
+notifier = None
+
+kinds = ["out_of_range", "stuck", "drift"]
+
+restore_retry = 60  # Seconds between attempts to restore alert states
+
+_lock = threading.Lock()
+_restore_lock = threading.Lock()  # Held while restoring, not under _lock
+_states = {}  # (probe id, sensor id) to its SensorState
+_ranges = {}  # Sensor id to its (low, high), from the matching range
+_pending = []  # Alerts not yet written, as storage was unavailable
+_restored = False
+_restore_after = 0  # Time of the next attempt to restore alert states
+_stats = {
+    "points" : 0,
+    "raised" : 0,
+    "cleared" : 0
+}
+
+
+class SensorState(object):
+    """ Running statistics of a sensor's readings, and which of its
+        alerts are raised
+
+    """
+    __slots__ = ["count", "mean", "m2", "ewma", "last_timestamp",
+        "last_value", "same_count", "active"]
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ewma = 0.0
+        self.last_timestamp = None
+        self.last_value = None
+        self.same_count = 0
+        self.active = dict((kind, False) for kind in kinds)
+
+
+class LogNotifier(object):
+    """ Appends a line per alert to a log file
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def notify(self, alert):
+        line = "%s %s %s/%s %s %s\n" % (
+            time.strftime("%Y-%m-%d %H:%M:%S",
+                time.localtime(alert["timestamp"])),
+            alert["state"].upper(), alert["probe_id"], alert["sensor_id"],
+            alert["kind"], alert["message"])
+        with self.lock:
+            with open(self.path, "a") as log_file:
+                log_file.write(line)
+
+
+def init_config():
+    """ Read alert settings from config file
+
+    """
+    global enabled, ranges, stuck_points, stuck_tolerance, drift_alpha, \
+        drift_sigmas, drift_warmup, notifier
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    enabled = config.getboolean("alerts", "enabled")
+    ranges = parse_ranges(config.get("alerts", "ranges"))
+    stuck_points = config.getint("alerts", "stuck_points")
+    stuck_tolerance = config.getfloat("alerts", "stuck_tolerance")
+    drift_alpha = config.getfloat("alerts", "drift_alpha")
+    drift_sigmas = config.getfloat("alerts", "drift_sigmas")
+    drift_warmup = config.getint("alerts", "drift_warmup")
+    notifier = create_notifier(config.get("alerts", "notifier"),
+        config.get("alerts", "log_file"))
+
+
+def parse_ranges(text):
+    """ Parses comma separated 'pattern:low:high' ranges, where either
+        bound may be left empty.  Returns a list of (pattern, low, high)
+        tuples.  Raises ValueError if a range is invalid.
+
+    """
+    parsed = []
+    for sensor_range in text.split(","):
+        if not sensor_range.strip():
+            continue
+        try:
+            pattern, low, high = [part.strip() for part in
+                sensor_range.split(":")]
+            parsed.append((pattern, float(low) if low else None,
+                float(high) if high else None))
+        except ValueError:
+            raise ValueError("Invalid sensor range '%s'" %
+                sensor_range.strip())
+    return parsed
+
+
+def create_notifier(name, log_file=None):
+    """ Returns the notifier of the given name, 'log', 'none' or the
+        dotted path of a notifier class
+
+    """
+    if name == "none":
+        return None
+    if name == "log":
+        return LogNotifier(log_file)
+
+    module_name, class_name = name.rsplit(".", 1)
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)()
+
+
+def set_notifier(new_notifier):
+    """ Replaces the notifier, such as with one of a test rig
+
+    """
+    global notifier
+    notifier = new_notifier
+
+
+def observe(probe_id, readings):
+    """ Checks the given SensorReadings of a probe, which have been
+        persisted, updating each sensor's statistics.  Writes and
+        notifies any alerts that were raised or cleared, and returns
+        them.  Readings no newer than the last checked of a sensor (such
+        as a replayed sync) are skipped.
+
+    """
+    global _pending
+
+    if not enabled or not len(readings):
+        return []
+
+    if not _restored:
+        _restore()
+
+    with _lock:
+        alerts = []
+        for index, sensor_id in enumerate(readings.sensor_ids):
+            in_sensor = readings.sensor_indexes == index
+            timestamps = readings.timestamps[in_sensor]
+            values = readings.values[in_sensor]
+            if len(timestamps) > 1 and (timestamps[1:] < timestamps[:-1]).any():
+                order = timestamps.argsort(kind="mergesort")
+                timestamps, values = timestamps[order], values[order]
+
+            state = _states.get((probe_id, sensor_id))
+            if state is None:
+                state = _states[(probe_id, sensor_id)] = SensorState()
+            _observe_sensor(probe_id, sensor_id, state, timestamps.tolist(),
+                values.tolist(), alerts)
+
+        _stats["points"] += len(readings)
+        for alert in alerts:
+            _stats[alert["state"]] += 1
+        # Each write takes the alerts pending, so none are written twice
+        _pending.extend(alerts)
+        pending, _pending = _pending, []
+
+    for alert in alerts:
+        metrics.inc("alerts_%s_total" % alert["state"])
+        if notifier is not None:
+            try:
+                notifier.notify(alert)
+            except Exception, e:
+                print "[WARN] Unable to notify alert %s: %s" % (
+                    alert["_id"], str(e))
+
+    if pending:
+        _write_pending(pending)
+
+    return alerts
+
+
+def _observe_sensor(probe_id, sensor_id, state, timestamps, values, alerts):
+    """ Updates the state of a sensor with its readings, sorted by time,
+        adding alerts that change state to the given list
+
+    """
+    low, high = _get_range(sensor_id)
+    active = state.active
+
+    # Locals, as this runs for every reading
+    count, mean, m2, ewma = state.count, state.mean, state.m2, state.ewma
+    last_timestamp, last_value = state.last_timestamp, state.last_value
+    same_count = state.same_count
+    alpha, tolerance, sigmas = drift_alpha, stuck_tolerance, drift_sigmas
+
+    for timestamp, value in zip(timestamps, values):
+        if last_timestamp is not None and timestamp <= last_timestamp:
+            continue
+
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        m2 += delta * (value - mean)
+        ewma = value if count == 1 else ewma + alpha * (value - ewma)
+
+        if last_value is not None and abs(value - last_value) <= tolerance:
+            same_count += 1
+        else:
+            same_count = 1
+        last_timestamp, last_value = timestamp, value
+
+        out_of_range = (low is not None and value < low) or \
+            (high is not None and value > high)
+        if out_of_range != active["out_of_range"]:
+            active["out_of_range"] = out_of_range
+            alerts.append(_new_alert(probe_id, sensor_id, "out_of_range",
+                out_of_range, timestamp, value,
+                "%g is outside of %g to %g" % (value,
+                    float("-inf") if low is None else low,
+                    float("inf") if high is None else high)))
+
+        stuck = 0 < stuck_points <= same_count
+        if stuck != active["stuck"]:
+            active["stuck"] = stuck
+            alerts.append(_new_alert(probe_id, sensor_id, "stuck", stuck,
+                timestamp, value, "%d readings in a row of %g" % (
+                    same_count if stuck else stuck_points, value)))
+
+        if count >= drift_warmup:
+            stddev = math.sqrt(m2 / (count - 1))
+            deviation = abs(ewma - mean)
+            drift = deviation > (sigmas / 2 if active["drift"] else sigmas) \
+                * stddev and stddev > 0
+            if drift != active["drift"]:
+                active["drift"] = drift
+                alerts.append(_new_alert(probe_id, sensor_id, "drift", drift,
+                    timestamp, value, "level %g is %0.1f std devs from "
+                    "mean %g" % (ewma, deviation / stddev if stddev else 0,
+                    mean)))
+
+    state.count, state.mean, state.m2, state.ewma = count, mean, m2, ewma
+    state.last_timestamp, state.last_value = last_timestamp, last_value
+    state.same_count = same_count
+
+
+def _new_alert(probe_id, sensor_id, kind, raised, timestamp, value, message):
+    state = "raised" if raised else "cleared"
+    return {
+        "_id" : "%s/%s/%s/%d/%s" % (probe_id, sensor_id, kind, timestamp,
+            state),
+        "probe_id" : probe_id,
+        "sensor_id" : sensor_id,
+        "kind" : kind,
+        "state" : state,
+        "timestamp" : timestamp,
+        "value" : value,
+        "message" : message
+    }
+
+
+def _get_range(sensor_id):
+    sensor_range = _ranges.get(sensor_id)
+    if sensor_range is None:
+        sensor_range = (None, None)
+        for pattern, low, high in ranges:
+            if fnmatch.fnmatchcase(sensor_id, pattern):
+                sensor_range = (low, high)
+                break
+        _ranges[sensor_id] = sensor_range
+    return sensor_range
+
+
+def _restore():
+    """ Restores which alerts are raised from storage, once, so a restart
+        doesn't raise them again.  Storage is read without holding _lock,
+        and while it's unavailable, readings are checked without the
+        restored states.  Sensors checked meanwhile keep their states.
+
+    """
+    global _restored, _restore_after
+
+    with _restore_lock:
+        if _restored or time.time() < _restore_after:
+            return
+
+        try:
+            alert_states = storage.get_storage().get_alert_states()
+        except storage.StorageUnavailable, e:
+            print "[WARN] Unable to restore alert states, will retry in " \
+                "%ds: %s" % (restore_retry, str(e))
+            _restore_after = time.time() + restore_retry
+            return
+
+        restored = {}
+        for alert_state in alert_states:
+            key = (alert_state["probe_id"], alert_state["sensor_id"])
+            state = restored.get(key)
+            if state is None:
+                state = restored[key] = SensorState()
+            state.active[alert_state["kind"]] = \
+                alert_state["state"] == "raised"
+
+        with _lock:
+            for key, state in restored.items():
+                _states.setdefault(key, state)
+            _restored = True
+
+
+def _write_pending(pending):
+    """ Writes alerts that haven't been yet.  Those that can't be, as
+        storage is unavailable, are retried with the next readings.
+
+    """
+    try:
+        storage.get_storage().append_alerts(pending)
+    except storage.StorageUnavailable, e:
+        print "[WARN] Unable to write %d alerts, will retry: %s" % (
+            len(pending), str(e))
+
+        # Ahead of those pending since, to be written in order
+        with _lock:
+            _pending[:0] = pending
+
+
+def get_stats():
+    """ Returns the number of sensors tracked, readings checked, alerts
+        raised and cleared, alerts raised now, and alerts waiting to
+        be written
+
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats["sensors"] = len(_states)
+        stats["active"] = sum(sum(state.active.values())
+            for state in _states.values())
+        stats["pending"] = len(_pending)
+    return stats
+
+
+def reset():
+    """ Forgets all sensor statistics and alert states, such as between
+        benchmark runs
+
+    """
+    global _restored, _restore_after
+
+    with _lock:
+        _states.clear()
+        _ranges.clear()
+        del _pending[:]
+        _restored = False
+        _restore_after = 0
+
+
+# Initialize config when loading module
+init_config()
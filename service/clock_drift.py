@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.clock_drift
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tracks how far each probe's clock is off from the Control Server's,
+    and corrects the timestamps of the probe's readings as they're
+    persisted, so they're stored at the server time they were taken
+    (and in the right daily documents).
+
+    Each sync observes the offset of the probe's clock, as the time the
+    sync was received, less its curr_time (taken as the middle of that
+    second, as it's truncated), less half the round trip of the probe's
+    previous sync (its round_trip_ms, if sent) as the time the request
+    took to arrive.  Observations are smoothed with an
+    alpha-beta filter, which keeps an offset and a rate (how many
+    seconds the offset grows per second of the probe's clock):
+
+      * the offset at the sync is predicted from the start of the
+        interval since the previous sync, and the rate, then moved
+        alpha of the way to the observed offset
+      * the rate is moved by beta of the prediction's error per second
+        of the interval, for intervals of at least min_interval seconds
+        (shorter ones can't resolve it, as curr_time is whole seconds),
+        and is bounded by max_rate
+
+    Probes set their clock to the curr_time of each sync's response (as
+    the Arduino library does), so each interval starts with the clock
+    behind by about the response's one way trip, and the fraction of a
+    second curr_time drops.  If sets_clock is unset, probes are taken
+    to keep their own clock, and an interval starts with the offset of
+    the previous sync.  (The syncs can't tell which, as a probe setting
+    its clock and drifting looks like one keeping a constant offset.)
+    An error of more than max_step seconds is taken as the clock having
+    been stepped (such as set by hand, or unset since a restart), and
+    the offset restarts from the observation.
+
+    A reading is corrected by the offset at its sync, less the drift
+    since it was taken: offset - rate * (curr_time - timestamp), where
+    readings taken before the interval started are corrected as at its
+    start.  Corrections are computed for a batch of readings at once.
+    Those of less than deadband seconds (at least 1) are dropped, as
+    the estimate of a clock that's right is only ever off by a fraction
+    of a second, and the rest are rounded to whole seconds.  So a
+    reading is only moved when its clock is off by more than noise, and
+    retries of a sync land on the same timestamps.
+
+    Each probe's estimate is kept in its probe status, and restored from
+    it on first use.  A sample of it is kept every history_interval
+    seconds in the clock history, which is served as a series.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import ConfigParser
+import threading
+import time
+
+import numpy
+
+from db import storage
+from probe_sync import SensorReadings
+
+import metrics
+import series_util
+
+# These values set from config file
+enabled = True
+sets_clock = True
+alpha = 0.5
+beta = 0.2
+min_interval = 300
+max_rate = 0.005
+max_step = 30
+deadband = 1.0
+history_interval = 300
+
+_lock = threading.Lock()
+_states = {}  # Probe id to its ClockState
+_history_times = {}  # Probe id to the time of its last history sample
+_stats = {
+    "syncs" : 0,
+    "steps" : 0,
+    "corrected" : 0
+}
+
+
+class ClockState(object):
+    """ The drift estimate of a probe's clock, as of its last sync
+
+    """
+    __slots__ = ["offset", "rate", "probe_time", "server_time",
+        "response_time"]
+
+    def __init__(self, clock):
+        self.offset = clock["offset"]
+        self.rate = clock["rate"]
+        self.probe_time = clock["probe_time"]
+        self.server_time = clock["server_time"]
+        self.response_time = clock["response_time"]
+
+
+def init_config():
+    """ Read clock drift settings from config file
+
+    """
+    global enabled, sets_clock, alpha, beta, min_interval, max_rate, \
+        max_step, deadband, history_interval
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    enabled = config.getboolean("clock_drift", "enabled")
+    sets_clock = config.getboolean("clock_drift", "sets_clock")
+    alpha = config.getfloat("clock_drift", "alpha")
+    beta = config.getfloat("clock_drift", "beta")
+    min_interval = config.getint("clock_drift", "min_interval")
+    max_rate = config.getfloat("clock_drift", "max_rate")
+    max_step = config.getfloat("clock_drift", "max_step")
+    deadband = max(config.getfloat("clock_drift", "deadband"), 1.0)
+    history_interval = config.getint("clock_drift", "history_interval")
+
+
+def observe(probe_sync, received=None):
+    """ Updates the drift estimate of the given sync's probe, from the
+        sync's curr_time and when it was received (now by default), and
+        sets it as the sync's clock.  Returns the clock, or None if drift
+        isn't tracked or the probe's time isn't set...
+
+          {"offset" : 2.1, "rate" : 0.00002, "observed" : 2.5,
+           "probe_time" : 1400000000, "server_time" : 1400000002.5,
+           "response_time" : 1400000002, "start_time" : 1399996400}
+
+        start_time is the probe time the sync's interval started at.
+
+    """
+    probe_sync.clock = None
+    curr_time = getattr(probe_sync, "curr_time", 0) or 0
+    if not enabled or curr_time <= 0:
+        return None
+
+    probe_id = probe_sync.probe_id
+    received = received if received is not None else time.time()
+    one_way = (getattr(probe_sync, "round_trip_ms", None) or 0) / 2000.0
+    observed = received - one_way - (curr_time + 0.5)
+
+    if probe_id not in _states:
+        _restore(probe_id)
+
+    with _lock:
+        state = _states.get(probe_id)
+        _stats["syncs"] += 1
+
+        # A restarted probe's clock starts over
+        if state is None or getattr(probe_sync, "sync_count", 0) <= 1:
+            start_time = curr_time
+            offset = observed
+            rate = state.rate if state is not None else 0.0
+
+        else:
+            if sets_clock:
+                start_time = state.response_time
+                start_offset = state.server_time - state.response_time + \
+                    one_way
+            else:
+                start_time = state.probe_time
+                start_offset = state.offset
+
+            elapsed = curr_time - start_time
+            predicted = start_offset + state.rate * elapsed
+            error = observed - predicted
+            rate = state.rate
+
+            if abs(error) > max_step:
+                offset = observed
+                _stats["steps"] += 1
+            else:
+                offset = predicted + alpha * error
+                if elapsed >= min_interval:
+                    rate = min(max(rate + beta * error / elapsed, -max_rate),
+                        max_rate)
+
+        clock = {
+            "offset" : offset,
+            "rate" : rate,
+            "observed" : observed,
+            "probe_time" : curr_time,
+            "server_time" : received,
+            "response_time" : int(received),
+            "start_time" : start_time
+        }
+        _states[probe_id] = ClockState(clock)
+
+    probe_sync.clock = clock
+    return clock
+
+
+def correct(probe_syncs):
+    """ Returns the readings of the given syncs, concatenated, with their
+        timestamps corrected by the clock of their sync (see observe())
+
+    """
+    readings_list = [probe_sync.readings for probe_sync in probe_syncs]
+    readings = readings_list[0] if len(readings_list) == 1 else \
+        SensorReadings.concatenate(readings_list)
+
+    clocks = [getattr(probe_sync, "clock", None) for probe_sync in probe_syncs]
+    if not len(readings) or not any(clocks):
+        return readings
+
+    # The clock of each reading's sync, as columns
+    counts = [len(r) for r in readings_list]
+    def column(key):
+        return numpy.repeat([clock[key] if clock is not None else 0
+            for clock in clocks], counts)
+
+    probe_times = column("probe_time")
+    elapsed = numpy.clip(probe_times - readings.timestamps, 0,
+        numpy.maximum(probe_times - column("start_time"), 0))
+    corrections = column("offset") - column("rate") * elapsed
+    corrections = numpy.where(numpy.abs(corrections) >= deadband,
+        numpy.rint(corrections), 0).astype(numpy.int64)
+
+    corrected = numpy.count_nonzero(corrections)
+    if not corrected:
+        return readings
+
+    with _lock:
+        _stats["corrected"] += corrected
+    metrics.inc("clock_corrected_points_total", corrected)
+    return SensorReadings(readings.sensor_ids, readings.sensor_indexes,
+        readings.timestamps + corrections, readings.values)
+
+
+def record(probe_id, probe_syncs):
+    """ Persists a sample of the clock of the given syncs of a probe to
+        its clock history, if history_interval seconds have passed since
+        the last
+
+    """
+    samples = []
+    with _lock:
+        for probe_sync in probe_syncs:
+            clock = getattr(probe_sync, "clock", None)
+            if clock is None:
+                continue
+
+            timestamp = int(clock["server_time"])
+            last = _history_times.get(probe_id)
+            if last is not None and timestamp - last < history_interval:
+                continue
+
+            _history_times[probe_id] = timestamp
+            samples.append({
+                "_id" : "%s/%d" % (probe_id, timestamp),
+                "probe_id" : probe_id,
+                "timestamp" : timestamp,
+                "observed" : clock["observed"],
+                "offset" : clock["offset"],
+                "rate" : clock["rate"]
+            })
+
+    if samples:
+        storage.get_storage().append_clock_history(samples)
+
+
+@metrics.timed("get_clock_series")
+def get_clock_series(probe_id, start, end, points=None):
+    """ Returns the clock history of a probe between the given timestamps
+        (inclusive) as a JSON serializable dict...
+
+          {"probe_id" : "probe0", "start" : 1400000000,
+           "end" : 1400604800, "timestamps" : [...], "values" : [...],
+           "observed" : [...], "rates" : [...]}
+
+        Values are the smoothed offsets, in seconds, and rates are in
+        seconds per second.  If points is given, the samples are
+        averaged into that many buckets, timed at their start, and
+        buckets without samples are None.
+
+    """
+    samples = storage.get_storage().get_clock_history(probe_id, start, end)
+    timestamps = numpy.array([s["timestamp"] for s in samples],
+        dtype=numpy.float64)
+    columns = numpy.array([[s[key] for s in samples] for key in
+        ["offset", "observed", "rate"]], dtype=numpy.float64)
+
+    # The three columns are bucketized together, as groups
+    if points is not None and len(samples) > points:
+        columns = series_util.bucketize(numpy.tile(timestamps, 3),
+            columns.ravel(), points, start, end,
+            groups=numpy.repeat(numpy.arange(3), len(samples)),
+            group_count=3)
+        timestamps = start + numpy.arange(points) * \
+            ((end - start) / float(points))
+
+    return {
+        "probe_id" : probe_id,
+        "start" : start,
+        "end" : end,
+        "timestamps" : series_util.to_list(timestamps),
+        "values" : series_util.to_list(columns[0]),
+        "observed" : series_util.to_list(columns[1]),
+        "rates" : series_util.to_list(columns[2])
+    }
+
+
+def _restore(probe_id):
+    """ Restores the drift estimate of the given probe from its status
+
+    """
+    try:
+        probes_status = storage.get_storage().get_probe_statuses([probe_id])
+    except storage.StorageUnavailable, e:
+        print "[WARN] Unable to restore the clock of probe '%s': %s" % (
+            probe_id, str(e))
+        return
+
+    clock = probes_status[0].get("clock") if probes_status else None
+    with _lock:
+        if clock is not None and probe_id not in _states:
+            _states[probe_id] = ClockState(clock)
+
+
+def get_stats():
+    """ Returns the number of probes tracked, syncs observed, clock steps
+        and readings corrected
+
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats["probes"] = len(_states)
+    return stats
+
+
+def reset():
+    """ Forgets all drift estimates, such as between benchmark runs
+
+    """
+    with _lock:
+        _states.clear()
+        _history_times.clear()
+
+
+# Initialize config when loading module
+init_config()
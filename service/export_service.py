@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.export_service
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Module that streams raw sensor readings out of storage, as CSV or
+    newline-delimited JSON.  Readings are walked a sensor-day at a time
+    (with a DB cursor for mongoDB) and formatted as they're read, so
+    memory use stays constant whether the time range is a day or five
+    years.  Used by the Control Server's /export endpoint and by...
+
+        $ python manage.py export -p probe_id --start 2014-05-01
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+
+from datetime import datetime
+
+from db import storage
+
+import date_util
+import metrics
+
+# Export formats, and their content types
+formats = {
+    "csv" : "text/csv",
+    "ndjson" : "application/x-ndjson"
+}
+
+time_formats = ["%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S"]
+
+
+def parse_time(text):
+    """ Returns the timestamp of the given time, given as a timestamp or
+        as a local date YYYY-MM-DD, optionally followed by THH:MM[:SS].
+        Raises ValueError if it isn't either.
+
+    """
+    if text.isdigit():
+        return int(text)
+
+    for time_format in time_formats:
+        try:
+            return date_util.get_timestamp(
+                datetime.strptime(text, time_format))
+        except ValueError:
+            pass
+
+    raise ValueError("Invalid time '%s'" % text)
+
+
+def export_readings(probe_id, start, end, sensor_ids=None, format="csv"):
+    """ Generates the readings of the given probe between the given
+        timestamps (inclusive), optionally limited to the given sensors,
+        in the given format.  Yields a chunk of text per sensor-day.
+        Readings are ordered by day, then by sensor, then by time...
+
+          probe_id,sensor_id,timestamp,value
+          probe_1,tmp0,1398981600,68.5
+
+          {"probe_id": "probe_1", "sensor_id": "tmp0", "timestamp": ...}
+
+    """
+    if format not in formats:
+        raise ValueError("Unknown export format '%s'" % format)
+
+    if format == "csv":
+        yield "probe_id,sensor_id,timestamp,value\n"
+
+    for sensor_id, timestamps, values in storage.get_storage().walk_points(
+            probe_id, start, end, sensor_ids):
+
+        # Each row is formatted from a template holding the ids
+        if format == "csv":
+            prefix = "%s,%s," % (_get_csv_field(probe_id),
+                _get_csv_field(sensor_id))
+            template = prefix.replace("%", "%%") + "%d,%r\n"
+        else:
+            prefix = '{"probe_id": %s, "sensor_id": %s, ' % (
+                json.dumps(probe_id), json.dumps(sensor_id))
+            template = prefix.replace("%", "%%") + \
+                '"timestamp": %d, "value": %r}\n'
+
+        chunk = "".join(template % row for row in
+            zip(timestamps.tolist(), values.tolist()))
+        metrics.inc("export_rows_total", len(timestamps))
+        yield chunk.encode("utf-8") if isinstance(chunk, unicode) else chunk
+
+
+def _get_csv_field(value):
+    if any(c in value for c in ',"\r\n'):
+        return '"%s"' % value.replace('"', '""')
+    return value
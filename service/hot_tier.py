@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.hot_tier
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    In-memory hot tier of recent sensor data.  The most recent readings
+    of each (probe, sensor) are kept in a fixed capacity ring buffer, so
+    reads of recent time windows (the overview's last week, short range
+    queries) can be served without going to the DB.
+
+    Buffers are filled as probe syncs are persisted, and warmed from the
+    DB at startup.  Each buffer tracks the time from which it holds all
+    of the sensor's data, so a window that reaches further back than
+    that is read from the DB instead.  Memory is bounded to roughly
+    16 bytes * max_points_per_sensor for each sensor.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import ConfigParser
+import threading
+
+from array import array
+
+import numpy
+
+from probe_sync import SensorReadings
+
+# These values set from config file
+enabled = False
+max_points_per_sensor = 40320
+warm_days = 7
+
+# The hot tier only holds data once it has been started, when the time
+# from which it has all data (of any sensor) is known.
+active = False
+_complete_since = None
+
+_buffers = {}
+_lock = threading.Lock()
+
+
+class RingBuffer(object):
+    """ Fixed capacity buffer of a sensor's most recent readings,
+        stored as compact arrays of timestamps and values.  Once full,
+        each append overwrites the oldest reading.
+
+    """
+
+    def __init__(self, capacity, complete_since):
+        self.capacity = capacity
+        self.timestamps = array('l', [0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        self.size = 0
+        self.head = 0  # Index of the next append
+
+        # All of the sensor's readings from this time on are buffered
+        self.complete_since = complete_since
+
+    def append(self, timestamp, value):
+        if self.size == self.capacity:
+            # Evicting a reading means earlier windows may be incomplete
+            evicted = self.timestamps[self.head]
+            if evicted >= self.complete_since:
+                self.complete_since = evicted + 1
+        else:
+            self.size += 1
+
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+
+    def covers(self, start):
+        return start >= self.complete_since
+
+    def get_window(self, start, end):
+        """ Returns the buffered readings between the given timestamps
+            (inclusive) as NumPy arrays of timestamps and values,
+            ordered by time.
+
+        """
+        timestamps = numpy.frombuffer(self.timestamps, dtype='l')
+        values = numpy.frombuffer(self.values, dtype='d')
+
+        if self.size < self.capacity:
+            timestamps, values = timestamps[:self.size], values[:self.size]
+        else:
+            timestamps = numpy.roll(timestamps, -self.head)
+            values = numpy.roll(values, -self.head)
+
+        in_range = (timestamps >= start) & (timestamps <= end)
+        timestamps, values = timestamps[in_range], values[in_range]
+
+        # Readings are appended in arrival order, which is nearly always
+        # time order.  Only sort if needed.
+        if len(timestamps) and (timestamps[1:] < timestamps[:-1]).any():
+            order = numpy.argsort(timestamps, kind="mergesort")
+            timestamps, values = timestamps[order], values[order]
+
+        return timestamps.astype(numpy.int64), values.copy()
+
+
+def init_config():
+    """ Read hot tier settings from config file
+
+    """
+    global enabled, max_points_per_sensor, warm_days
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    enabled = config.getboolean("hot_tier", "enabled")
+    max_points_per_sensor = config.getint("hot_tier", "max_points_per_sensor")
+    warm_days = config.getint("hot_tier", "warm_days")
+
+
+def start(complete_since):
+    """ Activates the hot tier.  Buffers of sensors first seen after
+        this are complete from the given timestamp on, so it should be
+        the start of the window the hot tier was warmed with.
+
+    """
+    global active, _complete_since
+
+    _complete_since = complete_since
+    active = True
+
+
+def stop():
+    """ Deactivates the hot tier, dropping all buffered readings
+
+    """
+    global active
+
+    with _lock:
+        active = False
+        _buffers.clear()
+
+
+def load(probe_id, sensor_id, timestamps, values):
+    """ Loads a sensor's readings from the DB (in time order) into its
+        buffer, when warming the hot tier.
+
+    """
+    buffer = _get_buffer(probe_id, sensor_id)
+    with _lock:
+        for timestamp, value in zip(timestamps, values):
+            buffer.append(timestamp, value)
+
+
+def append(probe_id, sensor_data):
+    """ Appends the given sensor data from a probe sync
+
+    """
+    if not active:
+        return
+
+    for sensor_id, timestamp, value in SensorReadings.wrap(sensor_data):
+        buffer = _get_buffer(probe_id, sensor_id)
+        with _lock:
+            buffer.append(timestamp, value)
+
+
+def get_probe_windows(probe_id, start, end):
+    """ Returns a list of (sensor id, timestamps, values) tuples with the
+        readings of each of the given probe's sensors between the given
+        timestamps.  Returns None if the hot tier doesn't hold all of
+        the probe's data for that window.
+
+    """
+    if not active or start < _complete_since:
+        return None
+
+    with _lock:
+        buffers = [(key[1], buffer) for key, buffer in _buffers.iteritems()
+            if key[0] == probe_id]
+
+        if not buffers or not all(b.covers(start) for s, b in buffers):
+            return None
+
+        windows = []
+        for sensor_id, buffer in sorted(buffers):
+            timestamps, values = buffer.get_window(start, end)
+            if len(timestamps):
+                windows.append((sensor_id, timestamps, values))
+
+    return windows
+
+
+def get_stats():
+    """ Returns the number of buffered sensors and readings
+
+    """
+    with _lock:
+        return {
+            "sensors" : len(_buffers),
+            "points" : sum(b.size for b in _buffers.values()),
+            "max_points_per_sensor" : max_points_per_sensor
+        }
+
+
+def _get_buffer(probe_id, sensor_id):
+    key = (probe_id, sensor_id)
+    buffer = _buffers.get(key)
+    if buffer is None:
+        with _lock:
+            buffer = _buffers.setdefault(key,
+                RingBuffer(max_points_per_sensor, _complete_since))
+    return buffer
+
+
+# Initialize config when loading module
+init_config()
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.import_service
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Module that bulk imports sensor readings from log files, such as
+    the backlog of a probe that was offline for days, without replaying
+    them through /probe_sync.  Three formats are read...
+
+      * csv: rows of probe_id,sensor_id,timestamp,value (as exported,
+        an optional header row is skipped)
+      * ndjson: a JSON object per line with the same fields (as
+        exported, 'id' is also accepted for the sensor id)
+      * binary: a stream of binary probe sync frames (see probe_sync)
+
+    The file is read in streaming chunks, each validated as a ProbeSync.
+    Readings are buffered by probe and day, and whole days are written
+    at once, so each daily document (and rollup) gets a single update.
+    Days can be written by several worker processes.
+
+    After each batch of days is written, the offset of the file read so
+    far is recorded in a checkpoint file next to it, and an interrupted
+    import resumes from there.  Readings written after the last
+    checkpoint are written again, which leaves the readings unchanged
+    but counts them twice in the rollups, so run backfill_rollups for
+    the probe after resuming.
+
+        $ python manage.py -v import_readings backlog.csv -w 4
+
+    Only readings are imported, not probe status.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import csv
+import json
+import multiprocessing
+import os
+import struct
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+
+import numpy
+
+from db import storage
+from probe_sync import ProbeSync
+from probe_sync import SensorReadings
+from probe_sync import decode_binary
+from probe_sync import is_valid_value
+
+import date_util
+
+formats = ["csv", "ndjson", "binary"]
+
+# Lines parsed per chunk, and bytes read per block
+chunk_lines = 10000
+block_size = 1 << 20
+
+_frame_length = struct.Struct("<I")
+
+
+class ImportStats(object):
+    """ Counts of an import's progress, for its throughput report
+
+    """
+
+    def __init__(self, offset=0):
+        self.start_time = time.time()
+        self.start_offset = offset
+        self.offset = offset
+        self.rows = 0
+        self.invalid_rows = 0
+        self.readings = 0
+        self.days = 0
+
+    def report(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        return "%d readings (%d days, %d invalid rows) in %0.1fs, " \
+            "%0.0f readings/s, %0.2f MB/s" % (self.readings, self.days,
+            self.invalid_rows, elapsed, self.readings / elapsed,
+            (self.offset - self.start_offset) / elapsed / (1 << 20))
+
+
+def import_file(path, format, workers=1, batch_readings=1000000,
+        resume=True, verbose=False):
+    """ Imports the readings of the given log file.  Readings are
+        written once batch_readings are buffered, or at the end of the
+        file.  Returns the ImportStats.
+
+    """
+    if format not in formats:
+        raise ValueError("Unknown import format '%s'" % format)
+
+    checkpoint_path = path + ".checkpoint"
+    offset = _read_checkpoint(checkpoint_path) if resume else 0
+    stats = ImportStats(offset)
+    if verbose and offset:
+        print "  Resuming from offset %d" % offset
+
+    pool = multiprocessing.Pool(workers, _init_worker) \
+        if workers > 1 else None
+    buffered = OrderedDict()  # (probe id, day) to a list of readings
+    buffered_readings = 0
+
+    try:
+        with open(path, "rb") as input_file:
+            input_file.seek(offset)
+            for probe_syncs, offset in _read_chunks(input_file, format,
+                    stats):
+                for probe_sync in probe_syncs:
+                    readings = probe_sync.readings
+                    for day, day_readings in _split_days(readings):
+                        buffered.setdefault((probe_sync.probe_id, day),
+                            []).append(day_readings)
+                    buffered_readings += len(readings)
+
+                if buffered_readings >= batch_readings:
+                    _write_days(buffered, pool, stats)
+                    _write_checkpoint(checkpoint_path, offset)
+                    buffered, buffered_readings = OrderedDict(), 0
+                    stats.offset = offset
+                    if verbose:
+                        print "  %s" % stats.report()
+
+            _write_days(buffered, pool, stats)
+            stats.offset = offset
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # The whole file was imported
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return stats
+
+
+def _read_chunks(input_file, format, stats):
+    """ Reads the given file from its current position.  Yields tuples
+        of (list of ProbeSyncs, offset of the file read so far).
+
+    """
+    if format == "binary":
+        for chunk in _read_binary_chunks(input_file, stats):
+            yield chunk
+        return
+
+    rows = []
+    for line, offset in _read_lines(input_file):
+        rows.append(line)
+        if len(rows) >= chunk_lines:
+            yield _parse_rows(rows, format, stats), offset
+            rows = []
+
+    if rows:
+        yield _parse_rows(rows, format, stats), input_file.tell()
+
+
+def _read_lines(input_file):
+    """ Yields each line of the file from its current position, with
+        the offset just past it
+
+    """
+    offset = input_file.tell()
+    rest = ""
+    while True:
+        block = input_file.read(block_size)
+        if not block:
+            if rest:
+                yield rest, offset + len(rest)
+            return
+
+        lines = (rest + block).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            offset += len(line) + 1
+            yield line, offset
+
+
+def _parse_rows(lines, format, stats):
+    """ Returns a ProbeSync per probe of the given rows.  Rows that
+        can't be read are counted as invalid and skipped.
+
+    """
+    sensor_data = OrderedDict()  # probe id to data point dicts
+
+    if format == "csv":
+        rows = csv.reader(lines)
+    else:
+        rows = (_parse_json_row(line) for line in lines)
+
+    for row in rows:
+        if not row or row[0] == "probe_id":
+            continue  # Blank line or header
+
+        stats.rows += 1
+        try:
+            probe_id, sensor_id, timestamp, value = row
+            if not probe_id or not sensor_id:
+                raise ValueError("Missing id")
+            data_point = {
+                "id" : _decode(sensor_id),
+                "timestamp" : int(timestamp),
+                "value" : float(value)
+            }
+            if not is_valid_value(data_point["value"]):
+                raise ValueError("Invalid value")
+            probe_id = _decode(probe_id)
+        except (TypeError, ValueError):
+            stats.invalid_rows += 1
+            continue
+
+        sensor_data.setdefault(probe_id, []).append(data_point)
+
+    return _validate([ProbeSync({
+        "probe_id" : probe_id,
+        "connection_attempts" : 0,
+        "sensor_data" : data_points
+    }) for probe_id, data_points in sensor_data.items()], stats)
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, str) else value
+
+
+def _parse_json_row(line):
+    if not line.strip():
+        return None
+    try:
+        row = json.loads(line)
+        return (row.get("probe_id"), row.get("sensor_id", row.get("id")),
+            row.get("timestamp"), row.get("value"))
+    except (AttributeError, ValueError):
+        return (None,)  # Counted as invalid
+
+
+def _read_binary_chunks(input_file, stats):
+    """ Reads binary frames in blocks, yielding the frames that are
+        complete in each block
+
+    """
+    offset = input_file.tell()
+    data = ""
+    while True:
+        block = input_file.read(block_size)
+        data += block
+
+        probe_syncs = []
+        pos = 0
+        while True:
+            try:
+                probe_sync, end = decode_binary(data, pos)
+            except ValueError:
+                # The frame is either incomplete, so the rest is in the
+                # next block, or malformed
+                if len(data) - pos >= _frame_length.size and \
+                        pos + _frame_length.size + _frame_length.unpack_from(
+                        data, pos)[0] <= len(data):
+                    raise ValueError("Malformed binary frame at offset %d"
+                        % (offset + pos))
+                break
+            probe_syncs.append(probe_sync)
+            stats.rows += len(probe_sync.readings)
+            pos = end
+
+        data = data[pos:]
+        offset += pos
+        yield _validate(probe_syncs, stats), offset
+
+        if not block:
+            if data:
+                raise ValueError("Truncated binary frame at offset %d" %
+                    offset)
+            return
+
+
+def _validate(probe_syncs, stats):
+    """ Returns the given ProbeSyncs, skipping any that aren't valid
+
+    """
+    valid = []
+    for probe_sync in probe_syncs:
+        if probe_sync.is_valid():
+            valid.append(probe_sync)
+        else:
+            stats.invalid_rows += len(probe_sync.readings)
+    return valid
+
+
+def _split_days(readings):
+    """ Yields a tuple of (midnight timestamp, SensorReadings) for each
+        day of the given readings
+
+    """
+    if not len(readings):
+        return
+
+    # Bounds of every day between the first and last reading
+    day = date_util.get_midnight(datetime.fromtimestamp(
+        readings.timestamps.min()))
+    last_day = date_util.get_midnight(datetime.fromtimestamp(
+        readings.timestamps.max()))
+    bounds = []
+    while day <= last_day:
+        bounds.append(date_util.get_timestamp(day))
+        day += timedelta(days=1)
+
+    day_indexes = numpy.searchsorted(bounds, readings.timestamps, "right") - 1
+    for day_index in numpy.unique(day_indexes).tolist():
+        in_day = day_indexes == day_index
+        yield bounds[day_index], SensorReadings(readings.sensor_ids,
+            readings.sensor_indexes[in_day], readings.timestamps[in_day],
+            readings.values[in_day])
+
+
+def _write_days(buffered, pool, stats):
+    """ Writes each buffered day, with the pool of worker processes if
+        given
+
+    """
+    days = [(probe_id, SensorReadings.concatenate(day_readings))
+        for (probe_id, day), day_readings in buffered.items()]
+
+    if pool is not None:
+        counts = pool.map(_write_day, days, chunksize=1)
+    else:
+        counts = [_write_day(day) for day in days]
+
+    stats.readings += sum(counts)
+    stats.days += len(days)
+
+
+def _write_day(day):
+    probe_id, readings = day
+    storage.get_storage().append_points(probe_id, readings)
+    return len(readings)
+
+
+def _init_worker():
+    # Each worker connects to the DB itself, rather than sharing the
+    # connection of the parent process
+    storage.set_storage(None)
+
+
+def _read_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return 0
+    with open(checkpoint_path) as checkpoint_file:
+        return json.load(checkpoint_file)["offset"]
+
+
+def _write_checkpoint(checkpoint_path, offset):
+    with open(checkpoint_path + ".tmp", "w") as checkpoint_file:
+        json.dump({"offset" : offset}, checkpoint_file)
+    os.rename(checkpoint_path + ".tmp", checkpoint_path)
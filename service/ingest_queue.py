@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.ingest_queue
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Module that decouples accepting probe syncs from writing them to
+    the DB.  When the ingest mode is 'async', validated probe syncs are
+    put onto a bounded in-process queue and acknowledged right away.
+    A pool of writer threads drains the queue, coalescing whatever
+    syncs are waiting into a single batch write.
+
+    If the queue is full, submit() returns False so the caller can
+    reject the sync (HTTP 503) and the probe can retry later.  Syncs
+    with a sync_id are recorded as applied (see sync_dedup) once their
+    batch has been written, or as failed if it's dropped, so a retry of
+    a sync that was lost is written again.
+
+    While the DB is unavailable, a writer thread keeps retrying its
+    batch with backoff rather than dropping it.  Only the writes that
+    didn't succeed are retried, so the counts of the probes written
+    before the failure aren't incremented twice.  The queue then fills
+    up and further syncs are rejected, so probes hold on to their data
+    until the DB is back.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import atexit
+import ConfigParser
+import Queue
+import threading
+import traceback
+
+from datetime import datetime
+
+from db import storage
+from service import probe_service
+from service import sync_dedup
+
+# These values set from config file
+async_mode = False
+queue_size = 1000
+worker_count = 2
+batch_size = 50
+
+# Seconds between retries of a batch while the DB is unavailable
+retry_backoff = 0.5
+retry_backoff_max = 30.0
+
+_queue = None
+_workers = []
+_stopping = threading.Event()
+_stats_lock = threading.Lock()
+_stats = {
+    "enqueued" : 0,
+    "rejected" : 0,
+    "processed" : 0,
+    "batches" : 0,
+    "errors" : 0,
+    "retries" : 0,
+    "max_depth" : 0
+}
+
+# Put on the queue to tell a writer thread to exit
+_STOP = object()
+
+
+def init_config():
+    """ Read ingest settings from config file
+
+    """
+    global async_mode, queue_size, worker_count, batch_size
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    async_mode = config.get("ingest", "mode") == "async"
+    queue_size = config.getint("ingest", "queue_size")
+    worker_count = config.getint("ingest", "worker_count")
+    batch_size = config.getint("ingest", "batch_size")
+
+
+def start():
+    """ Creates the ingest queue and starts the writer threads.  The
+        queue is flushed when the process exits.
+
+    """
+    global _queue
+
+    if _queue is not None:
+        return
+
+    _queue = Queue.Queue(queue_size)
+    for ii in range(worker_count):
+        worker = threading.Thread(target=_drain_queue,
+            name="ingest-writer-%d" % ii)
+        worker.daemon = True
+        worker.start()
+        _workers.append(worker)
+
+    atexit.register(flush)
+
+
+def submit(probe_sync):
+    """ Puts the given probe sync on the ingest queue.  Returns False,
+        without blocking, if the queue is full.
+
+    """
+    probe_sync.received = datetime.now()
+
+    try:
+        _queue.put_nowait(probe_sync)
+    except Queue.Full:
+        _inc_stat("rejected")
+        return False
+
+    with _stats_lock:
+        _stats["enqueued"] += 1
+        _stats["max_depth"] = max(_stats["max_depth"], _queue.qsize())
+
+    return True
+
+
+def flush():
+    """ Blocks until every queued probe sync has been written, then
+        stops the writer threads.
+
+    """
+    global _queue
+
+    if _queue is None:
+        return
+
+    print " * Flushing ingest queue (%d pending)" % _queue.qsize()
+    _stopping.set()
+    _queue.join()
+
+    for worker in _workers:
+        _queue.put(_STOP)
+    for worker in _workers:
+        worker.join()
+
+    del _workers[:]
+    _queue = None
+    _stopping.clear()
+
+
+def get_stats():
+    """ Returns counters and the current depth of the ingest queue
+
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+
+    stats["depth"] = _queue.qsize() if _queue else 0
+    stats["capacity"] = queue_size
+    stats["workers"] = len(_workers)
+    return stats
+
+
+def _drain_queue():
+    """ Writer thread loop.  Waits for a probe sync, then takes up to
+        batch_size - 1 more that are already waiting and writes them
+        all as one batch.
+
+    """
+    while True:
+        batch = [_queue.get()]
+        while len(batch) < batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(_queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        stop = batch[-1] is _STOP
+        probe_syncs = batch[:-1] if stop else batch
+
+        if probe_syncs:
+            _write_batch(probe_syncs)
+
+        for ii in range(len(batch)):
+            _queue.task_done()
+
+        if stop:
+            return
+
+
+def _write_batch(probe_syncs):
+    backoff = retry_backoff
+    written = {}  # Probe id to its last write that succeeded
+    try:
+        while True:
+            try:
+                probe_service.process_probe_sync_batch(probe_syncs, written)
+                break
+            except storage.StorageUnavailable, e:
+                # Keep the batch until the DB is back, unless shutting
+                # down
+                if _stopping.is_set():
+                    raise
+
+                print "[WARN] DB unavailable, retrying %d queued probe " \
+                    "syncs in %0.1fs: %s" % (len(probe_syncs), backoff, str(e))
+                _inc_stat("retries")
+                _stopping.wait(backoff)
+                backoff = min(backoff * 2, retry_backoff_max)
+
+        with _stats_lock:
+            _stats["processed"] += len(probe_syncs)
+            _stats["batches"] += 1
+
+    except Exception, e:
+        # Syncs have already been acknowledged, so the data in this
+        # batch is lost, unless the probes retry them.  Log it and keep
+        # draining.
+        print "[ERROR] Failed to write %d queued probe syncs: %s" %\
+            (len(probe_syncs), str(e))
+        traceback.print_exc()
+        _inc_stat("errors")
+
+    _end_syncs(probe_syncs, written)
+
+
+def _end_syncs(probe_syncs, written):
+    """ Records the given syncs that have a sync_id as applied if their
+        probe's sensor data was written, otherwise as failed (see
+        sync_dedup.end())
+
+    """
+    for probe_sync in probe_syncs:
+        sync_id = getattr(probe_sync, "sync_id", None)
+        if sync_id is None:
+            continue
+
+        applied = written.get(probe_sync.probe_id) == "sensor_data"
+        try:
+            sync_dedup.end(probe_sync.probe_id, sync_id, applied)
+        except Exception, e:
+            print "[WARN] Unable to end sync %s of probe '%s': %s" % (
+                sync_id, probe_sync.probe_id, str(e))
+
+
+def _inc_stat(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+# Initialize config when loading module
+init_config()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.live_updates
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    In-process publish/subscribe of new sensor readings and probe status
+    changes, streamed to browsers as Server-Sent Events (see /api/live
+    in control_server).  Two kinds of event are published, as syncs are
+    written...
+
+        event: points
+        data: {"probe_id" : "probe0", "sensors" : {"tmp0" :
+               {"timestamps" : [...], "values" : [...]}}}
+
+        event: status
+        data: {"probe_id" : "probe0", "last_contact" : 1400000000,
+               "syncs" : 1, "restart" : false}
+
+    An event is serialized once, and the same message is queued to every
+    subscriber.  Each subscriber is a bounded queue and an Event, so an
+    idle stream holds no resources other than its connection.  Serving
+    hundreds of idle streams without a thread each needs a server that
+    runs each connection as a greenlet (see gevent_server.py).  A
+    subscriber that falls queue_size messages behind is disconnected,
+    and its browser reconnects and catches up with the series API.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import ConfigParser
+import json
+import threading
+
+from collections import deque
+
+import date_util
+import metrics
+
+# These values set from config file
+enabled = True
+queue_size = 1000
+max_subscribers = 1000
+keepalive = 15
+retry_ms = 5000
+
+_lock = threading.Lock()
+_subscribers = set()
+_stats = {
+    "published" : 0,
+    "overflowed" : 0
+}
+
+
+class Subscriber(object):
+    """ A connected stream's queue of messages waiting to be sent
+
+    """
+
+    def __init__(self):
+        self.messages = deque()
+        self.ready = threading.Event()
+        self.overflowed = False
+        self.closed = False
+
+    def put(self, message):
+        if len(self.messages) >= queue_size:
+            self.overflowed = True
+        else:
+            self.messages.append(message)
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+
+def init_config():
+    """ Read live update settings from config file
+
+    """
+    global enabled, queue_size, max_subscribers, keepalive, retry_ms
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    enabled = config.getboolean("live_updates", "enabled")
+    queue_size = config.getint("live_updates", "queue_size")
+    max_subscribers = config.getint("live_updates", "max_subscribers")
+    keepalive = config.getint("live_updates", "keepalive")
+    retry_ms = config.getint("live_updates", "retry_ms")
+
+
+def subscribe():
+    """ Returns a new Subscriber to published events, or None if there
+        are already max_subscribers
+
+    """
+    with _lock:
+        if len(_subscribers) >= max_subscribers:
+            return None
+        subscriber = Subscriber()
+        _subscribers.add(subscriber)
+    return subscriber
+
+
+def unsubscribe(subscriber):
+    with _lock:
+        _subscribers.discard(subscriber)
+
+
+def stream(subscriber):
+    """ Generates the Server-Sent Events of the given subscriber, as
+        they're published, with a comment every keepalive seconds while
+        idle (which also finds streams whose browser has gone).  Ends
+        if the subscriber falls behind or is closed.
+
+    """
+    try:
+        yield "retry: %d\n\n" % retry_ms
+        while True:
+            subscriber.ready.wait(keepalive)
+            subscriber.ready.clear()
+            if subscriber.overflowed or subscriber.closed:
+                if subscriber.overflowed:
+                    with _lock:
+                        _stats["overflowed"] += 1
+                break
+
+            messages = subscriber.messages
+            chunk = []
+            while messages:
+                chunk.append(messages.popleft())
+            yield "".join(chunk) if chunk else ": keepalive\n\n"
+    finally:
+        unsubscribe(subscriber)
+
+
+def publish(event, data):
+    """ Queues the given event, of data serialized as JSON, to every
+        subscriber.  Returns the number of subscribers.
+
+    """
+    with _lock:
+        subscribers = list(_subscribers)
+        _stats["published"] += 1
+    if not subscribers:
+        return 0
+
+    message = "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+    for subscriber in subscribers:
+        subscriber.put(message)
+    return len(subscribers)
+
+
+def publish_points(probe_id, readings):
+    """ Publishes the given SensorReadings of a probe, which have been
+        written, grouped by sensor
+
+    """
+    if not _subscribers or not len(readings):
+        return
+
+    sensors = {}
+    for index, sensor_id in enumerate(readings.sensor_ids):
+        in_sensor = readings.sensor_indexes == index
+        if in_sensor.any():
+            sensors[sensor_id] = {
+                "timestamps" : readings.timestamps[in_sensor].tolist(),
+                "values" : readings.values[in_sensor].tolist()
+            }
+
+    publish("points", {"probe_id" : probe_id, "sensors" : sensors})
+    metrics.inc("live_points_published_total", len(readings))
+
+
+def publish_status(probe_id, contact_time, sync_total=1, restart=False):
+    """ Publishes that a probe synced sync_total times, last at the
+        given contact time
+
+    """
+    if not _subscribers:
+        return
+
+    publish("status", {
+        "probe_id" : probe_id,
+        "last_contact" : date_util.get_timestamp(contact_time),
+        "syncs" : sync_total,
+        "restart" : restart
+    })
+
+
+def close_all():
+    """ Ends every subscriber's stream, such as when shutting down
+
+    """
+    with _lock:
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        subscriber.close()
+
+
+def get_stats():
+    """ Returns the number of subscribers, events published, and streams
+        ended for falling behind
+
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats["subscribers"] = len(_subscribers)
+    return stats
+
+
+# Initialize config when loading module
+init_config()
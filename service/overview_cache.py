@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.overview_cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Cache of the computed probe overview, kept per probe, and of the
+    rendered overview page.  A probe's entry is only invalidated when a
+    sync writes new data for that probe, so auto-refreshing browsers
+    don't cause DB load while nothing changes.  Entries older than the
+    configured TTL are recomputed regardless, since the overview's week
+    slides forward and its dates are relative to now.
+
+    The rendered page carries an ETag (a hash of its HTML), so browsers
+    revalidating an unchanged page get a 304.
+
+    Entries are cached in each worker process, with the version of what
+    they cache in the shared state (see db.shared_state).  Invalidating
+    an entry bumps its version, so a sync written by one worker
+    invalidates the entry in every worker.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import ConfigParser
+import hashlib
+import threading
+import time
+
+from db import shared_state
+
+import metrics
+
+# These values set from config file
+enabled = True
+ttl = 300
+
+_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_generation = 0
+_probe_ids = None
+_probe_ids_time = 0
+_probes = {}
+_page = None
+_known_probe_ids = set()  # Probes whose syncs this process has written
+_stats = {
+    "hits" : 0,
+    "misses" : 0,
+    "invalidations" : 0
+}
+
+
+def init_config():
+    """ Read overview cache settings from config file
+
+    """
+    global enabled, ttl
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    enabled = config.getboolean("overview_cache", "enabled")
+    ttl = config.getint("overview_cache", "ttl")
+
+
+def get_generation():
+    """ Returns the current cache generation, which changes whenever
+        an entry is invalidated.  Read it before computing an entry, and
+        pass it when setting the entry, so that an entry computed from
+        data that changed in the meantime isn't cached.
+
+    """
+    return (_generation, _get_version("overview"))
+
+
+def get_probe_ids():
+    """ Returns the cached list of probe ids, or None
+
+    """
+    version = _get_version("overview/probes")
+    with _lock:
+        if _probe_ids is not None and not _expired(_probe_ids_time) and \
+                _probe_ids[0] == version:
+            return list(_probe_ids[1])
+    return None
+
+
+def set_probe_ids(probe_ids, generation):
+    global _probe_ids, _probe_ids_time
+
+    if not enabled or generation != get_generation():
+        return
+
+    version = _get_version("overview/probes")
+    with _lock:
+        if generation[0] != _generation:
+            return
+        _probe_ids = (version, list(probe_ids))
+        _probe_ids_time = time.time()
+
+
+def get_probe(probe_id):
+    """ Returns the cached overview of the given probe, or None
+
+    """
+    version = _get_version("overview/" + probe_id)
+    with _lock:
+        entry = _probes.get(probe_id)
+        if entry is not None and not _expired(entry[0]) and \
+                entry[2] == version:
+            _count("hits")
+            return entry[1]
+
+    _count("misses")
+    return None
+
+
+def set_probe(probe_id, probe_overview, generation):
+    if not enabled or generation != get_generation():
+        return
+
+    version = _get_version("overview/" + probe_id)
+    with _lock:
+        if generation[0] != _generation:
+            return
+        _probes[probe_id] = (time.time(), probe_overview, version)
+
+
+def get_page():
+    """ Returns the cached (ETag, HTML) of the overview page, or None
+
+    """
+    version = _get_version("overview")
+    with _lock:
+        if _page is not None and not _expired(_page[0]) and \
+                _page[3] == version:
+            _count("hits")
+            return _page[1], _page[2]
+
+    _count("misses")
+    return None
+
+
+def set_page(html, generation):
+    """ Caches the rendered overview page, returning its ETag
+
+    """
+    global _page
+
+    etag = hashlib.md5(html.encode("utf-8")).hexdigest()
+    if enabled and generation == get_generation():
+        with _lock:
+            if generation[0] == _generation:
+                _page = (time.time(), etag, html, generation[1])
+
+    return etag
+
+
+def invalidate(probe_id):
+    """ Invalidates the cached overview of the given probe (and so the
+        page), after new data has been written for it.
+
+    """
+    global _generation, _probe_ids, _page
+
+    with _lock:
+        _generation += 1
+        _probes.pop(probe_id, None)
+        _page = None
+        if _probe_ids is not None and probe_id not in _probe_ids[1]:
+            _probe_ids = None
+
+        # A probe that's new to this process may be new to all of them
+        keys = ["overview", "overview/" + probe_id]
+        if probe_id not in _known_probe_ids:
+            _known_probe_ids.add(probe_id)
+            keys.append("overview/probes")
+
+    shared_state.get_shared_state().bump_versions(keys)
+    _count("invalidations")
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _get_version(key):
+    return shared_state.get_shared_state().get_version(key)
+
+
+def _expired(cached_time):
+    return time.time() - cached_time > ttl
+
+
+def _count(name):
+    metrics.inc("overview_cache_%s_total" % name)
+    with _stats_lock:
+        _stats[name] += 1
+
+
+# Initialize config when loading module
+init_config()
@@ -8,79 +8,225 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import itertools
 import json
+import numpy
 
+from collections import OrderedDict
 from datetime import date
 from datetime import datetime
 from datetime import timedelta
 
-from db import mongo
+from db import storage
 from probe_sync import ProbeSync
+from probe_sync import SensorReadings
+from service import alert_service
+from service import clock_drift
+from service import hot_tier
+from service import live_updates
+from service import overview_cache
+from service import rollup_service
+from service import rule_service
 
 import date_util
+import metrics
+import series_util
 
-db_probe_status = None
-db_sensor_data = None
+@metrics.timed("get_probe_overview")
+def get_probe_overview(downsampler="bucket", cached=True):
+    """ Returns overview information on all probes in the system.  The
+        overview of each probe is cached until a sync writes new data
+        for it (see overview_cache).  An overview with a downsampler
+        other than the cached one should be requested with cached unset.
 
+    """
+    generation = overview_cache.get_generation()
+    probe_ids = _get_probe_ids(generation)
+
+    probes = dict((probe_id, overview_cache.get_probe(probe_id)
+        if cached else None) for probe_id in probe_ids)
 
-def init_db():
-    global db_probe_status, db_sensor_data
+    # Get status information on all probes that aren't cached
+    missing = [probe_id for probe_id in probe_ids if probes[probe_id] is None]
+    if missing:
+        probes_status = storage.get_storage().get_probe_statuses(missing)
+        for probe_status in probes_status:
+            probe = get_overview_for_probe(probe_status, downsampler)
+            if cached:
+                overview_cache.set_probe(probe["id"], probe, generation)
+            probes[probe["id"]] = probe
 
-    # Init DB
-    db_probe_status = mongo.get_probe_status_collection()
-    db_sensor_data = mongo.get_sensor_data_collection()
+    return [probes[probe_id] for probe_id in probe_ids
+        if probes[probe_id] is not None]
 
 
-def get_probe_overview():
-    """ Returns overview information on all probes in the system
+@metrics.timed("get_probe_summaries")
+def get_probe_summaries():
+    """ Returns the status information of all probes in the system, as
+        in the overview but without their sensors.  It takes a single
+        query, so a page skeleton can be rendered from it right away and
+        the sensors loaded separately (see get_overview_for_probe_id).
 
     """
-    probe_overview = []
-
-    # Get status information on all probes
-    probes_status = db_probe_status.find({})
-    for probe_status in probes_status:
-
-        # Create the probe return collection
-        probe = {
-            "id" : probe_status["_id"],
-            "desc" : "Mock probe, generates interesting fake data with Python", # TODO ps["desc"],
-            "last_contact" : probe_status["last_contact"],
-            "first_contact" : probe_status["first_contact"],
-            "last_restart" : probe_status["last_restart"],
-            "sync_count" : probe_status["sync_count"],
-            "sensors" : []
-        }
-        
-        # Get recent sensor data
-        end_time = datetime.now()
-        start_time = end_time - timedelta(days=7)
-        sensors_data = get_sensor_data_for_probe(
-            probe["id"], start_time, end_time)
+    probe_ids = _get_probe_ids(overview_cache.get_generation())
+    probes_status = dict((probe_status["_id"], probe_status) for probe_status
+        in storage.get_storage().get_probe_statuses(probe_ids))
+
+    return [_new_probe_overview(probes_status[probe_id])
+        for probe_id in probe_ids if probe_id in probes_status]
+
+
+def get_overview_for_probe_id(probe_id, downsampler="bucket", cached=True):
+    """ Returns the overview of the given probe, as in the overview of
+        all probes, or None if there's no such probe
+
+    """
+    generation = overview_cache.get_generation()
+    probe = overview_cache.get_probe(probe_id) if cached else None
 
-        for sensor_data in sensors_data:
+    if probe is None:
+        probes_status = storage.get_storage().get_probe_statuses([probe_id])
+        if not probes_status:
+            return None
 
-            sensor = {
-                "id" : sensor_data["_id"],
-                "desc" : "TODO Sensor Description...",
-                "units_label" : "&deg;",  # TODO: Need data type (degrees, etc)
-                "curr_value" : sensor_data["data"].values()[-1],
-                "min_value" : sensor_data["min_value"],
-                "max_value" : sensor_data["max_value"]
-            }
+        probe = get_overview_for_probe(probes_status[0], downsampler)
+        if cached:
+            overview_cache.set_probe(probe_id, probe, generation)
 
-            data = bucketize_data(168,
-                date_util.get_timestamp(start_time),
-                date_util.get_timestamp(end_time),
-                sensor_data["data"])
+    return probe
 
-            sensor["data"] = data
-            sensor["avg_value"] = average_list_values(data)
+
+def _get_probe_ids(generation):
+    probe_ids = overview_cache.get_probe_ids()
+    if probe_ids is None:
+        probe_ids = storage.get_storage().get_probe_ids()
+        overview_cache.set_probe_ids(probe_ids, generation)
+    return probe_ids
+
+
+def get_overview_for_probe(probe_status, downsampler="bucket"):
+    """ Returns overview information on the probe of the given status,
+        including a week of data for each of its sensors, downsampled
+        to 168 points for its sparkline with the given downsampler.
+
+    """
+    probe = _new_probe_overview(probe_status)
+
+    # Get the recent week of sensor data.  The week is aligned to
+    # whole hours, so each hourly rollup fills one bucket.
+    end_time = date_util.get_hour(datetime.now()) + timedelta(hours=1)
+    start_time = end_time - timedelta(days=7)
+    start = date_util.get_timestamp(start_time)
+    end = date_util.get_timestamp(end_time) - 1
+    probe["start"] = start
+    probe["end"] = end
+
+    # Served from the hot tier if it holds the whole week, otherwise
+    # from the hourly rollups
+    windows = hot_tier.get_probe_windows(probe["id"], start, end)
+    if windows is not None:
+        for sensor_id, timestamps, values in windows:
+            sensor = _new_sensor_overview(sensor_id, values[-1],
+                values.min(), values.max(), values.mean())
+            sensor["data"] = series_util.to_list(
+                bucketize_data(168, start, end, timestamps, values))
+            if downsampler == "minmax":
+                sensor["min_data"] = series_util.to_list(bucketize_data(
+                    168, start, end, timestamps, values, "min"))
+                sensor["max_data"] = series_util.to_list(bucketize_data(
+                    168, start, end, timestamps, values, "max"))
             probe["sensors"].append(sensor)
 
-        probe_overview.append(probe)
+    else:
+        sensors_rollups = rollup_service.get_hourly_rollups_for_probe(
+            probe["id"], start_time, end_time)
 
-    return probe_overview
+        for sensor_id, rollups in sensors_rollups.items():
+            hours = [date_util.get_timestamp(r["hour"]) for r in rollups]
+            sums = [r["sum_values"] for r in rollups]
+            counts = [r["count_values"] for r in rollups]
+
+            sensor = _new_sensor_overview(sensor_id,
+                rollups[-1]["last_value"],
+                min(r["min_value"] for r in rollups),
+                max(r["max_value"] for r in rollups),
+                sum(sums) / float(sum(counts)))
+            sensor["data"] = series_util.to_list(
+                bucketize_data(168, start, end, hours, sums, "sum") /
+                bucketize_data(168, start, end, hours, counts, "sum"))
+            if downsampler == "minmax":
+                sensor["min_data"] = series_util.to_list(bucketize_data(
+                    168, start, end, hours, [r["min_value"] for r in rollups],
+                    "min"))
+                sensor["max_data"] = series_util.to_list(bucketize_data(
+                    168, start, end, hours, [r["max_value"] for r in rollups],
+                    "max"))
+            probe["sensors"].append(sensor)
+
+    # LTTB picks points from the raw readings, which are read in full
+    if downsampler == "lttb" and probe["sensors"]:
+        series = dict((sensor["_id"], sensor) for sensor in
+            get_sensor_data_for_probe(probe["id"], start_time,
+                end_time - timedelta(seconds=1), 168, downsampler="lttb"))
+
+        for sensor in probe["sensors"]:
+            if sensor["id"] in series:
+                sensor["timestamps"] = series_util.to_list(
+                    series[sensor["id"]]["timestamps"])
+                sensor["data"] = series_util.to_list(
+                    series[sensor["id"]]["values"])
+
+    return probe
+
+
+def _new_probe_overview(probe_status):
+    return {
+        "id" : probe_status["_id"],
+        "desc" : "Mock probe, generates interesting fake data with Python", # TODO ps["desc"],
+        "last_contact" : probe_status["last_contact"],
+        "first_contact" : probe_status["first_contact"],
+        "last_restart" : probe_status["last_restart"],
+        "sync_count" : probe_status["sync_count"],
+        "sensors" : []
+    }
+
+
+def _new_sensor_overview(sensor_id, curr_value, min_value, max_value,
+        avg_value):
+    return {
+        "id" : sensor_id,
+        "desc" : "TODO Sensor Description...",
+        "units_label" : "&deg;",  # TODO: Need data type (degrees, etc)
+        "curr_value" : curr_value,
+        "min_value" : min_value,
+        "max_value" : max_value,
+        "avg_value" : avg_value
+    }
+
+
+def warm_hot_tier():
+    """ Starts the hot tier, loading it with the recent sensor data of
+        every probe from the DB.  The warmed window starts at midnight,
+        so it covers the hour aligned overview week.
+
+    """
+    now = date_util.get_current_timestamp()
+    since = date_util.get_timestamp(date_util.get_midnight(
+        datetime.now() - timedelta(days=hot_tier.warm_days)))
+    hot_tier.start(since)
+
+    store = storage.get_storage()
+    try:
+        for probe_id in store.get_probe_ids():
+            for sensor_id, timestamps, values in store.walk_points(
+                    probe_id, since, now):
+                hot_tier.load(probe_id, sensor_id, timestamps, values)
+
+    except storage.StorageUnavailable, e:
+        # Partly warmed buffers would serve incomplete windows, so all
+        # reads go to the DB instead
+        print "[WARN] Unable to warm the hot tier, disabling it: %s" % str(e)
+        hot_tier.stop()
 
 
 def process_probe_sync(probe_sync):
@@ -88,17 +234,88 @@ def process_probe_sync(probe_sync):
 
     """
 
+    persist_probe_sync(probe_sync)
+    return build_sync_response(probe_sync)
+
+
+def process_probe_sync_batch(probe_syncs, written=None):
+    """ Processes a batch of probe sync requests, such as those drained
+        from the ingest queue.  Syncs from the same probe are coalesced
+        so each probe's status and sensor data are written once per
+        batch rather than once per sync.  The timestamps of all of a
+        probe's readings are corrected for the drift of its clock at
+        once (see clock_drift).
+
+        The writes increment counts, so they mustn't be repeated.  If
+        written is given, it's a dict of probe id to the last of a
+        probe's writes that succeeded ("status" or "sensor_data"), which
+        is updated as they're made.  A batch that failed part way can
+        then be retried with the same dict, and only the writes that
+        didn't succeed are made.
+
+    """
+    written = written if written is not None else {}
+
+    probes = OrderedDict()
+    for probe_sync in probe_syncs:
+        probes.setdefault(probe_sync.probe_id, []).append(probe_sync)
+
+    for probe_id, syncs in probes.items():
+        if written.get(probe_id) == "sensor_data":
+            continue
+
+        # A sync count of 0 or 1 in any of the syncs indicates a restart
+        if written.get(probe_id) != "status":
+            update_probe_status(probe_id,
+                min(probe_sync.sync_count for probe_sync in syncs),
+                sync_total=len(syncs),
+                contact_time=max(probe_sync.received for probe_sync in syncs),
+                clock=_get_latest_clock(syncs))
+            written[probe_id] = "status"
+
+        persist_sensor_data(probe_id, clock_drift.correct(syncs))
+        written[probe_id] = "sensor_data"
+        clock_drift.record(probe_id, syncs)
+        overview_cache.invalidate(probe_id)
+
+
+def persist_probe_sync(probe_sync):
+    """ Persists the probe status and sensor data of the given probe
+        sync request.
+
+    """
+
     probe_id = probe_sync.probe_id
 
     # Persist information about the probe and this sync
-    update_probe_status(probe_id, probe_sync.sync_count)
+    update_probe_status(probe_id, probe_sync.sync_count,
+        clock=getattr(probe_sync, "clock", None))
 
-    # Persist any sensor data
-    persist_sensor_data(probe_id, probe_sync.sensor_data)
+    # Persist any sensor data, corrected for the drift of the probe's
+    # clock
+    persist_sensor_data(probe_id, clock_drift.correct([probe_sync]))
+    clock_drift.record(probe_id, [probe_sync])
+    overview_cache.invalidate(probe_id)
 
     # Persist any actuator history
     # TODO...
 
+
+def _get_latest_clock(probe_syncs):
+    clocks = [probe_sync.clock for probe_sync in probe_syncs
+        if getattr(probe_sync, "clock", None) is not None]
+    return max(clocks, key=lambda clock: clock["server_time"]) \
+        if clocks else None
+
+
+def build_sync_response(probe_sync, duplicate=False):
+    """ Builds the response returned to the probe for a sync request,
+        including the commands of any actuator rules that fired.  For
+        a duplicate sync, the commands it got the first time are
+        returned again.
+
+    """
+
     # Build response.  Note that curr_time will be off by remaining
     # control server processing, one way latency and probe processing.
     now = date_util.get_current_timestamp()
@@ -107,172 +324,263 @@ def process_probe_sync(probe_sync):
         "curr_time" : now
     }
 
+    with metrics.timed("rule_evaluation"):
+        commands = rule_service.get_commands(probe_sync) if duplicate \
+            else rule_service.evaluate(probe_sync)
+    if commands:
+        response["commands"] = commands
+
     return response
 
 
-def update_probe_status(probe_id, sync_count):
-    """ Persist information about this probe and its sync
+@metrics.timed("update_probe_status")
+def update_probe_status(probe_id, sync_count, sync_total=1,
+        contact_time=None, clock=None):
+    """ Persist information about this probe and its sync, and publish
+        it to live updates.  When syncs are coalesced, sync_total is the
+        number of syncs being recorded and contact_time is when the
+        latest of them was received.  clock, if given, is the latest
+        drift estimate of the probe's clock.
 
     """
 
-    now = datetime.now()
-    update_set = { "last_contact" : now}
-
-    if sync_count <= 1:
-        update_set["last_restart"] = now
-
-    db_probe_status.update(
-        {"_id" : probe_id}, {
-            "$set" : update_set,
-            "$inc" : {"sync_count" : 1},
-            "$setOnInsert" : {"first_contact" : now}
-        }, True)  # True for upsert
-
-
-def get_sensor_data_for_probe(probe_id, start_time, end_time):
-    """ Gets sensor data over the given time range for the given probe.
-
-        *** Runs the following mongoDB aggregation ***
-
-        db.sensor_data.aggregate(
-
-          { $match : 
-            {
-              "probe_id" : "test_probe",
-              "sensor_id" : "pho0",
-              "day" : {
-                $gte : ISODate("2014-05-06T00:00:00Z"),
-                $lte : ISODate("2014-05-09T00:00:00Z")
-              }
-            }
-          },
-
-          {
-            $group :
-            {
-              "_id" : { "probe_id" : "$probe_id", "sensor_id" : "$sensor_id"},
-              "min_value": { "$min" : "$min_value"},
-              "max_value": { "$min" : "$max_value"},
-              "max_value": { "$min" : "$max_value"},
-              "data" : { "$push" : "$data" },
-            }
-          }
-        )
-    """
-    sensor_data = db_sensor_data.aggregate([
-        {"$match": {
-            "probe_id" : probe_id,
-            "day" : {
-                "$gte" : start_time,
-                "$lte" : end_time
-            }
-        }},
-        {"$group" : {
-            "_id" : "$sensor_id",
-            "min_value": { "$min" : "$min_value"},
-            "max_value": { "$max" : "$max_value"},
-            "data" : { "$push" : "$data" },     
-        }}
-    ])
-
-    for sensor in sensor_data["result"]:
-
-        # Values are still grouped by day and need to be merged
-        merged_values = {}
-        for values in sensor["data"]:
-            merged_values.update(values)
-        sensor["data"] = merged_values
-
-    # TODO: Values are for the days in the start to end range.  The
-    # time isn't respected.  Need to go through and prune values
-    # before/after time range?
-
-    return sensor_data["result"]
+    contact_time = contact_time or datetime.now()
+    storage.get_storage().update_probe_status(probe_id, contact_time,
+        sync_total, restart=sync_count <= 1, clock=clock)
+    live_updates.publish_status(probe_id, contact_time, sync_total,
+        restart=sync_count <= 1)
+
+
+@metrics.timed("get_sensor_data_for_probe")
+def get_sensor_data_for_probe(probe_id, start_time, end_time, points=None,
+        agg="mean", downsampler="bucket", sensor_ids=None):
+    """ Gets sensor data over exactly the given time range (inclusive)
+        for the given probe, optionally limited to the given sensors.
+        Returns a list with an entry per sensor, holding its data as
+        parallel NumPy arrays of timestamps and values, ordered by time,
+        and the time of its last reading...
+
+          {"_id" : "tmp0", "timestamps" : [...], "values" : [...],
+           "min_value" : 68.0, "max_value" : 72.5,
+           "last_timestamp" : 1400000000}
+
+        If points is given, the data is downsampled as it's read into
+        that many buckets, aggregated with agg (see series_util), and
+        the timestamps are the start time of each bucket.  Sensor-days
+        are walked one at a time, so only one is in memory.  When each
+        bucket spans an hour or more, whole hours are read from the
+        hourly rollups instead (each placed in the bucket of its
+        midpoint), and raw data is only read for the partial hours at
+        either end of the range.
+
+        The downsampler (see series_util) picks how points are reduced.
+        'minmax' also returns the "min_values" and "max_values" of each
+        bucket, as an envelope around its mean.  'lttb' keeps up to
+        points of the sensor's readings, with their own timestamps,
+        rather than bucketizing.  It needs all of a sensor's readings in
+        the range at once, and can't use the rollups.
 
+    """
+    if downsampler not in series_util.downsamplers:
+        raise ValueError("Unknown downsampler '%s'" % downsampler)
+
+    start = date_util.get_timestamp(start_time)
+    end = date_util.get_timestamp(end_time)
+
+    # Recent windows can be served from the hot tier
+    windows = hot_tier.get_probe_windows(probe_id, start, end)
+    if windows is not None and sensor_ids is not None:
+        windows = [window for window in windows if window[0] in sensor_ids]
+    if windows is not None and downsampler != "lttb":
+        return _build_sensor_data(windows, start, end, points, agg,
+            envelope=downsampler == "minmax")
+
+    store = storage.get_storage()
+    if points is None or downsampler == "lttb":
+        sensors = _build_sensor_data(windows if windows is not None else
+            store.walk_points(probe_id, start, end, sensor_ids), start, end)
+        if points is not None:
+            for sensor in sensors:
+                sensor["timestamps"], sensor["values"] = series_util.lttb(
+                    sensor["timestamps"], sensor["values"], points)
+        return sensors
+
+    accumulators = OrderedDict()
+    raw_ranges = [(start, end)]
+    if (end - start) / float(points) >= 3600:
+
+        # Whole hours within the range, as [hours_start, hours_end)
+        hours_start = date_util.get_hour(start_time)
+        if date_util.get_timestamp(hours_start) < start:
+            hours_start += timedelta(hours=1)
+        hours_end = date_util.get_hour(end_time + timedelta(seconds=1))
+
+        if hours_start < hours_end:
+            sensors_rollups = rollup_service.get_hourly_rollups_for_probe(
+                probe_id, hours_start, hours_end - timedelta(seconds=1))
+
+            for sensor_id, rollups in sensors_rollups.items():
+                if sensor_ids is not None and sensor_id not in sensor_ids:
+                    continue
+                accumulator = series_util.BucketAccumulator(points, start, end)
+                accumulator.add_aggregates(
+                    [date_util.get_timestamp(r["hour"]) + 1800
+                        for r in rollups],
+                    [r["sum_values"] for r in rollups],
+                    [r["count_values"] for r in rollups],
+                    [r["min_value"] for r in rollups],
+                    [r["max_value"] for r in rollups],
+                    [r["last_timestamp"] for r in rollups],
+                    [r["last_value"] for r in rollups])
+                accumulators[sensor_id] = accumulator
+
+            raw_ranges = [
+                (start, date_util.get_timestamp(hours_start) - 1),
+                (date_util.get_timestamp(hours_end), end)]
+
+    chunks = itertools.chain.from_iterable(
+        store.walk_points(probe_id, range_start, range_end, sensor_ids)
+        for range_start, range_end in raw_ranges
+        if range_start <= range_end)
+
+    return _build_sensor_data(chunks, start, end, points, agg, accumulators,
+        downsampler == "minmax")
+
+
+def _build_sensor_data(chunks, start, end, points=None, agg="mean",
+        accumulators=None, envelope=False):
+    """ Builds the result of get_sensor_data_for_probe() from chunks of
+        (sensor id, timestamps, values), in time order per sensor.  If
+        points is given the chunks are bucketized as they're read, added
+        to any given (partially filled) accumulators, and if envelope is
+        set each bucket's min and max values are included.
 
-def persist_sensor_data(probe_id, sensor_data):
-    """ Perists the given sensor data in the DB.  Currently using a 
-        Document-Oriented schema design. For more details see: 
-          * http://blog.mongodb.org/post/65517193370/
-              schema-design-for-time-series-data-in-mongodb
+    """
+    sensors = []
+
+    if points is None:
+        by_sensor = OrderedDict()
+        for sensor_id, timestamps, values in chunks:
+            by_sensor.setdefault(sensor_id, []).append((timestamps, values))
+
+        for sensor_id, sensor_chunks in by_sensor.items():
+            values = numpy.concatenate([c[1] for c in sensor_chunks])
+            sensors.append({
+                "_id" : sensor_id,
+                "timestamps" : numpy.concatenate([c[0] for c in sensor_chunks]),
+                "values" : values,
+                "min_value" : values.min(),
+                "max_value" : values.max(),
+                "last_timestamp" : sensor_chunks[-1][0][-1]
+            })
+
+        return sensors
+
+    accumulators = accumulators if accumulators is not None else OrderedDict()
+    for sensor_id, timestamps, values in chunks:
+        if sensor_id not in accumulators:
+            accumulators[sensor_id] = series_util.BucketAccumulator(
+                points, start, end)
+        accumulators[sensor_id].add(timestamps, values)
+
+    for sensor_id, accumulator in accumulators.items():
+        sensor = {
+            "_id" : sensor_id,
+            "timestamps" : accumulator.get_timestamps(),
+            "values" : accumulator.get_values(agg),
+            "min_value" : accumulator.mins.min(),
+            "max_value" : accumulator.maxs.max(),
+            "last_timestamp" : accumulator.last_times.max()
+        }
+        if envelope:
+            sensor["min_values"] = accumulator.get_values("min")
+            sensor["max_values"] = accumulator.get_values("max")
+        sensors.append(sensor)
 
-        TODO: If a single probe's sensor data has many data points to
-        record at once, that could result in mongoDB having to
-        reallocate/grow the document multiple times.  A future
-        optimization would be to organize and write all values at once.
+    return sensors
 
-    """
-    for data_point in sensor_data:
-        sensor_id = data_point["id"]
-        timestamp = data_point["timestamp"]
-        date_time = datetime.fromtimestamp(timestamp)
-        day = date_util.get_midnight(date_time)
-        value = data_point["value"]
-
-        db_sensor_data.update(
-            {"_id" : get_metric_id(day, probe_id, sensor_id)},
-            {"$set" : {
-                "probe_id" : probe_id,
-                "sensor_id" : sensor_id,
-                "day" : day,
-                "data.%d" % (timestamp) : value},
-             "$inc" : { 
-                "count_values" : 1,
-                "sum_values" : value},
-             "$min" : {
-                "min_value" : value},
-             "$max" : {
-                "max_value" : value}
-            }, True)  # True for upsert
 
-    return None
+@metrics.timed("get_sensor_series")
+def get_sensor_series(probe_id, sensor_id, start, end, points=None,
+        agg="mean", downsampler="bucket", since=None):
+    """ Returns the data of one of a probe's sensors between the given
+        timestamps (inclusive), downsampled to points as with
+        get_sensor_data_for_probe(), as a JSON serializable dict...
 
+          {"probe_id" : "probe0", "sensor_id" : "tmp0",
+           "start" : 1400000000, "end" : 1400604800,
+           "timestamps" : [...], "values" : [...],
+           "last_timestamp" : 1400604795}
 
-def get_metric_id(day, probe_id, instrument_id):
-    """ Returns a string that can be used as the document id for
-        storing metric data.  Metric data is stored at daily 
-        granularity, the id is a composite key of the day, probe id
-        and instrument (sensor/actuator) id.
-          ex:  YYYYMMDD-probe_id-instrument_id
+        Buckets without data are None, and with the 'minmax' downsampler
+        "min_values" and "max_values" are included.  If since is given
+        (such as the last_timestamp of a previous response), only the
+        readings newer than it are returned, with their own timestamps
+        so they can be appended to the series.  If there are more than
+        points of them, they're downsampled with LTTB.
 
     """
-    mm = date_util.pad_month_day_value(day.month)
-    dd = date_util.pad_month_day_value(day.day)
-    return "%s%s%s-%s-%s" % (day.year, mm, dd, probe_id, instrument_id)
+    if since is not None:
+        start = max(start, since + 1)
+        downsampler = "lttb"
+
+    series = {
+        "probe_id" : probe_id,
+        "sensor_id" : sensor_id,
+        "start" : start,
+        "end" : end,
+        "timestamps" : [],
+        "values" : [],
+        "last_timestamp" : since
+    }
+    if start > end:
+        return series
 
+    sensors = get_sensor_data_for_probe(probe_id,
+        datetime.fromtimestamp(start), datetime.fromtimestamp(end), points,
+        agg, downsampler, [sensor_id])
 
-def bucketize_data(bucket_count, min_bucket, max_bucket, data):
-    """ Maps the given data into the specified number of buckets.
+    for sensor in sensors:
+        series["timestamps"] = series_util.to_list(sensor["timestamps"])
+        series["values"] = series_util.to_list(sensor["values"])
+        series["last_timestamp"] = int(sensor["last_timestamp"])
+        if "min_values" in sensor:
+            series["min_values"] = series_util.to_list(sensor["min_values"])
+            series["max_values"] = series_util.to_list(sensor["max_values"])
 
-    """
-    buckets = {}
-    divisor = (max_bucket - min_bucket) / bucket_count
-    #print "Min: %d   Max: %d    Div: %d" % (min_bucket, max_bucket, divisor)
-
-    # Map the data to the buckets
-    for d in data:
-        if int(d) < min_bucket or int(d) > max_bucket:
-            #print "Invalid Data Point %s" % d
-            continue
+    return series
+
+
+@metrics.timed("persist_sensor_data")
+def persist_sensor_data(probe_id, sensor_data):
+    """ Perists the given sensor data with the storage backend, which
+        also folds it into the hourly rollups, appends it to the hot
+        tier, checks it for alerts, and publishes it to live updates.
 
-        # Determine bucket, then add to bucket list
-        key = (int(d) - min_bucket) / divisor
-        if key not in buckets:
-            buckets[key] = [data[d]]
-        else:
-            buckets[key].append(data[d])
+        The sensor data may be given as SensorReadings or as a list of
+        data point dicts.
 
-    
-    # Average the values in each bucket
-    for key in buckets:
-        buckets[key] = average_list_values(buckets[key])
+    """
+    sensor_data = SensorReadings.wrap(sensor_data)
+    if not len(sensor_data):
+        return None
 
-    return buckets.values()
+    storage.get_storage().append_points(probe_id, sensor_data)
+    metrics.inc("points_ingested_total", len(sensor_data))
+    hot_tier.append(probe_id, sensor_data)
+    with metrics.timed("alerts"):
+        alert_service.observe(probe_id, sensor_data)
+    live_updates.publish_points(probe_id, sensor_data)
 
+    return None
 
-def average_list_values(l):
-    return sum(l)/float(len(l))
 
+@metrics.timed("bucketize_data")
+def bucketize_data(bucket_count, start, end, timestamps, values,
+        agg="mean", fill=numpy.nan):
+    """ Maps the given data into exactly bucket_count ordered buckets
+        over the time range [start, end].  See series_util.bucketize()
 
-# Initialize connection to DB when loading module
-init_db()    
\ No newline at end of file
+    """
+    return series_util.bucketize(timestamps, values, bucket_count,
+        start, end, agg, fill)
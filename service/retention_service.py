@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.retention_service
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Module that applies the retention policy to sensor data, so storage
+    doesn't grow without bound.  The policy is a list of tiers, each a
+    resolution and the age (in days) up to which data is kept at it...
+
+        tiers : raw:30, 900:365, 3600:forever
+
+    keeps every reading for 30 days, 15 minute buckets until a year
+    old, and hourly buckets forever.  Compaction rewrites the sensor-
+    days that have aged out of a tier at the next tier's resolution
+    (see Storage.compact_points), keeping the min, max, sum and count
+    of each bucket so daily and hourly aggregates stay exact.  Data
+    older than a last tier that isn't kept forever is deleted.  The
+    stored hourly and daily rollups aren't affected.
+
+    Each sensor-day is compacted on its own, and days already at a
+    tier's resolution are skipped, so an interrupted compaction simply
+    resumes where it left off when run again.  It runs in the background
+    every interval_hours, or with...
+
+        $ python manage.py -v compact
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import ConfigParser
+import threading
+import time
+import traceback
+
+from datetime import datetime
+from datetime import timedelta
+
+from db import shared_state
+from db import storage
+
+import date_util
+import metrics
+
+# These values set from config file
+tiers = [(0, None)]
+interval_hours = 0
+batch_days = 100
+
+_thread = None
+_stopping = threading.Event()
+
+
+class CompactionStats(object):
+    """ Counts of a compaction run, for its report
+
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.compacted = 0
+        self.dropped = 0
+        self.reclaimed = 0
+
+    def add(self, compacted, dropped, reclaimed):
+        self.compacted += compacted
+        self.dropped += dropped
+        self.reclaimed += reclaimed
+        metrics.inc("retention_days_compacted_total", compacted)
+        metrics.inc("retention_days_dropped_total", dropped)
+        metrics.inc("retention_bytes_reclaimed_total", reclaimed)
+
+    def report(self):
+        return "compacted %d and deleted %d sensor-days, reclaiming " \
+            "%0.2f MB in %0.1fs" % (self.compacted, self.dropped,
+            self.reclaimed / float(1 << 20), time.time() - self.start_time)
+
+
+def init_config():
+    """ Read retention settings from config file
+
+    """
+    global tiers, interval_hours, batch_days
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    tiers = parse_tiers(config.get("retention", "tiers"))
+    interval_hours = config.getfloat("retention", "interval_hours")
+    batch_days = config.getint("retention", "batch_days")
+
+
+def parse_tiers(text):
+    """ Parses a retention policy of comma separated 'resolution:days'
+        tiers.  The resolution is in seconds, or 'raw', and the days
+        may be 'forever' for the last tier.  Returns a list of tuples
+        of (resolution, days), with a resolution of 0 for raw readings
+        and days of None for forever.  Raises ValueError if the policy
+        is invalid.
+
+    """
+    parsed = []
+    for tier in text.split(","):
+        try:
+            resolution, days = [part.strip() for part in tier.split(":")]
+            parsed.append((0 if resolution == "raw" else int(resolution),
+                None if days == "forever" else int(days)))
+        except ValueError:
+            raise ValueError("Invalid retention tier '%s'" % tier.strip())
+
+    if parsed[0][0] != 0:
+        raise ValueError("The first retention tier must be raw")
+    for (resolution, days), (next_resolution, next_days) in zip(parsed,
+            parsed[1:]):
+        if days is None or next_resolution <= resolution or \
+                (next_days is not None and next_days <= days):
+            raise ValueError("Retention tiers must be in order of "
+                "increasing resolution and age, only the last kept forever")
+    if any(days is not None and days < 1 for resolution, days in parsed):
+        raise ValueError("Retention tiers must keep data for a day or more")
+
+    return parsed
+
+
+def compact(probe_id=None, verbose=False, stats=None):
+    """ Applies the retention policy to the sensor data of all probes,
+        or the given probe.  Returns the CompactionStats.
+
+    """
+    stats = stats or CompactionStats()
+    store = storage.get_storage()
+    today = date_util.get_midnight(datetime.now())
+
+    for probe_id in [probe_id] if probe_id else store.get_probe_ids():
+        resolution, days = tiers[-1]
+        if days is not None:
+            doc_count, reclaimed = store.drop_points(probe_id,
+                today - timedelta(days=days))
+            stats.add(0, doc_count, reclaimed)
+
+        # Coarsest first, so the oldest days are compacted once
+        for (resolution, days), previous in reversed(zip(tiers[1:],
+                tiers)):
+            before = today - timedelta(days=previous[1])
+            while not _stopping.is_set():
+                doc_count, reclaimed = store.compact_points(probe_id,
+                    before, resolution, batch_days)
+                stats.add(doc_count, 0, reclaimed)
+                if verbose and doc_count:
+                    print "  %s: %d sensor-days at %ds resolution" % (
+                        probe_id, doc_count, resolution)
+                if doc_count < batch_days:
+                    break
+
+    return stats
+
+
+def start():
+    """ Starts the background compaction thread, running every
+        interval_hours
+
+    """
+    global _thread
+
+    if _thread is not None or len(tiers) < 2 and tiers[0][1] is None:
+        return
+
+    _thread = threading.Thread(target=_compact_loop, name="retention")
+    _thread.daemon = True
+    _thread.start()
+
+
+def _compact_loop():
+    while not _stopping.wait(interval_hours * 3600):
+
+        # When served by several workers, only the one holding the lease
+        # compacts
+        if not shared_state.get_shared_state().acquire_lease("retention",
+                shared_state.get_worker_id(), interval_hours * 3600 * 1.5):
+            continue
+
+        try:
+            with metrics.timed("retention_compact"):
+                stats = compact()
+            print " * Retention: %s" % stats.report()
+
+        except storage.StorageUnavailable, e:
+            print "[WARN] Retention compaction postponed: %s" % str(e)
+
+        except Exception, e:
+            print "[ERROR] Retention compaction failed: %s" % str(e)
+            traceback.print_exc()
+
+
+# Initialize config when loading module
+init_config()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.rollup_service
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Module that reads hourly rollups of sensor data.  Each rollup holds
+    the min, max, sum and count of a sensor's values over one hour, so
+    overviews can be built from a handful of small rollups instead of
+    every raw data point.
+
+    Rollups are kept by the storage backend as sensor data is persisted
+    (see db.storage).  Stored rollups for data recorded before they
+    existed can be built with...
+
+        $ python manage.py backfill_rollups
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+from db import storage
+
+import metrics
+
+
+@metrics.timed("get_hourly_rollups_for_probe")
+def get_hourly_rollups_for_probe(probe_id, start_time, end_time):
+    """ Returns the hourly rollups of each of the given probe's sensors
+        over the given time range, as a dict of sensor id to a list of
+        rollups ordered by hour.
+
+    """
+    return storage.get_storage().get_hourly_rollups(probe_id, start_time,
+        end_time)
+
+
+def backfill(probe_id=None, verbose=False):
+    """ Rebuilds the stored rollups from the raw sensor data, optionally
+        limited to one probe.  The backfill can safely be rerun.
+        Returns the number of sensor-days read.
+
+    """
+    return storage.get_storage().backfill_rollups(probe_id, verbose)
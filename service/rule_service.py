@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.rule_service
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Rule engine that triggers actuators from sensor data.  Rules are
+    declared in the rules file (see [rules] in settings.cfg), one
+    section per rule...
+
+        [water_bed_2]
+        probe : probe0
+        when : mean(moisture1, 1h) < 30 and not max(weather/rain, 6h) > 0
+        actuator : bed2_valve
+        value : 1
+        cooldown : 3600
+
+    A condition compares aggregates (mean, min, max, last or count) of
+    a sensor's readings over a trailing window, or numbers, combined
+    with 'and', 'or', 'not' and parentheses.  Sensors are of the rule's
+    probe, or of another probe as 'probe_id/sensor_id' (such as one fed
+    with weather data).  When the condition holds as the rule's probe
+    syncs, the actuator command is returned in the sync response, at
+    most once per cooldown seconds.
+
+    Rules are compiled once, when loaded.  Each (probe, sensor, window)
+    the rules refer to is kept as a sliding window of its readings, with
+    a running sum and monotonic queues of its min and max, so each
+    reading is added and expired in amortized constant time and an
+    aggregate is read without going to the DB.  Only readings within a
+    window are held, so evaluation doesn't slow as history grows.  An
+    aggregate of an empty window (no recent readings) fails any
+    comparison.  Windows end at the probe's current time, and are held
+    in memory, so they refill after a restart of the Control Server.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import ConfigParser
+import operator
+import re
+import threading
+
+from collections import deque
+
+import date_util
+import metrics
+
+# These values set from config file
+enabled = False
+rules_file = "rules.cfg"
+default_cooldown = 3600
+
+rules = []
+
+_lock = threading.Lock()
+_windows = {}  # (probe id, sensor id, seconds) to its SlidingWindow
+_sensor_windows = {}  # (probe id, sensor id) to its SlidingWindows
+_probe_rules = {}  # Probe id to its rules
+_last_commands = {}  # Probe id to (sync id, commands) of its last sync
+_stats = {
+    "evaluations" : 0,
+    "commands" : 0
+}
+
+aggregations = ["mean", "min", "max", "last", "count"]
+
+comparisons = {
+    "<" : operator.lt,
+    "<=" : operator.le,
+    ">" : operator.gt,
+    ">=" : operator.ge,
+    "==" : operator.eq,
+    "!=" : operator.ne
+}
+
+durations = {"s" : 1, "m" : 60, "h" : 3600, "d" : 86400}
+
+_token_pattern = re.compile(r"\s*(?:(\d+(?:\.\d+)?[smhd]\b)|"
+    r"(-?\d+(?:\.\d+)?)|(<=|>=|==|!=|<|>|\(|\)|,)|([A-Za-z0-9_\-/.]+))")
+
+
+class RuleError(ValueError):
+    pass
+
+
+class SlidingWindow(object):
+    """ The readings of a sensor over a trailing window of seconds, with
+        running aggregates.  The min and max are kept in monotonic
+        queues, so both adding and expiring a reading take amortized
+        constant time.
+
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.readings = deque()
+        self.mins = deque()
+        self.maxs = deque()
+        self.sum = 0.0
+        self.latest = None
+
+    def add(self, timestamp, value):
+        # Readings older than the latest (such as a probe's backlog)
+        # don't fit the queues' order, and are ignored
+        if self.latest is not None and timestamp <= self.latest:
+            return
+        self.latest = timestamp
+
+        self.readings.append((timestamp, value))
+        self.sum += value
+        while self.mins and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((timestamp, value))
+        while self.maxs and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append((timestamp, value))
+
+    def expire(self, now):
+        """ Drops the readings from before the window ending at now
+
+        """
+        oldest = now - self.seconds
+        readings = self.readings
+        while readings and readings[0][0] <= oldest:
+            self.sum -= readings.popleft()[1]
+        while self.mins and self.mins[0][0] <= oldest:
+            self.mins.popleft()
+        while self.maxs and self.maxs[0][0] <= oldest:
+            self.maxs.popleft()
+
+        # Resets the sum's floating point drift once the window empties
+        if not readings:
+            self.sum = 0.0
+
+    def get(self, agg):
+        """ Returns the given aggregate of the readings in the window, or
+            None if it's empty
+
+        """
+        if agg == "count":
+            return len(self.readings)
+        if not self.readings:
+            return None
+        if agg == "mean":
+            return self.sum / len(self.readings)
+        if agg == "min":
+            return self.mins[0][1]
+        if agg == "max":
+            return self.maxs[0][1]
+        return self.readings[-1][1]
+
+
+class Rule(object):
+    """ A compiled rule.  Its condition is a function of no arguments,
+        reading the sliding windows it refers to.
+
+    """
+
+    def __init__(self, name, probe_id, condition, windows, actuator, value,
+            cooldown):
+        self.name = name
+        self.probe_id = probe_id
+        self.condition = condition
+        self.windows = windows
+        self.actuator = actuator
+        self.value = value
+        self.cooldown = cooldown
+        self.last_fired = None
+
+
+def init_config():
+    """ Read rule engine settings from config file, and load the rules
+
+    """
+    global enabled, rules_file, default_cooldown
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    enabled = config.getboolean("rules", "enabled")
+    rules_file = config.get("rules", "rules_file")
+    default_cooldown = config.getint("rules", "cooldown")
+
+    if enabled:
+        load_rules(rules_file)
+
+
+def load_rules(filename):
+    """ Compiles the rules of the given file, replacing any loaded.
+        Raises RuleError if a rule is invalid.
+
+    """
+    config = ConfigParser.SafeConfigParser({"cooldown" : str(default_cooldown)})
+    if not config.read(filename):
+        print "[WARN] Rules file '%s' not found, no rules loaded" % filename
+
+    set_rules([compile_rule(name, dict(config.items(name)))
+        for name in config.sections()])
+
+
+def set_rules(compiled_rules):
+    """ Replaces the loaded rules with the given compiled rules, and
+        resets the sliding windows to those they refer to
+
+    """
+    global rules
+
+    with _lock:
+        rules = compiled_rules
+        _windows.clear()
+        _sensor_windows.clear()
+        _probe_rules.clear()
+        _last_commands.clear()
+
+        for rule in rules:
+            _probe_rules.setdefault(rule.probe_id, []).append(rule)
+            for key, window in rule.windows.items():
+                if key not in _windows:
+                    _windows[key] = window
+                    _sensor_windows.setdefault(key[:2], []).append(window)
+
+
+def compile_rule(name, options):
+    """ Returns the Rule of the given name and options (probe, when,
+        actuator, value and cooldown).  Raises RuleError if it's
+        invalid.
+
+    """
+    try:
+        probe_id = options["probe"]
+        windows = {}
+        condition = _Parser(options["when"], probe_id, windows).parse()
+        return Rule(name, probe_id, condition, windows, options["actuator"],
+            float(options.get("value", 1)),
+            int(options.get("cooldown", default_cooldown)))
+
+    except KeyError, e:
+        raise RuleError("Rule '%s' is missing '%s'" % (name, e.args[0]))
+    except ValueError, e:
+        raise RuleError("Rule '%s': %s" % (name, str(e)))
+
+
+class _Parser(object):
+    """ Recursive descent parser of a rule's condition, into nested
+        closures.  The sliding windows it refers to are added to the
+        given dict, keyed by (probe id, sensor id, seconds), and shared
+        across references to the same window.
+
+    """
+
+    def __init__(self, text, probe_id, windows):
+        self.text = text
+        self.probe_id = probe_id
+        self.windows = windows
+        self.tokens = []
+
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = _token_pattern.match(text, position)
+            if match is None:
+                raise RuleError("Unexpected '%s'" % text[position:])
+            self.tokens.append(match.group(match.lastindex))
+            position = match.end()
+        self.tokens.reverse()
+
+    def parse(self):
+        condition = self.parse_or()
+        if self.tokens:
+            raise RuleError("Unexpected '%s'" % self.tokens[-1])
+        return condition
+
+    def peek(self):
+        return self.tokens[-1] if self.tokens else None
+
+    def take(self, expected=None):
+        if not self.tokens:
+            raise RuleError("Unexpected end of '%s'" % self.text)
+        token = self.tokens.pop()
+        if expected is not None and token != expected:
+            raise RuleError("Expected '%s' but found '%s'" % (expected, token))
+        return token
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() == "or":
+            self.take()
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda: any(term() for term in terms)
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.peek() == "and":
+            self.take()
+            terms.append(self.parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda: all(term() for term in terms)
+
+    def parse_not(self):
+        if self.peek() == "not":
+            self.take()
+            term = self.parse_not()
+            return lambda: not term()
+        if self.peek() == "(":
+            self.take()
+            term = self.parse_or()
+            self.take(")")
+            return term
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_value()
+        op = self.take()
+        if op not in comparisons:
+            raise RuleError("Expected a comparison but found '%s'" % op)
+        compare = comparisons[op]
+        right = self.parse_value()
+
+        def comparison():
+            a, b = left(), right()
+            return a is not None and b is not None and compare(a, b)
+        return comparison
+
+    def parse_value(self):
+        token = self.take()
+        if token not in aggregations:
+            try:
+                number = float(token)
+            except ValueError:
+                raise RuleError("Expected a value but found '%s'" % token)
+            return lambda: number
+
+        self.take("(")
+        sensor = self.take()
+        self.take(",")
+        duration = self.take()
+        self.take(")")
+
+        probe_id, sensor_id = sensor.split("/", 1) if "/" in sensor \
+            else (self.probe_id, sensor)
+        if duration[-1] not in durations:
+            raise RuleError("Expected a window such as '1h' but found '%s'" %
+                duration)
+        seconds = int(float(duration[:-1]) * durations[duration[-1]])
+
+        key = (probe_id, sensor_id, seconds)
+        window = self.windows.setdefault(key, SlidingWindow(seconds))
+        get = window.get
+        return lambda: get(token)
+
+
+def evaluate(probe_sync):
+    """ Adds the readings of the given probe sync to the sliding windows
+        that refer to them, then evaluates the rules of its probe.
+        Returns the list of actuator commands of the rules that fired...
+
+          [{"actuator" : "bed2_valve", "value" : 1.0,
+            "rule" : "water_bed_2"}]
+
+    """
+    if not rules:
+        return []
+
+    probe_id = probe_sync.probe_id
+    readings = probe_sync.readings
+    now = probe_sync.curr_time if probe_sync.curr_time > 0 else \
+        date_util.get_current_timestamp()
+
+    with _lock:
+        if len(readings):
+            sensor_windows = [_sensor_windows.get((probe_id, sensor_id))
+                for sensor_id in readings.sensor_ids]
+
+            if any(sensor_windows):
+                for index, timestamp, value in zip(
+                        readings.sensor_indexes.tolist(),
+                        readings.timestamps.tolist(),
+                        readings.values.tolist()):
+                    for window in sensor_windows[index] or ():
+                        window.add(timestamp, value)
+
+        commands = []
+        for rule in _probe_rules.get(probe_id, ()):
+            for window in rule.windows.itervalues():
+                window.expire(now)
+
+            _stats["evaluations"] += 1
+            if rule.last_fired is not None and \
+                    now - rule.last_fired < rule.cooldown:
+                continue
+
+            if rule.condition():
+                rule.last_fired = now
+                commands.append({
+                    "actuator" : rule.actuator,
+                    "value" : rule.value,
+                    "rule" : rule.name
+                })
+
+        _stats["commands"] += len(commands)
+        _last_commands[probe_id] = (getattr(probe_sync, "sync_id", None),
+            commands)
+
+    if commands:
+        metrics.inc("rule_commands_total", len(commands))
+    return commands
+
+
+def get_commands(probe_sync):
+    """ Returns the commands of the given probe sync if it was the last
+        one evaluated for its probe (such as a retry of a sync whose
+        response was lost), without evaluating it again
+
+    """
+    with _lock:
+        sync_id, commands = _last_commands.get(probe_sync.probe_id,
+            (None, []))
+    if sync_id is None or sync_id != getattr(probe_sync, "sync_id", None):
+        return []
+    return commands
+
+
+def get_stats():
+    """ Returns the number of rules and sliding windows, the readings
+        held in them, and counts of evaluations and commands
+
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats["rules"] = len(rules)
+        stats["windows"] = len(_windows)
+        stats["readings"] = sum(len(w.readings) for w in _windows.values())
+    return stats
+
+
+# Initialize config when loading module
+init_config()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.sync_dedup
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Deduplication of probe syncs that are sent more than once, such as
+    when a probe retries a sync whose response it never received.
+    Probes attach a sync_id to each sync, and the ids recently applied
+    for each probe are remembered in a bounded window (the last
+    'window' ids of each probe).  A repeated sync is acknowledged
+    without writing it again, or reading anything from the DB, so the
+    counts and sums that are incremented as data is persisted stay
+    exact under retries.
+
+    sync_ids are opaque, but must not repeat for a probe, including
+    after it restarts (e.g. combine a random boot id with a counter).
+    The windows are kept in the shared state (see db.shared_state), so
+    a retry is caught whichever worker process it reaches, but not if
+    it spans a restart of the Control Server.  Syncs without a sync_id
+    aren't deduplicated.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import ConfigParser
+import threading
+
+from db import shared_state
+
+import metrics
+
+# These values set from config file
+window = 32
+
+# Results of begin()
+NEW = shared_state.NEW
+DUPLICATE = shared_state.DUPLICATE
+IN_FLIGHT = shared_state.IN_FLIGHT
+
+_lock = threading.Lock()
+_stats = {
+    "checked" : 0,
+    "duplicates" : 0,
+    "in_flight" : 0
+}
+
+
+def init_config():
+    """ Read sync deduplication settings from config file
+
+    """
+    global window
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    window = config.getint("sync_dedup", "window")
+
+
+def begin(probe_id, sync_id):
+    """ Checks a probe sync before it's applied.  Returns NEW if it
+        should be applied, in which case end() must be called once it
+        has been (or has failed).  Returns DUPLICATE if it was already
+        applied, or IN_FLIGHT if the same sync is being applied right
+        now (the probe should retry later).
+
+    """
+    result = shared_state.get_shared_state().begin_sync(probe_id, sync_id)
+
+    with _lock:
+        _stats["checked"] += 1
+        if result == DUPLICATE:
+            _stats["duplicates"] += 1
+        elif result == IN_FLIGHT:
+            _stats["in_flight"] += 1
+
+    if result != NEW:
+        metrics.inc("sync_duplicates_total" if result == DUPLICATE
+            else "sync_in_flight_total")
+    return result
+
+
+def end(probe_id, sync_id, applied):
+    """ Records that a sync begun with begin() was applied, or failed
+        (so that a retry of it is applied)
+
+    """
+    shared_state.get_shared_state().end_sync(probe_id, sync_id, applied,
+        window)
+
+
+def get_stats():
+    """ Returns counters, and the fraction of checked syncs that were
+        duplicates
+
+    """
+    with _lock:
+        stats = dict(_stats)
+    stats["probes"] = shared_state.get_shared_state().get_stats()[
+        "dedup_probes"]
+
+    stats["dedup_rate"] = stats["duplicates"] / float(stats["checked"]) \
+        if stats["checked"] else 0.0
+    return stats
+
+
+# Initialize config when loading module
+init_config()
@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.service.sync_spool
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Module that makes accepted probe syncs durable on local disk before
+    they're written to the DB.  When the ingest mode is 'spool', each
+    sync is appended to a write-ahead spool and acknowledged once it's
+    been fsynced, so probes get a fast response however slow or
+    unavailable the DB is.  A background replayer applies spooled syncs
+    to storage in the order they were received.
+
+    The spool is a directory of numbered segment files, each a sequence
+    of records...
+
+        u32    Body length
+        u32    CRC-32 of the body
+        u32    Length of the JSON metadata (probe_id, sync_count,
+               sync_id, received time and sensor ids), then the JSON
+        i64[]  Timestamps of the readings
+        i32[]  Sensor index of each reading
+        f64[]  Values
+
+    Appends are fsynced in groups: syncs appended while an fsync is
+    underway are all covered by the next one, and fsync_interval_ms
+    can space fsyncs out to group more of them.  Segments are
+    rotated once they reach segment_mb, and removed once the replayer
+    has applied all of their records.  The replayer's position is kept
+    in a cursor file, so after a restart the spool is replayed from
+    where it left off.  The writes of the batch being replayed increment
+    counts, so each is recorded in the cursor as it's made.  A batch
+    that was partly applied before a restart is then read again up to
+    the same record, and only the writes that weren't made are made.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import atexit
+import ConfigParser
+import json
+import os
+import struct
+import threading
+import traceback
+import zlib
+
+from datetime import datetime
+
+import numpy
+
+from db import storage
+from probe_sync import ProbeSync
+from probe_sync import SensorReadings
+from service import probe_service
+
+import date_util
+
+# These values set from config file
+enabled = False
+spool_dir = "spool"
+segment_bytes = 16 << 20
+fsync_interval = 0
+replay_batch = 50
+
+# Seconds between replays of a batch while the DB is unavailable
+retry_backoff = 0.5
+retry_backoff_max = 30.0
+
+_record_header = struct.Struct("<II")
+_meta_length = struct.Struct("<I")
+_reading_size = 8 + 4 + 8
+
+_cond = threading.Condition()
+_segment = None  # File of the segment being appended to
+_written = None  # (segment, offset) past the last appended record
+_durable = None  # (segment, offset) past the last fsynced record
+_fsyncing = False  # Set while the fsync thread is fsyncing the segment
+_stopping = threading.Event()
+_threads = []
+_stats = {
+    "appended" : 0,
+    "appended_bytes" : 0,
+    "fsyncs" : 0,
+    "replayed" : 0,
+    "replay_batches" : 0,
+    "retries" : 0,
+    "errors" : 0,
+    "corrupt_segments" : 0,
+    "segments_removed" : 0
+}
+
+
+def init_config():
+    """ Read spool settings from config file
+
+    """
+    global enabled, spool_dir, segment_bytes, fsync_interval, replay_batch
+
+    config = ConfigParser.SafeConfigParser()
+    config.read("settings.cfg")
+
+    enabled = config.get("ingest", "mode") == "spool"
+    spool_dir = config.get("spool", "dir")
+    segment_bytes = config.getint("spool", "segment_mb") << 20
+    fsync_interval = config.getint("spool", "fsync_interval_ms") / 1000.0
+    replay_batch = config.getint("spool", "replay_batch")
+
+
+def start():
+    """ Opens the spool, recovering any segments left by a previous run,
+        and starts the fsync and replayer threads.  The spool is closed
+        when the process exits.
+
+    """
+    global _segment, _written, _durable
+
+    if _segment is not None:
+        return
+
+    if not os.path.isdir(spool_dir):
+        os.makedirs(spool_dir)
+
+    # A crash may have left a partly written record at the end of the
+    # last segment.  Appends go to a new segment.
+    segments = _list_segments()
+    if segments:
+        _truncate_torn_record(segments[-1])
+    seq = segments[-1] + 1 if segments else 1
+
+    _segment = open(_get_segment_path(seq), "ab")
+    _written = _durable = (seq, 0)
+    _stopping.clear()
+
+    for target, name in [(_fsync_loop, "spool-fsync"),
+            (_replay_loop, "spool-replayer")]:
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        _threads.append(thread)
+
+    atexit.register(stop)
+
+
+def stop():
+    """ Fsyncs and closes the spool, and stops the replayer.  Syncs not
+        yet replayed are replayed on the next start.
+
+    """
+    global _segment
+
+    if _segment is None:
+        return
+
+    _stopping.set()
+    with _cond:
+        _cond.notify_all()
+    for thread in _threads:
+        thread.join()
+    del _threads[:]
+
+    with _cond:
+        _fsync()
+        _segment.close()
+        _segment = None
+
+
+def append(probe_sync):
+    """ Appends the given probe sync to the spool, blocking until it's
+        been fsynced.  Returns False if the spool isn't open.
+
+    """
+    global _segment, _written, _durable
+
+    probe_sync.received = datetime.now()
+    record = _encode_record(probe_sync)
+
+    with _cond:
+        if _segment is None or _stopping.is_set():
+            return False
+
+        _segment.write(record)
+        seq, offset = _written
+        _written = (seq, offset + len(record))
+        position = _written
+        _cond.notify_all()
+
+        _stats["appended"] += 1
+        _stats["appended_bytes"] += len(record)
+
+        if _written[1] >= segment_bytes:
+            # Rotate, so the replayer can remove the full segment
+            while _fsyncing:
+                _cond.wait()
+            _fsync()
+            _segment.close()
+            _segment = open(_get_segment_path(seq + 1), "ab")
+            _written = _durable = (seq + 1, 0)
+            _cond.notify_all()
+
+        while _durable < position and _segment is not None:
+            _cond.wait()
+
+    return True
+
+
+def get_stats():
+    """ Returns counters, and the number of segments and bytes waiting
+        to be replayed
+
+    """
+    with _cond:
+        stats = dict(_stats)
+
+    cursor = _read_cursor()[:2]
+    pending = 0
+    segments = _list_segments() if os.path.isdir(spool_dir) else []
+    for seq in segments:
+        if seq >= cursor[0]:
+            size = os.path.getsize(_get_segment_path(seq))
+            pending += size - (cursor[1] if seq == cursor[0] else 0)
+
+    stats["segments"] = len(segments)
+    stats["pending_bytes"] = max(pending, 0)
+    return stats
+
+
+def _fsync():
+    global _durable
+
+    if _durable < _written:
+        _segment.flush()
+        os.fsync(_segment.fileno())
+        _durable = _written
+        _stats["fsyncs"] += 1
+        _cond.notify_all()
+
+
+def _fsync_loop():
+    """ Fsync thread loop.  Waits for appends, then fsyncs everything
+        appended so far, waking the appenders.  Appends aren't blocked
+        during the fsync, and are covered by the next one.
+
+    """
+    global _durable, _fsyncing
+
+    while True:
+        with _cond:
+            while _durable >= _written and not _stopping.is_set():
+                _cond.wait()
+            if _stopping.is_set():
+                return
+
+            _segment.flush()
+            target = _written
+            fileno = _segment.fileno()
+            _fsyncing = True
+
+        os.fsync(fileno)
+
+        with _cond:
+            _fsyncing = False
+            _durable = max(_durable, target)
+            _stats["fsyncs"] += 1
+            _cond.notify_all()
+
+        if fsync_interval:
+            _stopping.wait(fsync_interval)
+
+
+def _replay_loop():
+    """ Replayer thread loop.  Reads batches of durable records from the
+        cursor on, and applies them to storage.  While the DB is
+        unavailable the batch is retried with backoff.
+
+    """
+    seq, offset, batch = _read_cursor()
+
+    while not _stopping.is_set():
+        with _cond:
+            durable = _durable
+
+        # Skip to the oldest segment still spooled
+        if seq < durable[0] and not os.path.exists(_get_segment_path(seq)):
+            seq, offset = _next_segment(seq, durable[0]), 0
+            continue
+
+        # A batch that was partly applied before a restart is read
+        # again up to the same record, as its writes were made for it
+        limit = durable[1] if seq == durable[0] else None
+        written = {}
+        if batch is not None:
+            limit, written = batch["end"], batch["written"]
+            batch = None
+        try:
+            records, end = _read_records(seq, offset, limit, replay_batch)
+        except ValueError, e:
+            # A corrupt record in a closed segment.  The rest of the
+            # segment can't be read.
+            print "[ERROR] Skipping rest of spool segment %d: %s" % (seq,
+                str(e))
+            _inc_stat("corrupt_segments")
+            records, end = [], None
+
+        if records:
+            if not _replay(records, _BatchProgress(seq, offset, end,
+                    written)):
+                return  # Stopping
+            offset = end
+            _write_cursor(seq, offset)
+
+        elif seq < durable[0]:
+            # Every record of this closed segment has been applied
+            os.remove(_get_segment_path(seq))
+            _inc_stat("segments_removed")
+            seq, offset = seq + 1, 0
+            _write_cursor(seq, offset)
+
+        else:
+            with _cond:
+                if _durable == durable and not _stopping.is_set():
+                    _cond.wait(1.0)
+
+
+class _BatchProgress(dict):
+    """ Each probe's last write that succeeded of a batch of records
+        being replayed (see probe_service.process_probe_sync_batch()),
+        recorded in the cursor as it's made
+
+    """
+
+    def __init__(self, seq, offset, end, written):
+        dict.__init__(self, written)
+        self.seq = seq
+        self.offset = offset
+        self.end = end
+
+    def __setitem__(self, probe_id, write):
+        dict.__setitem__(self, probe_id, write)
+        _write_cursor(self.seq, self.offset, {"end" : self.end,
+            "written" : self})
+
+
+def _replay(records, written):
+    """ Applies the given records to storage, retrying while the DB is
+        unavailable.  Only the writes that haven't succeeded (as given
+        by written) are made.  Returns False if the spool was stopped
+        first.
+
+    """
+    probe_syncs = [_decode_record(record) for record in records]
+    backoff = retry_backoff
+
+    while True:
+        try:
+            probe_service.process_probe_sync_batch(probe_syncs, written)
+            break
+
+        except storage.StorageUnavailable, e:
+            print "[WARN] DB unavailable, retrying %d spooled probe syncs " \
+                "in %0.1fs: %s" % (len(probe_syncs), backoff, str(e))
+            _inc_stat("retries")
+            if _stopping.wait(backoff):
+                return False
+            backoff = min(backoff * 2, retry_backoff_max)
+
+        except Exception, e:
+            # Retrying won't help, so log it and move on
+            print "[ERROR] Failed to replay %d spooled probe syncs: %s" %\
+                (len(probe_syncs), str(e))
+            traceback.print_exc()
+            _inc_stat("errors")
+            break
+
+    with _cond:
+        _stats["replayed"] += len(probe_syncs)
+        _stats["replay_batches"] += 1
+    return True
+
+
+def _encode_record(probe_sync):
+    readings = probe_sync.readings
+    meta = json.dumps({
+        "probe_id" : probe_sync.probe_id,
+        "sync_count" : probe_sync.sync_count,
+        "sync_id" : getattr(probe_sync, "sync_id", None),
+        "received" : date_util.get_timestamp(probe_sync.received) +
+            probe_sync.received.microsecond / 1e6,
+        "clock" : getattr(probe_sync, "clock", None),
+        "sensor_ids" : readings.sensor_ids
+    })
+
+    body = "".join([_meta_length.pack(len(meta)), meta,
+        readings.timestamps.astype("<i8").tobytes(),
+        readings.sensor_indexes.astype("<i4").tobytes(),
+        readings.values.astype("<f8").tobytes()])
+    return _record_header.pack(len(body), zlib.crc32(body) & 0xFFFFFFFF) + \
+        body
+
+
+def _decode_record(body):
+    meta_length, = _meta_length.unpack_from(body)
+    pos = _meta_length.size + meta_length
+    meta = json.loads(body[_meta_length.size:pos])
+
+    count = (len(body) - pos) // _reading_size
+    timestamps = numpy.frombuffer(body, "<i8", count, pos)
+    sensor_indexes = numpy.frombuffer(body, "<i4", count, pos + count * 8)
+    values = numpy.frombuffer(body, "<f8", count, pos + count * 12)
+
+    probe_sync = ProbeSync({
+        "probe_id" : meta["probe_id"],
+        "sync_count" : meta["sync_count"],
+        "sensor_data" : SensorReadings(meta["sensor_ids"], sensor_indexes,
+            timestamps, values)
+    })
+    if meta["sync_id"] is not None:
+        probe_sync.sync_id = meta["sync_id"]
+    probe_sync.received = datetime.fromtimestamp(meta["received"])
+    probe_sync.clock = meta.get("clock")
+    return probe_sync
+
+
+def _read_records(seq, offset, limit, max_records):
+    """ Reads up to max_records record bodies of a segment from the
+        given offset, stopping at limit if given.  Returns a tuple of
+        (list of bodies, offset past the last one).  Raises ValueError
+        if a record is corrupt.
+
+    """
+    records = []
+    with open(_get_segment_path(seq), "rb") as segment:
+        segment.seek(offset)
+        while len(records) < max_records and (limit is None or
+                offset < limit):
+            try:
+                body = _read_record(segment, offset)
+            except ValueError:
+                if records:
+                    break  # Raised by the next read
+                raise
+            if body is None:
+                break
+
+            records.append(body)
+            offset += _record_header.size + len(body)
+
+    return records, offset
+
+
+def _read_record(segment, offset):
+    """ Returns the body of the record at the current position of the
+        segment file, or None at its end.  Raises ValueError if the
+        record is truncated or corrupt.
+
+    """
+    header = segment.read(_record_header.size)
+    if not header:
+        return None
+    if len(header) < _record_header.size:
+        raise ValueError("Truncated record at offset %d" % offset)
+
+    length, crc = _record_header.unpack(header)
+    body = segment.read(length)
+    if len(body) < length or zlib.crc32(body) & 0xFFFFFFFF != crc:
+        raise ValueError("Corrupt record at offset %d" % offset)
+    return body
+
+
+def _truncate_torn_record(seq):
+    """ Truncates a segment after its last complete record
+
+    """
+    path = _get_segment_path(seq)
+    offset = 0
+    with open(path, "rb") as segment:
+        while True:
+            try:
+                body = _read_record(segment, offset)
+            except ValueError:
+                break
+            if body is None:
+                break
+            offset += _record_header.size + len(body)
+
+    # Also reached after a corrupt record, so only records before it
+    # are replayed
+    if offset < os.path.getsize(path):
+        print "[WARN] Truncating spool segment %d after offset %d" % (seq,
+            offset)
+        with open(path, "r+b") as segment:
+            segment.truncate(offset)
+
+
+def _list_segments():
+    return sorted(int(name[:-len(".spool")]) for name in
+        os.listdir(spool_dir) if name.endswith(".spool"))
+
+
+def _next_segment(seq, current):
+    later = [s for s in _list_segments() if s > seq]
+    return later[0] if later else current
+
+
+def _get_segment_path(seq):
+    return os.path.join(spool_dir, "%012d.spool" % seq)
+
+
+def _read_cursor():
+    """ Returns the replayer's (segment, offset), and the progress of
+        the batch from there if one was partly applied, or None
+
+    """
+    path = os.path.join(spool_dir, "cursor.json")
+    if not os.path.exists(path):
+        return (0, 0, None)
+    with open(path) as cursor_file:
+        cursor = json.load(cursor_file)
+    return (cursor["segment"], cursor["offset"], cursor.get("batch"))
+
+
+def _write_cursor(seq, offset, batch=None):
+    path = os.path.join(spool_dir, "cursor.json")
+    cursor = {"segment" : seq, "offset" : offset}
+    if batch is not None:
+        cursor["batch"] = batch
+    with open(path + ".tmp", "w") as cursor_file:
+        json.dump(cursor, cursor_file)
+    os.rename(path + ".tmp", path)
+
+
+def _inc_stat(name):
+    with _cond:
+        _stats[name] += 1
+
+
+# Initialize config when loading module
+init_config()
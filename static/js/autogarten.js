@@ -2,57 +2,364 @@
    :license: MIT, see LICENSE for more details.
 */
 
+// How often lazily loaded sparklines are polled for new readings, when
+// live updates aren't available
+var pollSeconds = 60;
+
+// Rendered sparklines, by probe id and then sensor id
+var sparklines = {};
+
+// Incrementally drawn segments before a sparkline is redrawn whole
+var maxSegments = 100;
 
 
 function renderSparklines() {
 	/*
 	 * Based upon D3 sparkline example at:
 	 *   http://bl.ocks.org/benjchristensen/1133472
-	 * 
+	 *
 	 * Quick numbers for reference
 	 *   96 data points = 24 hrs  @ 15min gran
 	 *  168 data points = 07 days @ 1hr gran
 	 *  180 data points = 30 days @ 4hr gran
 	 */
 
-	// Get all sparkline containers and compute width/height from first sparkline
-    var sparklines = document.querySelectorAll(".sparkline");
-   	var sparklineWidth = (sparklines.length > 0) ? sparklines[0].offsetWidth : 0;
-	var sparklineHeight = (sparklines.length > 0) ? sparklines[0].offsetHeight : 0;
-
-	// Iterator over each sparkline in the page
-    for (i=0; i < sparklines.length; i++) {
-
-    	// Create an SVG element for the sparkline
-    	var sparkline = d3.select(sparklines[i])
-    		.append("svg:svg")
-			.attr("width", "100%")
-			.attr("height", "100%");
-
-		// Read data for this sparkline
-		var data = $.parseJSON(sparklines[i].getAttribute("data"));
-
-		// Create scales for rendering data. For more info on scales...
-		//  * https://github.com/mbostock/d3/wiki/Quantitative-Scales
-		//  * http://chimera.labs.oreilly.com/books/1230000000345/ch07.html
-		var xScale = d3.scale.linear()
-			.domain([0, data.values.length])
-			.range([0, sparklineWidth]);
-
-		var yScale = d3.scale.linear()
-			.domain([data.min_value, data.max_value])
-			.range([sparklineHeight, 0]);
-		
-		// Create an SVG line as the sparkline
-		var line = d3.svg.line()
-			.x(function(d,i) { return xScale(i); })
-			.y(function(d) { return yScale(d); });
-	
-		sparkline.append("svg:path").attr("d", line(data.values));
+	// Render each sparkline whose data was included in the page
+    var elements = document.querySelectorAll(".sparkline[data]");
+    for (i=0; i < elements.length; i++) {
+		var data = $.parseJSON(elements[i].getAttribute("data"));
+		registerSparkline(elements[i], data);
+		renderSparkline(elements[i], data);
+
+		// Live updates append readings after the last point (the
+		// start of the last bucket with data)
+		data.last_timestamp = data.start - 1;
+		for (var j=data.values.length - 1; j >= 0; j--) {
+			if (data.values[j] !== null) {
+				data.last_timestamp = data.timestamps[j];
+				break;
+			}
+		}
     }
 }
 
 
+function registerSparkline(container, data) {
+	var probeId = $(container).closest(".probeSection").attr("data-probe-id");
+	sparklines[probeId] = sparklines[probeId] || {};
+	sparklines[probeId][container.getAttribute("data-sensor-id")] = container;
+	container.sparklineData = data;
+}
+
+
+function renderSparkline(container, data) {
+
+	// Compute width/height from the sparkline's container
+	var sparklineWidth = container.offsetWidth;
+	var sparklineHeight = container.offsetHeight;
+
+	// Create an SVG element for the sparkline, replacing any already
+	// rendered
+	d3.select(container).selectAll("svg").remove();
+	var sparkline = d3.select(container)
+		.append("svg:svg")
+		.attr("width", "100%")
+		.attr("height", "100%");
+
+	// Points are placed by their timestamps, as those downsampled with
+	// LTTB or appended from live updates aren't evenly spaced.  Hourly
+	// buckets are placed at their start.
+	if (!data.timestamps) {
+		var span = data.end - data.start + 1;
+		data.timestamps = $.map(data.values, function(d,i) {
+			return data.start + Math.floor(i * span / data.values.length);
+		});
+	}
+
+	// Create scales for rendering data. For more info on scales...
+	//  * https://github.com/mbostock/d3/wiki/Quantitative-Scales
+	//  * http://chimera.labs.oreilly.com/books/1230000000345/ch07.html
+	var xScale = d3.scale.linear()
+		.domain([data.start, data.end])
+		.range([0, sparklineWidth]);
+
+	var yScale = d3.scale.linear()
+		.domain([data.min_value, data.max_value])
+		.range([sparklineHeight, 0]);
+
+	// Series are drawn within a group, which is shifted left as live
+	// updates slide the sparkline's week forward
+	var series = sparkline.append("svg:g");
+
+	// Draw the min/max envelope of each bucket, if given, as a band
+	// behind the line
+	if (data.min_values) {
+		var envelope = d3.svg.area()
+			.defined(function(d,i) { return data.min_values[i] !== null; })
+			.x(function(d,i) { return xScale(data.timestamps[i]); })
+			.y0(function(d,i) { return yScale(data.min_values[i]); })
+			.y1(function(d,i) { return yScale(data.max_values[i]); });
+
+		series.append("svg:path")
+			.attr("class", "envelope")
+			.attr("d", envelope(data.values));
+	}
+
+	// Create an SVG line as the sparkline, of [timestamp, value]
+	// points. Buckets without any data are null, and leave a gap in
+	// the line.
+	var line = d3.svg.line()
+		.defined(function(d) { return d[1] !== null; })
+		.x(function(d) { return xScale(d[0]); })
+		.y(function(d) { return yScale(d[1]); });
+
+	series.append("svg:path").attr("d",
+		line(d3.zip(data.timestamps, data.values)));
+
+	container.sparkline = {
+		series: series,
+		line: line,
+		xScale: xScale,
+		yScale: yScale,
+		origin: data.start,
+		segments: 0
+	};
+}
+
+
+function appendToSparkline(container, timestamps, values) {
+	/*
+	 * Appends readings newer than a sparkline's last to it.  Only the
+	 * new segment of the line is drawn, and the series is shifted as
+	 * its week slides forward.  The sparkline is redrawn whole if a
+	 * reading is outside of its scale, or after maxSegments appends.
+	 */
+	var data = container.sparklineData;
+	var state = container.sparkline;
+	if (!data || !state) {
+		return;
+	}
+
+	var points = [];
+	for (var i=0; i < timestamps.length; i++) {
+		if (timestamps[i] > data.last_timestamp) {
+			points.push([timestamps[i], values[i]]);
+		}
+	}
+	if (!points.length) {
+		return;
+	}
+
+	// The new segment continues the line from its last point
+	var last = data.values.length - 1;
+	var segment = (last >= 0 && data.values[last] !== null) ?
+		[[data.timestamps[last], data.values[last]]].concat(points) : points;
+
+	// Readings are appended as they are, and the envelope of each is
+	// just its value
+	$.each(points, function(i, point) {
+		data.timestamps.push(point[0]);
+		data.values.push(point[1]);
+		if (data.min_values) {
+			data.min_values.push(point[1]);
+			data.max_values.push(point[1]);
+		}
+	});
+	data.last_timestamp = points[points.length - 1][0];
+
+	// Slide the week forward, dropping what's now before it
+	var week = data.end - data.start;
+	data.end = Math.max(data.end, data.last_timestamp);
+	data.start = data.end - week;
+	var first = d3.bisectLeft(data.timestamps, data.start);
+	if (first > 0) {
+		data.timestamps = data.timestamps.slice(first);
+		data.values = data.values.slice(first);
+		if (data.min_values) {
+			data.min_values = data.min_values.slice(first);
+			data.max_values = data.max_values.slice(first);
+		}
+	}
+
+	var domain = state.yScale.domain();
+	var outOfScale = $.grep(points, function(point) {
+		return point[1] < domain[0] || point[1] > domain[1];
+	}).length > 0;
+
+	if (outOfScale || state.segments >= maxSegments) {
+		setValueRange(data);
+		renderSparkline(container, data);
+		return;
+	}
+
+	state.series.append("svg:path").attr("d", state.line(segment));
+	state.series.attr("transform", "translate(" +
+		(state.xScale(state.origin) - state.xScale(data.start)) + ",0)");
+	state.segments++;
+
+	// Show the latest reading as the sensor's current value
+	$(container).closest("tr").children().eq(1).html(formatNumber(
+		data.values[data.values.length - 1],
+		container.getAttribute("data-units") || ""));
+}
+
+
+function setValueRange(data) {
+	var values = $.grep(data.values, function(d) { return d !== null; });
+	data.min_value = d3.min(values.concat(data.min_values || [])) - 0.1;
+	data.max_value = d3.max(values.concat(data.max_values || [])) + 0.1;
+}
+
+
+function formatNumber(value, unitsLabel) {
+	return (value === null ? "-" : value.toFixed(2)) + unitsLabel;
+}
+
+
+function loadSensors() {
+	/*
+	 * Fills in the sensors of each probe rendered as a skeleton, and
+	 * then loads their sparklines.  Probes are loaded in parallel.
+	 */
+	$("tbody.lazySensors").each(function() {
+		var tbody = $(this);
+
+		$.getJSON(tbody.attr("data-sensors"), function(probe) {
+			tbody.empty();
+
+			$.each(probe.sensors, function(i, sensor) {
+				var row = $("<tr>");
+				$("<td>").text(sensor.id).appendTo(row);
+				$("<td>").html(formatNumber(sensor.curr_value,
+					sensor.units_label)).appendTo(row);
+				$("<td>").html(formatNumber(sensor.avg_value,
+					sensor.units_label)).appendTo(row);
+				var container = $("<div class='sparkline'>")
+					.attr("data-sensor-id", sensor.id)
+					.attr("data-units", sensor.units_label);
+				$("<td>").append(container).appendTo(row);
+				$("<td class='center-align'>").html(
+					formatNumber(sensor.min_value, sensor.units_label) +
+					" / " + formatNumber(sensor.max_value, sensor.units_label)
+				).appendTo(row);
+				tbody.append(row);
+
+				loadSeries(container[0], probe.start, probe.end,
+					tbody.attr("data-sensors") + "/" +
+					encodeURIComponent(sensor.id) + "/series",
+					tbody.attr("data-downsample"));
+			});
+		});
+	});
+}
+
+
+function loadSeries(container, start, end, url, downsample) {
+	/*
+	 * Loads the series of a sparkline.  Newer readings are then
+	 * appended from live updates, or polled for if they aren't
+	 * available.
+	 */
+	$.getJSON(url, {start: start, end: end, points: 168,
+			downsample: downsample}, function(series) {
+
+		var data = {
+			start: start,
+			end: end,
+			timestamps: series.timestamps,
+			values: series.values,
+			min_values: series.min_values,
+			max_values: series.max_values,
+			last_timestamp: (series.last_timestamp !== null) ?
+				series.last_timestamp : start - 1
+		};
+		setValueRange(data);
+		registerSparkline(container, data);
+		renderSparkline(container, data);
+
+		// Gets the readings since the last, such as those missed while
+		// live updates were reconnecting
+		container.catchUp = function() {
+			$.getJSON(url, {since: data.last_timestamp, points: 168},
+				function(newer) {
+					appendToSparkline(container, newer.timestamps,
+						newer.values);
+				});
+		};
+
+		if (!liveUpdates) {
+			setInterval(container.catchUp, pollSeconds * 1000);
+		}
+	});
+}
+
+
+function formatTime(timestamp) {
+	var time = new Date(timestamp * 1000);
+	return "Today at " + time.toTimeString().substr(0, 8);
+}
+
+
+function listenForUpdates(url) {
+	/*
+	 * Appends readings to sparklines and updates probes' status, as
+	 * they're written, from Server-Sent Events.  Returns false if the
+	 * browser doesn't support them.  The browser reconnects a dropped
+	 * stream, and sparklines then catch up on what they missed.
+	 */
+	if (!url || !window.EventSource) {
+		return false;
+	}
+
+	var source = new EventSource(url);
+	var opened = false;
+
+	source.addEventListener("open", function() {
+		if (opened) {
+			$.each(sparklines, function(probeId, sensors) {
+				$.each(sensors, function(sensorId, container) {
+					if (container.catchUp) {
+						container.catchUp();
+					}
+				});
+			});
+		}
+		opened = true;
+	});
+
+	source.addEventListener("points", function(e) {
+		var update = $.parseJSON(e.data);
+		var sensors = sparklines[update.probe_id] || {};
+		$.each(update.sensors, function(sensorId, points) {
+			if (sensors[sensorId]) {
+				appendToSparkline(sensors[sensorId], points.timestamps,
+					points.values);
+			}
+		});
+	});
+
+	source.addEventListener("status", function(e) {
+		var update = $.parseJSON(e.data);
+		var section = $(".probeSection").filter(function() {
+			return $(this).attr("data-probe-id") === update.probe_id;
+		});
+		var syncCount = section.find(".syncCount");
+		section.find(".lastContact").text(formatTime(update.last_contact));
+		syncCount.text(parseInt(syncCount.text(), 10) + update.syncs);
+		if (update.restart) {
+			section.find(".lastRestart").text(formatTime(update.last_contact));
+		}
+	});
+
+	return true;
+}
+
+
+var liveUpdates = false;
+
 $(document).ready(function() {
+	liveUpdates = listenForUpdates(
+		(typeof liveUrl !== "undefined") ? liveUrl : null);
 	renderSparklines();
-});
\ No newline at end of file
+	loadSensors();
+});
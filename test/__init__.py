@@ -3,7 +3,102 @@
     autogarten.test
     ~~~~~~~~~~~~~~~
 
-    autogarten test package 
-    
+    autogarten test package
+
+    Helpers shared by the tests: a factory of probe syncs, and a test
+    case that runs each test with the local storage backend in a
+    temporary directory.
+
     :license: MIT, see LICENSE for more details.
-"""
\ No newline at end of file
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime
+
+from db import shared_state
+from db import storage
+from db.local_storage import LocalStorage
+from probe_sync import ProbeSync
+from probe_sync import SensorReadings
+from service import alert_service
+
+
+def new_probe_sync(probe_id, sensor_data=(), curr_time=0, sync_id=None,
+        sync_count=2):
+    """ Returns a sync of a probe, received now, with readings given as
+        SensorReadings or as (sensor id, timestamp, value) tuples
+
+    """
+    if not isinstance(sensor_data, SensorReadings):
+        sensor_data = [{"id" : sensor_id, "timestamp" : timestamp,
+            "value" : value} for sensor_id, timestamp, value in sensor_data]
+
+    probe_sync = ProbeSync({
+        "probe_id" : probe_id,
+        "token" : "changeme",
+        "connection_attempts" : 1,
+        "sync_count" : sync_count,
+        "curr_time" : curr_time,
+        "sensor_data" : sensor_data
+    })
+    if sync_id is not None:
+        probe_sync.sync_id = sync_id
+    probe_sync.received = datetime.now()
+    return probe_sync
+
+
+class FlakyStorage(LocalStorage):
+    """ Local storage whose appends of points fail while failures are
+        left, as if the DB went down after a probe's status was written
+
+    """
+
+    def __init__(self, data_dir, failures=0):
+        LocalStorage.__init__(self, data_dir)
+        self.failures = failures
+
+    def append_points(self, probe_id, readings):
+        if self.failures:
+            self.failures -= 1
+            raise storage.StorageUnavailable("down")
+        LocalStorage.append_points(self, probe_id, readings)
+
+
+class StorageTestCase(unittest.TestCase):
+    """ Runs each test with the storage backend of create_storage() (by
+        default the local backend) in a temporary directory, memory
+        shared state and no alert notifier
+
+    """
+
+    def create_storage(self, data_dir):
+        return LocalStorage(data_dir)
+
+    def setUp(self):
+        shared_state.set_shared_state(
+            shared_state.create_shared_state("memory"))
+        alert_service.set_notifier(None)
+
+        self.data_dir = tempfile.mkdtemp(prefix="autogarten_test_")
+        self.storage = self.create_storage(self.data_dir)
+        storage.set_storage(self.storage)
+
+    def tearDown(self):
+        storage.get_storage().close()
+        shutil.rmtree(self.data_dir)
+
+    def get_sync_count(self, probe_id):
+        return self.storage.get_probe_statuses([probe_id])[0]["sync_count"]
+
+    def get_count_values(self, probe_id, start, end):
+        """ Returns the number of readings of each sensor of a probe in
+            the hours between the given timestamps, from its rollups
+
+        """
+        rollups = self.storage.get_hourly_rollups(probe_id,
+            datetime.fromtimestamp(start), datetime.fromtimestamp(end))
+        return dict((sensor_id, sum(rollup["count_values"] for rollup in
+            hours)) for sensor_id, hours in rollups.items())
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.benchmark_alerts
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Micro-benchmark of streaming alerts (service.alert_service), feeding
+    probes' syncs to it in time order and reporting the readings checked
+    per second...
+
+        $ python -m test.benchmark_alerts --probes 200 --hours 24
+
+    Each sensor follows a daily cycle with noise, and a few sensors have
+    a fault injected halfway through: going out of range, getting stuck
+    at one value, or drifting away from their level.  The faults that
+    were alerted on, and any alerts raised on sensors without a fault,
+    are reported.  Alerts are written to the local storage backend, in a
+    temporary directory, so it doesn't require mongoDB.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy
+
+from db import storage
+from db.local_storage import LocalStorage
+from probe_sync import SensorReadings
+from service import alert_service
+
+start_time = 1400000000
+faults = ["out_of_range", "stuck", "drift"]
+
+
+class CountingNotifier(object):
+    """ Counts the alerts raised of each (probe, sensor, kind)
+
+    """
+
+    def __init__(self):
+        self.raised = {}
+
+    def notify(self, alert):
+        if alert["state"] == "raised":
+            key = (alert["probe_id"], alert["sensor_id"], alert["kind"])
+            self.raised[key] = self.raised.get(key, 0) + 1
+
+
+def generate_sync(probe, sync_time, sensor_count, sensor_freq, sync_freq,
+        fault_start, fault):
+    """ Returns SensorReadings of each sensor since the last sync.  The
+        first sensor has the given fault (if any) from fault_start.
+
+    """
+    timestamps = numpy.arange(sync_time - sync_freq, sync_time,
+        sensor_freq) + 1
+    count = len(timestamps)
+    values = numpy.empty(count * sensor_count)
+    for sensor in range(sensor_count):
+        values[sensor * count:(sensor + 1) * count] = 20 + 5 * numpy.sin(
+            2 * numpy.pi * timestamps / 86400.0 + probe + sensor) + \
+            numpy.random.normal(0, 0.5, count)
+
+    faulty = timestamps >= fault_start
+    if fault and faulty.any():
+        first = values[:count]
+        if fault == "out_of_range":
+            first[faulty] = 60
+        elif fault == "stuck":
+            first[faulty] = 21.5
+        else:
+            first[faulty] += 12 + 4 * (timestamps[faulty] - fault_start) / \
+                86400.0
+
+    return SensorReadings(["tmp%d" % ii for ii in range(sensor_count)],
+        numpy.repeat(numpy.arange(sensor_count), count),
+        numpy.tile(timestamps, sensor_count), values)
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten streaming alerts benchmark")
+    parser.add_argument("-n", "--probes", type=int, default=200,
+            help="Probes syncing")
+    parser.add_argument("--sensors", type=int, default=4,
+            help="Sensors of each probe")
+    parser.add_argument("--sensor_freq", type=int, default=15,
+            help="Seconds between each sensor's readings")
+    parser.add_argument("--sync_freq", type=int, default=600,
+            help="Seconds between each probe's syncs")
+    parser.add_argument("--hours", type=int, default=24,
+            help="Hours of readings fed")
+    parser.add_argument("--faulty", type=float, default=0.1,
+            help="Share of probes whose first sensor has a fault")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    numpy.random.seed(0)
+
+    data_dir = tempfile.mkdtemp(prefix="autogarten_benchmark_")
+    storage.set_storage(LocalStorage(data_dir))
+    notifier = CountingNotifier()
+    alert_service.set_notifier(notifier)
+    alert_service.ranges = alert_service.parse_ranges("tmp*:0:45")
+    alert_service.drift_warmup = 3600 / args.sensor_freq
+    alert_service.reset()
+
+    probe_faults = {}
+    for probe in range(int(args.probes * args.faulty)):
+        probe_faults[probe] = faults[probe % len(faults)]
+    fault_start = start_time + args.hours * 3600 / 2
+
+    print "%8s  %12s  %12s  %14s  %8s" % ("hours", "readings", "elapsed",
+        "readings/sec", "alerts")
+
+    readings_count = 0
+    elapsed = 0.0
+    sync_time = start_time
+    end_time = start_time + args.hours * 3600
+    while sync_time < end_time:
+        sync_time += args.sync_freq
+        syncs = [("probe%d" % probe, generate_sync(probe, sync_time,
+            args.sensors, args.sensor_freq, args.sync_freq, fault_start,
+            probe_faults.get(probe))) for probe in range(args.probes)]
+
+        start = time.time()
+        for probe_id, readings in syncs:
+            alert_service.observe(probe_id, readings)
+        elapsed += time.time() - start
+        readings_count += sum(len(readings) for probe_id, readings in syncs)
+
+        if (sync_time - start_time) % (args.hours * 3600 / 4) == 0:
+            stats = alert_service.get_stats()
+            print "%8.1f  %12d  %11.2fs  %14d  %8d" % (
+                (sync_time - start_time) / 3600.0, readings_count, elapsed,
+                readings_count / elapsed, stats["raised"])
+
+    print "\nInjected faults alerted on:"
+    for fault in faults:
+        probes = [probe for probe, kind in probe_faults.items()
+            if kind == fault]
+        alerted = [probe for probe in probes
+            if ("probe%d" % probe, "tmp0", fault) in notifier.raised]
+        print "  %-14s %d of %d" % (fault, len(alerted), len(probes))
+
+    false_alerts = sum(count for (probe_id, sensor_id, kind), count
+        in notifier.raised.items() if sensor_id != "tmp0" or
+        probe_faults.get(int(probe_id[5:])) is None)
+    print "  %-14s %d" % ("other alerts", false_alerts)
+    print "\n%d alerts written" % len(storage.get_storage().get_alerts())
+
+    storage.get_storage().close()
+    shutil.rmtree(data_dir)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.benchmark_bucketize
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Micro-benchmark of series_util.bucketize() against the original
+    dict based bucketize_data() loop, for 10^4 to 10^7 data points
+    bucketized into 168 buckets.  Also times bucketizing many sensors
+    at once.  Doesn't require mongoDB.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import time
+
+import numpy
+
+import series_util
+
+bucket_count = 168
+sensor_count = 16
+
+
+def bucketize_data_dict(bucket_count, min_bucket, max_bucket, data):
+    """ The original bucketize_data(), which maps a dict of stringified
+        timestamps to values into unordered buckets.
+
+    """
+    buckets = {}
+    divisor = (max_bucket - min_bucket) / bucket_count
+
+    for d in data:
+        if int(d) < min_bucket or int(d) > max_bucket:
+            continue
+
+        key = (int(d) - min_bucket) / divisor
+        if key not in buckets:
+            buckets[key] = [data[d]]
+        else:
+            buckets[key].append(data[d])
+
+    for key in buckets:
+        buckets[key] = sum(buckets[key]) / float(len(buckets[key]))
+
+    return buckets.values()
+
+
+def generate_series(count, start=1400000000, span=7 * 24 * 3600):
+    timestamps = numpy.sort(numpy.random.randint(start, start + span, count))
+    values = numpy.random.random(count) * 100
+    return timestamps, values, start, start + span
+
+
+def time_it(fn, *args, **kwargs):
+    start = time.time()
+    fn(*args, **kwargs)
+    return time.time() - start
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten bucketize benchmark")
+    parser.add_argument("-e", "--exponents", type=int, nargs="+",
+            default=[4, 5, 6, 7], help="Benchmark 10^n data points")
+    parser.add_argument("--skip_dict", action="store_true",
+            help="Skip the (slow) original dict based loop")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    print "%10s  %10s  %10s  %10s  %10s  %16s" % ("points", "dict loop",
+        "mean", "min", "last", "%d sensors mean" % sensor_count)
+
+    for exponent in args.exponents:
+        count = 10 ** exponent
+        timestamps, values, start, end = generate_series(count)
+
+        dict_time = float("nan")
+        if not args.skip_dict:
+            data = dict(zip(timestamps.astype(str).tolist(), values.tolist()))
+            dict_time = time_it(bucketize_data_dict,
+                bucket_count, start, end, data)
+            del data
+
+        times = [time_it(series_util.bucketize, timestamps, values,
+            bucket_count, start, end, agg) for agg in ["mean", "min", "last"]]
+
+        groups = numpy.arange(count) % sensor_count
+        group_time = time_it(series_util.bucketize, timestamps, values,
+            bucket_count, start, end, groups=groups, group_count=sensor_count)
+
+        print "%10d  %9.4fs  %9.4fs  %9.4fs  %9.4fs  %15.4fs" % \
+            tuple([count, dict_time] + times + [group_time])
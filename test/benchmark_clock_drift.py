@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.benchmark_clock_drift
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Checks the clock drift correction of probe readings (see
+    service.clock_drift), in two parts...
+
+        $ python -m test.benchmark_clock_drift --probes 50 --hours 72
+
+    Latency: the time to correct the timestamps of a sync of --points
+    readings, and of a batch of such syncs, against the time to persist
+    them with the local storage backend.
+
+    Accuracy: probes whose clocks run fast or slow (by up to --ppm parts
+    per million, with a random offset at the start) take readings every
+    sensor_freq seconds of their own clock, and sync every sync_freq
+    seconds.  Each request and response takes a random one way trip of
+    up to --max_trip seconds, and the probe sends the round trip of its
+    previous sync.  Half of the probes set their clock to each
+    response's curr_time, as the Arduino library does, the rest keep it
+    (as with sets_clock unset).  The error of the readings' stored
+    timestamps from the server time they were taken at is reported, as
+    they were sent and as corrected, after the first --warmup syncs.
+
+    Both run against the local storage backend, in a temporary
+    directory, so they don't require mongoDB.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy
+
+from db import storage
+from db.local_storage import LocalStorage
+from probe_sync import ProbeSync
+from probe_sync import SensorReadings
+from service import clock_drift
+from service import probe_service
+
+start_time = 1400000000.0
+
+
+class DriftingProbe(object):
+    """ A probe whose clock runs at (1 - rate) of the server's, from an
+        initial offset
+
+    """
+
+    def __init__(self, probe_id, rate, offset, sets_clock):
+        self.probe_id = probe_id
+        self.rate = rate
+        self.sets_clock = sets_clock
+        self.sync_count = 0
+        self.round_trip_ms = None
+
+        # The probe's clock reads clock_base at server time server_base
+        self.server_base = start_time
+        self.clock_base = start_time - offset
+
+    def get_time(self, server_time):
+        return self.clock_base + (server_time - self.server_base) * \
+            (1 - self.rate)
+
+    def get_server_time(self, probe_time):
+        return self.server_base + (probe_time - self.clock_base) / \
+            (1 - self.rate)
+
+    def sync(self, sync_time, sensor_freq, sync_freq, max_trip):
+        """ Returns the sync the probe sends at server time sync_time,
+            with its readings since the previous sync, the server time
+            it's received at, and the true server time of each reading
+
+        """
+        end = int(self.get_time(sync_time))
+        timestamps = numpy.arange(end - sync_freq, end, sensor_freq) + 1
+        true_times = self.get_server_time(timestamps)
+
+        probe_sync = ProbeSync({
+            "probe_id" : self.probe_id,
+            "sync_count" : self.sync_count,
+            "curr_time" : end,
+            "sensor_data" : SensorReadings(["tmp0"],
+                numpy.zeros(len(timestamps)), timestamps,
+                numpy.ones(len(timestamps)))
+        })
+        if self.round_trip_ms is not None:
+            probe_sync.round_trip_ms = self.round_trip_ms
+
+        request_trip, response_trip = numpy.random.uniform(0, max_trip, 2)
+        received = sync_time + request_trip
+        self.round_trip_ms = int((request_trip + response_trip) * 1000)
+        self.sync_count += 1
+
+        # The response's curr_time is read response_trip later
+        if self.sets_clock:
+            self.server_base = received + response_trip
+            self.clock_base = int(received)
+
+        return probe_sync, received, true_times
+
+
+def time_correction(points, batch, repeat):
+    """ Returns the seconds to correct a sync of the given points, and a
+        batch of such syncs, and to persist the same sync
+
+    """
+    def new_sync(ii):
+        timestamps = numpy.arange(points) * 15 + int(start_time)
+        probe_sync = ProbeSync({
+            "probe_id" : "timed%d" % ii,
+            "sync_count" : 2,
+            "sensor_data" : SensorReadings(["tmp%d" % (jj % 4) for jj in
+                range(4)], numpy.arange(points) % 4, timestamps,
+                numpy.random.uniform(0, 40, points))
+        })
+        probe_sync.clock = {"offset" : 12.3, "rate" : 0.0004,
+            "probe_time" : int(timestamps[-1]) + 5,
+            "start_time" : int(timestamps[0]) - 5}
+        return probe_sync
+
+    syncs = [new_sync(ii) for ii in range(batch)]
+
+    def best(function):
+        times = []
+        for ii in range(repeat):
+            start = time.time()
+            function()
+            times.append(time.time() - start)
+        return min(times)
+
+    return (best(lambda: clock_drift.correct(syncs[:1])),
+        best(lambda: clock_drift.correct(syncs)),
+        best(lambda: probe_service.persist_sensor_data("timed0",
+            syncs[0].readings)))
+
+
+def get_errors(stored, true_times):
+    errors = numpy.abs(stored - true_times)
+    return errors.mean(), numpy.percentile(errors, 99), \
+        numpy.mean(errors <= 1) * 100
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten clock drift correction benchmark")
+    parser.add_argument("--points", type=int, default=1000,
+            help="Readings in each timed sync")
+    parser.add_argument("--batch", type=int, default=50,
+            help="Syncs in each timed batch")
+    parser.add_argument("--repeat", type=int, default=50,
+            help="Times each is timed, taking the best")
+    parser.add_argument("-n", "--probes", type=int, default=50,
+            help="Simulated probes")
+    parser.add_argument("--hours", type=int, default=72,
+            help="Simulated hours")
+    parser.add_argument("--sensor_freq", type=int, default=15,
+            help="Seconds between readings")
+    parser.add_argument("--sync_freq", type=int, default=3600,
+            help="Seconds between syncs")
+    parser.add_argument("--ppm", type=float, default=2000,
+            help="Most the probes' clocks are fast or slow by")
+    parser.add_argument("--max_offset", type=float, default=20,
+            help="Most the probes' clocks are off by at the start")
+    parser.add_argument("--max_trip", type=float, default=2,
+            help="Most each request or response takes, in seconds")
+    parser.add_argument("--warmup", type=int, default=6,
+            help="Syncs of each probe not counted")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    numpy.random.seed(0)
+
+    data_dir = tempfile.mkdtemp(prefix="autogarten_benchmark_")
+    storage.set_storage(LocalStorage(data_dir))
+    clock_drift.reset()
+
+    print "------------------------< autogarten Clock Drift Benchmark >----"
+    one, batch, persist = time_correction(args.points, args.batch,
+        args.repeat)
+    print "  Correct %d readings:      %8.1f us  (persisting them: %0.1f us)" % (
+        args.points, one * 1e6, persist * 1e6)
+    print "  Correct %d x %d readings: %8.1f us  (%0.2f us per sync)" % (
+        args.batch, args.points, batch * 1e6, batch * 1e6 / args.batch)
+    print ""
+
+    probes = [DriftingProbe("probe%d" % ii,
+        numpy.random.uniform(-args.ppm, args.ppm) / 1e6,
+        numpy.random.uniform(-args.max_offset, args.max_offset),
+        ii % 2 == 0) for ii in range(args.probes)]
+
+    results = dict((sets_clock, ([], [], [])) for sets_clock in [True, False])
+    for ii in range(args.hours * 3600 / args.sync_freq):
+        sync_time = start_time + (ii + 1) * args.sync_freq
+        for probe in probes:
+            probe_sync, received, true_times = probe.sync(sync_time,
+                args.sensor_freq, args.sync_freq, args.max_trip)
+            clock_drift.sets_clock = probe.sets_clock
+            clock_drift.observe(probe_sync, received)
+            corrected = clock_drift.correct([probe_sync])
+
+            if ii >= args.warmup:
+                sent, stored, truth = results[probe.sets_clock]
+                sent.append(probe_sync.readings.timestamps)
+                stored.append(corrected.timestamps)
+                truth.append(true_times)
+
+    print "  %d probes up to %d ppm, syncing every %ds for %d hours" % (
+        args.probes, args.ppm, args.sync_freq, args.hours)
+    print "%22s  %22s  %22s" % ("", "error as sent", "error corrected")
+    print "%22s  %6s  %6s  %8s  %6s  %6s  %8s" % ("", "mean", "p99",
+        "<= 1s", "mean", "p99", "<= 1s")
+    for sets_clock in [True, False]:
+        sent, stored, truth = [numpy.concatenate(column)
+            for column in results[sets_clock]]
+        print "%22s  %5.1fs  %5.1fs  %7.1f%%  %5.1fs  %5.1fs  %7.1f%%" % ((
+            "probes setting clocks" if sets_clock else "probes keeping clocks",) +
+            get_errors(sent, truth) + get_errors(stored, truth))
+
+    print ""
+    print "  %s" % clock_drift.get_stats()
+
+    storage.get_storage().close()
+    shutil.rmtree(data_dir)
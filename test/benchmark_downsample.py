@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.benchmark_downsample
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Micro-benchmark of the series_util downsamplers ('bucket' means,
+    the 'minmax' envelope and 'lttb'), for 10^4 to 10^7 data points of
+    a week long temperature-like series reduced to 168 and 1000 points.
+    Short sudden drops are injected into the series, and the share of
+    them that's still visible once downsampled (reaching at least half
+    of the drop's depth) is reported for each downsampler.  LTTB is
+    checked against a straightforward pure Python implementation.
+    Doesn't require mongoDB.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import time
+
+import numpy
+
+import series_util
+
+span = 7 * 24 * 3600
+spike_count = 20
+spike_depth = 15.0
+
+
+def generate_series(count, start=1400000000):
+    """ Returns a tuple of timestamps, values, the time range and the
+        times of the injected drops, of a daily temperature cycle with
+        noise and spike_count sudden drops each lasting 0.05% of it.
+
+    """
+    timestamps = numpy.linspace(start, start + span, count).astype(numpy.int64)
+    values = 70 + 8 * numpy.sin(2 * numpy.pi * (timestamps - start) / 86400.0)
+    values += numpy.random.normal(0, 0.3, count)
+
+    spikes = numpy.random.randint(start, start + span, spike_count)
+    for spike in spikes:
+        dropped = (timestamps >= spike) & (timestamps < spike + span / 2000)
+        values[dropped] -= spike_depth
+
+    return timestamps, values, start, start + span, spikes
+
+
+def lttb_reference(timestamps, values, points):
+    """ Largest-Triangle-Three-Buckets, looping over every data point
+
+    """
+    count = len(values)
+    edge = lambda ii: int(ii * (count - 2) / float(points - 2)) + 1
+    kept = [0]
+    previous = 0
+
+    for ii in range(points - 2):
+        lo, hi = edge(ii), edge(ii + 1)
+
+        # The last bucket is followed by the last data point
+        next_lo, next_hi = (hi, edge(ii + 2)) if ii < points - 3 else \
+            (count - 1, count)
+        avg_x = sum(float(t) for t in timestamps[next_lo:next_hi]) / \
+            (next_hi - next_lo)
+        avg_y = sum(values[next_lo:next_hi]) / (next_hi - next_lo)
+
+        max_area = -1
+        for jj in range(lo, hi):
+            area = abs((timestamps[previous] - avg_x) *
+                (values[jj] - values[previous]) -
+                (timestamps[previous] - timestamps[jj]) *
+                (avg_y - values[previous]))
+            if area > max_area:
+                max_area = area
+                chosen = jj
+        kept.append(chosen)
+        previous = chosen
+
+    kept.append(count - 1)
+    return kept
+
+
+def downsample(timestamps, values, points, start, end, downsampler):
+    """ Returns the timestamps and the lowest values of the downsampled
+        series
+
+    """
+    if downsampler == "bucket":
+        return (start + numpy.arange(points) * (end - start) / float(points),
+            series_util.bucketize(timestamps, values, points, start, end))
+    if downsampler == "minmax":
+        # As the series API builds the envelope (see probe_service)
+        accumulator = series_util.BucketAccumulator(points, start, end)
+        accumulator.add(timestamps, values)
+        return accumulator.get_timestamps(), accumulator.get_values("min")
+    return series_util.lttb(timestamps, values, points)
+
+
+def visible_spikes(timestamps, values, start, spikes, result, points):
+    """ Returns the share of spikes that the downsampled result shows
+        reaching half of their depth
+
+    """
+    result_times, result_values = result
+    width = span / float(points)
+    visible = 0
+
+    for spike in spikes:
+        near = (result_times >= spike - width) & (result_times <= spike + width)
+        baseline = 70 + 8 * numpy.sin(2 * numpy.pi * (spike - start) / 86400.0)
+        if near.any() and numpy.nanmin(result_values[near]) <= \
+                baseline - spike_depth / 2:
+            visible += 1
+
+    return visible / float(len(spikes))
+
+
+def time_it(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return time.time() - start, result
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten downsample benchmark")
+    parser.add_argument("-e", "--exponents", type=int, nargs="+",
+            default=[4, 5, 6, 7], help="Benchmark 10^n data points")
+    parser.add_argument("-p", "--points", type=int, nargs="+",
+            default=[168, 1000], help="Downsample to this many points")
+    parser.add_argument("--skip_reference", action="store_true",
+            help="Skip checking LTTB against the (slow) pure Python loop")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    numpy.random.seed(0)
+
+    if not args.skip_reference:
+        timestamps, values, start, end, spikes = generate_series(10 ** 4)
+        for points in args.points:
+            kept_times, kept_values = series_util.lttb(timestamps, values,
+                points)
+            reference = lttb_reference(timestamps.tolist(), values.tolist(),
+                points)
+            assert kept_times.tolist() == timestamps[reference].tolist(), \
+                "LTTB differs from the reference for %d points" % points
+        print "LTTB matches the reference implementation\n"
+
+    print "%10s  %6s  %-8s  %10s  %8s" % ("points", "to", "method", "time",
+        "spikes")
+
+    for exponent in args.exponents:
+        count = 10 ** exponent
+        timestamps, values, start, end, spikes = generate_series(count)
+
+        for points in args.points:
+            for downsampler in series_util.downsamplers:
+                elapsed, result = time_it(downsample, timestamps, values,
+                    points, start, end, downsampler)
+                print "%10d  %6d  %-8s  %9.4fs  %7.0f%%" % (count, points,
+                    downsampler, elapsed, 100 * visible_spikes(timestamps,
+                    values, start, spikes, result, points))
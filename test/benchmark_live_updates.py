@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.benchmark_live_updates
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Checks the fan-out latency of live updates.  Serves the Control
+    Server in this process (with the local storage backend, in a
+    temporary directory), opens many idle /api/live streams to it over
+    HTTP, then posts syncs and measures the time from posting each sync
+    until each stream receives its points...
+
+        $ python -m test.benchmark_live_updates --streams 500 --gevent
+
+    With --gevent the server (and the streams' readers) run as
+    greenlets, as with gevent_server.py, otherwise each connection has
+    a thread, as with the Werkzeug server.  The OS threads of the
+    process while the streams are idle are reported, with percentiles
+    of the latency.  Exits with status 1 if the 99th percentile exceeds
+    --max_latency_ms, or a stream misses an update.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import sys
+
+# Must patch the standard library before anything else imports it
+if "--gevent" in sys.argv:
+    from gevent import monkey
+    monkey.patch_all()
+
+import argparse
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib2
+
+import numpy
+
+from db import storage
+from db.local_storage import LocalStorage
+from test.load_probes import encode_request
+from test.load_probes import SimulatedProbe
+
+import control_server
+import date_util
+
+
+class Stream(object):
+    """ An idle /api/live connection, recording when each points event
+        arrives
+
+    """
+
+    def __init__(self, port):
+        self.received = []
+        self.socket = socket.create_connection(("127.0.0.1", port))
+        self.socket.sendall("GET /api/live HTTP/1.0\r\n\r\n")
+
+    def read(self):
+        tail = ""
+        try:
+            while True:
+                chunk = self.socket.recv(65536)
+                if not chunk:
+                    break
+                now = time.time()
+                data = tail + chunk
+                self.received.extend([now] * data.count("event: points\n"))
+                tail = data[-len("event: points\n") + 1:]
+        except socket.error:
+            pass
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+
+
+def start_server(use_gevent):
+    """ Serves the Control Server on a free local port, in the
+        background.  Returns the server and its port.
+
+    """
+    if use_gevent:
+        from gevent.pywsgi import WSGIServer
+        server = WSGIServer(("127.0.0.1", 0), control_server.app, log=None)
+        server.start()
+        return server, server.server_port
+
+    from werkzeug.serving import make_server
+    from werkzeug.serving import WSGIRequestHandler
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, control_server.app, threaded=True,
+        request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name="server")
+    thread.daemon = True
+    thread.start()
+    return server, server.server_port
+
+
+def get_os_threads():
+    """ Returns the OS threads of this process, or None if unknown
+
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten live updates fan-out latency check")
+    parser.add_argument("-n", "--streams", type=int, default=300,
+            help="Idle live update streams")
+    parser.add_argument("--syncs", type=int, default=20,
+            help="Syncs posted")
+    parser.add_argument("--interval", type=float, default=0.2,
+            help="Seconds between syncs")
+    parser.add_argument("--sensors", type=int, default=4,
+            help="Sensors of the syncing probe")
+    parser.add_argument("--gevent", action="store_true",
+            help="Serve with gevent rather than a thread per connection")
+    parser.add_argument("--max_latency_ms", type=float, default=250,
+            help="Fail if the 99th percentile latency exceeds this")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="autogarten_benchmark_")
+    storage.set_storage(LocalStorage(data_dir))
+    control_server.init_config()
+    control_server.live_updates.enabled = True
+    control_server.live_updates.max_subscribers = args.streams
+    server, port = start_server(args.gevent)
+
+    print "-----------------------------< autogarten Live Updates Check >----"
+    print "  %d streams, %d syncs of %d sensors, %s" % (args.streams,
+        args.syncs, args.sensors, "gevent" if args.gevent else
+        "a thread per connection")
+
+    streams = []
+    readers = []
+    for ii in range(args.streams):
+        stream = Stream(port)
+        reader = threading.Thread(target=stream.read, name="reader")
+        reader.daemon = True
+        reader.start()
+        streams.append(stream)
+        readers.append(reader)
+
+    # Wait for every stream to subscribe
+    deadline = time.time() + 30
+    while control_server.live_updates.get_stats()["subscribers"] < \
+            args.streams and time.time() < deadline:
+        time.sleep(0.05)
+    subscribers = control_server.live_updates.get_stats()["subscribers"]
+    print "  Subscribed: %d, OS threads while idle: %s" % (subscribers,
+        get_os_threads())
+
+    probe = SimulatedProbe("live_probe", args.sensors, 15, 60, 0, 0,
+        date_util.get_current_timestamp() - args.syncs * 60,
+        control_server.token)
+    url = "http://127.0.0.1:%d/probe_sync" % port
+    posted = []
+    post_times = []
+    for ii in range(args.syncs):
+        content_type, body = encode_request(probe.sync(), False)
+        request = urllib2.Request(url, body, {"Content-Type" : content_type})
+        start = time.time()
+        posted.append(start)
+        urllib2.urlopen(request).read()
+        post_times.append(time.time() - start)
+        time.sleep(args.interval)
+
+    # Give the last update time to arrive
+    deadline = time.time() + 5
+    while time.time() < deadline and \
+            min(len(stream.received) for stream in streams) < args.syncs:
+        time.sleep(0.05)
+
+    latencies = []
+    missed = 0
+    for stream in streams:
+        missed += args.syncs - len(stream.received)
+        for sent, received in zip(posted, stream.received):
+            latencies.append(received - sent)
+
+    # End the streams, so their connections finish before the server
+    # stops
+    control_server.live_updates.close_all()
+    for reader in readers:
+        reader.join(5)
+    for stream in streams:
+        stream.close()
+    if args.gevent:
+        server.stop()
+    else:
+        server.shutdown()
+
+    latencies = numpy.array(latencies) * 1000
+    post_times = numpy.array(post_times) * 1000
+    print "  Sync post ms:  p50 %0.2f  max %0.2f" % (
+        numpy.percentile(post_times, 50), post_times.max())
+    if len(latencies):
+        print "  Fan-out ms:    p50 %0.2f  p95 %0.2f  p99 %0.2f  max %0.2f" % \
+            tuple(numpy.percentile(latencies, [50, 95, 99]).tolist() +
+                [latencies.max()])
+    print "  Missed:        %d" % missed
+
+    storage.get_storage().close()
+    shutil.rmtree(data_dir)
+
+    if missed or not len(latencies) or \
+            numpy.percentile(latencies, 99) > args.max_latency_ms:
+        print "\nFAILED"
+        sys.exit(1)
+    print "\nOK"
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.benchmark_persist
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmark that compares persisting a probe sync one upsert per
+    data point (the original approach) against the grouped, single
+    bulk write done by the mongoDB storage backend.  Reports
+    the number of round trips to mongoDB and the wall time for each.
+
+    Writes to a scratch 'benchmark_sensor_data' collection in the
+    mongoDB instance configured in settings.cfg, which is dropped
+    before and after each run.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import math
+import time
+
+from datetime import datetime
+
+from db import mongo
+from db.mongo_storage import MongoStorage
+from db.mongo_storage import get_metric_id
+
+import date_util
+
+sync_sizes = [10, 1000, 100000]
+sensor_ids = ["tmp0", "tmp1", "pho0", "mos0"]
+
+
+class CountingCollection(object):
+    """ Wraps a mongoDB collection and counts the round trips made
+        through update() and bulk write execute() calls.
+
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.round_trips = 0
+
+    def update(self, *args, **kwargs):
+        self.round_trips += 1
+        return self.collection.update(*args, **kwargs)
+
+    def initialize_ordered_bulk_op(self):
+        bulk = self.collection.initialize_ordered_bulk_op()
+        find, execute = bulk.find, bulk.execute
+        batch_size = self.collection.database.connection.max_write_batch_size
+        ops = [0]
+
+        def counting_find(*args, **kwargs):
+            ops[0] += 1
+            return find(*args, **kwargs)
+
+        def counting_execute(*args, **kwargs):
+            # The driver splits a bulk write into batches of at most
+            # max_write_batch_size operations, one round trip each
+            self.round_trips += int(math.ceil(ops[0] / float(batch_size)))
+            return execute(*args, **kwargs)
+
+        bulk.find, bulk.execute = counting_find, counting_execute
+        return bulk
+
+
+def persist_sensor_data_per_point(store, probe_id, sensor_data):
+    """ The original implementation of persist_sensor_data(), which
+        sends one upsert per data point.
+
+    """
+    for data_point in sensor_data:
+        sensor_id = data_point["id"]
+        timestamp = data_point["timestamp"]
+        date_time = datetime.fromtimestamp(timestamp)
+        day = date_util.get_midnight(date_time)
+        value = data_point["value"]
+
+        store.get_collection("sensor_data").update(
+            {"_id" : get_metric_id(day, probe_id, sensor_id)},
+            {"$set" : {
+                "probe_id" : probe_id,
+                "sensor_id" : sensor_id,
+                "day" : day,
+                "data.%d" % (timestamp) : value},
+             "$inc" : {
+                "count_values" : 1,
+                "sum_values" : value},
+             "$min" : {
+                "min_value" : value},
+             "$max" : {
+                "max_value" : value}
+            }, True)  # True for upsert
+
+
+def generate_sensor_data(count, sensor_freq=15):
+    """ Returns count data points spread round-robin across the test
+        sensors, as a probe would buffer them between syncs.
+
+    """
+    sensor_data = []
+    timestamp = date_util.get_current_timestamp() - \
+        (count / len(sensor_ids)) * sensor_freq
+
+    for ii in xrange(count):
+        if ii and ii % len(sensor_ids) == 0:
+            timestamp += sensor_freq
+
+        sensor_data.append({
+            "id" : sensor_ids[ii % len(sensor_ids)],
+            "timestamp" : timestamp,
+            "value" : float(ii % 100)
+        })
+
+    return sensor_data
+
+
+def persist_sensor_data_bulk(store, probe_id, sensor_data):
+    store.append_points(probe_id, sensor_data)
+
+
+def run(persist_fn, sensor_data):
+    """ Runs the given persist function against empty scratch
+        collections.  Returns (round trips of the sensor data
+        collection, wall time in seconds)
+
+    """
+    store = MongoStorage()
+    for name in ["sensor_data", "sensor_rollup_hourly", "sensor_rollup_daily"]:
+        collection = mongo.get_mongodb_connection("benchmark_" + name)
+        collection.drop()
+        store.collections[name] = collection
+
+    counting = CountingCollection(store.collections["sensor_data"])
+    store.collections["sensor_data"] = counting
+
+    start = time.time()
+    persist_fn(store, "benchmark_probe", sensor_data)
+    elapsed = time.time() - start
+
+    counting.collection.drop()
+    store.collections["sensor_rollup_hourly"].drop()
+    store.collections["sensor_rollup_daily"].drop()
+    return counting.round_trips, elapsed
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten persist_sensor_data benchmark")
+    parser.add_argument("-s", "--sizes", type=int, nargs="+",
+            default=sync_sizes, help="Number of data points per sync")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    print "%10s  %22s  %22s" % ("points", "per point (trips/s)",
+        "bulk (trips/s)")
+
+    for size in args.sizes:
+        sensor_data = generate_sensor_data(size)
+        before = run(persist_sensor_data_per_point, sensor_data)
+        after = run(persist_sensor_data_bulk, sensor_data)
+
+        print "%10d  %10d / %9.3fs  %10d / %9.3fs" % \
+            (size, before[0], before[1], after[0], after[1])
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.benchmark_query_plans
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Checks that each hot mongoDB query (the overview's rollups, a range
+    query, an export of a sensor and the retention policy's scan) is
+    answered from an index, as the stored data grows.  Probes' data is
+    generated in steps of days into scratch 'plancheck_' collections
+    of the mongoDB instance configured in settings.cfg, which are
+    bootstrapped then dropped.  After each step, every query is
+    explained and the index it used, and the keys and documents it
+    scanned versus the documents it returned, are reported...
+
+        $ python -m test.benchmark_query_plans --days 30 365 1825
+
+    Exits with status 1 if any query scans the collection, or examines
+    more documents than it returns.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import sys
+
+from datetime import datetime
+from datetime import timedelta
+
+import pymongo
+
+from db import mongo
+from db import mongo_storage
+from db.mongo_storage import MongoStorage
+from probe_sync import SensorReadings
+
+import date_util
+
+collection_names = ["probe_status", "sensor_data", "sensor_rollup_hourly",
+    "sensor_rollup_daily"]
+
+
+def generate_days(storage, probe_count, sensor_count, first_day, days):
+    """ Appends a reading per sensor per hour, for each probe, for each
+        of the given number of days from first_day
+
+    """
+    sensor_ids = ["snr%d" % ii for ii in range(sensor_count)]
+    for day in range(days):
+        start = date_util.get_timestamp(first_day + timedelta(days=day))
+        timestamps = range(start, start + 86400, 3600)
+        readings = SensorReadings(sensor_ids,
+            [ii for timestamp in timestamps for ii in range(sensor_count)],
+            [timestamp for timestamp in timestamps for ii in sensor_ids],
+            [float(ii) for timestamp in timestamps for ii in range(sensor_count)])
+
+        for probe in range(probe_count):
+            storage.append_points("plan_probe_%d" % probe, readings)
+
+
+def get_hot_queries(end_time):
+    """ Returns a list of (name, collection name, query, sort field) of
+        the hot queries, for the first probe up to end_time
+
+    """
+    end = date_util.get_timestamp(end_time)
+    return [
+        ("overview rollups", "sensor_rollup_hourly",
+            mongo_storage.get_rollup_query("plan_probe_0",
+                end_time - timedelta(days=7), end_time), "hour"),
+        ("range, 1 day", "sensor_data",
+            mongo_storage.get_walk_query("plan_probe_0", end - 86400, end),
+            "day"),
+        ("export, 1 sensor", "sensor_data",
+            mongo_storage.get_walk_query("plan_probe_0", end - 365 * 86400,
+                end, ["snr0"]), "day"),
+        ("retention scan", "sensor_data",
+            mongo_storage.get_before_query("plan_probe_0",
+                end_time - timedelta(days=30)), "day")
+    ]
+
+
+def explain(collection, query, sort):
+    """ Returns a tuple of (index name or None, keys examined, documents
+        examined, documents returned) of the given query's plan.  Both
+        the legacy and the queryPlanner explain formats are read.
+
+    """
+    plan = collection.find(query).sort(sort, 1).explain()
+
+    if "queryPlanner" in plan:
+        stats = plan["executionStats"]
+        stage = plan["queryPlanner"]["winningPlan"]
+        index = None
+        while stage is not None:
+            if stage.get("stage") == "IXSCAN":
+                index = stage["indexName"]
+            stage = stage.get("inputStage")
+        return (index, stats["totalKeysExamined"],
+            stats["totalDocsExamined"], stats["nReturned"])
+
+    cursor = plan["cursor"]
+    index = cursor.split(" ", 1)[1] if cursor.startswith("BtreeCursor") \
+        else None
+    return (index, plan.get("nscannedAllPlans", plan["nscanned"]),
+        plan["nscannedObjects"], plan["n"])
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten mongoDB query plan check")
+    parser.add_argument("-d", "--days", type=int, nargs="+",
+            default=[30, 365, 1825],
+            help="Days of data stored at each step")
+    parser.add_argument("-n", "--probes", type=int, default=5,
+            help="Probes storing data")
+    parser.add_argument("--sensors", type=int, default=4,
+            help="Sensors of each probe")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    try:
+        pymongo.MongoClient(mongo.db_host, mongo.db_port,
+            connectTimeoutMS=1000).close()
+    except pymongo.errors.ConnectionFailure:
+        print "mongoDB isn't available @ %s:%d" % (mongo.db_host, mongo.db_port)
+        sys.exit(1)
+
+    storage = MongoStorage()
+    for name in collection_names:
+        storage.collections[name] = \
+            mongo.get_mongodb_connection("plancheck_" + name)
+        storage.collections[name].drop()
+    storage.bootstrap()
+
+    end_time = date_util.get_midnight(datetime.now())
+    stored_days = 0
+    failures = 0
+
+    print "%6s  %-18s  %-32s  %8s  %8s  %8s" % ("days", "query", "index",
+        "keys", "docs", "returned")
+    try:
+        for days in sorted(args.days):
+            generate_days(storage, args.probes, args.sensors,
+                end_time - timedelta(days=days), days - stored_days)
+            stored_days = days
+
+            for name, collection_name, query, sort in get_hot_queries(
+                    end_time):
+                index, keys, docs, returned = explain(
+                    storage.get_collection(collection_name), query, sort)
+
+                failed = index is None or docs > returned
+                failures += failed
+                print "%6d  %-18s  %-32s  %8d  %8d  %8d%s" % (days, name,
+                    index or "COLLECTION SCAN", keys, docs, returned,
+                    "  FAILED" if failed else "")
+
+    finally:
+        for collection in storage.collections.values():
+            collection.drop()
+
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.benchmark_rules
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Micro-benchmark of the actuator rule engine (service.rule_service),
+    with thousands of random rules across hundreds of probes.  Probes'
+    syncs are fed to the engine in time order, and the time to evaluate
+    a sync is reported once each amount of history has been fed, to
+    show it stays flat as history grows...
+
+        $ python -m test.benchmark_rules --probes 200 --rules 5000
+
+    For comparison, the same rules are also evaluated for a sample of
+    syncs by re-aggregating each sensor's whole history with NumPy (a
+    lower bound of re-querying the DB), whose cost grows with history.
+    Doesn't require mongoDB.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import random
+import re
+import time
+
+import numpy
+
+from probe_sync import SensorReadings
+from service import rule_service
+
+start_time = 1400000000
+windows = ["15m", "1h", "6h"]
+
+
+class Sync(object):
+    """ The parts of a ProbeSync that the rule engine reads
+
+    """
+
+    def __init__(self, probe_id, curr_time, readings):
+        self.probe_id = probe_id
+        self.curr_time = curr_time
+        self.readings = readings
+
+
+def generate_rules(rule_count, probe_count, sensor_count):
+    """ Returns the options of rule_count random rules, each comparing
+        aggregates of one or two sensors, sometimes of another probe
+
+    """
+    rules = {}
+    for ii in range(rule_count):
+        probe = random.randrange(probe_count)
+
+        def term():
+            sensor = "snr%d" % random.randrange(sensor_count)
+            if random.random() < 0.1:
+                sensor = "probe%d/%s" % (random.randrange(probe_count), sensor)
+            return "%s(%s, %s) %s %d" % (
+                random.choice(["mean", "min", "max", "last"]), sensor,
+                random.choice(windows), random.choice(["<", ">"]),
+                random.randrange(40, 100))
+
+        when = term() if random.random() < 0.5 else "%s and not %s" % (
+            term(), term())
+        rules["rule%d" % ii] = {
+            "probe" : "probe%d" % probe,
+            "when" : when,
+            "actuator" : "act%d" % random.randrange(4),
+            "cooldown" : "3600"
+        }
+    return rules
+
+
+def generate_sync(probe, sync_time, sensor_count, sensor_freq, sync_freq):
+    """ Returns a Sync of the readings of each sensor since the last
+        sync, following a daily cycle
+
+    """
+    timestamps = numpy.arange(sync_time - sync_freq, sync_time,
+        sensor_freq) + 1
+    values = 70 + 25 * numpy.sin(2 * numpy.pi * timestamps / 86400.0 + probe)
+    return Sync("probe%d" % probe, sync_time, SensorReadings(
+        ["snr%d" % ii for ii in range(sensor_count)],
+        numpy.repeat(numpy.arange(sensor_count), len(timestamps)),
+        numpy.tile(timestamps, sensor_count),
+        numpy.tile(values, sensor_count) + numpy.random.random(
+            len(timestamps) * sensor_count)))
+
+
+def requery(options, histories, now):
+    """ Evaluates a rule's aggregates by re-aggregating each sensor's
+        whole history, as re-querying it would
+
+    """
+    for sensor, duration in re.findall(
+            r"\((\S+), (\d+[smhd])\)", options["when"]):
+        probe_id, sensor_id = sensor.split("/") if "/" in sensor else \
+            (options["probe"], sensor)
+        timestamps, values = histories[(probe_id, sensor_id)]
+        seconds = int(duration[:-1]) * rule_service.durations[duration[-1]]
+        in_window = values[(timestamps > now - seconds) & (timestamps <= now)]
+        if len(in_window):
+            in_window.mean(), in_window.min(), in_window.max()
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten rule engine benchmark")
+    parser.add_argument("-n", "--probes", type=int, default=200,
+            help="Probes syncing")
+    parser.add_argument("-r", "--rules", type=int, default=5000,
+            help="Rules across the probes")
+    parser.add_argument("--sensors", type=int, default=4,
+            help="Sensors of each probe")
+    parser.add_argument("--sensor_freq", type=int, default=60,
+            help="Seconds between each sensor's readings")
+    parser.add_argument("--sync_freq", type=int, default=600,
+            help="Seconds between each probe's syncs")
+    parser.add_argument("--hours", type=int, nargs="+", default=[1, 24, 168],
+            help="Hours of history fed before each measurement")
+    parser.add_argument("--skip_requery", action="store_true",
+            help="Skip re-aggregating history for comparison")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(0)
+    numpy.random.seed(0)
+
+    rules = generate_rules(args.rules, args.probes, args.sensors)
+    compile_start = time.time()
+    rule_service.set_rules([rule_service.compile_rule(name, options)
+        for name, options in rules.items()])
+    print "Compiled %d rules in %0.2fs, sharing %d sliding windows\n" % (
+        len(rules), time.time() - compile_start,
+        rule_service.get_stats()["windows"])
+
+    probe_rules = {}
+    for options in rules.values():
+        probe_rules.setdefault(options["probe"], []).append(options)
+
+    history = {}  # (probe id, sensor id) to lists of arrays
+    print "%8s  %10s  %14s  %12s  %10s  %16s" % ("hours", "syncs",
+        "eval/sync", "eval/rule", "commands", "requery/sync")
+
+    sync_time = start_time
+    for hours in sorted(args.hours):
+
+        # Feed the history up to the last hour, then time the last hour
+        end_time = start_time + hours * 3600
+        elapsed = 0.0
+        syncs = 0
+        evaluations = 0
+        commands = rule_service.get_stats()["commands"]
+
+        while sync_time < end_time:
+            sync_time += args.sync_freq
+            timed = sync_time > end_time - 3600
+            for probe in range(args.probes):
+                sync = generate_sync(probe, sync_time, args.sensors,
+                    args.sensor_freq, args.sync_freq)
+                if not args.skip_requery:
+                    readings = sync.readings
+                    for index, sensor_id in enumerate(readings.sensor_ids):
+                        chunks = history.setdefault((sync.probe_id, sensor_id),
+                            ([], []))
+                        mask = readings.sensor_indexes == index
+                        chunks[0].append(readings.timestamps[mask])
+                        chunks[1].append(readings.values[mask])
+
+                if timed:
+                    start = time.time()
+                    rule_service.evaluate(sync)
+                    elapsed += time.time() - start
+                    syncs += 1
+                    evaluations += len(probe_rules.get(sync.probe_id, ()))
+                else:
+                    rule_service.evaluate(sync)
+
+        stats = rule_service.get_stats()
+
+        requery_time = float("nan")
+        if not args.skip_requery:
+            histories = dict((key, (numpy.concatenate(chunks[0]),
+                numpy.concatenate(chunks[1])))
+                for key, chunks in history.items())
+            sample = range(min(args.probes, 50))
+            start = time.time()
+            for probe in sample:
+                for options in probe_rules.get("probe%d" % probe, []):
+                    requery(options, histories, sync_time)
+            requery_time = (time.time() - start) / len(sample)
+
+        print "%8d  %10d  %12.1fus  %10.2fus  %10d  %14.1fus" % (hours, syncs,
+            1e6 * elapsed / max(syncs, 1),
+            1e6 * elapsed / max(evaluations, 1),
+            stats["commands"] - commands, 1e6 * requery_time)
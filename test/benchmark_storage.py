@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.benchmark_storage
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmark comparing the storage backends (see db.storage) at
+    appending a probe's readings sync by sync, and at range scans of
+    a day and of a week of its readings.  The local backend runs in a
+    temporary directory, and the mongoDB backend over the in-memory
+    stand-in, or with --mongo over the mongoDB instance configured in
+    settings.cfg (scratch 'benchmark_' collections are used and
+    dropped).
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+from db import memory
+from db import mongo
+from db.local_storage import LocalStorage
+from db.mongo_storage import MongoStorage
+from probe_sync import SensorReadings
+
+import date_util
+
+collection_names = ["probe_status", "sensor_data", "sensor_rollup_hourly",
+    "sensor_rollup_daily"]
+
+
+def generate_syncs(days, sensor_count, sensor_freq, sync_freq):
+    """ Returns SensorReadings of each sync of a probe over the given
+        number of days, ending now
+
+    """
+    sensor_ids = ["snr%d" % ii for ii in range(sensor_count)]
+    end = date_util.get_current_timestamp()
+    syncs = []
+
+    for sync_start in xrange(end - days * 86400, end, sync_freq):
+        timestamps = range(sync_start, sync_start + sync_freq, sensor_freq)
+        syncs.append(SensorReadings(sensor_ids,
+            [ii for timestamp in timestamps for ii in range(sensor_count)],
+            [timestamp for timestamp in timestamps for ii in sensor_ids],
+            [(timestamp % 1000) / 10.0 for timestamp in timestamps
+                for ii in sensor_ids]))
+
+    return end, syncs
+
+
+def scan(storage, start, end):
+    """ Walks all readings in the range, returning the number read
+
+    """
+    return sum(len(timestamps) for sensor_id, timestamps, values in
+        storage.walk_points("benchmark_probe", start, end))
+
+
+def run(storage, end, syncs, repeat):
+    """ Returns (append seconds, day scan seconds, week scan seconds)
+
+    """
+    start = time.time()
+    for readings in syncs:
+        storage.append_points("benchmark_probe", readings)
+    append_time = time.time() - start
+
+    scan_times = []
+    for days in [1, 7]:
+        start = time.time()
+        for ii in range(repeat):
+            scan(storage, end - days * 86400, end)
+        scan_times.append((time.time() - start) / repeat)
+
+    return [append_time] + scan_times
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten storage backend benchmark")
+    parser.add_argument("-d", "--days", type=int, default=7,
+            help="Days of readings stored")
+    parser.add_argument("--sensors", type=int, default=4,
+            help="Sensors of the probe")
+    parser.add_argument("--sensor_freq", type=int, default=15,
+            help="Seconds between sensor reads")
+    parser.add_argument("--sync_freq", type=int, default=300,
+            help="Seconds between syncs")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+            help="Times each range scan is repeated")
+    parser.add_argument("-m", "--mongo", action="store_true",
+            help="Benchmark mongoDB rather than its in-memory stand-in")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    end, syncs = generate_syncs(args.days, args.sensors, args.sensor_freq,
+        args.sync_freq)
+
+    data_dir = tempfile.mkdtemp(prefix="autogarten_benchmark_")
+    mongo_storage = MongoStorage()
+    for name in collection_names:
+        if args.mongo:
+            collection = mongo.get_mongodb_connection("benchmark_" + name)
+            collection.drop()
+        else:
+            collection = memory.MemoryCollection(name)
+        mongo_storage.collections[name] = collection
+
+    print "%d syncs, %d readings" % (len(syncs), sum(map(len, syncs)))
+    print "%8s  %12s  %12s  %12s" % ("backend", "append", "1 day scan",
+        "7 day scan")
+
+    for name, storage in [("local", LocalStorage(data_dir)),
+            ("mongo" if args.mongo else "memory", mongo_storage)]:
+        append_time, day_time, week_time = run(storage, end, syncs,
+            args.repeat)
+        print "%8s  %11.3fs  %10.1fms  %10.1fms" % (name, append_time,
+            day_time * 1000, week_time * 1000)
+
+    shutil.rmtree(data_dir)
+    if args.mongo:
+        for collection in mongo_storage.collections.values():
+            collection.drop()
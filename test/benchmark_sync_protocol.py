@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.benchmark_sync_protocol
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmark comparing the JSON and binary probe sync formats, by
+    payload size and by the time the Control Server takes to parse a
+    request into a ProbeSync with its SensorReadings.  Doesn't require
+    mongoDB.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import json
+import time
+
+from probe_sync import ProbeSync
+from probe_sync import SensorReadings
+from probe_sync import encode_binary
+
+sensor_ids = ["tmp0", "tmp1", "pho0", "mos0"]
+
+
+def generate_request(reading_count, sensor_freq=15):
+    now = 1400000000
+    sensor_data = []
+    for ii in xrange(reading_count):
+        sensor_data.append({
+            "id" : sensor_ids[ii % len(sensor_ids)],
+            "timestamp" : now + (ii / len(sensor_ids)) * sensor_freq,
+            "value" : float(ii % 100) + 0.5
+        })
+
+    return {
+        "probe_id" : "test_probe",
+        "token" : "changeme",
+        "connection_attempts" : 1,
+        "sensor_freq" : sensor_freq,
+        "sync_freq" : 31,
+        "sync_count" : 42,
+        "curr_time" : now,
+        "sensor_data" : sensor_data
+    }
+
+
+def parse_json(payload):
+    probe_sync = ProbeSync(json.loads(payload))
+    return probe_sync.readings
+
+
+def parse_binary(payload):
+    return ProbeSync.from_binary(payload).readings
+
+
+def time_parse(parse_fn, payload, repeat):
+    start = time.time()
+    for ii in xrange(repeat):
+        parse_fn(payload)
+    return (time.time() - start) / repeat
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten sync protocol benchmark")
+    parser.add_argument("-r", "--readings", type=int, nargs="+",
+            default=[5, 25, 100, 1000, 10000],
+            help="Number of readings per sync")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    print "%8s  %10s  %10s  %6s  %12s  %12s  %8s" % ("readings", "json B",
+        "binary B", "ratio", "json parse", "binary parse", "speedup")
+
+    for count in args.readings:
+        request_content = generate_request(count)
+        json_payload = json.dumps(request_content)
+        binary_payload = encode_binary(
+            request_content["probe_id"], request_content["token"],
+            request_content["connection_attempts"],
+            request_content["sync_count"], request_content["curr_time"],
+            request_content["sensor_freq"], request_content["sync_freq"],
+            SensorReadings.from_dicts(request_content["sensor_data"]))
+
+        repeat = max(1, 20000 / count)
+        json_time = time_parse(parse_json, json_payload, repeat)
+        binary_time = time_parse(parse_binary, binary_payload, repeat)
+
+        print "%8d  %10d  %10d  %5.1fx  %10.1fus  %10.1fus  %7.1fx" % (count,
+            len(json_payload), len(binary_payload),
+            len(json_payload) / float(len(binary_payload)),
+            json_time * 1e6, binary_time * 1e6, json_time / binary_time)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.benchmark_workers
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the throughput of the sync endpoint when the Control Server
+    is served (see serve.py) by one worker process and by several...
+
+        $ python -m test.benchmark_workers --workers 1 4
+
+    Each server is started on a free local port, loaded over HTTP by
+    test.load_probes, then stopped.  Each worker uses the in-memory
+    stand-in for mongoDB, so the server rather than the DB is measured,
+    unless --mongo is given to use the mongoDB configured in
+    settings.cfg.  A fraction of syncs are sent twice, as probe retries,
+    and the syncs and duplicates counted by /metrics (summed across the
+    workers through the shared state) are reported alongside.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+from test import load_probes
+
+import date_util
+
+
+def get_free_port():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+
+def serve(args):
+    """ Serves the Control Server, in this process, until it's stopped
+
+    """
+    import serve
+
+    def setup():
+        from db import mongo
+        from db import shared_state
+        if not args.mongo:
+            mongo.use_memory_db()
+        shared_state.path = os.path.join(args.data_dir, "shared_state.db")
+        shared_state.metrics_interval = 1
+
+    serve.shared_state_path = os.path.join(args.data_dir, "shared_state.db")
+    serve.run({
+        "bind" : "127.0.0.1:%d" % args.port,
+        "workers" : args.workers[0],
+        "threads" : args.threads,
+        "worker_class" : "gthread",
+        "loglevel" : "warning"
+    }, setup=setup)
+
+
+def start_server(workers, args):
+    """ Starts a server of the given number of workers, in a new
+        process, and waits until it's ready.  Returns the process and
+        its port.
+
+    """
+    port = get_free_port()
+    command = [sys.executable, "-m", "test.benchmark_workers", "--serve",
+        "--port", str(port), "--workers", str(workers), "--threads",
+        str(args.threads), "--data_dir", args.data_dir]
+    if args.mongo:
+        command.append("--mongo")
+    process = subprocess.Popen(command)
+
+    deadline = time.time() + 30
+    while time.time() < deadline and process.poll() is None:
+        try:
+            urllib2.urlopen("http://127.0.0.1:%d/health" % port,
+                timeout=1).read()
+            return process, port
+        except Exception:
+            time.sleep(0.2)
+
+    if process.poll() is None:
+        process.terminate()
+    raise RuntimeError("Server of %d workers didn't start" % workers)
+
+
+def get_metrics(port, names):
+    """ Returns the values of the given metrics from /metrics
+
+    """
+    text = urllib2.urlopen("http://127.0.0.1:%d/metrics" % port).read()
+    values = {}
+    for name in names:
+        match = re.search(r"^autogarten_%s (\S+)$" % name, text, re.M)
+        values[name] = float(match.group(1)) if match else 0
+    return values
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten worker processes benchmark")
+    parser.add_argument("-w", "--workers", type=int, nargs="+",
+            default=[1, 4], help="Worker processes of each server compared")
+    parser.add_argument("-t", "--threads", type=int, default=8,
+            help="Threads of each worker")
+    parser.add_argument("-n", "--probes", type=int, default=200,
+            help="Number of simulated probes")
+    parser.add_argument("--syncs", type=int, default=10,
+            help="Syncs sent per probe")
+    parser.add_argument("--sensors", type=int, default=4,
+            help="Sensors per probe")
+    parser.add_argument("-c", "--concurrency", type=int, default=16,
+            help="Number of concurrent sync requests")
+    parser.add_argument("--retries", type=float, default=0.05,
+            help="Fraction of syncs sent twice, as retries")
+    parser.add_argument("--mongo", action="store_true",
+            help="Use the configured mongoDB rather than its stand-in")
+    parser.add_argument("--serve", action="store_true",
+            help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--data_dir", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.serve:
+        serve(args)
+        sys.exit(0)
+
+    print "--------------------------< autogarten Worker Processes Benchmark >----"
+    print "  %d probes x %d syncs, %d sensors each, %d concurrent, %d CPUs" % (
+        args.probes, args.syncs, args.sensors, args.concurrency,
+        os.sysconf("SC_NPROCESSORS_ONLN"))
+    print ""
+    print "%8s  %8s  %10s  %9s  %9s  %14s  %10s" % ("workers", "syncs",
+        "syncs/s", "p50 ms", "p99 ms", "counted syncs", "duplicates")
+
+    for workers in args.workers:
+        args.data_dir = tempfile.mkdtemp(prefix="autogarten_benchmark_")
+        process, port = start_server(workers, args)
+        try:
+            send = load_probes.get_http_sender("127.0.0.1", port, 30)
+            start_time = date_util.get_current_timestamp() - \
+                args.syncs * 60
+            probes = [load_probes.SimulatedProbe("probe_%05d" % ii,
+                args.sensors, 15, 60, 0, 0.1, start_time, "changeme")
+                for ii in range(args.probes)]
+
+            elapsed, latencies, statuses, reading_count = load_probes.run(
+                send, probes, args.syncs, args.concurrency, False, 0,
+                args.retries)
+            latencies = sorted(latencies)
+
+            # Give every worker time to publish its metrics
+            time.sleep(2)
+            counted = get_metrics(port, ["probe_sync_seconds_count",
+                "sync_duplicates_total"])
+
+            print "%8d  %8d  %10.1f  %9.2f  %9.2f  %14d  %10d" % (workers,
+                len(latencies), len(latencies) / elapsed,
+                1000 * latencies[len(latencies) / 2],
+                1000 * latencies[int(len(latencies) * 0.99)],
+                counted["probe_sync_seconds_count"],
+                counted["sync_duplicates_total"])
+            if set(statuses) - set([200]):
+                # 503s are retries that arrived while their sync was
+                # still being applied
+                print "          statuses: %s" % statuses
+
+        finally:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(args.data_dir)
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.load_probes
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Load generator that simulates a fleet of probes (1 to 10,000+)
+    syncing with the Control Server, to measure how ingest scales.
+    Each simulated probe has its own sensors, sensor/sync frequencies
+    and jitter, and may start with a backlog of buffered readings.
+    Syncs are sent concurrently, in order of their simulated time, and
+    throughput and p50/p95/p99 latency are reported.
+
+    By default the Flask app is driven in-process through its test
+    client, with the in-memory stand-in for mongoDB, so no network or
+    database server is needed...
+
+        $ python -m test.load_probes --probes 1000 --syncs 5
+
+    Use --storage local to store to the embedded local backend instead.
+
+    Use --retries to resend a fraction of syncs, as probes do when a
+    response is lost, to measure sync deduplication.
+
+    Use --host to instead load a running Control Server over HTTP.
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import argparse
+import heapq
+import json
+import random
+import tempfile
+import threading
+import time
+import urllib2
+import Queue
+
+import numpy
+
+import date_util
+import probe_sync
+
+
+class SimulatedProbe(object):
+    """ A probe that reads its sensors every sensor_freq seconds, and
+        syncs every sync_freq seconds.  Both are varied by +/- jitter
+        (a fraction of the interval).
+
+    """
+
+    def __init__(self, probe_id, sensor_count, sensor_freq, sync_freq,
+            backlog, jitter, start_time, token):
+        self.probe_id = probe_id
+        self.sensor_ids = ["snr%d" % ii for ii in range(sensor_count)]
+        self.sensor_freq = sensor_freq
+        self.sync_freq = sync_freq
+        self.jitter = jitter
+        self.token = token
+        self.sync_count = 0
+        self.boot_id = random.getrandbits(32)
+        self.values = [random.uniform(0, 100) for s in self.sensor_ids]
+
+        # The first sync includes a backlog of readings per sensor
+        self.next_read = start_time - backlog * sensor_freq
+        self.next_sync = start_time + random.uniform(0, sync_freq)
+
+    def _jittered(self, interval):
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def sync(self):
+        """ Returns the sync request for the next scheduled sync, with
+            all readings taken since the previous sync, and schedules
+            the following sync.
+
+        """
+        sensor_data = []
+        while self.next_read <= self.next_sync:
+            for ii, sensor_id in enumerate(self.sensor_ids):
+                self.values[ii] += random.uniform(-1, 1)
+                sensor_data.append({
+                    "id" : sensor_id,
+                    "timestamp" : int(self.next_read),
+                    "value" : round(self.values[ii], 2)
+                })
+            self.next_read += self._jittered(self.sensor_freq)
+
+        request_content = {
+            "probe_id" : self.probe_id,
+            "token" : self.token,
+            "connection_attempts" : 1,
+            "sensor_freq" : self.sensor_freq,
+            "sync_freq" : self.sync_freq,
+            "sync_count" : self.sync_count,
+            "sync_id" : (self.boot_id + self.sync_count) & 0xFFFFFFFF,
+            "curr_time" : date_util.get_current_timestamp(),
+            "sensor_data" : sensor_data
+        }
+
+        self.sync_count += 1
+        self.next_sync += self._jittered(self.sync_freq)
+        return request_content
+
+
+def encode_request(request_content, binary):
+    """ Returns the (content type, body) of the given sync request
+
+    """
+    if not binary:
+        return "application/json", json.dumps(request_content)
+
+    return probe_sync.BINARY_CONTENT_TYPE, probe_sync.encode_binary(
+        request_content["probe_id"], request_content["token"],
+        request_content["connection_attempts"],
+        request_content["sync_count"], request_content["curr_time"],
+        request_content["sensor_freq"], request_content["sync_freq"],
+        request_content["sensor_data"], request_content["sync_id"])
+
+
+def get_inprocess_sender(backend="memory", data_dir=None):
+    """ Returns a function that posts a sync to the Flask app in this
+        process and returns the HTTP status.  The app is backed by the
+        in-memory DB, or by the local storage backend in data_dir (a
+        temporary directory by default).
+
+    """
+    from db import mongo
+    from db import storage
+
+    if backend == "memory":
+        mongo.use_memory_db()
+        storage.set_storage(storage.create_storage("mongo"))
+    else:
+        storage.set_storage(storage.create_storage("local",
+            data_dir=data_dir or tempfile.mkdtemp(prefix="autogarten_")))
+
+    import control_server
+    control_server.init_config()
+    local = threading.local()
+
+    def send(content_type, body):
+        if not hasattr(local, "client"):
+            local.client = control_server.app.test_client()
+        response = local.client.post("/probe_sync", data=body,
+            content_type=content_type)
+        return response.status_code
+
+    return send, control_server.token
+
+
+def get_http_sender(host, port, timeout):
+    """ Returns a function that posts a sync to a running Control Server
+        and returns the HTTP status.
+
+    """
+    url = "http://%s:%d/probe_sync" % (host, port)
+
+    def send(content_type, body):
+        request = urllib2.Request(url, body, {"Content-Type" : content_type})
+        try:
+            response = urllib2.urlopen(request, timeout=timeout)
+            response.read()
+            return response.getcode()
+        except urllib2.HTTPError, e:
+            return e.code
+        except Exception:
+            return 0
+
+    return send
+
+
+def run(send, probes, syncs_per_probe, concurrency, binary, speedup,
+        retries=0):
+    """ Sends syncs_per_probe syncs from each probe, in order of their
+        simulated time, using concurrency sender threads.  If speedup is
+        given, syncs are paced at that many simulated seconds per second.
+        The retries fraction of syncs are sent twice.  Returns (elapsed
+        seconds, latencies, status code counts, readings)
+
+    """
+    work = Queue.Queue(concurrency * 4)
+    latencies = []
+    statuses = {}
+    stats_lock = threading.Lock()
+
+    def sender():
+        while True:
+            item = work.get()
+            if item is None:
+                return
+
+            content_type, body = item
+            start = time.time()
+            status = send(content_type, body)
+            latency = time.time() - start
+
+            with stats_lock:
+                latencies.append(latency)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=sender) for ii in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    schedule = [(probe.next_sync, ii) for ii, probe in enumerate(probes)]
+    heapq.heapify(schedule)
+    remaining = [syncs_per_probe] * len(probes)
+    sim_start = schedule[0][0] if schedule else 0
+    reading_count = 0
+
+    start = time.time()
+    while schedule:
+        sync_time, ii = heapq.heappop(schedule)
+        if speedup:
+            delay = (sync_time - sim_start) / speedup - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        request_content = probes[ii].sync()
+        reading_count += len(request_content["sensor_data"])
+        request = encode_request(request_content, binary)
+        work.put(request)
+        if random.random() < retries:
+            work.put(request)
+
+        remaining[ii] -= 1
+        if remaining[ii]:
+            heapq.heappush(schedule, (probes[ii].next_sync, ii))
+
+    for thread in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+
+    return time.time() - start, latencies, statuses, reading_count
+
+
+def parse_args():
+    """ Parse the command line arguments
+
+    """
+    parser = argparse.ArgumentParser(
+        description="autogarten probe fleet load generator")
+    parser.add_argument("-n", "--probes", type=int, default=100,
+            help="Number of simulated probes")
+    parser.add_argument("--sensors", type=int, default=4,
+            help="Sensors per probe")
+    parser.add_argument("--sensor_freq", type=int, default=15,
+            help="Seconds between sensor reads")
+    parser.add_argument("--sync_freq", type=int, default=60,
+            help="Seconds between syncs")
+    parser.add_argument("--syncs", type=int, default=5,
+            help="Syncs sent per probe")
+    parser.add_argument("--backlog", type=int, default=0,
+            help="Readings per sensor buffered before each probe's first sync")
+    parser.add_argument("--jitter", type=float, default=0.1,
+            help="Random variation of sensor/sync intervals, as a fraction")
+    parser.add_argument("-c", "--concurrency", type=int, default=8,
+            help="Number of concurrent sync requests")
+    parser.add_argument("--speedup", type=float, default=0,
+            help="Pace syncs at this many simulated seconds per second "
+                 "(default: send as fast as possible)")
+    parser.add_argument("-b", "--binary", action="store_true",
+            help="Send syncs as binary frames rather than JSON")
+    parser.add_argument("--retries", type=float, default=0,
+            help="Fraction of syncs sent twice, as retries")
+    parser.add_argument("--storage", choices=["memory", "local"],
+            default="memory",
+            help="Storage backend of the in-process app")
+    parser.add_argument("--data_dir",
+            help="Data directory of the local storage backend "
+                 "(default: a new temporary directory)")
+    parser.add_argument("-s", "--host",
+            help="Load a running Control Server on this host over HTTP, "
+                 "rather than the app in-process")
+    parser.add_argument("-p", "--port", type=int, default=5000,
+            help="Control Server Port")
+    parser.add_argument("-t", "--token", default="changeme",
+            help="Control Server Auth Token (HTTP only)")
+    parser.add_argument("--timeout", type=float, default=30,
+            help="HTTP request timeout in seconds")
+    return parser.parse_args()
+
+
+def print_report(elapsed, latencies, statuses, reading_count):
+    latencies = numpy.array(latencies) * 1000
+    print ""
+    print "  Syncs:      %d in %0.2fs  (%0.1f syncs/s)" % \
+        (len(latencies), elapsed, len(latencies) / elapsed)
+    print "  Readings:   %d  (%0.1f readings/s)" % \
+        (reading_count, reading_count / elapsed)
+    print "  Statuses:   %s" % ", ".join("%s: %d" % (code, count)
+        for code, count in sorted(statuses.items()))
+    if len(latencies):
+        print "  Latency ms: p50 %0.2f  p95 %0.2f  p99 %0.2f  max %0.2f" % \
+            tuple(numpy.percentile(latencies, [50, 95, 99]).tolist() +
+                [latencies.max()])
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.host:
+        send, token = get_http_sender(args.host, args.port, args.timeout), \
+            args.token
+    else:
+        send, token = get_inprocess_sender(args.storage, args.data_dir)
+
+    # Simulated time ends around now, so data lands in the overview
+    start_time = date_util.get_current_timestamp() - \
+        args.syncs * args.sync_freq
+    probes = [SimulatedProbe("load_probe_%05d" % ii, args.sensors,
+        args.sensor_freq, args.sync_freq, args.backlog, args.jitter,
+        start_time, token) for ii in range(args.probes)]
+
+    print "--------------------------------< autogarten Probe Load Test >----"
+    print "  %d probes x %d syncs, %d sensors each, %s, %s" % (args.probes,
+        args.syncs, args.sensors, "binary" if args.binary else "JSON",
+        "http://%s:%d" % (args.host, args.port) if args.host
+            else "in-process, %s storage" % args.storage)
+
+    print_report(*run(send, probes, args.syncs, args.concurrency,
+        args.binary, args.speedup, args.retries))
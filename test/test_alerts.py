@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_alerts
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the streaming alerts on sensor data (see
+    service.alert_service): out of range, stuck and drifting sensors,
+    their notification, and their states being kept with the local
+    storage backend, in a temporary directory, and restored from it.
+
+    To run...
+
+        $ python -m test.test_alerts -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import os
+import unittest
+
+import numpy
+
+from db import storage
+from db.local_storage import LocalStorage
+from probe_sync import SensorReadings
+from service import alert_service
+from service import probe_service
+from test import StorageTestCase
+
+base = 1400000000
+
+
+def readings(sensor_id, values, start=0):
+    """ Returns SensorReadings of a sensor with the given values, a
+        minute apart from start minutes after base
+
+    """
+    return SensorReadings([sensor_id], numpy.zeros(len(values)),
+        base + (start + numpy.arange(len(values))) * 60, values)
+
+
+class RecordingNotifier(object):
+
+    def __init__(self):
+        self.alerts = []
+
+    def notify(self, alert):
+        self.alerts.append(alert)
+
+
+class AlertsStorage(LocalStorage):
+    """ Local storage whose alerts can't be written or their states read
+        while down, recording the alerts of each write.  on_append is
+        called (once) as alerts are written.
+
+    """
+
+    def __init__(self, data_dir):
+        LocalStorage.__init__(self, data_dir)
+        self.down = False
+        self.on_append = None
+        self.written = []
+        self.state_reads = []
+
+    def append_alerts(self, alerts):
+        if self.on_append is not None:
+            on_append, self.on_append = self.on_append, None
+            on_append()
+        if self.down:
+            raise storage.StorageUnavailable("down")
+        self.written.append([alert["_id"] for alert in alerts])
+        LocalStorage.append_alerts(self, alerts)
+
+    def get_alert_states(self):
+        # Whether other threads can check readings meanwhile
+        unlocked = alert_service._lock.acquire(False)
+        if unlocked:
+            alert_service._lock.release()
+        self.state_reads.append(unlocked)
+
+        if self.down:
+            raise storage.StorageUnavailable("down")
+        return LocalStorage.get_alert_states(self)
+
+
+class AlertServiceTest(StorageTestCase):
+
+    settings = ["enabled", "ranges", "stuck_points", "stuck_tolerance",
+        "drift_alpha", "drift_sigmas", "drift_warmup", "notifier",
+        "restore_retry"]
+
+    def create_storage(self, data_dir):
+        return AlertsStorage(data_dir)
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.saved = dict((name, getattr(alert_service, name))
+            for name in self.settings)
+        alert_service.enabled = True
+        alert_service.ranges = alert_service.parse_ranges(
+            "tmp*:-10:45, moisture*:10:")
+        alert_service.stuck_points = 5
+        alert_service.stuck_tolerance = 0.1
+        alert_service.drift_warmup = 50
+        alert_service.restore_retry = 60
+        self.notifier = RecordingNotifier()
+        alert_service.set_notifier(self.notifier)
+        alert_service.reset()
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(alert_service, name, value)
+        alert_service.reset()
+        StorageTestCase.tearDown(self)
+
+    def observe(self, sensor_id, values, start=0, probe_id="probe_a"):
+        """ Returns the (kind, state, minute) of each alert raised or
+            cleared by the given readings
+
+        """
+        return [(alert["kind"], alert["state"],
+            (alert["timestamp"] - base) / 60) for alert in
+            alert_service.observe(probe_id, readings(sensor_id, values,
+                start))]
+
+    def test_parse_ranges(self):
+        self.assertEqual(alert_service.parse_ranges(" tmp*:-10:45, pho0::9,"),
+            [("tmp*", -10.0, 45.0), ("pho0", None, 9.0)])
+        self.assertEqual(alert_service.parse_ranges(""), [])
+        for invalid in ["tmp*:1", "tmp*:low:45", "tmp*:1:2:3"]:
+            self.assertRaises(ValueError, alert_service.parse_ranges, invalid)
+
+    def test_out_of_range(self):
+        self.assertEqual(self.observe("tmp0", [20.0, 50.0, 46.0, 30.0, -11.0]),
+            [("out_of_range", "raised", 1), ("out_of_range", "cleared", 3),
+                ("out_of_range", "raised", 4)])
+
+        # Only a low bound for moisture, and no range for others
+        self.assertEqual(self.observe("moisture1", [500.0, 5.0]),
+            [("out_of_range", "raised", 1)])
+        self.assertEqual(self.observe("pho0", [-1e6, 1e6]), [])
+
+    def test_stuck(self):
+        self.assertEqual(self.observe("pho0",
+            [1.0, 2.0, 2.05, 2.0, 2.08, 2.0, 2.0, 3.0]),
+            [("stuck", "raised", 5), ("stuck", "cleared", 7)])
+
+        alert_service.stuck_points = 0
+        self.assertEqual(self.observe("pho1", [1.0] * 20), [])
+
+    def test_drift(self):
+        # The shifted readings widen the std dev too, so it takes a long
+        # history for a shift to stand out
+        numpy.random.seed(0)
+        steady = list(20 + numpy.random.normal(0, 1, 3000))
+        self.assertEqual(self.observe("pho0", steady), [])
+
+        # The level shifts, then returns
+        alerts = self.observe("pho0", [30.0 + ii % 2 for ii in range(40)] +
+            steady[:200], 3000)
+        self.assertEqual([alert[:2] for alert in alerts],
+            [("drift", "raised"), ("drift", "cleared")])
+        self.assertTrue(3000 < alerts[0][2] < 3040 < alerts[1][2])
+
+    def test_replayed_readings_skipped(self):
+        self.assertEqual(len(self.observe("tmp0", [50.0, 20.0])), 2)
+        self.assertEqual(self.observe("tmp0", [50.0, 20.0]), [])
+
+        # Readings out of order within a sync are checked in time order
+        sensor_data = SensorReadings(["tmp0"], [0, 0],
+            [base + 240, base + 180], [20.0, 50.0])
+        self.assertEqual([alert["state"] for alert in
+            alert_service.observe("probe_a", sensor_data)],
+            ["raised", "cleared"])
+
+    def test_notified_and_written(self):
+        raised = alert_service.get_stats()["raised"]
+        alerts = alert_service.observe("probe_a", readings("tmp0",
+            [20.0, 50.0]))
+        self.assertEqual(self.notifier.alerts, alerts)
+        self.assertEqual([alert["_id"] for alert in
+            self.storage.get_alerts("probe_a")],
+            ["probe_a/tmp0/out_of_range/%d/raised" % (base + 60)])
+
+        # Each probe's sensors are checked on their own
+        self.assertEqual(self.observe("tmp0", [50.0], 5, "probe_b"),
+            [("out_of_range", "raised", 5)])
+        stats = alert_service.get_stats()
+        self.assertEqual((stats["sensors"], stats["active"], stats["raised"]),
+            (2, 2, raised + 2))
+
+    def test_states_restored(self):
+        self.observe("tmp0", [20.0, 50.0, 20.0, 50.0])
+        self.observe("tmp1", [50.0, 20.0])
+        self.observe("pho0", [1.0] * 5)
+
+        # After a restart, a raised alert isn't raised again, from the
+        # newest alert of each sensor and kind
+        alert_service.reset()
+        del self.storage.state_reads[:]
+        self.assertEqual(self.observe("tmp0", [60.0], 4), [])
+        self.assertEqual(self.observe("tmp0", [20.0], 5),
+            [("out_of_range", "cleared", 5)])
+        self.assertEqual(self.observe("tmp1", [60.0], 2),
+            [("out_of_range", "raised", 2)])
+        self.assertEqual(self.observe("pho0", [2.0], 5),
+            [("stuck", "cleared", 5)])
+
+        # Without holding the lock of checking readings
+        self.assertEqual(self.storage.state_reads, [True])
+
+    def test_restore_retried(self):
+        self.observe("tmp0", [50.0])
+        alert_service.reset()
+        del self.storage.state_reads[:]
+
+        # While storage is down, readings are checked without the
+        # restored states, and restoring is retried after a while
+        self.storage.down = True
+        self.assertEqual(self.observe("tmp1", [50.0], 1),
+            [("out_of_range", "raised", 1)])
+        self.observe("tmp1", [20.0], 2)
+        self.assertEqual(len(self.storage.state_reads), 1)
+
+        self.storage.down = False
+        alert_service._restore_after = 0
+        self.assertEqual(self.observe("tmp0", [60.0], 3), [])
+        self.assertEqual(len(self.storage.state_reads), 2)
+
+        # Sensors checked meanwhile keep their states
+        self.assertEqual(self.observe("tmp1", [60.0], 4),
+            [("out_of_range", "raised", 4)])
+
+    def test_pending_until_written(self):
+        self.storage.down = True
+        self.observe("tmp0", [50.0])
+        self.observe("tmp0", [20.0], 1)
+        self.assertEqual(alert_service.get_stats()["pending"], 2)
+
+        self.storage.down = False
+        self.observe("tmp0", [21.0], 2)
+        self.assertEqual(alert_service.get_stats()["pending"], 0)
+        self.assertEqual(self.storage.written, [[
+            "probe_a/tmp0/out_of_range/%d/raised" % base,
+            "probe_a/tmp0/out_of_range/%d/cleared" % (base + 60)]])
+
+    def test_pending_written_once(self):
+        # Alerts raised while others are being written are written on
+        # their own
+        self.storage.on_append = lambda: self.observe("tmp1", [50.0], 1)
+        self.observe("tmp0", [50.0])
+        self.assertEqual(self.storage.written, [
+            ["probe_a/tmp1/out_of_range/%d/raised" % (base + 60)],
+            ["probe_a/tmp0/out_of_range/%d/raised" % base]])
+        self.assertEqual(alert_service.get_stats()["pending"], 0)
+
+    def test_pending_kept_in_order(self):
+        # Alerts that fail to be written are kept ahead of those raised
+        # while they were being written
+        self.storage.down = True
+        self.storage.on_append = lambda: self.observe("tmp1", [50.0], 1)
+        self.observe("tmp0", [50.0])
+        self.assertEqual(alert_service.get_stats()["pending"], 2)
+
+        self.storage.down = False
+        self.observe("tmp0", [20.0], 2)
+        self.assertEqual(self.storage.written, [[
+            "probe_a/tmp0/out_of_range/%d/raised" % base,
+            "probe_a/tmp1/out_of_range/%d/raised" % (base + 60),
+            "probe_a/tmp0/out_of_range/%d/cleared" % (base + 120)]])
+
+    def test_notifiers(self):
+        class FailingNotifier(object):
+            def notify(self, alert):
+                raise IOError("unreachable")
+
+        # A notifier that fails doesn't stop alerts being written
+        alert_service.set_notifier(FailingNotifier())
+        self.assertEqual(len(self.observe("tmp0", [50.0])), 1)
+        self.assertEqual(len(self.storage.get_alerts()), 1)
+
+        log_path = os.path.join(self.data_dir, "alerts.log")
+        alert_service.set_notifier(alert_service.create_notifier("log",
+            log_path))
+        self.observe("tmp0", [20.0], 1)
+        with open(log_path) as log_file:
+            self.assertIn("CLEARED probe_a/tmp0 out_of_range", log_file.read())
+
+        self.assertIsNone(alert_service.create_notifier("none"))
+        self.assertEqual(type(alert_service.create_notifier(
+            "test.test_alerts.RecordingNotifier")).__name__,
+            "RecordingNotifier")
+
+    def test_disabled(self):
+        alert_service.enabled = False
+        self.assertEqual(self.observe("tmp0", [50.0]), [])
+
+    def test_persisted_readings_checked(self):
+        probe_service.persist_sensor_data("probe_a", readings("tmp0",
+            [20.0, 50.0]))
+        self.assertEqual([alert["kind"] for alert in self.notifier.alerts],
+            ["out_of_range"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_binary_sync
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of binary probe sync frames (see probe_sync): encoding and
+    decoding them, rejecting malformed ones, and posting them to
+    /probe_sync.  Syncs are written to the local storage backend, in a
+    temporary directory.
+
+    To run...
+
+        $ python -m test.test_binary_sync -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+import unittest
+
+from probe_sync import ProbeSync
+from probe_sync import SensorReadings
+from test import StorageTestCase
+
+import probe_sync
+
+base = 1398981600
+
+
+class BinaryFrameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.readings = SensorReadings(["tmp0", u"pho\xe9"], [1, 0, 0],
+            [base + 120, base, base + 60], [300.0, 70.5, 71.0])
+
+    def encode(self, **kwargs):
+        return probe_sync.encode_binary("probe_a", "changeme", 2, 5,
+            base + 130, 15, 60, self.readings, **kwargs)
+
+    def test_round_trip(self):
+        sync = ProbeSync.from_binary(self.encode(sync_id=0xFFFFFFFF,
+            round_trip_ms=70000))
+
+        self.assertEqual((sync.probe_id, sync.token, sync.connection_attempts,
+            sync.sync_count, sync.curr_time, sync.sensor_freq,
+            sync.sync_freq, sync.sync_id, sync.round_trip_ms), ("probe_a",
+            "changeme", 2, 5, base + 130, 15, 60, 0xFFFFFFFF, 0xFFFF))
+        self.assertTrue(sync.is_valid())
+
+        # Readings come back in time order
+        self.assertEqual(list(sync.readings), [("tmp0", base, 70.5),
+            ("tmp0", base + 60, 71.0), (u"pho\xe9", base + 120, 300.0)])
+
+    def test_optional_fields(self):
+        sync = ProbeSync.from_binary(self.encode())
+        self.assertFalse(hasattr(sync, "sync_id"))
+        self.assertFalse(hasattr(sync, "round_trip_ms"))
+
+        self.readings = SensorReadings([], [], [], [])
+        self.assertEqual(len(ProbeSync.from_binary(self.encode()).readings), 0)
+
+    def test_stream_of_frames(self):
+        frames = self.encode(sync_id=1) + self.encode(sync_id=2)
+        first, offset = probe_sync.decode_binary(frames)
+        second, end = probe_sync.decode_binary(frames, offset)
+        self.assertEqual((first.sync_id, second.sync_id, end),
+            (1, 2, len(frames)))
+
+    def test_malformed_frames(self):
+        frame = self.encode()
+        malformed = [
+            frame[:-1],  # Truncated
+            frame + "\0",  # Trailing data
+            frame[:4] + "XX" + frame[6:],  # Bad magic
+            frame[:6] + "\x02" + frame[7:],  # Unsupported version
+            frame[:4],  # Header only
+            ""
+        ]
+
+        # A reading of a sensor that isn't in the dictionary
+        unknown = bytearray(frame)
+        unknown[-7] = 5
+        malformed.append(str(unknown))
+
+        for data in malformed:
+            self.assertRaises(ValueError, ProbeSync.from_binary, data)
+
+    def test_readings_too_far_apart(self):
+        self.readings = SensorReadings(["tmp0"], [0, 0],
+            [base, base + 0x10000], [1.0, 2.0])
+        self.assertRaises(ValueError, self.encode)
+
+
+class BinarySyncEndpointTest(StorageTestCase):
+
+    def test_sync_endpoint(self):
+        import control_server
+
+        readings = SensorReadings(["tmp0"], [0, 0], [base, base + 60],
+            [70.5, 71.0])
+        def encode(readings):
+            return probe_sync.encode_binary("probe_a", "changeme", 1, 2, 0,
+                15, 60, readings)
+
+        token = control_server.token
+        control_server.token = "changeme"
+        try:
+            app = control_server.app.test_client()
+            def post(data):
+                return app.post("/probe_sync", data=data,
+                    content_type=probe_sync.BINARY_CONTENT_TYPE)
+
+            response = post(encode(readings))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)["probe_id"], "probe_a")
+            self.assertEqual(self.get_sync_count("probe_a"), 1)
+
+            # Malformed frames, or values that aren't finite
+            self.assertEqual(post(encode(readings)[:-3]).status_code, 400)
+            readings.values[1] = float("inf")
+            self.assertEqual(post(encode(readings)).status_code, 400)
+            self.assertEqual(self.get_sync_count("probe_a"), 1)
+
+        finally:
+            control_server.token = token
+
+
+if __name__ == "__main__":
+    unittest.main()
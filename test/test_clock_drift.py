@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_clock_drift
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the tracking of probes' clock drift, and the correction of
+    their readings' timestamps (see service.clock_drift).  Probes are
+    simulated as in test.benchmark_clock_drift, against the local
+    storage backend in a temporary directory.
+
+    To run...
+
+        $ python -m test.test_clock_drift -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import unittest
+
+import numpy
+
+from probe_sync import SensorReadings
+from service import clock_drift
+from test import StorageTestCase
+from test import new_probe_sync
+from test.benchmark_clock_drift import DriftingProbe
+from test.benchmark_clock_drift import start_time
+
+sensor_freq = 15
+sync_freq = 3600
+
+
+class ClockDriftTest(StorageTestCase):
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        numpy.random.seed(0)
+        self.sets_clock = clock_drift.sets_clock
+        clock_drift.reset()
+        clock_drift._stats.update(syncs=0, steps=0, corrected=0)
+
+    def tearDown(self):
+        clock_drift.sets_clock = self.sets_clock
+        clock_drift.reset()
+        StorageTestCase.tearDown(self)
+
+    def run_syncs(self, probe, count, first=1, max_trip=0.5):
+        """ Syncs the probe count times, an hour apart, and returns the
+            syncs' readings as sent and as corrected, and their true times
+
+        """
+        sent, stored, truth = [], [], []
+        for ii in range(first, first + count):
+            probe_sync, received, true_times = probe.sync(
+                start_time + ii * sync_freq, sensor_freq, sync_freq, max_trip)
+            clock_drift.observe(probe_sync, received)
+            sent.append(probe_sync.readings.timestamps)
+            stored.append(clock_drift.correct([probe_sync]).timestamps)
+            truth.append(true_times)
+
+        return [numpy.concatenate(column) for column in [sent, stored, truth]]
+
+    def new_sync(self, offset, rate=0.0):
+        timestamps = numpy.arange(10) * sensor_freq + int(start_time)
+        probe_sync = new_probe_sync("probe0", SensorReadings(["tmp0"],
+            numpy.zeros(10), timestamps, numpy.ones(10)))
+        probe_sync.clock = {"offset" : offset, "rate" : rate,
+            "probe_time" : int(timestamps[-1]),
+            "start_time" : int(timestamps[0])}
+        return probe_sync
+
+    def test_steady_clock(self):
+        # A probe whose clock is right isn't corrected, whether or not
+        # it's taken to set its clock
+        for sets_clock in [True, False]:
+            clock_drift.sets_clock = sets_clock
+            probe = DriftingProbe("probe%d" % sets_clock, 0.0, 0.0, False)
+            sent, stored, truth = self.run_syncs(probe, 48)
+            self.assertTrue(numpy.array_equal(stored, sent))
+
+        self.assertEqual(clock_drift.get_stats()["corrected"], 0)
+
+    def assertCorrected(self, stored, truth):
+        # Readings' timestamps are whole seconds, so are off by up to a
+        # second before any error in the estimate
+        errors = numpy.abs(stored - truth)
+        self.assertLess(errors.mean(), 1)
+        self.assertLessEqual(numpy.percentile(errors, 99), 2)
+
+    def test_drifting_clock(self):
+        # A clock kept by the probe, losing 1.8s an hour
+        clock_drift.sets_clock = False
+        probe = DriftingProbe("probe0", 0.0005, 0.0, False)
+        sent, stored, truth = self.run_syncs(probe, 48)
+        warm = slice(6 * sync_freq / sensor_freq, None)
+        self.assertGreater(numpy.abs(sent - truth)[warm].mean(), 30)
+        self.assertCorrected(stored[warm], truth[warm])
+
+        # A clock set by each sync, losing 7.2s an hour
+        clock_drift.sets_clock = True
+        probe = DriftingProbe("probe1", 0.002, 0.0, True)
+        sent, stored, truth = self.run_syncs(probe, 48)
+        self.assertGreater(numpy.abs(sent - truth)[warm].mean(), 3)
+        self.assertCorrected(stored[warm], truth[warm])
+
+    def test_step(self):
+        clock_drift.sets_clock = False
+        probe = DriftingProbe("probe0", 0.0, 0.0, False)
+        self.run_syncs(probe, 6)
+
+        # The clock is set back two minutes
+        probe.clock_base -= 120
+        sent, stored, truth = self.run_syncs(probe, 1, first=7)
+        self.assertEqual(clock_drift.get_stats()["steps"], 1)
+
+        # Restarted from a single observation, the offset is only as
+        # good as curr_time's whole second
+        self.assertLessEqual(numpy.abs(stored - truth).max(), 2)
+
+        clock = clock_drift._states["probe0"]
+        self.assertAlmostEqual(clock.offset, 120, delta=1)
+
+    def test_restart(self):
+        clock_drift.sets_clock = False
+        probe = DriftingProbe("probe0", 0.0005, 0.0, False)
+        self.run_syncs(probe, 24)
+        rate = clock_drift._states["probe0"].rate
+        self.assertAlmostEqual(rate, 0.0005, delta=0.0002)
+
+        # The probe restarts with its clock unset, counting from zero
+        probe.sync_count = 0
+        probe.server_base = start_time + 24.5 * sync_freq
+        probe.clock_base = 0
+        sent, stored, truth = self.run_syncs(probe, 1, first=25)
+
+        clock = clock_drift._states["probe0"]
+        self.assertEqual(clock.rate, rate)
+        self.assertEqual(clock_drift.get_stats()["steps"], 0)
+        self.assertLessEqual(numpy.abs(stored - truth).max(), 2)
+
+    def test_deadband(self):
+        # Corrections under a second are dropped, the rest are rounded
+        for offset, correction in [(0.9, 0), (-0.9, 0), (1.6, 2), (-1.2, -1)]:
+            probe_sync = self.new_sync(offset)
+            corrected = clock_drift.correct([probe_sync])
+            self.assertTrue(numpy.array_equal(corrected.timestamps,
+                probe_sync.readings.timestamps + correction))
+
+        # As is the drift since a reading was taken
+        probe_sync = self.new_sync(1.4, 0.005)
+        corrections = clock_drift.correct([probe_sync]).timestamps - \
+            probe_sync.readings.timestamps
+        self.assertEqual(list(corrections), [0] * 4 + [1] * 6)
+        self.assertEqual(clock_drift.get_stats()["corrected"], 26)
+
+    def test_time_unset(self):
+        probe_sync = new_probe_sync("probe0")
+        self.assertIsNone(clock_drift.observe(probe_sync))
+        self.assertIsNone(probe_sync.clock)
+        self.assertEqual(clock_drift.get_stats()["syncs"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_export_import
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of exporting readings (see service.export_service), as the
+    manage.py export command and /export do, and of bulk importing them
+    (see service.import_service), including a round trip of each export
+    format through an import.  Readings are kept with the local storage
+    backend, in a temporary directory.
+
+    To run...
+
+        $ python -m test.test_export_import -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import csv
+import json
+import os
+import unittest
+
+from datetime import datetime
+
+import numpy
+
+from db import storage
+from db.local_storage import LocalStorage
+from probe_sync import SensorReadings
+from service import export_service
+from service import import_service
+from test import StorageTestCase
+
+import date_util
+import probe_sync
+
+# Two hours before midnight, so readings span two days
+base = date_util.get_timestamp(datetime(2014, 5, 1, 22))
+
+sensor_ids = ["tmp0", u"pho\xe9", 'soil "a",1']
+
+
+class ReadingsTestCase(StorageTestCase):
+    """ Runs each test with readings of two probes in a 'source' local
+        storage backend
+
+    """
+
+    def create_storage(self, data_dir):
+        return LocalStorage(os.path.join(data_dir, "source"))
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+
+        # Readings of three sensors every 5 minutes for four hours
+        numpy.random.seed(0)
+        count = 4 * 12
+        self.readings = SensorReadings(sensor_ids,
+            numpy.arange(count * 3) % 3,
+            base + numpy.arange(count * 3) // 3 * 300,
+            numpy.random.uniform(-10, 40, count * 3))
+        storage.get_storage().append_points("probe_a", self.readings)
+        storage.get_storage().append_points("probe_b", SensorReadings(
+            ["tmp0"], [0], [base], [1.0]))
+
+    def open_storage(self, name):
+        storage.set_storage(LocalStorage(os.path.join(self.data_dir, name)))
+
+    def walk(self, probe_id, start=base, end=base + 86400):
+        """ Returns the walked readings of a probe as a sorted list of
+            (sensor id, timestamp, value) tuples
+
+        """
+        return sorted((sensor_id, timestamp, value) for sensor_id, timestamps,
+            values in storage.get_storage().walk_points(probe_id, start, end)
+            for timestamp, value in zip(timestamps.tolist(), values.tolist()))
+
+    def export(self, format, probe_id="probe_a", start=base,
+            end=base + 86400, sensor_ids=None):
+        path = os.path.join(self.data_dir, "%s.%s" % (probe_id, format))
+        with open(path, "wb") as output:
+            for chunk in export_service.export_readings(probe_id, start, end,
+                    sensor_ids, format):
+                output.write(chunk)
+        return path
+
+
+class ExportTest(ReadingsTestCase):
+
+    def test_export_csv(self):
+        with open(self.export("csv", end=base + 300)) as export_file:
+            rows = list(csv.reader(export_file))
+
+        self.assertEqual(rows[0], ["probe_id", "sensor_id", "timestamp",
+            "value"])
+        self.assertEqual(sorted(row[1].decode("utf-8") for row in rows[1:]),
+            sorted(sensor_ids * 2))
+        self.assertEqual(set(int(row[2]) for row in rows[1:]),
+            set([base, base + 300]))
+
+    def test_export_ndjson_of_sensors(self):
+        with open(self.export("ndjson", sensor_ids=["tmp0"])) as export_file:
+            rows = [json.loads(line) for line in export_file]
+
+        self.assertEqual(len(rows), len(self.readings) / 3)
+        self.assertEqual(set(row["sensor_id"] for row in rows),
+            set(["tmp0"]))
+        self.assertEqual(rows[0], {"probe_id" : "probe_a", "sensor_id" : "tmp0",
+            "timestamp" : base, "value" : self.readings.values[0]})
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, list,
+            export_service.export_readings("probe_a", base, base, None, "xml"))
+
+    def test_export_endpoint(self):
+        import control_server
+
+        app = control_server.app.test_client()
+        response = app.get("/export?probe_id=probe_a&sensor_id=tmp0"
+            "&start=%d&end=2014-05-01T22:05&format=ndjson" % base)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, export_service.formats["ndjson"])
+        self.assertEqual(response.headers["Content-Disposition"],
+            "attachment; filename=probe_a.ndjson")
+        self.assertEqual([json.loads(line)["timestamp"] for line in
+            response.data.splitlines()], [base, base + 300])
+
+        for query in ["", "?probe_id=probe_a&format=xml",
+                "?probe_id=probe_a&start=May"]:
+            self.assertEqual(app.get("/export" + query).status_code, 400)
+
+    def test_parse_time(self):
+        self.assertEqual(export_service.parse_time(str(base)), base)
+        self.assertEqual(export_service.parse_time("2014-05-01T22:00"), base)
+        self.assertEqual(export_service.parse_time("2014-05-02"), base + 7200)
+        self.assertRaises(ValueError, export_service.parse_time, "May 1")
+
+
+class ImportTest(ReadingsTestCase):
+
+    def test_round_trip(self):
+        expected = self.walk("probe_a")
+        self.assertEqual(len(expected), len(self.readings))
+
+        for format in ["csv", "ndjson"]:
+            path = self.export(format)
+            self.open_storage("import_" + format)
+            stats = import_service.import_file(path, format)
+            self.assertEqual((stats.readings, stats.invalid_rows, stats.days),
+                (len(self.readings), 0, 2))
+
+            # Values are exported exactly
+            self.assertEqual(self.walk("probe_a"), expected)
+            self.assertEqual(self.walk("probe_b"), [])
+            self.assertFalse(os.path.exists(path + ".checkpoint"))
+            self.open_storage("source")
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, import_service.import_file,
+            os.path.join(self.data_dir, "probe_a.xml"), "xml")
+
+    def test_import_binary(self):
+        # A probe's log of binary sync frames
+        path = os.path.join(self.data_dir, "probe_c.bin")
+        with open(path, "wb") as log_file:
+            for ii in range(0, len(self.readings), 30):
+                part = slice(ii, ii + 30)
+                log_file.write(probe_sync.encode_binary("probe_c", "changeme",
+                    1, ii, 0, 300, 3600, SensorReadings(sensor_ids,
+                        self.readings.sensor_indexes[part],
+                        self.readings.timestamps[part],
+                        self.readings.values[part])))
+
+        self.open_storage("import_binary")
+        stats = import_service.import_file(path, "binary")
+        self.assertEqual(stats.readings, len(self.readings))
+
+        # Values are sent as 32 bit floats
+        self.open_storage("source")
+        expected = self.walk("probe_a")
+        self.open_storage("import_binary")
+        imported = self.walk("probe_c")
+        self.assertEqual([row[:2] for row in imported],
+            [row[:2] for row in expected])
+        self.assertTrue(numpy.allclose([row[2] for row in imported],
+            [row[2] for row in expected], rtol=1e-6))
+
+    def test_import_truncated_binary(self):
+        path = os.path.join(self.data_dir, "probe_c.bin")
+        with open(path, "wb") as log_file:
+            log_file.write(probe_sync.encode_binary("probe_c", "changeme", 1,
+                1, 0, 300, 3600, self.readings)[:-5])
+
+        self.assertRaises(ValueError, import_service.import_file, path,
+            "binary")
+
+    def test_invalid_rows_skipped(self):
+        path = os.path.join(self.data_dir, "probe_d.csv")
+        with open(path, "wb") as log_file:
+            log_file.write("probe_id,sensor_id,timestamp,value\n"
+                "probe_d,tmp0,%d,1.5\n"
+                "probe_d,tmp0,yesterday,2.5\n"
+                ",tmp0,%d,3.5\n"
+                "probe_d,tmp0,%d\n"
+                "probe_d,tmp0,%d,nan\n"
+                "\n"
+                "probe_d,tmp0,%d,4.5" % (base, base, base, base, base + 60))
+
+        stats = import_service.import_file(path, "csv")
+        self.assertEqual((stats.rows, stats.invalid_rows, stats.readings),
+            (6, 4, 2))
+        self.assertEqual(self.walk("probe_d"), [("tmp0", base, 1.5),
+            ("tmp0", base + 60, 4.5)])
+
+    def test_import_resumes(self):
+        path = os.path.join(self.data_dir, "probe_d.ndjson")
+        lines = [json.dumps({"probe_id" : "probe_d", "id" : "tmp0",
+            "timestamp" : base + ii * 60, "value" : ii}) + "\n"
+            for ii in range(4)]
+        with open(path, "wb") as log_file:
+            log_file.write("".join(lines))
+
+        # An import interrupted after its first two lines
+        with open(path + ".checkpoint", "w") as checkpoint_file:
+            json.dump({"offset" : len(lines[0]) + len(lines[1])},
+                checkpoint_file)
+
+        stats = import_service.import_file(path, "ndjson")
+        self.assertEqual(stats.readings, 2)
+        self.assertEqual(self.walk("probe_d"), [("tmp0", base + 120, 2.0),
+            ("tmp0", base + 180, 3.0)])
+        self.assertFalse(os.path.exists(path + ".checkpoint"))
+
+        # Or restarted from the beginning
+        stats = import_service.import_file(path, "ndjson", resume=False)
+        self.assertEqual(stats.readings, 4)
+
+    def test_import_checkpoints(self):
+        path = self.export("csv")
+        checkpoints = []
+        write_checkpoint = import_service._write_checkpoint
+        def record_checkpoint(checkpoint_path, offset):
+            checkpoints.append(offset)
+            write_checkpoint(checkpoint_path, offset)
+
+        chunk_lines = import_service.chunk_lines
+        import_service._write_checkpoint = record_checkpoint
+        import_service.chunk_lines = 10
+        try:
+            self.open_storage("import")
+            import_service.import_file(path, "csv", batch_readings=20)
+        finally:
+            import_service._write_checkpoint = write_checkpoint
+            import_service.chunk_lines = chunk_lines
+
+        # Each checkpoint is at the end of a line
+        with open(path, "rb") as export_file:
+            data = export_file.read()
+        self.assertTrue(len(checkpoints) >= 5)
+        self.assertTrue(all(data[offset - 1] == "\n"
+            for offset in checkpoints))
+        self.assertEqual(len(self.walk("probe_a")), len(self.readings))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_hot_tier
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the in-memory hot tier of recent sensor data (see
+    service.hot_tier): its ring buffers, and the windows it can serve
+    without going to the DB.
+
+    To run...
+
+        $ python -m test.test_hot_tier -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import unittest
+
+from probe_sync import SensorReadings
+from service import hot_tier
+
+base = 1400000000
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def get_window(self, buffer, start=base - 100, end=base + 100):
+        timestamps, values = buffer.get_window(start, end)
+        return zip(timestamps.tolist(), values.tolist())
+
+    def test_append(self):
+        buffer = hot_tier.RingBuffer(4, base)
+        self.assertEqual(self.get_window(buffer), [])
+
+        for ii in range(3):
+            buffer.append(base + ii, ii * 1.5)
+        self.assertEqual(self.get_window(buffer), [(base, 0.0),
+            (base + 1, 1.5), (base + 2, 3.0)])
+        self.assertEqual(self.get_window(buffer, base + 1, base + 1),
+            [(base + 1, 1.5)])
+
+    def test_wraparound(self):
+        buffer = hot_tier.RingBuffer(4, base)
+        for ii in range(10):
+            buffer.append(base + ii, float(ii))
+
+        # The oldest readings are evicted, and the rest come back in
+        # time order
+        self.assertEqual((buffer.size, buffer.head), (4, 2))
+        self.assertEqual(self.get_window(buffer), [(base + ii, float(ii))
+            for ii in range(6, 10)])
+
+        # So the buffer only holds all of the readings from after the
+        # last one evicted
+        self.assertEqual(buffer.complete_since, base + 6)
+        self.assertFalse(buffer.covers(base + 5))
+        self.assertTrue(buffer.covers(base + 6))
+
+    def test_unordered(self):
+        buffer = hot_tier.RingBuffer(4, base)
+        for offset in [0, 3, 1, 2, 5]:
+            buffer.append(base + offset, float(offset))
+        self.assertEqual(self.get_window(buffer), [(base + offset,
+            float(offset)) for offset in [1, 2, 3, 5]])
+
+    def test_older_reading_evicted(self):
+        # Evicting a reading from before the buffer was complete (such
+        # as one warmed from the DB) doesn't change what it covers
+        buffer = hot_tier.RingBuffer(2, base + 10)
+        for offset in [5, 11, 12]:
+            buffer.append(base + offset, 1.0)
+        self.assertEqual(buffer.complete_since, base + 10)
+
+        buffer.append(base + 13, 1.0)
+        self.assertEqual(buffer.complete_since, base + 12)
+
+
+class HotTierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.max_points_per_sensor = hot_tier.max_points_per_sensor
+        hot_tier.max_points_per_sensor = 10
+        hot_tier.stop()
+
+    def tearDown(self):
+        hot_tier.stop()
+        hot_tier.max_points_per_sensor = self.max_points_per_sensor
+
+    def append(self, probe_id, sensor_id, offsets):
+        hot_tier.append(probe_id, SensorReadings([sensor_id],
+            [0] * len(offsets), [base + offset for offset in offsets],
+            [float(offset) for offset in offsets]))
+
+    def get_windows(self, probe_id, start, end):
+        windows = hot_tier.get_probe_windows(probe_id, start, end)
+        if windows is None:
+            return None
+        return [(sensor_id, timestamps.tolist(), values.tolist())
+            for sensor_id, timestamps, values in windows]
+
+    def test_inactive(self):
+        self.append("probe_a", "tmp0", [0, 1])
+        self.assertIsNone(self.get_windows("probe_a", base, base + 10))
+        self.assertEqual(hot_tier.get_stats()["points"], 0)
+
+    def test_windows(self):
+        hot_tier.start(base)
+        self.append("probe_a", "tmp0", [0, 60, 120])
+        self.append("probe_a", "pho0", [0])
+        self.append("probe_b", "tmp0", [30])
+
+        self.assertEqual(self.get_windows("probe_a", base + 60, base + 120),
+            [("tmp0", [base + 60, base + 120], [60.0, 120.0])])
+        self.assertEqual(self.get_windows("probe_a", base, base + 30),
+            [("pho0", [base], [0.0]), ("tmp0", [base], [0.0])])
+        self.assertEqual(hot_tier.get_stats(), {"sensors" : 3, "points" : 5,
+            "max_points_per_sensor" : 10})
+
+    def test_window_not_covered(self):
+        hot_tier.start(base)
+        self.append("probe_a", "tmp0", [0, 60])
+
+        # Before the hot tier was warmed, or of a probe it hasn't seen
+        self.assertIsNone(self.get_windows("probe_a", base - 1, base + 60))
+        self.assertIsNone(self.get_windows("probe_b", base, base + 60))
+
+        # Once one of the probe's buffers evicts readings in the window
+        self.append("probe_a", "pho0", range(0, 1200, 60))
+        self.assertIsNone(self.get_windows("probe_a", base, base + 1200))
+
+        # Sensors without readings in a window are left out of it
+        self.assertEqual([window[0] for window in self.get_windows(
+            "probe_a", base + 600, base + 1200)], ["pho0"])
+
+    def test_stopped(self):
+        hot_tier.start(base)
+        self.append("probe_a", "tmp0", [0])
+        hot_tier.stop()
+        self.assertIsNone(self.get_windows("probe_a", base, base + 10))
+        self.assertEqual(hot_tier.get_stats()["sensors"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_ingest
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the async ingest queue (see service.ingest_queue), and of
+    malformed probe syncs being rejected before they're queued.  Syncs
+    are written to the local storage backend, in a temporary directory.
+
+    To run...
+
+        $ python -m test.test_ingest -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+import unittest
+import Queue
+
+from probe_sync import SensorReadings
+from service import ingest_queue
+from test import FlakyStorage
+from test import StorageTestCase
+from test import new_probe_sync
+
+base = 1398981600
+
+
+def readings_at(offset):
+    """ Returns a reading of tmp0 and of pho0 at the given offset from
+        base
+
+    """
+    return [("tmp0", base + offset, 70.0), ("pho0", base + offset, 12.5)]
+
+
+class IngestQueueTest(StorageTestCase):
+
+    def create_storage(self, data_dir):
+        return FlakyStorage(data_dir)
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.retry_backoff = ingest_queue.retry_backoff
+        ingest_queue.retry_backoff = 0.01
+
+    def tearDown(self):
+        ingest_queue._queue = None
+        ingest_queue.retry_backoff = self.retry_backoff
+        StorageTestCase.tearDown(self)
+
+    def get_count_values(self, probe_id):
+        return StorageTestCase.get_count_values(self, probe_id, base - 3600,
+            base + 3600)
+
+    def test_batch_coalesced(self):
+        ingest_queue._write_batch([new_probe_sync("probe_a", readings_at(0)),
+            new_probe_sync("probe_b", readings_at(0)),
+            new_probe_sync("probe_a", readings_at(60))])
+
+        self.assertEqual(self.get_sync_count("probe_a"), 2)
+        self.assertEqual(self.get_sync_count("probe_b"), 1)
+        self.assertEqual(self.get_count_values("probe_a"),
+            {"tmp0" : 2, "pho0" : 2})
+
+    def test_retry_until_available(self):
+        # The DB is down for the first two attempts, after probe_a's
+        # status was written
+        self.storage.failures = 2
+        retries = ingest_queue.get_stats()["retries"]
+        ingest_queue._write_batch([new_probe_sync("probe_a", readings_at(0)),
+            new_probe_sync("probe_b", readings_at(0))])
+
+        self.assertEqual(ingest_queue.get_stats()["retries"], retries + 2)
+        for probe_id in ["probe_a", "probe_b"]:
+            self.assertEqual(self.get_sync_count(probe_id), 1)
+            self.assertEqual(self.get_count_values(probe_id),
+                {"tmp0" : 1, "pho0" : 1})
+
+    def test_full_queue_rejects(self):
+        ingest_queue._queue = Queue.Queue(2)
+        rejected = ingest_queue.get_stats()["rejected"]
+
+        self.assertEqual([ingest_queue.submit(new_probe_sync("probe_a",
+            readings_at(ii))) for ii in range(3)], [True, True, False])
+        self.assertEqual(ingest_queue.get_stats()["rejected"], rejected + 1)
+        self.assertEqual(ingest_queue.get_stats()["depth"], 2)
+
+    def test_flush_writes_queued(self):
+        ingest_queue.start()
+        for ii in range(20):
+            self.assertTrue(ingest_queue.submit(new_probe_sync("probe_a",
+                readings_at(ii * 60))))
+        ingest_queue.flush()
+
+        self.assertEqual(self.get_sync_count("probe_a"), 20)
+        self.assertEqual(self.get_count_values("probe_a"),
+            {"tmp0" : 20, "pho0" : 20})
+
+
+class SyncValidationTest(StorageTestCase):
+
+    def test_values_checked(self):
+        self.assertEqual(list(SensorReadings.from_dicts([{"id" : "tmp0",
+            "timestamp" : base, "value" : 1}])), [("tmp0", base, 1.0)])
+
+        for value in [None, "1.5", True, float("nan"), float("inf")]:
+            self.assertRaises(ValueError, SensorReadings.from_dicts,
+                [{"id" : "tmp0", "timestamp" : base, "value" : value}])
+
+        # Binary frames carry their values as floats, which may not be
+        # finite either
+        probe_sync = new_probe_sync("probe_a", SensorReadings(["tmp0"], [0],
+            [base], [float("nan")]))
+        self.assertRaises(ValueError, probe_sync.validate_readings)
+
+    def test_sync_endpoint(self):
+        import control_server
+
+        token = control_server.token
+        control_server.token = "changeme"
+        try:
+            app = control_server.app.test_client()
+            def post(value):
+                return app.post("/probe_sync", data=json.dumps({
+                    "probe_id" : "probe_a", "token" : "changeme",
+                    "connection_attempts" : 1, "sync_count" : 2,
+                    "curr_time" : 0, "sensor_data" : [{"id" : "tmp0",
+                        "timestamp" : base, "value" : value}]}),
+                    content_type="application/json")
+
+            # A malformed sync isn't written at all
+            self.assertEqual(post(None).status_code, 400)
+            self.assertEqual(post("warm").status_code, 400)
+            self.assertEqual(self.storage.get_probe_statuses(["probe_a"]), [])
+
+            self.assertEqual(post(21.5).status_code, 200)
+            self.assertEqual(self.get_sync_count("probe_a"), 1)
+
+        finally:
+            control_server.token = token
+
+
+if __name__ == "__main__":
+    unittest.main()
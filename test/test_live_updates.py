@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_live_updates
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the live updates of new sensor readings and probe status
+    changes (see service.live_updates): publishing events to every
+    subscriber, disconnecting subscribers that fall behind, the framing
+    of their Server-Sent Events, and streaming them from /api/live as
+    syncs are written to the local storage backend, in a temporary
+    directory.
+
+    To run...
+
+        $ python -m test.test_live_updates -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+import threading
+import time
+import unittest
+
+from datetime import datetime
+
+from probe_sync import SensorReadings
+from service import live_updates
+from test import StorageTestCase
+
+import date_util
+
+base = 1400000000
+
+
+def parse_events(chunk):
+    """ Returns the (event, data) of each Server-Sent Event in the given
+        chunk of a stream
+
+    """
+    events = []
+    for message in chunk.split("\n\n")[:-1]:
+        fields = dict(line.split(": ", 1) for line in message.split("\n"))
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+class LiveUpdatesTestCase(StorageTestCase):
+
+    settings = ["enabled", "queue_size", "max_subscribers", "keepalive",
+        "retry_ms"]
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.saved = dict((name, getattr(live_updates, name))
+            for name in self.settings)
+        live_updates.enabled = True
+        live_updates.keepalive = 10
+        live_updates.retry_ms = 5000
+        live_updates._subscribers.clear()
+
+    def tearDown(self):
+        live_updates.close_all()
+        live_updates._subscribers.clear()
+        for name, value in self.saved.items():
+            setattr(live_updates, name, value)
+        StorageTestCase.tearDown(self)
+
+
+class LiveUpdatesTest(LiveUpdatesTestCase):
+
+    def test_published_to_every_subscriber(self):
+        # Each subscriber's stream is read by a thread of its own, as
+        # each would be served
+        received = {}
+        def read(index, subscriber):
+            chunks = live_updates.stream(subscriber)
+            chunks.next()  # The retry interval
+            chunk = chunks.next()
+            received[index] = (time.time(), parse_events(chunk))
+            list(chunks)  # Until closed
+
+        subscribers = [live_updates.subscribe() for ii in range(50)]
+        threads = [threading.Thread(target=read, args=(index, subscriber))
+            for index, subscriber in enumerate(subscribers)]
+        for thread in threads:
+            thread.start()
+
+        published = time.time()
+        live_updates.publish_points("probe_a", SensorReadings(["tmp0",
+            "pho0"], [0, 1, 0], [base, base, base + 60], [70.0, 9.5, 71.0]))
+
+        deadline = published + 5
+        while len(received) < len(subscribers) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(received), len(subscribers))
+
+        for received_time, events in received.values():
+            self.assertTrue(received_time - published < 1)
+            self.assertEqual(events, [("points", {"probe_id" : "probe_a",
+                "sensors" : {
+                    "tmp0" : {"timestamps" : [base, base + 60],
+                        "values" : [70.0, 71.0]},
+                    "pho0" : {"timestamps" : [base], "values" : [9.5]}}})])
+
+        # Closed streams end and unsubscribe
+        live_updates.close_all()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(live_updates.get_stats()["subscribers"], 0)
+
+    def test_framing(self):
+        live_updates.keepalive = 0.01
+        subscriber = live_updates.subscribe()
+        chunks = live_updates.stream(subscriber)
+
+        # The browser's reconnection interval, then comments while idle
+        self.assertEqual(chunks.next(), "retry: 5000\n\n")
+        self.assertEqual(chunks.next(), ": keepalive\n\n")
+
+        # Events queued meanwhile are sent together
+        live_updates.publish_status("probe_a", datetime.fromtimestamp(base))
+        live_updates.publish_status("probe_b", datetime.fromtimestamp(base),
+            2, True)
+        chunk = chunks.next()
+        self.assertTrue(chunk.startswith("event: status\ndata: {"))
+        self.assertEqual(parse_events(chunk), [
+            ("status", {"probe_id" : "probe_a", "last_contact" : base,
+                "syncs" : 1, "restart" : False}),
+            ("status", {"probe_id" : "probe_b", "last_contact" : base,
+                "syncs" : 2, "restart" : True})])
+
+    def test_overflow_disconnects(self):
+        live_updates.queue_size = 3
+        slow, fast = live_updates.subscribe(), live_updates.subscribe()
+        slow_chunks = live_updates.stream(slow)
+        fast_chunks = live_updates.stream(fast)
+        slow_chunks.next()
+        fast_chunks.next()
+
+        overflowed = live_updates.get_stats()["overflowed"]
+        for ii in range(2):
+            live_updates.publish("status", {"probe_id" : "probe_a"})
+        self.assertEqual(len(parse_events(fast_chunks.next())), 2)
+        for ii in range(2):
+            live_updates.publish("status", {"probe_id" : "probe_a"})
+
+        # The subscriber that fell behind is disconnected, and the other
+        # keeps receiving events
+        self.assertRaises(StopIteration, slow_chunks.next)
+        self.assertEqual(live_updates.get_stats()["overflowed"],
+            overflowed + 1)
+        self.assertEqual(live_updates._subscribers, set([fast]))
+        self.assertEqual(len(parse_events(fast_chunks.next())), 2)
+
+    def test_close_unsubscribes(self):
+        subscriber = live_updates.subscribe()
+        chunks = live_updates.stream(subscriber)
+        chunks.next()
+
+        # Such as when the browser has gone
+        chunks.close()
+        self.assertEqual(live_updates.get_stats()["subscribers"], 0)
+        self.assertEqual(live_updates.publish("status", {}), 0)
+
+    def test_max_subscribers(self):
+        live_updates.max_subscribers = 2
+        subscribers = [live_updates.subscribe() for ii in range(3)]
+        self.assertIsNone(subscribers[2])
+
+        live_updates.unsubscribe(subscribers[0])
+        self.assertIsNotNone(live_updates.subscribe())
+
+    def test_nothing_published_without_subscribers(self):
+        published = live_updates.get_stats()["published"]
+        live_updates.publish_points("probe_a", SensorReadings(["tmp0"], [0],
+            [base], [70.0]))
+        live_updates.publish_status("probe_a", datetime.now())
+        self.assertEqual(live_updates.get_stats()["published"], published)
+
+
+class LiveStreamTest(LiveUpdatesTestCase):
+
+    def setUp(self):
+        import control_server
+
+        LiveUpdatesTestCase.setUp(self)
+        self.token = control_server.token
+        control_server.token = "changeme"
+        self.app = control_server.app.test_client()
+
+    def tearDown(self):
+        import control_server
+
+        control_server.token = self.token
+        LiveUpdatesTestCase.tearDown(self)
+
+    def test_stream(self):
+        response = self.app.get("/api/live")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.mimetype, response.headers["Cache-Control"],
+            response.headers["X-Accel-Buffering"]), ("text/event-stream",
+            "no-cache", "no"))
+
+        chunks = iter(response.response)
+        self.assertEqual(chunks.next(), "retry: 5000\n\n")
+        self.assertEqual(live_updates.get_stats()["subscribers"], 1)
+
+        # A sync's status and readings, as they're written
+        now = date_util.get_current_timestamp()
+        self.assertEqual(self.app.post("/probe_sync", data=json.dumps({
+            "probe_id" : "probe_a", "token" : "changeme",
+            "connection_attempts" : 1, "sync_count" : 2, "curr_time" : 0,
+            "sensor_data" : [{"id" : "tmp0", "timestamp" : now,
+                "value" : 21.5}]}),
+            content_type="application/json").status_code, 200)
+
+        events = []
+        while len(events) < 2:
+            events.extend(parse_events(chunks.next()))
+        events = dict(events)
+        self.assertEqual(events["points"], {"probe_id" : "probe_a",
+            "sensors" : {"tmp0" : {"timestamps" : [now], "values" : [21.5]}}})
+        self.assertEqual((events["status"]["probe_id"],
+            events["status"]["syncs"]), ("probe_a", 1))
+
+        # Closing the response unsubscribes
+        response.close()
+        self.assertEqual(live_updates.get_stats()["subscribers"], 0)
+
+    def test_unavailable(self):
+        live_updates.max_subscribers = 0
+        self.assertEqual(self.app.get("/api/live").status_code, 503)
+
+        live_updates.enabled = False
+        self.assertEqual(self.app.get("/api/live").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
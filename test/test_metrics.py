@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the always-on instrumentation (see metrics): timing blocks
+    and functions into histograms, rendering them in the Prometheus
+    format, and summing the metrics of several workers at /metrics.
+
+    To run...
+
+        $ python -m test.test_metrics -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from db import shared_state
+
+import control_server
+import metrics
+
+
+class FakeClock(object):
+    """ Stands in for the time module, returning the given times in turn
+
+    """
+
+    def __init__(self, *times):
+        self.times = list(times)
+
+    def time(self):
+        return self.times.pop(0)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (metrics._counters, metrics._histograms,
+            metrics._gauges, metrics.time)
+        metrics._counters, metrics._histograms, metrics._gauges = {}, {}, {}
+
+    def tearDown(self):
+        (metrics._counters, metrics._histograms, metrics._gauges,
+            metrics.time) = self.saved
+
+    def get_histogram(self, name):
+        histogram = metrics._histograms[name]
+        return histogram.counts, histogram.sum, histogram.count
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram((0.001, 0.01, 0.1))
+        for seconds in [0.0005, 0.001, 0.002, 0.05, 0.1, 20.0]:
+            histogram.observe(seconds)
+
+        # Bounds are inclusive, and the last bucket is +Inf
+        self.assertEqual(histogram.counts, [2, 1, 2, 1])
+        self.assertEqual(histogram.count, 6)
+        self.assertAlmostEqual(histogram.sum, 20.1535)
+
+    def test_timed_block(self):
+        metrics.time = FakeClock(100.0, 100.25, 200.0, 200.002)
+        for ii in range(2):
+            with metrics.timed("block"):
+                pass
+
+        counts, total, count = self.get_histogram("block")
+        self.assertEqual((count, counts[metrics.BUCKETS.index(0.25)],
+            counts[metrics.BUCKETS.index(0.0025)]), (2, 1, 1))
+        self.assertAlmostEqual(total, 0.252)
+
+    def test_timed_function(self):
+        @metrics.timed("fn")
+        def divide(a, b):
+            """ Divides a by b """
+            return a / b
+
+        metrics.time = FakeClock(0.0, 0.003, 1.0, 1.5)
+        self.assertEqual(divide(6, 3), 2)
+        self.assertEqual((divide.__name__, divide.__doc__),
+            ("divide", " Divides a by b "))
+
+        # Calls that raise are timed too
+        self.assertRaises(ZeroDivisionError, divide, 1, 0)
+        counts, total, count = self.get_histogram("fn")
+        self.assertEqual(count, 2)
+        self.assertAlmostEqual(total, 0.503)
+
+    def test_render(self):
+        metrics.inc("syncs_total")
+        metrics.inc("syncs_total", 2)
+        metrics.observe("parse", 0.003)
+        metrics.observe("parse", 30.0)
+        metrics.register_gauge("queue", lambda: {"depth" : 4, "max" : 10})
+        metrics.register_gauge("workers", lambda: 2)
+
+        lines = metrics.render().splitlines()
+        self.assertEqual(metrics.get_counter("syncs_total"), 3)
+        for line in ["# TYPE autogarten_syncs_total counter",
+                "autogarten_syncs_total 3",
+                "# TYPE autogarten_parse_seconds histogram",
+                'autogarten_parse_seconds_bucket{le="0.0025"} 0',
+                'autogarten_parse_seconds_bucket{le="0.005"} 1',
+                'autogarten_parse_seconds_bucket{le="10.0"} 1',
+                'autogarten_parse_seconds_bucket{le="+Inf"} 2',
+                "autogarten_parse_seconds_sum 30.003000",
+                "autogarten_parse_seconds_count 2",
+                "autogarten_queue_depth 4", "autogarten_queue_max 10",
+                "# TYPE autogarten_workers gauge", "autogarten_workers 2"]:
+            self.assertIn(line, lines)
+
+    def test_render_snapshots(self):
+        metrics.inc("syncs_total", 3)
+        metrics.observe("parse", 0.003)
+        first = metrics.snapshot()
+
+        metrics._counters, metrics._histograms = {}, {}
+        metrics.inc("syncs_total", 4)
+        metrics.inc("retries_total")
+        metrics.observe("parse", 0.003)
+        metrics.observe("parse", 0.3)
+
+        # Counters and histograms are summed across the workers
+        lines = metrics.render([first, metrics.snapshot()]).splitlines()
+        for line in ["autogarten_syncs_total 7", "autogarten_retries_total 1",
+                'autogarten_parse_seconds_bucket{le="0.005"} 2',
+                'autogarten_parse_seconds_bucket{le="0.5"} 3',
+                "autogarten_parse_seconds_count 3"]:
+            self.assertIn(line, lines)
+
+
+class MetricsPageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (metrics._counters, metrics._histograms, metrics._gauges,
+            shared_state.backend)
+        metrics._counters, metrics._histograms, metrics._gauges = {}, {}, {}
+        self.app = control_server.app.test_client()
+
+    def tearDown(self):
+        (metrics._counters, metrics._histograms, metrics._gauges,
+            shared_state.backend) = self.saved
+        shared_state.set_shared_state(
+            shared_state.create_shared_state("memory"))
+
+    def get_lines(self):
+        response = self.app.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/plain")
+        return response.data.splitlines()
+
+    def test_single_worker(self):
+        shared_state.backend = "memory"
+        metrics.inc("syncs_total", 2)
+        self.assertIn("autogarten_syncs_total 2", self.get_lines())
+
+    def test_workers_summed(self):
+        data_dir = tempfile.mkdtemp(prefix="autogarten_test_")
+        try:
+            shared_state.backend = "sqlite"
+            shared_state.set_shared_state(shared_state.create_shared_state(
+                "sqlite", path=os.path.join(data_dir, "shared_state.db")))
+            shared_state.get_shared_state().put_metrics("other:1",
+                {"counters" : {"syncs_total" : 5}, "histograms" : {}})
+
+            metrics.inc("syncs_total", 2)
+            self.assertIn("autogarten_syncs_total 7", self.get_lines())
+
+        finally:
+            shared_state.set_shared_state(
+                shared_state.create_shared_state("memory"))
+            shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
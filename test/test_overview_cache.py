@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_overview_cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the cache of the probe overview (see service.overview_cache),
+    and of syncs invalidating it, in this worker process and in others
+    sharing its state.  Syncs are written to the local storage backend,
+    in a temporary directory.
+
+    To run...
+
+        $ python -m test.test_overview_cache -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import unittest
+
+from db import shared_state
+from service import overview_cache
+from service import probe_service
+from test import StorageTestCase
+from test import new_probe_sync
+
+import date_util
+
+
+def reading_now(sensor_id="tmp0", value=70.0):
+    return [(sensor_id, date_util.get_current_timestamp(), value)]
+
+
+class OverviewCacheTest(StorageTestCase):
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.state = shared_state.get_shared_state()
+
+        self.enabled, self.ttl = overview_cache.enabled, overview_cache.ttl
+        overview_cache.enabled, overview_cache.ttl = True, 300
+        overview_cache._probes.clear()
+        overview_cache._probe_ids = None
+        overview_cache._page = None
+        overview_cache._known_probe_ids.clear()
+
+    def tearDown(self):
+        overview_cache.enabled, overview_cache.ttl = self.enabled, self.ttl
+        StorageTestCase.tearDown(self)
+
+    def get_sensor_ids(self, probe_id):
+        probe = probe_service.get_overview_for_probe_id(probe_id)
+        return [sensor["id"] for sensor in probe["sensors"]]
+
+    def test_probe_cached_until_invalidated(self):
+        generation = overview_cache.get_generation()
+        self.assertIsNone(overview_cache.get_probe("probe_a"))
+        overview_cache.set_probe("probe_a", {"id" : "probe_a"}, generation)
+        self.assertEqual(overview_cache.get_probe("probe_a"),
+            {"id" : "probe_a"})
+
+        overview_cache.set_probe("probe_b", {"id" : "probe_b"}, generation)
+        overview_cache.invalidate("probe_a")
+        self.assertIsNone(overview_cache.get_probe("probe_a"))
+        self.assertEqual(overview_cache.get_probe("probe_b"),
+            {"id" : "probe_b"})
+
+    def test_stale_entry_not_cached(self):
+        # An entry computed from data that changed meanwhile isn't cached
+        generation = overview_cache.get_generation()
+        overview_cache.invalidate("probe_a")
+        overview_cache.set_probe("probe_a", {"id" : "probe_a"}, generation)
+        overview_cache.set_probe_ids(["probe_a"], generation)
+        overview_cache.set_page(u"<html/>", generation)
+
+        self.assertIsNone(overview_cache.get_probe("probe_a"))
+        self.assertIsNone(overview_cache.get_probe_ids())
+        self.assertIsNone(overview_cache.get_page())
+
+    def test_invalidated_by_other_workers(self):
+        generation = overview_cache.get_generation()
+        overview_cache.set_probe("probe_a", {"id" : "probe_a"}, generation)
+        overview_cache.set_probe_ids(["probe_a"], generation)
+        etag = overview_cache.set_page(u"<html/>", generation)
+        self.assertEqual(overview_cache.get_page(), (etag, u"<html/>"))
+
+        # Another worker writes a sync of probe_a
+        self.state.bump_versions(["overview", "overview/probe_a"])
+        self.assertIsNone(overview_cache.get_probe("probe_a"))
+        self.assertIsNone(overview_cache.get_page())
+        self.assertEqual(overview_cache.get_probe_ids(), ["probe_a"])
+
+        # And then of a probe that's new
+        self.state.bump_versions(["overview/probes"])
+        self.assertIsNone(overview_cache.get_probe_ids())
+
+    def test_expired(self):
+        generation = overview_cache.get_generation()
+        overview_cache.set_probe("probe_a", {"id" : "probe_a"}, generation)
+        overview_cache.ttl = -1
+        self.assertIsNone(overview_cache.get_probe("probe_a"))
+
+    def test_disabled(self):
+        overview_cache.enabled = False
+        generation = overview_cache.get_generation()
+        overview_cache.set_probe("probe_a", {"id" : "probe_a"}, generation)
+        etag = overview_cache.set_page(u"<html/>", generation)
+        self.assertIsNone(overview_cache.get_probe("probe_a"))
+        self.assertIsNone(overview_cache.get_page())
+        self.assertEqual(len(etag), 32)
+
+    def test_sync_invalidates_overview(self):
+        probe_service.process_probe_sync(new_probe_sync("probe_a",
+            reading_now()))
+        self.assertEqual(self.get_sensor_ids("probe_a"), ["tmp0"])
+        hits = overview_cache.get_stats()["hits"]
+        self.assertEqual(self.get_sensor_ids("probe_a"), ["tmp0"])
+        self.assertEqual(overview_cache.get_stats()["hits"], hits + 1)
+
+        # A sync of probe_a refreshes its overview, but not probe_b's
+        probe_service.process_probe_sync(new_probe_sync("probe_b",
+            reading_now()))
+        self.assertEqual([probe["id"] for probe in
+            probe_service.get_probe_overview()], ["probe_a", "probe_b"])
+        probe_service.process_probe_sync(new_probe_sync("probe_a",
+            reading_now("pho0")))
+        self.assertIsNone(overview_cache.get_probe("probe_a"))
+        self.assertIsNotNone(overview_cache.get_probe("probe_b"))
+        self.assertEqual(sorted(self.get_sensor_ids("probe_a")),
+            ["pho0", "tmp0"])
+
+    def test_batch_invalidates_overview(self):
+        probe_service.process_probe_sync_batch([new_probe_sync("probe_a",
+            reading_now())])
+        self.assertEqual([probe["id"] for probe in
+            probe_service.get_probe_overview()], ["probe_a"])
+
+        probe_service.process_probe_sync_batch([new_probe_sync("probe_a",
+            reading_now(value=80.0)), new_probe_sync("probe_b",
+            reading_now())])
+        overview = probe_service.get_probe_overview()
+        self.assertEqual([probe["id"] for probe in overview],
+            ["probe_a", "probe_b"])
+        self.assertEqual(overview[0]["sensors"][0]["curr_value"], 80.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
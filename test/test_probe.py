@@ -13,6 +13,7 @@ import argparse
 import json
 import logging
 import random
+import socket
 import urllib2
 
 from apscheduler.scheduler import Scheduler
@@ -20,8 +21,10 @@ from datetime import datetime
 from time import sleep
 
 import date_util
+import probe_sync
 
 verbose = False
+binary = False
 control_server_hostname = None
 control_server_port = None
 token = None
@@ -30,6 +33,15 @@ sched = Scheduler()
 sensor_data = []
 
 sync_count = 0
+round_trip_ms = None  # Of the previous sync
+
+# Each sync has a sync_id of a random boot id and a counter, so the
+# Control Server can tell a retry from a new sync, even after a restart.
+# A sync that fails is retried as it was, with the same sync_id, and
+# readings taken meanwhile go in the next one.
+boot_id = random.randrange(0x10000)
+sync_counter = 0
+pending_request = None
 
 probe_id = "test_probe"
 
@@ -38,37 +50,67 @@ sync_freq = 31      # Sync with control server every 60s
 
 
 def send_probe_sync_request():
-    global sync_count
+    global sync_count, round_trip_ms, sync_counter, pending_request
 
     url = "http://%s:%d/probe_sync" %\
         (control_server_hostname, control_server_port)
     print " **********************************************************"
     print " > Sending probe sync request to: %s with token [%s]" % (url, token)
 
-    request_content = {
-        "probe_id" : probe_id,
-        "token" : token,
-        "connection_attempts" : 1,
-        "sensor_freq" : sensor_freq,
-        "sync_freq" : sync_freq,
-        "sync_count" : sync_count,
-        "curr_time" : date_util.get_current_timestamp(),
-        "sensor_data" : sensor_data
-    }
+    if pending_request is not None:
+        request_content = pending_request
+        request_content["connection_attempts"] += 1
+        request_content["curr_time"] = date_util.get_current_timestamp()
+    else:
+        request_content = {
+            "probe_id" : probe_id,
+            "token" : token,
+            "connection_attempts" : 1,
+            "sensor_freq" : sensor_freq,
+            "sync_freq" : sync_freq,
+            "sync_count" : sync_count,
+            "sync_id" : (boot_id << 16) | (sync_counter & 0xFFFF),
+            "curr_time" : date_util.get_current_timestamp(),
+            "sensor_data" : list(sensor_data)
+        }
+        del sensor_data[:]
+        sync_counter += 1
+        pending_request = request_content
+
+    if round_trip_ms is not None:
+        request_content["round_trip_ms"] = round_trip_ms
 
     # Print Request
     print "---- Request ----"
     print json.dumps(request_content, indent=1)
 
     request = urllib2.Request(url)
-    request.add_header('Content-Type', 'application/json')
-
-    response = urllib2.urlopen(request, json.dumps(request_content))
-    response_content_str = response.read()
+    if binary:
+        request.add_header('Content-Type', probe_sync.BINARY_CONTENT_TYPE)
+        request_body = encode_binary_request(request_content)
+    else:
+        request.add_header('Content-Type', 'application/json')
+        request_body = json.dumps(request_content)
+
+    sent = datetime.now()
+    try:
+        response = urllib2.urlopen(request, request_body)
+        response_content_str = response.read()
+    except urllib2.HTTPError, e:
+        # A rejected sync (such as a 400) won't succeed if retried
+        if e.code < 500:
+            print " > Sync rejected, dropping it: %s" % str(e)
+            pending_request = None
+        else:
+            print " > Sync failed, it will be retried: %s" % str(e)
+        return
+    except (urllib2.URLError, socket.error), e:
+        print " > Sync failed, it will be retried: %s" % str(e)
+        return
+    round_trip_ms = int((datetime.now() - sent).total_seconds() * 1000)
     response_content = json.loads(response_content_str)
 
-    # Clear sensor data
-    del sensor_data[:]
+    pending_request = None
     sync_count += 1
 
     # Print Response
@@ -78,6 +120,24 @@ def send_probe_sync_request():
     print ""
 
 
+def encode_binary_request(request_content):
+    """ Encodes the given probe sync request as a binary frame, the
+        compact alternative to JSON.  See probe_sync for the format.
+
+    """
+    return probe_sync.encode_binary(
+        request_content["probe_id"],
+        request_content["token"],
+        request_content["connection_attempts"],
+        request_content["sync_count"],
+        request_content["curr_time"],
+        request_content["sensor_freq"],
+        request_content["sync_freq"],
+        request_content["sensor_data"],
+        sync_id=request_content["sync_id"],
+        round_trip_ms=request_content.get("round_trip_ms"))
+
+
 def get_seconds_since_midnight():
     now = datetime.now()
     midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -127,7 +187,7 @@ def parse_args():
     """ Parse the command line arguments
 
     """
-    global verbose, control_server_hostname, control_server_port, token
+    global verbose, binary, control_server_hostname, control_server_port, token
 
     parser = argparse.ArgumentParser(description="autogarten Test Probe")
     parser.add_argument("-v", "--verbose", action="store_true",
@@ -138,12 +198,15 @@ def parse_args():
             help="Control Server Port")
     parser.add_argument("-t", "--token", default="changeme",
             help="Control Server Auth Token")
+    parser.add_argument("-b", "--binary", action="store_true",
+            help="Send syncs as binary frames rather than JSON")
     args = parser.parse_args()   
     
     verbose = args.verbose
     control_server_hostname = args.host
     control_server_port = args.port
     token = args.token
+    binary = args.binary
     return args
 
 
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_retention
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the retention policy (see service.retention_service): the
+    parsing of its tiers, and compacting and deleting a probe's sensor-
+    days as they age through them.  Readings are kept with the local
+    storage backend, in a temporary directory.
+
+    To run...
+
+        $ python -m test.test_retention -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import unittest
+
+from datetime import datetime
+from datetime import timedelta
+
+import numpy
+
+from probe_sync import SensorReadings
+from service import retention_service
+from test import StorageTestCase
+
+import date_util
+
+today = date_util.get_midnight(datetime.now())
+
+
+def get_noon(days_ago):
+    return date_util.get_timestamp(today - timedelta(days=days_ago, hours=-12))
+
+
+class RetentionTest(StorageTestCase):
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.tiers = retention_service.tiers
+        self.batch_days = retention_service.batch_days
+        retention_service.tiers = retention_service.parse_tiers(
+            "raw:30, 900:365, 3600:forever")
+
+        # Readings every minute for two hours from noon, of days in
+        # each tier
+        self.days = [400, 100, 5]
+        for probe_id in ["probe_a", "probe_b"]:
+            self.storage.update_probe_status(probe_id, datetime.now())
+            for days_ago in self.days:
+                timestamps = get_noon(days_ago) + numpy.arange(0, 7200, 60)
+                self.storage.append_points(probe_id, SensorReadings(["tmp0"],
+                    numpy.zeros(len(timestamps)), timestamps,
+                    numpy.arange(len(timestamps), dtype=numpy.float64)))
+
+    def tearDown(self):
+        retention_service.tiers = self.tiers
+        retention_service.batch_days = self.batch_days
+        StorageTestCase.tearDown(self)
+
+    def walk(self, probe_id, days_ago):
+        start = get_noon(days_ago)
+        return [timestamps.tolist() for sensor_id, timestamps, values in
+            self.storage.walk_points(probe_id, start, start + 86399)]
+
+    def get_intervals(self, probe_id):
+        """ Returns the interval between the readings of each day, in
+            days_ago order, or None for a day that's gone
+
+        """
+        intervals = []
+        for days_ago in self.days:
+            chunks = self.walk(probe_id, days_ago)
+            intervals.append(numpy.diff(chunks[0]).tolist()[0]
+                if chunks else None)
+        return intervals
+
+    def test_parse_tiers(self):
+        self.assertEqual(retention_service.parse_tiers("raw:forever"),
+            [(0, None)])
+        self.assertEqual(retention_service.parse_tiers(" raw : 7, 300:90 "),
+            [(0, 7), (300, 90)])
+
+        for invalid in ["900:30", "raw:30, 900", "raw:30, 900:20",
+                "raw:forever, 900:30", "raw:30, 60:90, 30:120", "raw:0",
+                "raw:30, hourly:forever"]:
+            self.assertRaises(ValueError, retention_service.parse_tiers,
+                invalid)
+
+    def get_aggregates(self, probe_id):
+        return [(r["hour"], r["min_value"], r["max_value"], r["sum_values"],
+            r["count_values"]) for r in self.storage.get_hourly_rollups(
+                probe_id, today - timedelta(days=401), today)["tmp0"]]
+
+    def test_compact(self):
+        before = self.get_aggregates("probe_a")
+
+        stats = retention_service.compact()
+        self.assertEqual((stats.compacted, stats.dropped), (4, 0))
+        self.assertTrue(stats.reclaimed > 0)
+        for probe_id in ["probe_a", "probe_b"]:
+            self.assertEqual(self.get_intervals(probe_id), [3600, 900, 60])
+
+        # The hourly bucket keeps the mean of its readings
+        start = get_noon(400)
+        for sensor_id, timestamps, values in self.storage.walk_points(
+                "probe_a", start, start + 7199):
+            self.assertEqual(values.tolist(), [29.5, 89.5])
+
+        # The hourly aggregates stay exact
+        self.assertEqual(self.get_aggregates("probe_a"), before)
+
+        # Days already compacted are skipped
+        stats = retention_service.compact()
+        self.assertEqual((stats.compacted, stats.dropped), (0, 0))
+
+    def test_compact_probe(self):
+        retention_service.compact("probe_a")
+        self.assertEqual(self.get_intervals("probe_a"), [3600, 900, 60])
+        self.assertEqual(self.get_intervals("probe_b"), [60, 60, 60])
+
+    def test_compact_in_batches(self):
+        retention_service.batch_days = 1
+        stats = retention_service.compact("probe_a")
+        self.assertEqual(stats.compacted, 2)
+        self.assertEqual(self.get_intervals("probe_a"), [3600, 900, 60])
+
+    def test_drop_after_last_tier(self):
+        retention_service.tiers = retention_service.parse_tiers(
+            "raw:30, 900:365")
+        stats = retention_service.compact("probe_a")
+        self.assertEqual((stats.compacted, stats.dropped), (1, 1))
+        self.assertEqual(self.get_intervals("probe_a"), [None, 900, 60])
+        self.assertEqual(self.get_intervals("probe_b"), [60, 60, 60])
+
+
+if __name__ == "__main__":
+    unittest.main()
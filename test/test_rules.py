@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_rules
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the actuator rule engine (see service.rule_service): the
+    compiling of rules, their sliding windows, and the commands they
+    return as probes sync.
+
+    To run...
+
+        $ python -m test.test_rules -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from service import probe_service
+from service import rule_service
+from test import new_probe_sync
+
+base = 1400000000
+
+water_rule = {
+    "probe" : "probe0",
+    "when" : "mean(moisture1, 1h) < 30 and not max(weather/rain, 6h) > 0",
+    "actuator" : "bed2_valve",
+    "value" : "1",
+    "cooldown" : "3600"
+}
+
+
+class SlidingWindowTest(unittest.TestCase):
+
+    def test_aggregates(self):
+        window = rule_service.SlidingWindow(60)
+        self.assertEqual((window.get("count"), window.get("mean")), (0, None))
+
+        for offset, value in [(0, 5.0), (20, 1.0), (40, 3.0), (50, 4.0)]:
+            window.add(base + offset, value)
+        window.expire(base + 50)
+        self.assertEqual([window.get(agg) for agg in
+            rule_service.aggregations], [3.25, 1.0, 5.0, 4.0, 4])
+
+        # The min and max expire with their readings
+        window.expire(base + 61)
+        self.assertEqual([window.get(agg) for agg in
+            rule_service.aggregations], [8 / 3.0, 1.0, 4.0, 4.0, 3])
+        window.expire(base + 81)
+        self.assertEqual((window.get("min"), window.get("max")), (3.0, 4.0))
+
+        window.expire(base + 200)
+        self.assertEqual((window.get("count"), window.get("mean"), window.sum),
+            (0, None, 0.0))
+
+    def test_older_readings_ignored(self):
+        window = rule_service.SlidingWindow(60)
+        window.add(base + 10, 1.0)
+        window.add(base, 9.0)
+        window.add(base + 10, 9.0)
+        self.assertEqual((window.get("count"), window.get("max")), (1, 1.0))
+
+
+class RuleServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        rule_service.set_rules([rule_service.compile_rule("water_bed_2",
+            water_rule)])
+
+    def tearDown(self):
+        rule_service.set_rules([])
+
+    def sync(self, probe_id, offset, sensor_data=(), sync_id=None):
+        return rule_service.evaluate(new_probe_sync(probe_id,
+            [(sensor_id, base + reading_offset, value)
+                for sensor_id, reading_offset, value in sensor_data],
+            base + offset, sync_id))
+
+    def test_compile_errors(self):
+        for when in ["mean(moisture1, 1h) <", "mean(moisture1, 1y) < 30",
+                "median(moisture1, 1h) < 30", "mean(moisture1 1h) < 30",
+                "mean(moisture1, 1h) < 30 30", "(mean(moisture1, 1h) < 30",
+                "mean(moisture1, 1h) ~ 30", "mean(moisture1, 1h)"]:
+            options = dict(water_rule, when=when)
+            self.assertRaises(rule_service.RuleError,
+                rule_service.compile_rule, "bad", options)
+
+        options = dict(water_rule)
+        del options["actuator"]
+        self.assertRaises(rule_service.RuleError, rule_service.compile_rule,
+            "bad", options)
+
+    def test_rule_fires(self):
+        # No readings yet, so the condition fails
+        self.assertEqual(self.sync("probe0", 0), [])
+
+        self.assertEqual(self.sync("probe0", 600, [("moisture1", 0, 40.0),
+            ("moisture1", 300, 20.0), ("moisture1", 600, 10.0)]),
+            [{"actuator" : "bed2_valve", "value" : 1.0,
+                "rule" : "water_bed_2"}])
+
+        # Another probe's syncs don't evaluate probe0's rules
+        evaluations = rule_service.get_stats()["evaluations"]
+        self.assertEqual(self.sync("probe1", 700, [("moisture1", 700, 5.0)]),
+            [])
+        self.assertEqual(rule_service.get_stats()["evaluations"], evaluations)
+
+    def test_other_probe_sensor(self):
+        # Rain reported by the weather probe holds the valve closed
+        self.sync("weather", 0, [("rain", 0, 1.0)])
+        self.assertEqual(self.sync("probe0", 600, [("moisture1", 600, 10.0)]),
+            [])
+
+        # Until the rain is out of the 6h window
+        self.assertEqual(len(self.sync("probe0", 6 * 3600 + 1,
+            [("moisture1", 6 * 3600, 10.0)])), 1)
+
+    def test_window_expires(self):
+        self.sync("probe0", 0, [("moisture1", 0, 10.0)])
+        rule_service.set_rules([rule_service.compile_rule("dry",
+            dict(water_rule, when="count(moisture1, 30m) >= 2"))])
+
+        self.assertEqual(self.sync("probe0", 60, [("moisture1", 0, 10.0),
+            ("moisture1", 60, 10.0)]), [{"actuator" : "bed2_valve",
+            "value" : 1.0, "rule" : "dry"}])
+        stats = rule_service.get_stats()
+        self.assertEqual((stats["rules"], stats["windows"], stats["readings"]),
+            (1, 1, 2))
+
+        self.sync("probe0", 1800)
+        self.assertEqual(rule_service.get_stats()["readings"], 1)
+
+    def test_cooldown(self):
+        def dry_sync(offset):
+            return self.sync("probe0", offset, [("moisture1", offset, 10.0)])
+
+        self.assertEqual(len(dry_sync(0)), 1)
+        self.assertEqual(dry_sync(1800), [])
+        self.assertEqual(len(dry_sync(3600)), 1)
+
+    def test_retried_sync(self):
+        commands = self.sync("probe0", 0, [("moisture1", 0, 10.0)], 7)
+        self.assertEqual(len(commands), 1)
+
+        # A retry gets the same commands, without evaluating the rules
+        evaluations = rule_service.get_stats()["evaluations"]
+        retry = new_probe_sync("probe0", curr_time=base, sync_id=7)
+        self.assertEqual(rule_service.get_commands(retry), commands)
+        self.assertEqual(probe_service.build_sync_response(retry,
+            duplicate=True)["commands"], commands)
+        self.assertEqual(rule_service.get_stats()["evaluations"], evaluations)
+
+        self.assertEqual(rule_service.get_commands(new_probe_sync("probe0",
+            curr_time=base, sync_id=8)), [])
+
+    def test_load_rules(self):
+        rules_dir = tempfile.mkdtemp(prefix="autogarten_test_")
+        try:
+            path = os.path.join(rules_dir, "rules.cfg")
+            with open(path, "w") as rules_file:
+                rules_file.write("[water_bed_2]\n" + "".join("%s : %s\n" %
+                    item for item in water_rule.items() if item[0] !=
+                    "cooldown") + "\n[lamp]\nprobe : probe1\n"
+                    "when : last(pho0, 10m) < 100 or min(tmp0, 1d) < -5\n"
+                    "actuator : lamp\nvalue : 0.5\ncooldown : 60\n")
+
+            rule_service.load_rules(path)
+            self.assertEqual(sorted((rule.name, rule.probe_id, rule.value,
+                rule.cooldown) for rule in rule_service.rules),
+                [("lamp", "probe1", 0.5, 60), ("water_bed_2", "probe0", 1.0,
+                    rule_service.default_cooldown)])
+            self.assertEqual(rule_service.get_stats()["windows"], 4)
+
+            # The rules file shipped only has examples
+            rule_service.load_rules("rules.cfg")
+            self.assertEqual(rule_service.rules, [])
+
+        finally:
+            shutil.rmtree(rules_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_sensor_data
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of reading a probe's sensor data over a time range (see
+    service.probe_service.get_sensor_data_for_probe), checked against
+    brute force aggregations of its raw readings.  Readings are kept
+    with the local storage backend, in a temporary directory.
+
+    To run...
+
+        $ python -m test.test_sensor_data -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import unittest
+
+from datetime import datetime
+
+import numpy
+
+from probe_sync import SensorReadings
+from service import probe_service
+from test import StorageTestCase
+
+import date_util
+import series_util
+
+base = date_util.get_timestamp(datetime(2014, 5, 1))
+
+# Edges partway through an hour
+start = base + 5 * 3600 + 20 * 60 + 7
+end = base + 61 * 3600 + 41 * 60 + 13
+
+
+def get_hour(timestamp):
+    return date_util.get_timestamp(date_util.get_hour(
+        datetime.fromtimestamp(timestamp)))
+
+
+class SensorDataTest(StorageTestCase):
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+
+        # Readings at random times over three days, and outside of the
+        # range at either end
+        numpy.random.seed(0)
+        self.readings = {}
+        for sensor_id in ["tmp0", "pho0"]:
+            timestamps = numpy.sort(base + numpy.random.choice(72 * 3600,
+                3000, replace=False))
+            values = numpy.random.uniform(-10, 40, 3000)
+            self.readings[sensor_id] = (timestamps, values)
+            self.storage.append_points("probe_a", SensorReadings([sensor_id],
+                numpy.zeros(3000), timestamps, values))
+
+    def get_sensor_data(self, points=None, agg="mean"):
+        sensors = probe_service.get_sensor_data_for_probe("probe_a",
+            datetime.fromtimestamp(start), datetime.fromtimestamp(end),
+            points, agg)
+        return dict((sensor["_id"], sensor) for sensor in sensors)
+
+    def expected(self, sensor_id, points, agg):
+        """ Returns the aggregate of each bucket of a sensor's readings,
+            or None for a bucket without data.  When buckets span an hour
+            or more, the readings of each whole hour in the range are in
+            the bucket of the hour's midpoint, as its rollup is.
+
+        """
+        width = (end - start) / float(points)
+        hours_start = get_hour(start - 1) + 3600
+        hours_end = get_hour(end + 1)
+
+        buckets = [[] for ii in range(points)]
+        for timestamp, value in zip(*[column.tolist() for column in
+                self.readings[sensor_id]]):
+            if not start <= timestamp <= end:
+                continue
+            placed = timestamp
+            if width >= 3600 and hours_start <= timestamp < hours_end:
+                placed = get_hour(timestamp) + 1800
+            bucket = min(int((placed - start) / width), points - 1)
+            buckets[bucket].append((timestamp, value))
+
+        reduce_bucket = {
+            "mean" : lambda points: sum(v for t, v in points) / len(points),
+            "min" : lambda points: min(v for t, v in points),
+            "max" : lambda points: max(v for t, v in points),
+            "last" : lambda points: max(points)[1],
+            "count" : len,
+            "sum" : lambda points: sum(v for t, v in points)
+        }[agg]
+        return [reduce_bucket(points) if points else None
+            for points in buckets]
+
+    def assertBuckets(self, result, expected):
+        self.assertEqual(len(result), len(expected))
+        for value, expected_value in zip(result.tolist(), expected):
+            if expected_value is None:
+                self.assertTrue(numpy.isnan(value))
+            else:
+                self.assertAlmostEqual(value, expected_value)
+
+    def test_exact_range(self):
+        sensors = self.get_sensor_data()
+        self.assertEqual(sorted(sensors), ["pho0", "tmp0"])
+        for sensor_id, (timestamps, values) in self.readings.items():
+            in_range = (timestamps >= start) & (timestamps <= end)
+            sensor = sensors[sensor_id]
+            self.assertEqual(sensor["timestamps"].tolist(),
+                timestamps[in_range].tolist())
+            self.assertEqual(sensor["values"].tolist(),
+                values[in_range].tolist())
+            self.assertEqual((sensor["min_value"], sensor["max_value"],
+                sensor["last_timestamp"]), (values[in_range].min(),
+                values[in_range].max(), timestamps[in_range][-1]))
+
+    def test_rollups_and_raw_edges(self):
+        # Buckets of over five hours, read from the rollups of the whole
+        # hours and the raw readings of the partial hours at either end
+        for agg in series_util.aggregations:
+            sensors = self.get_sensor_data(10, agg)
+            for sensor_id, (timestamps, values) in self.readings.items():
+                self.assertBuckets(sensors[sensor_id]["values"],
+                    self.expected(sensor_id, 10, agg))
+
+                in_range = (timestamps >= start) & (timestamps <= end)
+                self.assertEqual((sensors[sensor_id]["min_value"],
+                    sensors[sensor_id]["max_value"]),
+                    (values[in_range].min(), values[in_range].max()))
+
+    def test_raw_buckets(self):
+        # Buckets of under an hour are read from the raw readings only
+        for agg in series_util.aggregations:
+            sensors = self.get_sensor_data(300, agg)
+            for sensor_id in self.readings:
+                self.assertBuckets(sensors[sensor_id]["values"],
+                    self.expected(sensor_id, 300, agg))
+
+        self.assertEqual(self.get_sensor_data(300)["tmp0"]["timestamps"][:2
+            ].tolist(), [start, start + (end - start) / 300.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_series_api
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the JSON API of a probe's sensors and their series (see
+    control_server): validating the arguments, downsampling, getting
+    only newer readings, serializing empty buckets, and revalidating
+    responses with their ETags.  Readings are kept with the local
+    storage backend, in a temporary directory.
+
+    To run...
+
+        $ python -m test.test_series_api -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+import unittest
+
+from datetime import datetime
+
+import numpy
+
+from probe_sync import SensorReadings
+from service import overview_cache
+from test import StorageTestCase
+
+import control_server
+import date_util
+
+# Readings every minute for two hours, from a whole hour yesterday
+hour = date_util.get_timestamp(date_util.get_hour(datetime.now())) - 86400
+
+
+class SeriesApiTest(StorageTestCase):
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.enabled = overview_cache.enabled
+        overview_cache.enabled = False
+        self.app = control_server.app.test_client()
+
+        self.storage.update_probe_status("probe_a", datetime.now())
+        self.append(numpy.arange(0, 7200, 60))
+
+    def tearDown(self):
+        overview_cache.enabled = self.enabled
+        StorageTestCase.tearDown(self)
+
+    def append(self, offsets):
+        self.storage.append_points("probe_a", SensorReadings(["tmp0"],
+            numpy.zeros(len(offsets)), hour + offsets,
+            offsets / 60.0))
+
+    def get(self, url, **args):
+        return self.app.get(url, query_string=args)
+
+    def get_series(self, **args):
+        response = self.get("/api/probes/probe_a/sensors/tmp0/series",
+            **args)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_series(self):
+        series = self.get_series(start=hour, end=hour + 7199)
+        self.assertEqual((series["probe_id"], series["sensor_id"],
+            series["start"], series["end"]), ("probe_a", "tmp0", hour,
+            hour + 7199))
+        self.assertEqual(series["timestamps"], range(hour, hour + 7200, 60))
+        self.assertEqual(series["values"], [float(ii) for ii in range(120)])
+        self.assertEqual(series["last_timestamp"], hour + 7140)
+
+        # Buckets of half an hour
+        series = self.get_series(start=hour, end=hour + 7200, points=4)
+        self.assertEqual(series["timestamps"], range(hour, hour + 7200, 1800))
+        self.assertEqual(series["values"], [14.5, 44.5, 74.5, 104.5])
+
+        series = self.get_series(start=hour, end=hour + 7200, points=4,
+            downsample="minmax", agg="max")
+        self.assertEqual((series["min_values"], series["max_values"]),
+            ([0.0, 30.0, 60.0, 90.0], [29.0, 59.0, 89.0, 119.0]))
+
+    def test_empty_buckets_null(self):
+        response = self.get("/api/probes/probe_a/sensors/tmp0/series",
+            start=hour - 7200, end=hour + 7200, points=4)
+        self.assertNotIn("NaN", response.data)
+
+        series = json.loads(response.data)
+        self.assertEqual(series["values"], [None, None, 29.5, 89.5])
+
+        series = self.get_series(start=hour - 7200, end=hour + 7200,
+            points=4, downsample="minmax")
+        self.assertEqual((series["min_values"], series["max_values"]),
+            ([None, None, 0.0, 60.0], [None, None, 59.0, 119.0]))
+
+        # A sensor without readings
+        series = json.loads(self.get(
+            "/api/probes/probe_a/sensors/pho0/series", start=hour,
+            end=hour + 7200).data)
+        self.assertEqual((series["timestamps"], series["values"],
+            series["last_timestamp"]), ([], [], None))
+
+    def test_since(self):
+        # Only readings newer than since, with their own timestamps
+        series = self.get_series(since=hour + 7020)
+        self.assertEqual((series["timestamps"], series["values"],
+            series["last_timestamp"]), ([hour + 7080, hour + 7140],
+            [118.0, 119.0], hour + 7140))
+
+        # Nothing newer
+        series = self.get_series(since=hour + 7140)
+        self.assertEqual((series["timestamps"], series["last_timestamp"]),
+            ([], hour + 7140))
+
+        # More newer readings than points are downsampled with LTTB,
+        # keeping the newest
+        series = self.get_series(since=hour - 1, points=5)
+        self.assertEqual(len(series["timestamps"]), 5)
+        self.assertEqual((series["timestamps"][0], series["last_timestamp"]),
+            (hour, hour + 7140))
+
+    def test_invalid_arguments(self):
+        series_max_points = control_server.series_max_points
+        for args in [
+                {"start" : hour, "end" : hour, "points" : 10},
+                {"start" : hour + 60, "end" : hour},
+                {"points" : 2}, {"points" : series_max_points + 1},
+                {"points" : "many"}, {"start" : "yesterday"},
+                {"since" : "then"}, {"downsample" : "median"},
+                {"agg" : "median"}]:
+            response = self.get("/api/probes/probe_a/sensors/tmp0/series",
+                **args)
+            self.assertEqual(response.status_code, 400, args)
+
+        # A range of one timestamp, without points
+        self.assertEqual(self.get_series(start=hour, end=hour)["values"],
+            [0.0])
+        self.assertEqual(len(self.get_series(points=series_max_points)[
+            "values"]), series_max_points)
+
+    def test_etag(self):
+        url = "/api/probes/probe_a/sensors/tmp0/series"
+        response = self.get(url, start=hour, end=hour + 7199)
+        etag = response.headers["ETag"]
+        self.assertEqual(response.cache_control.max_age,
+            control_server.series_history_max_age)
+        self.assertEqual(self.get(url).cache_control.max_age,
+            control_server.series_max_age)
+
+        response = self.app.get(url, query_string={"start" : hour,
+            "end" : hour + 7199}, headers={"If-None-Match" : etag})
+        self.assertEqual((response.status_code, response.data), (304, ""))
+
+        # A late sync filling in the range changes it
+        self.append(numpy.array([30]))
+        response = self.app.get(url, query_string={"start" : hour,
+            "end" : hour + 7199}, headers={"If-None-Match" : etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_sensors(self):
+        response = self.get("/api/probes/probe_a/sensors")
+        self.assertEqual(response.status_code, 200)
+        probe = json.loads(response.data)
+        self.assertEqual(probe["probe_id"], "probe_a")
+        self.assertEqual(probe["end"] - probe["start"], 7 * 86400 - 1)
+
+        # Without the series of the sensors
+        self.assertEqual(probe["sensors"], [{"id" : "tmp0",
+            "desc" : "TODO Sensor Description...", "units_label" : "&deg;",
+            "curr_value" : 119.0, "min_value" : 0.0, "max_value" : 119.0,
+            "avg_value" : 59.5}])
+
+        response = self.app.get("/api/probes/probe_a/sensors",
+            headers={"If-None-Match" : response.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+        self.assertEqual(self.get("/api/probes/probe_b/sensors").status_code,
+            404)
+
+
+if __name__ == "__main__":
+    unittest.main()
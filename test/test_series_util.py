@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_series_util
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the NumPy time series functions (see series_util), checked
+    against plain Python aggregations and downsampling of the same data
+    points.
+
+    To run...
+
+        $ python -m test.test_series_util -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import unittest
+
+import numpy
+
+import series_util
+
+base = 1400000000
+
+
+class BucketizeTest(unittest.TestCase):
+
+    def setUp(self):
+        # Unordered data points over an hour, in four 15 minute buckets
+        numpy.random.seed(0)
+        self.timestamps = base + numpy.random.permutation(3600)[:500]
+        self.values = numpy.random.uniform(-10, 40, 500)
+
+    def expected(self, agg, bucket_count=4, start=base, end=base + 3600):
+        """ Returns the aggregate of each bucket, in plain Python, or
+            None for a bucket without data
+
+        """
+        width = (end - start) / float(bucket_count)
+        buckets = [[] for ii in range(bucket_count)]
+        for timestamp, value in zip(self.timestamps.tolist(),
+                self.values.tolist()):
+            if start <= timestamp <= end:
+                bucket = min(int((timestamp - start) / width),
+                    bucket_count - 1)
+                buckets[bucket].append((timestamp, value))
+
+        reduce_bucket = {
+            "mean" : lambda points: sum(v for t, v in points) / len(points),
+            "min" : lambda points: min(v for t, v in points),
+            "max" : lambda points: max(v for t, v in points),
+            "last" : lambda points: max(points)[1],
+            "count" : len,
+            "sum" : lambda points: sum(v for t, v in points)
+        }[agg]
+        return [reduce_bucket(points) if points else None
+            for points in buckets]
+
+    def assertBuckets(self, result, expected):
+        self.assertEqual(len(result), len(expected))
+        for value, expected_value in zip(result.tolist(), expected):
+            if expected_value is None:
+                self.assertTrue(numpy.isnan(value))
+            else:
+                self.assertAlmostEqual(value, expected_value)
+
+    def test_aggregations(self):
+        # Including last, whose data points aren't in time order
+        for agg in series_util.aggregations:
+            self.assertBuckets(series_util.bucketize(self.timestamps,
+                self.values, 4, base, base + 3600, agg), self.expected(agg))
+
+        self.assertRaises(ValueError, series_util.bucketize, self.timestamps,
+            self.values, 4, base, base + 3600, "median")
+
+    def test_fixed_length(self):
+        # Buckets without data are filled, however much data is in range
+        for count in [0, 1, 500]:
+            for bucket_count in [1, 7, 3600, 5000]:
+                result = series_util.bucketize(self.timestamps[:count],
+                    self.values[:count], bucket_count, base, base + 3600)
+                self.assertEqual(result.shape, (bucket_count,))
+
+        result = series_util.bucketize(self.timestamps, self.values, 8,
+            base + 7200, base + 10800)
+        self.assertTrue(numpy.isnan(result).all())
+
+    def test_fill(self):
+        self.timestamps = numpy.array([base + 100, base + 3000])
+        self.values = numpy.array([1.0, 2.0])
+        self.assertEqual(series_util.bucketize(self.timestamps, self.values,
+            4, base, base + 3600, "max", fill=-1).tolist(),
+            [1.0, -1, -1, 2.0])
+
+        # Empty buckets have a count of 0, whatever the fill
+        self.assertEqual(series_util.bucketize(self.timestamps, self.values,
+            4, base, base + 3600, "count", fill=-1).tolist(),
+            [1.0, 0.0, 0.0, 1.0])
+
+    def test_range_edges(self):
+        # A data point at exactly the end is in the last bucket, and
+        # data points outside of the range are ignored
+        self.timestamps = numpy.array([base - 1, base, base + 3600,
+            base + 3601])
+        self.values = numpy.array([1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(series_util.bucketize(self.timestamps, self.values,
+            4, base, base + 3600, "sum", fill=0).tolist(),
+            [2.0, 0.0, 0.0, 3.0])
+
+    def test_empty_range(self):
+        self.timestamps = numpy.array([base - 1, base, base, base + 1])
+        self.values = numpy.array([1.0, 2.0, 3.0, 4.0])
+        for agg, expected in [("mean", 2.5), ("count", 2), ("last", 3.0)]:
+            result = series_util.bucketize(self.timestamps, self.values, 3,
+                base, base, agg)
+            self.assertEqual(len(result), 3)
+            self.assertEqual(result[-1], expected)
+
+    def test_groups(self):
+        groups = numpy.arange(500) % 3
+        for agg in series_util.aggregations:
+            result = series_util.bucketize(self.timestamps, self.values, 4,
+                base, base + 3600, agg, groups=groups, group_count=4)
+            self.assertEqual(result.shape, (4, 4))
+
+            # Each group is bucketized as if on its own
+            timestamps, values = self.timestamps, self.values
+            for group in range(3):
+                self.timestamps = timestamps[groups == group]
+                self.values = values[groups == group]
+                self.assertBuckets(result[group], self.expected(agg))
+            self.timestamps, self.values = timestamps, values
+
+            # A group without data
+            self.assertBuckets(result[3], [0] * 4 if agg == "count"
+                else [None] * 4)
+
+
+class LttbTest(unittest.TestCase):
+
+    def setUp(self):
+        # A noisy series, a reading a minute for a day
+        numpy.random.seed(0)
+        self.timestamps = base + numpy.arange(0, 86400, 60)
+        self.values = numpy.sin(numpy.arange(1440) / 100.0) + \
+            numpy.random.normal(0, 0.1, 1440)
+
+    def expected(self, points):
+        """ Returns the indexes of the data points kept, by a plain
+            Python Largest-Triangle-Three-Buckets
+
+        """
+        x, y = self.timestamps.tolist(), self.values.tolist()
+        count = len(x)
+        edges = [int(ii * (count - 2) / float(points - 2)) + 1
+            for ii in range(points - 1)]
+
+        kept = [0]
+        for ii in range(points - 2):
+            lo, hi = edges[ii], edges[ii + 1]
+            next_bucket = (range(edges[ii + 1], edges[ii + 2])
+                if ii + 2 < len(edges) else [count - 1])
+            avg_x = sum(x[jj] for jj in next_bucket) / float(len(next_bucket))
+            avg_y = sum(y[jj] for jj in next_bucket) / float(len(next_bucket))
+            ax, ay = x[kept[-1]], y[kept[-1]]
+            areas = [abs((ax - avg_x) * (y[jj] - ay) -
+                (ax - x[jj]) * (avg_y - ay)) for jj in range(lo, hi)]
+            kept.append(lo + areas.index(max(areas)))
+        return kept + [count - 1]
+
+    def test_downsample(self):
+        for points in [3, 4, 100, 1439]:
+            timestamps, values = series_util.lttb(self.timestamps,
+                self.values, points)
+
+            # Exactly points data points, including the first and last
+            self.assertEqual((len(timestamps), len(values)), (points, points))
+            self.assertEqual((timestamps[0], timestamps[-1]),
+                (self.timestamps[0], self.timestamps[-1]))
+
+            kept = self.expected(points)
+            self.assertEqual(timestamps.tolist(),
+                self.timestamps[kept].tolist())
+            self.assertEqual(values.tolist(), self.values[kept].tolist())
+
+    def test_spike_kept(self):
+        self.values[700] = 50.0
+        self.values[900] = -50.0
+        timestamps, values = series_util.lttb(self.timestamps, self.values,
+            20)
+        self.assertIn(self.timestamps[700], timestamps)
+        self.assertIn(self.timestamps[900], timestamps)
+        self.assertEqual((values.max(), values.min()), (50.0, -50.0))
+
+    def test_fewer_data_points(self):
+        # The data points are returned as they are
+        for points in [1440, 2000]:
+            timestamps, values = series_util.lttb(self.timestamps,
+                self.values, points)
+            self.assertEqual(timestamps.tolist(), self.timestamps.tolist())
+            self.assertEqual(values.tolist(), self.values.tolist())
+
+        timestamps, values = series_util.lttb([], [], 10)
+        self.assertEqual((len(timestamps), len(values)), (0, 0))
+
+    def test_too_few_points(self):
+        for points in [0, 1, 2]:
+            self.assertRaises(ValueError, series_util.lttb, self.timestamps,
+                self.values, points)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_storage
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Conformance suite for the storage backends (see db.storage).  The
+    same tests run against...
+
+      * the local backend, in a temporary directory
+      * the mongoDB backend, over the in-memory stand-in for mongoDB
+      * the mongoDB backend, over the mongoDB instance configured in
+        settings.cfg (skipped if it can't be reached).  Scratch
+        'conformance_' collections are used and dropped.
+
+    To run...
+
+        $ python -m test.test_storage -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime
+from datetime import timedelta
+
+import numpy
+import pymongo
+
+from db import memory
+from db import mongo
+from db.local_storage import LocalStorage
+from db.mongo_storage import MongoStorage
+from db.storage import StorageUnavailable
+from probe_sync import SensorReadings
+
+import date_util
+
+collection_names = ["probe_status", "sensor_data", "sensor_rollup_hourly",
+    "sensor_rollup_daily", "alerts", "alert_states", "clock_history"]
+
+# Two hours before midnight, so readings span two days
+base_time = datetime(2014, 5, 1, 22)
+base = date_util.get_timestamp(base_time)
+
+
+def readings(*data_points):
+    """ Returns SensorReadings of the given (sensor id, timestamp offset
+        from base, value) tuples
+
+    """
+    return SensorReadings.from_dicts([{"id" : sensor_id,
+        "timestamp" : base + offset, "value" : value}
+        for sensor_id, offset, value in data_points])
+
+
+class StorageConformance(object):
+    """ Tests that every storage backend must pass.  Subclasses create
+        the backend under test in create_storage().
+
+    """
+
+    def setUp(self):
+        self.storage = self.create_storage()
+
+    def walk(self, probe_id, start, end):
+        """ Returns the walked points of each sensor, concatenated, as
+            a dict of sensor id to (timestamps, values) lists
+
+        """
+        sensors = {}
+        for sensor_id, timestamps, values in self.storage.walk_points(
+                probe_id, start, end):
+            sensor = sensors.setdefault(sensor_id, ([], []))
+            sensor[0].extend(timestamps.tolist())
+            sensor[1].extend(values.tolist())
+        return sensors
+
+    def test_probe_status_upsert(self):
+        first = datetime(2014, 5, 1, 12, 0, 0)
+        second = first + timedelta(minutes=1)
+
+        self.storage.update_probe_status("probe_a", first, restart=True)
+        self.storage.update_probe_status("probe_a", second, sync_total=3,
+            clock={"offset" : 2.5, "rate" : 0.0001})
+        self.storage.update_probe_status("probe_b", second)
+
+        self.assertEqual(sorted(self.storage.get_probe_ids()),
+            ["probe_a", "probe_b"])
+
+        status = self.storage.get_probe_statuses(["probe_a"])
+        self.assertEqual(len(status), 1)
+        self.assertEqual(status[0]["_id"], "probe_a")
+        self.assertEqual(status[0]["first_contact"], first)
+        self.assertEqual(status[0]["last_contact"], second)
+        self.assertEqual(status[0]["last_restart"], first)
+        self.assertEqual(status[0]["sync_count"], 4)
+        self.assertEqual(status[0]["clock"], {"offset" : 2.5, "rate" : 0.0001})
+
+        status = self.storage.get_probe_statuses(["probe_b", "unknown"])
+        self.assertEqual([s["_id"] for s in status], ["probe_b"])
+        self.assertEqual(status[0]["last_restart"], None)
+        self.assertEqual(status[0]["clock"], None)
+        self.assertEqual(len(self.storage.get_probe_statuses()), 2)
+
+    def test_bootstrap_is_idempotent(self):
+        created = self.storage.bootstrap()
+        self.assertEqual(self.storage.bootstrap(), created)
+
+    def test_walk_points_sorted_by_time(self):
+        self.storage.append_points("probe_a", readings(
+            ("tmp0", 7200, 3.0), ("tmp0", 0, 1.0), ("pho0", 60, 10.0),
+            ("tmp0", 3600, 2.0), ("pho0", 7260, 20.0)))
+
+        sensors = self.walk("probe_a", base, base + 86400)
+        self.assertEqual(sensors["tmp0"],
+            ([base, base + 3600, base + 7200], [1.0, 2.0, 3.0]))
+        self.assertEqual(sensors["pho0"],
+            ([base + 60, base + 7260], [10.0, 20.0]))
+
+    def test_walk_points_chunks_in_day_order(self):
+        self.storage.append_points("probe_a", readings(
+            ("tmp0", 2 * 86400, 3.0), ("tmp0", 0, 1.0), ("tmp0", 7200, 2.0)))
+
+        chunks = list(self.storage.walk_points("probe_a", base,
+            base + 2 * 86400))
+        self.assertEqual(len(chunks), 3)
+        firsts = [timestamps[0] for sensor_id, timestamps, values in chunks]
+        self.assertEqual(firsts, sorted(firsts))
+        for sensor_id, timestamps, values in chunks:
+            self.assertEqual(timestamps.dtype, numpy.int64)
+            self.assertEqual(values.dtype, numpy.float64)
+
+    def test_walk_points_range_is_inclusive(self):
+        self.storage.append_points("probe_a", readings(
+            *[("tmp0", offset, float(offset)) for offset in
+                range(0, 3 * 3600, 900)]))
+
+        sensors = self.walk("probe_a", base + 900, base + 2700)
+        self.assertEqual(sensors["tmp0"][0],
+            [base + 900, base + 1800, base + 2700])
+
+        self.assertEqual(self.walk("probe_a", base + 901, base + 1799), {})
+        self.assertEqual(self.walk("probe_a", base - 86400, base - 1), {})
+        self.assertEqual(self.walk("unknown", base, base + 86400), {})
+
+    def test_appends_across_syncs(self):
+        self.storage.append_points("probe_a", readings(
+            ("tmp0", 60, 1.0), ("tmp0", 120, 2.0)))
+        self.storage.append_points("probe_a", readings(
+            ("tmp0", 180, 3.0), ("tmp0", 240, 4.0)))
+
+        # Late data, older than what's already stored
+        self.storage.append_points("probe_a", readings(("tmp0", 0, 0.0)))
+
+        sensors = self.walk("probe_a", base, base + 3600)
+        self.assertEqual(sensors["tmp0"],
+            ([base + offset for offset in range(0, 300, 60)],
+             [0.0, 1.0, 2.0, 3.0, 4.0]))
+
+    def test_same_timestamp_replaces(self):
+        self.storage.append_points("probe_a", readings(
+            ("tmp0", 0, 1.0), ("tmp0", 60, 2.0)))
+        self.storage.append_points("probe_a", readings(("tmp0", 0, 5.0)))
+
+        sensors = self.walk("probe_a", base, base + 3600)
+        self.assertEqual(sensors["tmp0"], ([base, base + 60], [5.0, 2.0]))
+
+    def test_walk_points_of_sensors(self):
+        self.storage.append_points("probe_a", readings(
+            ("tmp0", 0, 1.0), ("pho0", 0, 2.0), ("mos0", 0, 3.0)))
+
+        sensors = self.storage.walk_points("probe_a", base, base,
+            sensor_ids=["tmp0", "mos0"])
+        self.assertEqual(sorted(sensor_id for sensor_id, t, v in sensors),
+            ["mos0", "tmp0"])
+
+    def test_points_isolated_by_probe(self):
+        self.storage.append_points("probe_a", readings(("tmp0", 0, 1.0)))
+        self.storage.append_points("probe_b", readings(("tmp0", 0, 2.0)))
+
+        self.assertEqual(self.walk("probe_a", base, base)["tmp0"][1], [1.0])
+        self.assertEqual(self.walk("probe_b", base, base)["tmp0"][1], [2.0])
+
+    def test_hourly_rollups(self):
+        self.storage.append_points("probe_a", readings(
+            ("tmp0", 0, 4.0), ("tmp0", 1200, 2.0), ("tmp0", 2400, 6.0),
+            ("tmp0", 3600, 1.0), ("tmp0", 10800, 8.0), ("pho0", 60, 9.0)))
+        self.storage.append_points("probe_a", readings(("tmp0", 3660, 3.0)))
+
+        sensors = self.storage.get_hourly_rollups("probe_a",
+            base_time + timedelta(minutes=30), base_time + timedelta(hours=2))
+
+        self.assertEqual(sorted(sensors.keys()), ["pho0", "tmp0"])
+        rollups = sensors["tmp0"]
+        self.assertEqual([r["hour"] for r in rollups],
+            [base_time, base_time + timedelta(hours=1)])
+
+        self.assertEqual(rollups[0]["min_value"], 2.0)
+        self.assertEqual(rollups[0]["max_value"], 6.0)
+        self.assertEqual(rollups[0]["sum_values"], 12.0)
+        self.assertEqual(rollups[0]["count_values"], 3)
+        self.assertEqual(rollups[0]["last_timestamp"], base + 2400)
+        self.assertEqual(rollups[0]["last_value"], 6.0)
+
+        self.assertEqual(rollups[1]["min_value"], 1.0)
+        self.assertEqual(rollups[1]["max_value"], 3.0)
+        self.assertEqual(rollups[1]["sum_values"], 4.0)
+        self.assertEqual(rollups[1]["count_values"], 2)
+        self.assertEqual(rollups[1]["last_timestamp"], base + 3660)
+        self.assertEqual(rollups[1]["last_value"], 3.0)
+
+        self.assertEqual(self.storage.get_hourly_rollups("unknown",
+            base_time, base_time + timedelta(hours=2)), {})
+
+    def test_hourly_rollups_late_sync(self):
+        self.storage.append_points("probe_a", readings(("tmp0", 2400, 6.0)))
+        self.storage.append_points("probe_a", readings(("tmp0", 1200, 2.0)))
+
+        rollups = self.storage.get_hourly_rollups("probe_a", base_time,
+            base_time + timedelta(minutes=59))["tmp0"]
+        self.assertEqual(rollups[0]["count_values"], 2)
+        self.assertEqual(rollups[0]["last_timestamp"], base + 2400)
+        self.assertEqual(rollups[0]["last_value"], 6.0)
+
+    def get_rollup_stats(self, probe_id):
+        sensors = self.storage.get_hourly_rollups(probe_id, base_time,
+            base_time + timedelta(hours=3))
+        return dict((sensor_id, [(r["hour"], r["min_value"], r["max_value"],
+            round(r["sum_values"], 6), r["count_values"]) for r in rollups])
+            for sensor_id, rollups in sensors.items())
+
+    def test_compact_points_keeps_aggregates(self):
+        self.storage.append_points("probe_a", readings(
+            *[(sensor_id, offset, (offset % 1000) / 10.0)
+                for offset in range(0, 3 * 3600, 60)
+                for sensor_id in ["tmp0", "pho0"]]))
+        before = self.get_rollup_stats("probe_a")
+        next_day = base_time + timedelta(hours=2)
+
+        # Only the sensor-days before the next day are compacted
+        doc_count, reclaimed = self.storage.compact_points("probe_a",
+            next_day, 900)
+        self.assertEqual(doc_count, 2)
+        self.assertTrue(reclaimed > 0)
+        self.assertEqual(self.storage.compact_points("probe_a", next_day,
+            900), (0, 0))
+
+        sensors = self.walk("probe_a", base, base + 3 * 3600)
+        self.assertEqual(sensors["tmp0"][0][:8], range(base, base + 7200, 900))
+        self.assertAlmostEqual(sensors["tmp0"][1][0],
+            numpy.mean([(offset % 1000) / 10.0 for offset in range(0, 900, 60)]))
+        self.assertEqual(sensors["tmp0"][0][8:],
+            range(base + 7200, base + 3 * 3600, 60))
+
+        self.storage.backfill_rollups("probe_a")
+        self.assertEqual(self.get_rollup_stats("probe_a"), before)
+
+        # Compacting further, and appending to a compacted day
+        self.assertEqual(self.storage.compact_points("probe_a", next_day,
+            3600, limit=1)[0], 1)
+        self.assertEqual(self.storage.compact_points("probe_a", next_day,
+            3600)[0], 1)
+        self.storage.append_points("probe_a", readings(("tmp0", 30, 500.0)))
+        self.storage.backfill_rollups("probe_a")
+
+        after = self.get_rollup_stats("probe_a")
+        self.assertEqual(after["pho0"], before["pho0"])
+        hour, min_value, max_value, sum_values, count_values = \
+            before["tmp0"][0]
+        self.assertEqual(after["tmp0"][0], (hour, min_value, 500.0,
+            sum_values + 500.0, count_values + 1))
+        self.assertEqual(after["tmp0"][1:], before["tmp0"][1:])
+
+    def test_drop_points(self):
+        self.storage.append_points("probe_a", readings(
+            ("tmp0", 0, 1.0), ("pho0", 60, 2.0), ("tmp0", 7200, 3.0)))
+        self.storage.append_points("probe_b", readings(("tmp0", 0, 4.0)))
+
+        doc_count, reclaimed = self.storage.drop_points("probe_a",
+            base_time + timedelta(hours=2))
+        self.assertEqual(doc_count, 2)
+        self.assertTrue(reclaimed > 0)
+
+        self.assertEqual(self.walk("probe_a", base, base + 86400),
+            {"tmp0" : ([base + 7200], [3.0])})
+        self.assertEqual(self.walk("probe_b", base, base)["tmp0"],
+            ([base], [4.0]))
+
+    def test_alerts(self):
+        def alert(probe_id, offset, state):
+            return {"_id" : "%s/tmp0/stuck/%d/%s" % (probe_id, offset, state),
+                "probe_id" : probe_id, "sensor_id" : "tmp0", "kind" : "stuck",
+                "state" : state, "timestamp" : base + offset, "value" : 1.0,
+                "message" : ""}
+
+        self.storage.append_alerts([alert("probe_a", 0, "raised"),
+            alert("probe_b", 60, "raised")])
+        self.storage.append_alerts([alert("probe_a", 0, "raised"),
+            alert("probe_a", 120, "cleared")])
+
+        self.assertEqual([(a["probe_id"], a["state"], a["timestamp"])
+            for a in self.storage.get_alerts()], [
+                ("probe_a", "cleared", base + 120),
+                ("probe_b", "raised", base + 60),
+                ("probe_a", "raised", base)])
+        self.assertEqual([a["_id"] for a in
+            self.storage.get_alerts("probe_a", limit=1)],
+            ["probe_a/tmp0/stuck/120/cleared"])
+
+    def test_alert_states(self):
+        def alert(probe_id, kind, offset, state):
+            return {"_id" : "%s/tmp0/%s/%d/%s" % (probe_id, kind, offset,
+                state), "probe_id" : probe_id, "sensor_id" : "tmp0",
+                "kind" : kind, "state" : state, "timestamp" : base + offset,
+                "value" : 1.0, "message" : ""}
+
+        self.assertEqual(self.storage.get_alert_states(), [])
+
+        # The newest alert of each kind, even if written out of order
+        self.storage.append_alerts([alert("probe_a", "stuck", 0, "raised"),
+            alert("probe_a", "stuck", 120, "cleared"),
+            alert("probe_a", "drift", 60, "raised")])
+        self.storage.append_alerts([alert("probe_a", "stuck", 60, "raised"),
+            alert("probe_b", "stuck", 0, "raised")])
+
+        self.assertEqual(sorted((s["probe_id"], s["sensor_id"], s["kind"],
+            s["state"], s["timestamp"]) for s in
+            self.storage.get_alert_states()), [
+                ("probe_a", "tmp0", "drift", "raised", base + 60),
+                ("probe_a", "tmp0", "stuck", "cleared", base + 120),
+                ("probe_b", "tmp0", "stuck", "raised", base)])
+
+    def test_clock_history(self):
+        def sample(probe_id, offset, value):
+            return {"_id" : "%s/%d" % (probe_id, base + offset),
+                "probe_id" : probe_id, "timestamp" : base + offset,
+                "observed" : value, "offset" : value, "rate" : 0.0}
+
+        self.storage.append_clock_history([sample("probe_a", 60, 1.0),
+            sample("probe_b", 0, 2.0), sample("probe_a", 0, 3.0)])
+        self.storage.append_clock_history([sample("probe_a", 60, 4.0),
+            sample("probe_a", 120, 5.0)])
+
+        self.assertEqual([(s["timestamp"], s["offset"]) for s in
+            self.storage.get_clock_history("probe_a", base, base + 120)],
+            [(base, 3.0), (base + 60, 1.0), (base + 120, 5.0)])
+        self.assertEqual([s["timestamp"] for s in
+            self.storage.get_clock_history("probe_a", base + 1, base + 60)],
+            [base + 60])
+        self.assertEqual(self.storage.get_clock_history("probe_c", base,
+            base + 120), [])
+
+
+class LocalStorageTest(StorageConformance, unittest.TestCase):
+
+    def create_storage(self):
+        self.data_dir = tempfile.mkdtemp(prefix="autogarten_test_")
+        return LocalStorage(self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_reopen(self):
+        contact_time = datetime(2014, 5, 1, 12, 0, 0, 500000)
+        self.storage.update_probe_status("probe_a", contact_time,
+            clock={"offset" : 1.5})
+        self.storage.append_points("probe_a", readings(("tmp0", 0, 1.0)))
+        self.storage.append_clock_history([{"_id" : "probe_a/0",
+            "probe_id" : "probe_a", "timestamp" : base}])
+
+        storage = LocalStorage(self.data_dir)
+        self.assertEqual(storage.get_probe_statuses()[0]["last_contact"],
+            contact_time)
+        self.assertEqual(storage.get_probe_statuses()[0]["clock"],
+            {"offset" : 1.5})
+        self.assertEqual(len(storage.get_clock_history("probe_a", base,
+            base)), 1)
+        self.assertEqual(list(storage.walk_points("probe_a", base, base))[0][2],
+            [1.0])
+
+    def test_reopen_alerts(self):
+        alert = {"_id" : "a", "probe_id" : "probe_a", "timestamp" : base}
+        self.storage.append_alerts([alert])
+
+        # Including after a crash cut an append short
+        with open(self.data_dir + "/alerts.ndjson", "a") as alerts_file:
+            alerts_file.write('{"_id" : "b", "pro')
+
+        storage = LocalStorage(self.data_dir)
+        self.assertEqual(storage.get_alerts(), [alert])
+
+        storage.append_alerts([dict(alert, _id="c", timestamp=base + 60)])
+        self.assertEqual([a["_id"] for a in
+            LocalStorage(self.data_dir).get_alerts()], ["c", "a"])
+
+    def test_interrupted_append_ignored(self):
+        self.storage.append_points("probe_a", readings(("tmp0", 0, 1.0)))
+
+        # Bytes of an append that wasn't recorded in the index
+        sensor_dir = self.storage._get_sensor_dir("probe_a", "tmp0")
+        with open(sensor_dir + "/" + base_time.strftime("%Y%m%d.ts"),
+                "ab") as column_file:
+            column_file.write("\xff" * 12)
+
+        self.assertEqual(self.walk("probe_a", base, base + 3600)["tmp0"],
+            ([base], [1.0]))
+
+        self.storage.append_points("probe_a", readings(("tmp0", 60, 2.0)))
+        self.assertEqual(self.walk("probe_a", base, base + 3600)["tmp0"],
+            ([base, base + 60], [1.0, 2.0]))
+
+    def test_invalid_id(self):
+        self.assertRaises(ValueError, self.storage.append_points, "..",
+            readings(("tmp0", 0, 1.0)))
+
+
+class MongoStorageChecks(object):
+    """ Tests of the mongoDB backend beyond the conformance suite
+
+    """
+
+    def test_backfill_after_repeated_write(self):
+        data = readings(("tmp0", 0, 4.0), ("tmp0", 1200, 2.0))
+        self.storage.append_points("probe_a", data)
+        self.storage.append_points("probe_a", data)
+
+        self.storage.backfill_rollups("probe_a")
+        rollup = self.storage.get_hourly_rollups("probe_a", base_time,
+            base_time)["tmp0"][0]
+        self.assertEqual((rollup["sum_values"], rollup["count_values"]),
+            (6.0, 2))
+
+        daily = list(self.storage.get_collection("sensor_rollup_daily").find(
+            {"probe_id" : "probe_a"}))
+        self.assertEqual([(r["sum_values"], r["count_values"]) for r in daily],
+            [(6.0, 2)])
+
+    def test_increments_not_retried(self):
+        class Disconnected(object):
+            calls = 0
+            def __getattr__(self, name):
+                Disconnected.calls += 1
+                raise pymongo.errors.AutoReconnect("disconnected")
+
+        for name in collection_names:
+            self.storage.collections[name] = Disconnected()
+
+        self.assertRaises(StorageUnavailable, self.storage.update_probe_status,
+            "probe_a", base_time)
+        self.assertRaises(StorageUnavailable, self.storage.append_points,
+            "probe_a", readings(("tmp0", 0, 4.0)))
+        self.assertEqual(Disconnected.calls, 2)
+
+
+class MemoryMongoStorageTest(MongoStorageChecks, StorageConformance,
+        unittest.TestCase):
+
+    def create_storage(self):
+        storage = MongoStorage()
+        for name in collection_names:
+            storage.collections[name] = memory.MemoryCollection(name)
+        return storage
+
+
+class MongoStorageTest(MongoStorageChecks, StorageConformance,
+        unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            pymongo.MongoClient(mongo.db_host, mongo.db_port,
+                connectTimeoutMS=1000).close()
+        except pymongo.errors.ConnectionFailure:
+            raise unittest.SkipTest("mongoDB isn't available @ %s:%d" %
+                (mongo.db_host, mongo.db_port))
+
+    def create_storage(self):
+        storage = MongoStorage()
+        for name in collection_names:
+            storage.collections[name] = \
+                mongo.get_mongodb_connection("conformance_" + name)
+            storage.collections[name].drop()
+        return storage
+
+    def tearDown(self):
+        for collection in self.storage.collections.values():
+            collection.drop()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_sync_dedup
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the deduplication of retried probe syncs (see
+    service.sync_dedup), and of the shared state it's kept in.  The
+    same shared state tests run against...
+
+      * the memory backend
+      * the sqlite backend, in a temporary directory
+
+    To run...
+
+        $ python -m test.test_sync_dedup -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import Queue
+
+from db import shared_state
+from db import storage
+from db.local_storage import LocalStorage
+from service import ingest_queue
+from service import sync_dedup
+from test import StorageTestCase
+from test import new_probe_sync
+
+import date_util
+
+
+class SharedStateConformance(object):
+    """ Tests that every shared state backend must pass.  Subclasses
+        create the backend under test in create_shared_state().
+
+    """
+
+    def setUp(self):
+        self.state = self.create_shared_state()
+
+    def tearDown(self):
+        self.state.close()
+
+    def test_begin_end_sync(self):
+        self.assertEqual(self.state.begin_sync("probe_a", 1),
+            shared_state.NEW)
+        self.assertEqual(self.state.begin_sync("probe_a", 1),
+            shared_state.IN_FLIGHT)
+        self.assertEqual(self.state.begin_sync("probe_b", 1),
+            shared_state.NEW)
+
+        self.state.end_sync("probe_a", 1, True, 32)
+        self.assertEqual(self.state.begin_sync("probe_a", 1),
+            shared_state.DUPLICATE)
+        self.assertEqual(self.state.begin_sync("probe_a", 2),
+            shared_state.NEW)
+        self.assertEqual(self.state.get_stats(), {"dedup_probes" : 1})
+
+    def test_failed_sync(self):
+        self.state.begin_sync("probe_a", "boot-1")
+        self.state.end_sync("probe_a", "boot-1", False, 32)
+        self.assertEqual(self.state.begin_sync("probe_a", "boot-1"),
+            shared_state.NEW)
+
+    def test_window(self):
+        for sync_id in range(4):
+            self.state.begin_sync("probe_a", sync_id)
+            self.state.end_sync("probe_a", sync_id, True, 2)
+
+        self.assertEqual([self.state.begin_sync("probe_a", sync_id)
+            for sync_id in [3, 2, 1]], [shared_state.DUPLICATE,
+                shared_state.DUPLICATE, shared_state.NEW])
+
+    def test_versions(self):
+        self.assertEqual(self.state.get_version("probe_a"), 0)
+        self.state.bump_versions(["probe_a", "probe_b"])
+        self.state.bump_versions(["probe_a"])
+        self.assertEqual(self.state.get_version("probe_a"), 2)
+        self.assertEqual(self.state.get_version("probe_b"), 1)
+
+    def test_metrics(self):
+        self.state.put_metrics("worker_a", {"syncs_total" : 1})
+        self.state.put_metrics("worker_b", {"syncs_total" : 2})
+        self.state.put_metrics("worker_a", {"syncs_total" : 3})
+        self.assertEqual(sorted(snapshot["syncs_total"] for snapshot in
+            self.state.get_metrics()), [2, 3])
+
+    def test_leases(self):
+        self.assertTrue(self.state.acquire_lease("retention", "worker_a", 60))
+        self.assertTrue(self.state.acquire_lease("retention", "worker_a", 60))
+        self.assertFalse(self.state.acquire_lease("retention", "worker_b", 60))
+        self.assertTrue(self.state.acquire_lease("other", "worker_b", 60))
+
+        # An expired lease can be taken over
+        self.state.acquire_lease("retention", "worker_a", -1)
+        self.assertTrue(self.state.acquire_lease("retention", "worker_b", 60))
+
+
+class MemorySharedStateTest(SharedStateConformance, unittest.TestCase):
+
+    def create_shared_state(self):
+        return shared_state.create_shared_state("memory")
+
+
+class SqliteSharedStateTest(SharedStateConformance, unittest.TestCase):
+
+    def create_shared_state(self):
+        self.data_dir = tempfile.mkdtemp(prefix="autogarten_test_")
+        self.path = os.path.join(self.data_dir, "shared_state.db")
+        return shared_state.create_shared_state("sqlite", path=self.path)
+
+    def tearDown(self):
+        SharedStateConformance.tearDown(self)
+        shutil.rmtree(self.data_dir)
+
+    def test_shared_by_workers(self):
+        other = shared_state.create_shared_state("sqlite", path=self.path)
+        try:
+            self.state.begin_sync("probe_a", 1)
+            self.assertEqual(other.begin_sync("probe_a", 1),
+                shared_state.IN_FLIGHT)
+            self.state.end_sync("probe_a", 1, True, 32)
+            self.assertEqual(other.begin_sync("probe_a", 1),
+                shared_state.DUPLICATE)
+
+            other.bump_versions(["probe_a"])
+            self.assertEqual(self.state.get_version("probe_a"), 1)
+        finally:
+            other.close()
+
+    def test_abandoned_sync(self):
+        timeout = shared_state.in_flight_timeout
+        shared_state.in_flight_timeout = -1
+        try:
+            self.state.begin_sync("probe_a", 1)
+            self.assertEqual(self.state.begin_sync("probe_a", 1),
+                shared_state.NEW)
+        finally:
+            shared_state.in_flight_timeout = timeout
+
+
+class SyncDedupTest(StorageTestCase):
+    """ Tests of sync_dedup, and of syncs being ended once they're
+        written in async ingest mode
+
+    """
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        sync_dedup._stats.update(checked=0, duplicates=0, in_flight=0)
+
+    def test_begin_end(self):
+        self.assertEqual(sync_dedup.begin("probe_a", 7), sync_dedup.NEW)
+        self.assertEqual(sync_dedup.begin("probe_a", 7), sync_dedup.IN_FLIGHT)
+        sync_dedup.end("probe_a", 7, True)
+        self.assertEqual(sync_dedup.begin("probe_a", 7), sync_dedup.DUPLICATE)
+
+        stats = sync_dedup.get_stats()
+        self.assertEqual((stats["checked"], stats["duplicates"],
+            stats["in_flight"], stats["probes"]), (3, 1, 1, 1))
+        self.assertAlmostEqual(stats["dedup_rate"], 1 / 3.0)
+
+    def test_queued_sync_applied_once_written(self):
+        probe_sync = new_probe_sync("probe_a", [("tmp0",
+            date_util.get_current_timestamp(), 70.0)], sync_id=7)
+        sync_dedup.begin("probe_a", 7)
+
+        ingest_queue._write_batch([probe_sync])
+        self.assertEqual(sync_dedup.begin("probe_a", 7), sync_dedup.DUPLICATE)
+        self.assertEqual(self.storage.get_probe_statuses(
+            ["probe_a"])[0]["sync_count"], 1)
+
+    def test_dropped_sync_retried(self):
+        class UnavailableStorage(LocalStorage):
+            def update_probe_status(self, *args, **kwargs):
+                raise storage.StorageUnavailable("down")
+
+        storage.set_storage(UnavailableStorage(self.data_dir))
+        sync_dedup.begin("probe_a", 7)
+
+        # A batch that can't be written while shutting down is dropped
+        ingest_queue._stopping.set()
+        try:
+            ingest_queue._write_batch([new_probe_sync("probe_a",
+                sync_id=7)])
+        finally:
+            ingest_queue._stopping.clear()
+        self.assertEqual(sync_dedup.begin("probe_a", 7), sync_dedup.NEW)
+
+    def test_queued_sync_in_flight(self):
+        import control_server
+
+        async_mode = ingest_queue.async_mode
+        ingest_queue.async_mode = True
+        ingest_queue._queue = Queue.Queue(10)
+        try:
+            app = control_server.app.test_client()
+            body = json.dumps({"probe_id" : "probe_a",
+                "token" : control_server.token, "connection_attempts" : 1,
+                "sync_count" : 2, "sync_id" : 7, "curr_time" : 0,
+                "sensor_data" : []})
+            def post():
+                return app.post("/probe_sync", data=body,
+                    content_type="application/json")
+
+            # Until the queued sync is written, a retry is in flight
+            self.assertEqual(post().status_code, 200)
+            self.assertEqual(post().status_code, 503)
+
+            ingest_queue._write_batch([ingest_queue._queue.get_nowait()])
+            response = post()
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(json.loads(response.data)["duplicate"])
+            self.assertTrue(ingest_queue._queue.empty())
+
+        finally:
+            ingest_queue.async_mode = async_mode
+            ingest_queue._queue = None
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+    autogarten.test.test_sync_spool
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the write-ahead spool of probe syncs (see
+    service.sync_spool): replaying spooled syncs while the DB is down
+    and across restarts, without repeating their writes, and recovering
+    from a torn record.  Syncs are written to the local storage backend,
+    in a temporary directory.
+
+    To run...
+
+        $ python -m test.test_sync_spool -v
+
+    :license: MIT, see LICENSE for more details.
+"""
+
+import os
+import time
+import unittest
+
+from db import storage
+from db.local_storage import LocalStorage
+from service import sync_spool
+from test import FlakyStorage
+from test import StorageTestCase
+from test import new_probe_sync
+
+base = 1398981600
+
+
+def readings_at(offset):
+    """ Returns a reading of tmp0 and of pho0 at the given offset from
+        base
+
+    """
+    return [("tmp0", base + offset, 70.0), ("pho0", base + offset, 12.5)]
+
+
+class PartlyDownStorage(LocalStorage):
+    """ Local storage that's unavailable for the probes in down, and
+        whose appends of points also fail for those in points_down
+
+    """
+
+    def __init__(self, data_dir):
+        LocalStorage.__init__(self, data_dir)
+        self.down = set()
+        self.points_down = set()
+
+    def update_probe_status(self, probe_id, *args, **kwargs):
+        if probe_id in self.down:
+            raise storage.StorageUnavailable("down")
+        LocalStorage.update_probe_status(self, probe_id, *args, **kwargs)
+
+    def append_points(self, probe_id, readings):
+        if probe_id in self.down | self.points_down:
+            raise storage.StorageUnavailable("down")
+        LocalStorage.append_points(self, probe_id, readings)
+
+
+class SyncSpoolTest(StorageTestCase):
+
+    def create_storage(self, data_dir):
+        return FlakyStorage(os.path.join(data_dir, "db"))
+
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.spool_dir = sync_spool.spool_dir
+        self.retry_backoff = sync_spool.retry_backoff
+        sync_spool.spool_dir = os.path.join(self.data_dir, "spool")
+        sync_spool.retry_backoff = 0.01
+
+    def tearDown(self):
+        sync_spool.stop()
+        sync_spool.spool_dir = self.spool_dir
+        sync_spool.retry_backoff = self.retry_backoff
+        StorageTestCase.tearDown(self)
+
+    def get_count_values(self, probe_id):
+        return StorageTestCase.get_count_values(self, probe_id, base - 3600,
+            base + 3600)
+
+    def wait_until(self, condition, message):
+        deadline = time.time() + 10
+        while not condition():
+            self.assertTrue(time.time() < deadline, message)
+            time.sleep(0.01)
+
+    def wait_for_replay(self, count):
+        """ Waits for count syncs to be replayed since the spool was
+            last started
+
+        """
+        replayed = self.replayed + count
+        self.wait_until(lambda: sync_spool.get_stats()["replayed"] >=
+            replayed, "Spool not replayed")
+
+    def start(self):
+        self.replayed = sync_spool.get_stats()["replayed"]
+        sync_spool.start()
+
+    def append(self, probe_id, offset):
+        return sync_spool.append(new_probe_sync(probe_id, readings_at(offset)))
+
+    def test_replay(self):
+        self.start()
+        for ii in range(5):
+            self.assertTrue(self.append("probe_a", ii * 60))
+        self.wait_for_replay(5)
+
+        self.assertEqual(self.get_sync_count("probe_a"), 5)
+        self.assertEqual(self.get_count_values("probe_a"),
+            {"tmp0" : 5, "pho0" : 5})
+
+    def test_replay_retried(self):
+        self.storage.failures = 3
+        self.start()
+        self.append("probe_a", 0)
+        self.wait_for_replay(1)
+
+        self.assertEqual(self.get_sync_count("probe_a"), 1)
+        self.assertEqual(self.get_count_values("probe_a"),
+            {"tmp0" : 1, "pho0" : 1})
+
+    def test_replay_resumes_after_restart(self):
+        # Syncs spooled while the DB is down are replayed after a restart
+        self.storage.failures = 1000
+        self.start()
+        self.append("probe_a", 0)
+        self.append("probe_a", 60)
+        sync_spool.stop()
+        self.assertFalse(self.append("probe_a", 120))
+
+        self.storage.failures = 0
+        self.start()
+        self.wait_for_replay(2)
+        self.assertEqual(self.get_count_values("probe_a"),
+            {"tmp0" : 2, "pho0" : 2})
+
+        # The segment from before the restart is removed once replayed
+        self.wait_until(lambda: sync_spool.get_stats()["segments"] <= 1,
+            "Segment not removed")
+        self.assertEqual(sync_spool.get_stats()["pending_bytes"], 0)
+
+    def test_partly_applied_batch_not_repeated(self):
+        self.storage = PartlyDownStorage(os.path.join(self.data_dir, "db"))
+        storage.set_storage(self.storage)
+
+        # Syncs spooled while the DB is down are replayed together after
+        # a restart
+        self.storage.down = set(["probe_a", "probe_b"])
+        self.start()
+        self.append("probe_a", 0)
+        self.append("probe_b", 0)
+        sync_spool.stop()
+
+        # A batch of which probe_a's writes and probe_b's status were
+        # made before another restart
+        self.storage.down = set()
+        self.storage.points_down = set(["probe_b"])
+        self.start()
+        self.wait_until(lambda: (sync_spool._read_cursor()[2] or {}).get(
+            "written") == {"probe_a" : "sensor_data", "probe_b" : "status"},
+            "Batch not partly applied")
+        sync_spool.stop()
+
+        # Appended after the restart, but not part of that batch
+        self.storage.points_down = set()
+        self.start()
+        self.append("probe_a", 60)
+        self.wait_for_replay(3)
+
+        self.assertEqual(self.get_sync_count("probe_a"), 2)
+        self.assertEqual(self.get_sync_count("probe_b"), 1)
+        self.assertEqual(self.get_count_values("probe_a"),
+            {"tmp0" : 2, "pho0" : 2})
+        self.assertEqual(self.get_count_values("probe_b"),
+            {"tmp0" : 1, "pho0" : 1})
+        self.assertIsNone(sync_spool._read_cursor()[2])
+
+    def test_torn_record_truncated(self):
+        self.storage.failures = 1000
+        self.start()
+        self.append("probe_a", 0)
+        sync_spool.stop()
+
+        # A crash part way through appending a record
+        segment = sync_spool._get_segment_path(sync_spool._list_segments()[-1])
+        size = os.path.getsize(segment)
+        with open(segment, "ab") as segment_file:
+            segment_file.write(sync_spool._encode_record(
+                new_probe_sync("probe_a", readings_at(60)))[:20])
+
+        # Still down, so the segment isn't replayed and removed meanwhile
+        self.start()
+        self.assertEqual(os.path.getsize(segment), size)
+        self.storage.failures = 0
+        self.wait_for_replay(1)
+        self.assertEqual(self.get_count_values("probe_a"),
+            {"tmp0" : 1, "pho0" : 1})
+
+    def test_record_round_trip(self):
+        sync = new_probe_sync("probe_a", readings_at(0), sync_id=7)
+        sync.clock = {"offset" : 1.5}
+        record = sync_spool._encode_record(sync)
+        decoded = sync_spool._decode_record(record[8:])
+
+        self.assertEqual((decoded.probe_id, decoded.sync_count,
+            decoded.sync_id, decoded.clock), ("probe_a", 2, 7,
+            {"offset" : 1.5}))
+        self.assertEqual(list(decoded.readings), list(sync.readings))
+
+
+if __name__ == "__main__":
+    unittest.main()